@@ -2,8 +2,18 @@ import re
 import os
 import json, csv
 import random
+import queue
 import argparse
+import threading
 import traceback
+import socket
+import sqlite3
+import time
+import math
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import torch
 import numpy as np
@@ -57,7 +67,32 @@ def parse_args():
 
     parser.add_argument("--static_tree", action="store_true", help="Use static tree based drafting")
     parser.add_argument("--eagle_version", type=int, default=1, help="EAGLE version")
-    parser.add_argument("--cfg_mode", type=str, default="sequential", help="CFG mode")
+    parser.add_argument("--cfg_mode", type=str, default="sequential", choices=["sequential", "parallel", "ragged"],
+                        help="CFG mode")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="Number of prompts decoded together with continuous batching (requires --cfg_mode parallel)")
+    parser.add_argument("--prefix_cache_mb", type=int, default=0,
+                        help="Memory budget in MiB of the prompt prefix cache of the EAGLE model of Lumina-mGPT "
+                             "(requires --cfg_mode sequential or ragged); 0 disables it")
+    parser.add_argument("--save_workers", type=int, default=1,
+                        help="Number of threads decoding and saving the images while the next ones are generated; "
+                             "0 saves them synchronously")
+    parser.add_argument("--save_queue_size", type=int, default=8,
+                        help="Maximum number of generated images waiting to be saved before the generation blocks")
+    parser.add_argument("--shard_db", type=str, default=None,
+                        help="SQLite work queue shared by the workers of a run (e.g., one per GPU); the workers claim "
+                             "chunks of prompts from it, skip the existing images and resume interrupted runs; the "
+                             "workers must load the same prompts (use --set_seed when --num_images samples them)")
+    parser.add_argument("--shard_chunk_size", type=int, default=16, help="Number of prompts per claimed chunk")
+    parser.add_argument("--shard_lease", type=float, default=1800.0,
+                        help="Seconds after which a chunk claimed by another worker that did not complete it is "
+                             "claimed again")
+    parser.add_argument("--worker_id", type=str, default=None,
+                        help="Name of the worker in the work queue; default is the host and the visible devices, so "
+                             "that a restarted worker resumes its own chunks")
+    parser.add_argument("--metrics_file", type=str, default="metrics.jsonl",
+                        help="JSONL file in the output directory that a record of metrics is appended to for every "
+                             "saved image; an empty string disables it")
 
     # Experimental arguments
     parser.add_argument("--tree_choices", type=str, help="Tree choice for LANTERN",
@@ -109,6 +144,8 @@ def load_model(args):
                 cfg_mode=args.cfg_mode,
                 eagle_version=args.eagle_version,
             )
+            if args.prefix_cache_mb > 0:
+                model.model.init_prompt_prefix_cache(args.prefix_cache_mb * 2 ** 20)
         else:
             raise ValueError(f"Model type {args.model_type} is not supported for model {args.model}")
     elif args.model == "anole":
@@ -200,7 +237,7 @@ def load_prompts(args):
     
     return prompts
 
-def generate_and_save_image(model, model_name, prompt, img_save_path, **kwargs):
+def generate_image(model, model_name, prompt, **kwargs):
     # print(f"Generating image for prompt: {prompt}")
     if model_name == "lumina_mgpt":
         generate_params = {
@@ -237,31 +274,292 @@ def generate_and_save_image(model, model_name, prompt, img_save_path, **kwargs):
         generate_params["tree_choices"] = kwargs["tree_choices"]
         generate_params["drafter_top_k"] = kwargs["drafter_top_k"]
 
-    generated_tokens, step_compression, latency = model.generate(**generate_params)
+    return model.generate(**generate_params)
+
+def decode_and_save_image(model, model_name, generated_tokens, img_save_path):
     _, generated_image = model.decode_ids(generated_tokens)
 
+    # the image is written under a temporary name so that an interrupted run never leaves a truncated one behind
+    tmp_path = f"{img_save_path}.{os.getpid()}.tmp"
     if model_name in ["lumina_mgpt", "anole"]:
-        generated_image[0].save(img_save_path, "png")
+        generated_image[0].save(tmp_path, "png")
     elif "llamagen" in model_name:
-        save_image(generated_image, img_save_path, normalize=True, value_range=(-1, 1))
-
-    return step_compression, latency
-
-def run_generate_image(args):
-    assert args.model_type != "vllm", "VLLM model is not supported for single image generation"
-
-    if args.set_seed:
-        set_seed(args.random_seed)
-    
-    model = load_model(args)
-    prompts = load_prompts(args)
-    if not os.path.exists(args.output_dir):
-        os.makedirs(args.output_dir)
-
-    global_statistics = {}  
-    for idx, prompt in tqdm(enumerate(prompts), total=len(prompts)):
-        if idx < args.start_idx or idx >= args.end_idx:
-            continue
+        save_image(generated_image, tmp_path, normalize=True, value_range=(-1, 1), format="png")
+    os.replace(tmp_path, img_save_path)
+
+def make_metrics_record(idx, prompt, generated_tokens, step_compression, latency, generation_stats=None):
+    # generation_stats: the prefill time and the number of decoding steps reported by the generator, if any
+    generation_stats = generation_stats or {}
+    num_tokens = generated_tokens.shape[-1] if torch.is_tensor(generated_tokens) else len(generated_tokens)
+    decode_steps = generation_stats.get("decode_steps")
+    if decode_steps is None and math.isfinite(step_compression) and step_compression > 0:
+        # the generators without statistics commit `step_compression` tokens per step on average
+        decode_steps = round(num_tokens / step_compression)
+    return {
+        "prompt_idx": idx,
+        "prompt": prompt,
+        "num_tokens": num_tokens,
+        "decode_steps": decode_steps,
+        # NaN (e.g., the mean of no accept lengths) is not valid JSON
+        "step_compression": step_compression if math.isfinite(step_compression) else None,
+        "latency": latency,
+        "prefill_time": generation_stats.get("prefill_time"),
+        "tokens_per_second": num_tokens / latency if latency > 0 else None,
+    }
+
+class RollingSummary:
+    """
+    Aggregates of the metrics records, updated incrementally: the means of `keys` over all images and the throughput
+    over the last `window` images. The missing (None) values of a key are left out of its mean.
+    """
+
+    def __init__(self, keys, window=32):
+        self.keys = keys
+        self.count = 0
+        self.counts = dict.fromkeys(keys, 0)
+        self.means = dict.fromkeys(keys, 0.0)
+        self.times = collections.deque(maxlen=window)
+
+    def update(self, record):
+        self.count += 1
+        for key in self.keys:
+            if record.get(key) is None:
+                continue
+            self.counts[key] += 1
+            self.means[key] += (record[key] - self.means[key]) / self.counts[key]
+        self.times.append(record["time"])
+
+    def summary(self):
+        summary = {"num_images": self.count}
+        summary.update({f"mean_{key}": value for key, value in self.means.items() if self.counts[key] > 0})
+        if len(self.times) > 1 and self.times[-1] > self.times[0]:
+            summary["images_per_second"] = (len(self.times) - 1) / (self.times[-1] - self.times[0])
+        return summary
+
+class MetricsLog:
+    """
+    An append-only JSONL stream of the metrics of every saved image. Every record is flushed, so that a killed run
+    keeps its measurements and a running one can be followed (e.g., with `tail -f`); the workers of a sharded run
+    append to the same file, one line per write.
+    """
+
+    def __init__(self, path=None):
+        self.file = open(path, "a") if path else None
+        self.lock = threading.Lock()
+        self.rolling_summary = RollingSummary(
+            ["step_compression", "latency", "prefill_time", "tokens_per_second", "decode_time"]
+        )
+
+    def write(self, record):
+        record = {**record, "time": time.time()}
+        with self.lock:
+            if self.file is not None:
+                self.file.write(json.dumps(record) + "\n")
+                self.file.flush()
+            self.rolling_summary.update(record)
+
+    def summary(self):
+        with self.lock:
+            return self.rolling_summary.summary()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+class ImageWriter:
+    """
+    Decode the generated tokens and save the images on a pool of threads, so that the VQ decoding and the PNG
+    encoding of an image overlap with the generation of the next ones.
+
+    At most `max_pending` images are waiting or being saved; `submit` blocks the generation once they are all taken.
+    The saved images are retired in submission order by `drain`, which re-raises the error of a failed one. The
+    metrics record of an image, if any, is completed with its decoding time and logged once it is saved.
+    """
+
+    def __init__(self, model, model_name, num_workers=1, max_pending=8, metrics_log=None):
+        self.model = model
+        self.model_name = model_name
+        self.metrics_log = metrics_log
+        self.executor = ThreadPoolExecutor(max_workers=num_workers) if num_workers > 0 else None
+        self.slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self.pending = collections.deque()
+
+    def submit(self, generated_tokens, img_save_path, record=None):
+        if self.executor is None:
+            self.save(generated_tokens, img_save_path, record)
+            return
+
+        self.slots.acquire()
+        future = self.executor.submit(self.save, generated_tokens, img_save_path, record)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.pending.append(future)
+        self.drain(block=False)
+
+    def save(self, generated_tokens, img_save_path, record=None):
+        start = time.time()
+        # the grad mode is local to the thread
+        with torch.no_grad():
+            decode_and_save_image(self.model, self.model_name, generated_tokens, img_save_path)
+
+        if record is not None and self.metrics_log is not None:
+            self.metrics_log.write({**record, "decode_time": time.time() - start})
+
+    def drain(self, block=True):
+        while self.pending and (block or self.pending[0].done()):
+            self.pending.popleft().result()
+
+    def close(self):
+        try:
+            self.drain()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+
+
+class PromptShardQueue:
+    """
+    A work queue of prompt chunks in a SQLite database shared by the workers of a run.
+
+    Every worker claims the next chunk once it is done with the previous one, so that all workers stay busy until the
+    last prompt regardless of how long the prompts take. A chunk claimed by a worker that stopped before completing it
+    is resumed by the same worker when it restarts, or taken over by another one once its lease has expired.
+    """
+
+    def __init__(self, path, start_idx, end_idx, chunk_size=16, lease=1800.0):
+        self.lease = lease
+        self.connection = sqlite3.connect(path, timeout=600.0, isolation_level=None)
+        with self.transaction():
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, start_idx INTEGER, end_idx INTEGER, "
+                "status TEXT, worker TEXT, claimed_at REAL)"
+            )
+            bounds = self.connection.execute("SELECT MIN(start_idx), MAX(end_idx) FROM chunks").fetchone()
+            if bounds[0] is None:
+                self.connection.executemany(
+                    "INSERT INTO chunks (start_idx, end_idx, status) VALUES (?, ?, 'pending')",
+                    [(start, min(start + chunk_size, end_idx)) for start in range(start_idx, end_idx, chunk_size)],
+                )
+            else:
+                assert tuple(bounds) == (start_idx, end_idx), \
+                    f"The work queue covers the prompts {bounds[0]}-{bounds[1]}, but this run covers {start_idx}-{end_idx}"
+
+    @contextmanager
+    def transaction(self):
+        # the write lock is taken upfront, so that two workers never claim the same chunk
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def claim(self, worker_id):
+        """
+        Claim a chunk: an unfinished chunk of this worker first, then a pending one, then an expired one.
+
+        Returns:
+            tuple: The id, start and end of the chunk, or None if there is no chunk left to claim.
+        """
+        now = time.time()
+        with self.transaction():
+            chunk = self.connection.execute(
+                "SELECT id, start_idx, end_idx FROM chunks "
+                "WHERE status = 'pending' OR (status = 'claimed' AND (worker = ? OR claimed_at < ?)) "
+                "ORDER BY CASE WHEN status = 'claimed' AND worker = ? THEN 0 WHEN status = 'pending' THEN 1 ELSE 2 END, id "
+                "LIMIT 1",
+                (worker_id, now - self.lease, worker_id),
+            ).fetchone()
+            if chunk is not None:
+                self.connection.execute(
+                    "UPDATE chunks SET status = 'claimed', worker = ?, claimed_at = ? WHERE id = ?",
+                    (worker_id, now, chunk[0]),
+                )
+        return chunk
+
+    def complete(self, chunk_id):
+        with self.transaction():
+            self.connection.execute("UPDATE chunks SET status = 'done' WHERE id = ?", (chunk_id,))
+
+    def progress(self):
+        """Return the number of chunks of every status."""
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM chunks GROUP BY status").fetchall())
+
+    def close(self):
+        self.connection.close()
+
+def run_generate_image_continuous(args, model, prompts, indices, metrics_log=None):
+    assert args.model == "lumina_mgpt" and args.model_type == "eagle", \
+        "Continuous batching is only supported for the EAGLE model of Lumina-mGPT"
+    assert args.cfg_mode == "parallel", "Continuous batching requires --cfg_mode parallel"
+
+    requests = []
+    for idx in indices:
+        q1 = f"Generate an image of 768x768 according to the following prompt:\n{prompts[idx]}"
+        requests.append((idx, [[q1, None]]))
+
+    generate_params = {
+        "images": [],
+        "requests": requests,
+        "batch_size": args.batch_size,
+        "max_gen_len": 2354,
+        "temperature": args.temperature,
+        "top_k": args.top_k,
+        "cfg_scale": args.cfg,
+        "lantern": args.lantern,
+        "lantern_k": args.lantern_k,
+        "lantern_delta": args.lantern_delta,
+    }
+    if USE_EXPERIMENTAL_FEATURES:
+        generate_params["tree_choices"] = getattr(choices, args.tree_choices)
+        generate_params["drafter_top_k"] = args.drafter_top_k
+
+    # decode and save the finished images while the next ones are generated
+    output_queue = queue.Queue()
+    worker_errors = []
+
+    def generate_continuous():
+        try:
+            model.generate_continuous(output_queue=output_queue, **generate_params)
+        except BaseException as e:
+            # the queue is still closed by the generator; the error is raised again once the worker is joined
+            worker_errors.append(e)
+
+    worker = threading.Thread(target=generate_continuous)
+    worker.start()
+    image_writer = ImageWriter(model, args.model, args.save_workers, args.save_queue_size, metrics_log)
+
+    global_statistics = {}
+    pbar = tqdm(total=len(requests))
+    while (output := output_queue.get()) is not None:
+        idx, generated_tokens, step_compression, latency, generation_stats = output
+        record = make_metrics_record(idx, prompts[idx], generated_tokens, step_compression, latency, generation_stats)
+        image_writer.submit(generated_tokens, f"{args.output_dir}/prompt_{idx}.png", record)
+
+        global_statistics[f"prompt_{idx}"] = {
+            "prompt": prompts[idx],
+            "step_compression": step_compression,
+            "latency": latency
+        }
+        pbar.update(1)
+        if metrics_log is not None:
+            pbar.set_postfix(metrics_log.summary(), refresh=False)
+    pbar.close()
+    worker.join()
+    image_writer.close()
+    if worker_errors:
+        # the images of the prompts that were not finished are missing, so the chunk must not be completed
+        raise worker_errors[0]
+
+    return global_statistics
+
+def run_generate_image_sequential(args, model, prompts, indices, metrics_log=None):
+    image_writer = ImageWriter(model, args.model, args.save_workers, args.save_queue_size, metrics_log)
+
+    global_statistics = {}
+    pbar = tqdm(indices)
+    for idx in pbar:
+        prompt = prompts[idx]
         if args.model == "lumina_mgpt":
             q1 = f"Generate an image of 768x768 according to the following prompt:\n{prompt}"
         else:
@@ -278,21 +576,20 @@ def run_generate_image(args):
             "lantern": args.lantern,
             "lantern_k": args.lantern_k,
             "lantern_delta": args.lantern_delta,
-            "img_save_path": f"{args.output_dir}/prompt_{idx}.png",
             "static_tree": args.static_tree,
         }
 
         if USE_EXPERIMENTAL_FEATURES:
-            try:
-                tree_choices = getattr(choices, args.tree_choices)
-            except AttributeError:
-                print(f"Tree choices {args.tree_choices} is not a valid choice")
-                return
-            
-            generate_image_kwargs["tree_choices"] = tree_choices
+            generate_image_kwargs["tree_choices"] = getattr(choices, args.tree_choices)
             generate_image_kwargs["drafter_top_k"] = args.drafter_top_k
-        
-        step_compression, latency = generate_and_save_image(**generate_image_kwargs)
+    
+        generated_tokens, step_compression, latency = generate_image(**generate_image_kwargs)
+        record = make_metrics_record(
+            idx, prompt, generated_tokens, step_compression, latency, getattr(model, "generation_stats", None)
+        )
+        image_writer.submit(generated_tokens, f"{args.output_dir}/prompt_{idx}.png", record)
+        if metrics_log is not None:
+            pbar.set_postfix(metrics_log.summary(), refresh=False)
 
         statistics = {
             "prompt": prompt,
@@ -301,13 +598,111 @@ def run_generate_image(args):
         }
 
         global_statistics[f"prompt_{idx}"] = statistics
+    image_writer.close()
+
+    return global_statistics
+
+def write_chunk_statistics(path, indices, global_statistics, metrics_path=None):
+    """
+    Write the statistics of the prompts `indices` of a chunk. The prompts generated before an interruption of the
+    chunk are not in `global_statistics`: their statistics are kept from a previous statistics file of the chunk, or
+    rebuilt from the metrics log.
+    """
+    previous_statistics = {}
+    if metrics_path is not None and os.path.exists(metrics_path):
+        with open(metrics_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line of a killed run may be truncated
+                    continue
+                previous_statistics[f"prompt_{record['prompt_idx']}"] = {
+                    "prompt": record["prompt"],
+                    "step_compression": record["step_compression"],
+                    "latency": record["latency"],
+                }
+    if os.path.exists(path):
+        with open(path) as f:
+            previous_statistics.update(json.load(f))
+
+    chunk_statistics = {}
+    for idx in indices:
+        key = f"prompt_{idx}"
+        if key in global_statistics:
+            chunk_statistics[key] = global_statistics[key]
+        elif key in previous_statistics:
+            chunk_statistics[key] = previous_statistics[key]
+    with open(path, "w") as f:
+        json.dump(chunk_statistics, f, indent=4)
+
+def run_generate_image_sharded(args, model, prompts, start_idx, end_idx, metrics_log=None):
+    worker_id = args.worker_id or f"{socket.gethostname()}:{os.getenv('CUDA_VISIBLE_DEVICES', '')}"
+    shard_queue = PromptShardQueue(args.shard_db, start_idx, end_idx, args.shard_chunk_size, args.shard_lease)
+
+    while (chunk := shard_queue.claim(worker_id)) is not None:
+        chunk_id, chunk_start, chunk_end = chunk
+        # the images saved before an interruption are kept
+        indices = [
+            idx for idx in range(chunk_start, chunk_end)
+            if not os.path.exists(f"{args.output_dir}/prompt_{idx}.png")
+        ]
+        if args.batch_size > 1:
+            global_statistics = run_generate_image_continuous(args, model, prompts, indices, metrics_log)
+        else:
+            global_statistics = run_generate_image_sequential(args, model, prompts, indices, metrics_log)
+
+        # the statistics of a chunk are written once all of its images are saved, then the chunk is completed
+        write_chunk_statistics(
+            f"{args.output_dir}/global_statistics_{chunk_start}_{chunk_end}.json",
+            range(chunk_start, chunk_end),
+            global_statistics,
+            os.path.join(args.output_dir, args.metrics_file) if args.metrics_file else None,
+        )
+        shard_queue.complete(chunk_id)
+        print(f"Chunk {chunk_start}-{chunk_end} done by {worker_id}; work queue: {shard_queue.progress()}")
+
+    shard_queue.close()
 
-    with open(f"{args.output_dir}/global_statistics_{args.start_idx}_{args.end_idx}.json", "w") as f:
-        json.dump(global_statistics, f, indent=4)
+def run_generate_image(args):
+    assert args.model_type != "vllm", "VLLM model is not supported for single image generation"
+
+    if args.set_seed:
+        set_seed(args.random_seed)
+    
+    model = load_model(args)
+    prompts = load_prompts(args)
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    if USE_EXPERIMENTAL_FEATURES and not hasattr(choices, args.tree_choices):
+        print(f"Tree choices {args.tree_choices} is not a valid choice")
+        return
+
+    metrics_log = MetricsLog(os.path.join(args.output_dir, args.metrics_file) if args.metrics_file else None)
+
+    start_idx, end_idx = args.start_idx, min(args.end_idx, len(prompts))
+    if args.shard_db is not None:
+        run_generate_image_sharded(args, model, prompts, start_idx, end_idx, metrics_log)
+    else:
+        indices = list(range(start_idx, end_idx))
+        if args.batch_size > 1:
+            global_statistics = run_generate_image_continuous(args, model, prompts, indices, metrics_log)
+        else:
+            global_statistics = run_generate_image_sequential(args, model, prompts, indices, metrics_log)
+
+        with open(f"{args.output_dir}/global_statistics_{args.start_idx}_{args.end_idx}.json", "w") as f:
+            json.dump(global_statistics, f, indent=4)
 
     with open(f"{args.output_dir}/generation_configs.json", "w") as f:
         json.dump(vars(args), f, indent=4)
 
+    print(f"Metrics: {metrics_log.summary()}")
+    metrics_log.close()
+
+    if getattr(getattr(model, "model", None), "prompt_prefix_cache", None) is not None:
+        print(f"Prompt prefix cache: {model.model.prompt_prefix_cache.stats()}")
+
 if __name__ == "__main__":
     parser = parse_args()
     args = parser.parse_args()
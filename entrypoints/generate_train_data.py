@@ -11,6 +11,8 @@ from tqdm import tqdm
 from torch.utils.data import Dataset
 import random
 
+from entrypoints.train_drafter.data_utils import TrainDataShardWriter, TrainDataShards, is_sharded_train_data
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Generate data for drafter training')
     
@@ -21,6 +23,12 @@ def parse_args():
     parser.add_argument('--output_dir', type=str, default='data/drafter_train_data/lumina_mgpt')
     parser.add_argument('--num_samples', type=int, default=100000)
     parser.add_argument("--precision", type=str, default="bf16")
+    parser.add_argument("--data_format", type=str, default="shards", choices=["shards", "ckpt"],
+                        help="Memory-mapped shards of the data points, or one torch.save file per data point")
+    parser.add_argument("--shard_size_mb", type=int, default=1024, help="Size in MiB after which a new shard is started")
+    parser.add_argument("--batch_size", type=int, default=8, help="Number of samples per forward of the base model")
+    parser.add_argument("--bucket_window", type=int, default=16,
+                        help="Number of batches whose samples are sorted by length together, to reduce the padding")
 
     return parser
 
@@ -100,6 +108,12 @@ class SupervisedDataset(Dataset):
             raise NotImplementedError(f"Model {self.model} not supported")
         return self
 
+    def lengths(self):
+        # lengths of the samples without loading them, to group them into batches of similar lengths
+        if self.model == "lumina_mgpt" or self.model == "anole":
+            return [len(data["prompt_token_ids"]) + len(data["out_token_ids"]) for data in self.dataset]
+        return [self.cond_length + self.input_length] * len(self)
+
     def select(self, indices: Sequence[int]):
         if self.model == "lumina_mgpt" or self.model == "anole":
             self.dataset = [self.dataset[i] for i in indices]
@@ -108,52 +122,87 @@ class SupervisedDataset(Dataset):
             self.text_data = [self.text_data[i] for i in indices]
         return self
 
-@torch.no_grad()
-def generate_data(model, data, model_type):
+def length_buckets(lengths, batch_size, window):
+    """
+    Group the samples into batches of similar lengths: the samples are sorted by length within windows of `window`
+    batches, so that a batch has little padding while the order of the samples stays shuffled across windows.
+    """
+    window_size = batch_size * window
+    for start in range(0, len(lengths), window_size):
+        indices = sorted(range(start, min(start + window_size, len(lengths))), key=lambda i: lengths[i])
+        for i in range(0, len(indices), batch_size):
+            yield indices[i:i + batch_size]
+
+def cfg_input_ids(data, model_type):
+    # the conditional and unconditional sequences of a sample, or None if it is skipped
+    prompt_token_ids = data["prompt_token_ids"]
+    out_token_ids = data["out_token_ids"]
     if model_type == "lumina_mgpt":
-        if (data['out_token_ids'][0][:3] == torch.tensor([8197, 8828, 8828])).sum().item() != 3:
-            print(data['out_token_ids'][0][:3])
+        if (out_token_ids[0][:3] == torch.tensor([8197, 8828, 8828])).sum().item() != 3:
+            print(out_token_ids[0][:3])
             return None
-
-        prompt_token_ids = data["prompt_token_ids"]
-        out_token_ids = data["out_token_ids"]
-
         cond_input_ids = torch.cat([prompt_token_ids, out_token_ids], dim=-1)
-        cond_outputs = model(input_ids=cond_input_ids.cuda(), output_hidden_states=True)
-
         uncond_input_ids = out_token_ids
-        uncond_outputs = model(input_ids=uncond_input_ids.cuda(), output_hidden_states=True)
+    else:
+        cond_input_ids = torch.cat([prompt_token_ids, torch.tensor([[8710, 8197]]), out_token_ids], dim=-1)
+        uncond_input_ids = torch.cat([torch.tensor([[0, 8197]]), out_token_ids], dim=-1)
+    return cond_input_ids[0], uncond_input_ids[0]
 
-        return {"cond_input_ids": cond_input_ids.cpu()[0], "cond_hidden_states": cond_outputs.hidden_states[-1].cpu()[0],
-                "uncond_input_ids": uncond_input_ids.cpu()[0], "uncond_hidden_states": uncond_outputs.hidden_states[-1].cpu()[0]}
-    elif model_type == "anole":
-        prompt_token_ids = data["prompt_token_ids"]
-        out_token_ids = data["out_token_ids"]
+@torch.no_grad()
+def generate_data(model, batch, model_type):
+    """
+    Extract the last hidden states of the base model for a batch of samples in a single forward.
 
-        cond_input_ids = torch.cat([prompt_token_ids, torch.tensor([[8710, 8197]]), out_token_ids], dim=-1)
-        cond_outputs = model(input_ids=cond_input_ids.cuda(), output_hidden_states=True)
+    Only the decoder is run: its output is the normalized last hidden state (`hidden_states[-1]` of the full model),
+    so neither the hidden states of the other layers nor the logits are computed.
 
-        uncond_input_ids = torch.cat([torch.tensor([[0, 8197]]), out_token_ids], dim=-1)
-        uncond_outputs = model(input_ids=uncond_input_ids.cuda(), output_hidden_states=True)
+    Returns:
+        list: The data point of every sample of the batch, or None for a skipped sample.
+    """
+    if model_type == "lumina_mgpt" or model_type == "anole":
+        batch_samples = [cfg_input_ids(data, model_type) for data in batch]
+        samples = [input_ids for input_ids in batch_samples if input_ids is not None]
+        if not samples:
+            return batch_samples
+
+        # the conditional and unconditional rows of all samples are right-padded into one batch; with causal attention
+        # the tokens never attend to the padding after them, hence no attention mask is needed and the positions
+        # are the ones of separate forwards
+        rows = [cond_input_ids for cond_input_ids, _ in samples] + [uncond_input_ids for _, uncond_input_ids in samples]
+        input_ids = torch.zeros((len(rows), max(len(row) for row in rows)), dtype=torch.long)
+        for i, row in enumerate(rows):
+            input_ids[i, :len(row)] = row
+        hidden_states = model.model(input_ids=input_ids.cuda())[0].cpu()
 
-        return {"cond_input_ids": cond_input_ids.cpu()[0], "cond_hidden_states": cond_outputs.hidden_states[-1].cpu()[0],
-                "uncond_input_ids": uncond_input_ids.cpu()[0], "uncond_hidden_states": uncond_outputs.hidden_states[-1].cpu()[0]}
+        outputs = []
+        for i, (cond_input_ids, uncond_input_ids) in enumerate(samples):
+            outputs.append({
+                "cond_input_ids": cond_input_ids,
+                "cond_hidden_states": hidden_states[i, :len(cond_input_ids)].clone(),
+                "uncond_input_ids": uncond_input_ids,
+                "uncond_hidden_states": hidden_states[len(samples) + i, :len(uncond_input_ids)].clone(),
+            })
+        outputs = iter(outputs)
+        return [None if input_ids is None else next(outputs) for input_ids in batch_samples]
     elif "llamagen" in model_type:
-        input_ids=data["input_ids"]
-        cond_idx=data["cond_idx"].to(model.dtype)
-        loss_mask=data["loss_mask"]
-        attention_mask = data["attention_mask"]
-        outs_big = model(cond_idx=cond_idx.cuda(), input_ids=input_ids.cuda(),attention_mask=attention_mask.cuda(), output_hidden_states=True)
-        hidden_state_big = outs_big.hidden_states[-1]
-        return {"cond_idx":cond_idx, "input_ids":input_ids.cpu()[0],"hidden_state":hidden_state_big.cpu()[0],
-                "loss_mask":loss_mask.cpu()[0],'attention_mask':attention_mask[0]}
+        # all samples have the same length
+        input_ids = torch.cat([data["input_ids"] for data in batch])
+        cond_idx = torch.cat([data["cond_idx"] for data in batch]).to(model.dtype)
+        loss_mask = torch.cat([data["loss_mask"] for data in batch])
+        attention_mask = torch.cat([data["attention_mask"] for data in batch])
+        hidden_states = model.model(cond_idx=cond_idx.cuda(), input_ids=input_ids.cuda(), attention_mask=attention_mask.cuda())[0].cpu()
+
+        return [
+            {"cond_idx": cond_idx[i:i + 1].clone(), "input_ids": input_ids[i].clone(),
+             "hidden_state": hidden_states[i].clone(), "loss_mask": loss_mask[i].clone(),
+             "attention_mask": attention_mask[i].clone()}
+            for i in range(len(batch))
+        ]
     else:
         raise NotImplementedError(f"Model {model_type} not supported")
-def writedata(name, data_point):
+def writedata(name, data_point, idx):
     if not os.path.exists(name):
         os.makedirs(name)
-    current_length=len(os.listdir(name))
-    idx=current_length
     torch.save(data_point, f'{name}/data_{idx}.ckpt')
 
 def run_generate_data(args):
@@ -194,10 +243,34 @@ def run_generate_data(args):
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
-    for data in tqdm(ds):
-        outdata = generate_data(model, data, args.model)
-        if outdata is not None:
-            writedata(args.output_dir, outdata)
+    samples = list(range(len(ds)))
+    if args.data_format == "shards":
+        if is_sharded_train_data(args.output_dir):
+            # a resumed run skips the samples written before the interruption
+            written = TrainDataShards(args.output_dir).sample_indices()
+            samples = [i for i in samples if i not in written]
+        writer = TrainDataShardWriter(args.output_dir, shard_size=args.shard_size_mb * 2 ** 20)
+    else:
+        # the directory is listed once, the following files are numbered from there
+        idx = len(os.listdir(args.output_dir))
+
+    lengths = ds.lengths()
+    pbar = tqdm(total=len(samples))
+    for batch in length_buckets([lengths[i] for i in samples], args.batch_size, args.bucket_window):
+        indices = [samples[j] for j in batch]
+        for i, outdata in zip(indices, generate_data(model, [ds[i] for i in indices], args.model)):
+            if outdata is None:
+                continue
+            if args.data_format == "shards":
+                writer.write(outdata, sample_idx=i)
+            else:
+                writedata(args.output_dir, outdata, idx)
+                idx += 1
+        pbar.update(len(indices))
+    pbar.close()
+
+    if args.data_format == "shards":
+        writer.close()
 
 if __name__ == '__main__':
     parser = parse_args()
@@ -1,5 +1,7 @@
 import os
+import json
 import random
+import numpy as np
 import torch
 
 from typing import Any, Dict, List
@@ -13,6 +15,118 @@ def list_files(path):
             datapath.append(file_path)
     return datapath
 
+def is_sharded_train_data(path):
+    return os.path.exists(os.path.join(path, "shard_00000.index.jsonl"))
+
+class TrainDataShardWriter:
+    """
+    Append data points (dicts of tensors) to the shards of a training data directory.
+
+    A shard is a binary file of the raw bytes of the tensors of consecutive data points, and an index with one JSON
+    line per data point giving the offset, dtype and shape of each of its tensors, and the index of the sample it was
+    generated from. The index line of a data point is written after its bytes, so that the tail of an interrupted shard
+    is ignored. A new shard is started once a shard exceeds `shard_size` bytes, and every writer starts a new shard, so
+    that an interrupted run can be resumed by skipping the samples of `TrainDataShards.sample_indices`.
+    """
+
+    def __init__(self, path, shard_size=2 ** 30):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.shard_size = shard_size
+        self.num_shards = len([file for file in os.listdir(path) if file.endswith(".index.jsonl")])
+        self.data_file = None
+        self.index_file = None
+
+    def open_shard(self):
+        self.close()
+        name = os.path.join(self.path, f"shard_{self.num_shards:05d}")
+        self.data_file = open(f"{name}.bin", "wb")
+        self.index_file = open(f"{name}.index.jsonl", "w")
+        self.num_shards += 1
+
+    def write(self, data_point, sample_idx=None):
+        if self.data_file is None or self.data_file.tell() >= self.shard_size:
+            self.open_shard()
+
+        entry = {}
+        for key, tensor in data_point.items():
+            tensor = tensor.detach().cpu().contiguous()
+            # every tensor starts at an aligned offset, so that its view in the mapped bytes is aligned for its dtype
+            self.data_file.write(bytes(-self.data_file.tell() % 64))
+            entry[key] = [self.data_file.tell(), str(tensor.dtype).split(".")[-1], list(tensor.shape)]
+            # numpy has no bfloat16, hence the bytes are written through an integer view of the same width
+            self.data_file.write(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+        self.data_file.flush()
+        self.index_file.write(json.dumps({"sample": sample_idx, "tensors": entry}) + "\n")
+        self.index_file.flush()
+
+    def close(self):
+        if self.data_file is not None:
+            self.data_file.close()
+            self.index_file.close()
+            self.data_file = None
+            self.index_file = None
+
+class TrainDataShards:
+    """
+    The data points of a directory written by `TrainDataShardWriter`, as a sequence of dicts of tensors.
+
+    The shards are memory-mapped, and the tensors of a data point are views of the mapped bytes: loading a data point
+    copies nothing until it is used. The shards are mapped lazily, e.g., in every worker of a DataLoader. Slicing
+    returns the sequence of a subset of the data points, like a list of files.
+    """
+
+    def __init__(self, path, entries=None):
+        self.path = path
+        if entries is None:
+            entries = []
+            index_files = sorted(file for file in os.listdir(path) if file.endswith(".index.jsonl"))
+            for index_file in index_files:
+                shard = index_file[:-len(".index.jsonl")]
+                with open(os.path.join(path, index_file)) as f:
+                    entries.extend((shard, json.loads(line)) for line in f if line.endswith("\n"))
+        self.entries = entries
+        self.shards = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def sample_indices(self):
+        """Return the indices of the samples the data points were generated from, e.g., to resume a run."""
+        return {entry["sample"] for _, entry in self.entries if entry["sample"] is not None}
+
+    def shard(self, name):
+        if name not in self.shards:
+            # copy-on-write mapping: the pages are shared with the file, and the views are writable as torch expects
+            self.shards[name] = np.memmap(os.path.join(self.path, f"{name}.bin"), dtype=np.uint8, mode="c")
+        return self.shards[name]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return TrainDataShards(self.path, self.entries[index])
+
+        shard, entry = self.entries[index]
+        data = self.shard(shard)
+        data_point = {}
+        for key, (offset, dtype, shape) in entry["tensors"].items():
+            dtype = getattr(torch, dtype)
+            num_bytes = int(np.prod(shape, dtype=np.int64)) * torch.empty((), dtype=dtype).element_size()
+            tensor = torch.from_numpy(data[offset:offset + num_bytes]).view(dtype)
+            data_point[key] = tensor.view(shape)
+        return data_point
+
+    def __getstate__(self):
+        # the mappings are not pickled to the DataLoader workers, which map the shards again
+        state = self.__dict__.copy()
+        state["shards"] = {}
+        return state
+
+def load_data_point(data, index):
+    # `data` is either a list of files saved with `torch.save` or the data points of sharded training data
+    if isinstance(data, TrainDataShards):
+        return data[index]
+    return torch.load(data[index], weights_only=True)
+
 class AddGaussianNoise:
     def __init__(self, mean=0.0, std=0.0):
         self.mean = mean
@@ -61,7 +175,7 @@ class CustomDataset(Dataset):
         return len(self.data)
 
     def __getitem__(self, index):
-        data = torch.load(self.data[index], weights_only=True)
+        data = load_data_point(self.data, index)
         
         if self.model == "lumina_mgpt" or self.model == "anole":
 
@@ -212,7 +326,7 @@ class CoupledDataset(Dataset):
 
 
     def __getitem__(self, index):
-        data = torch.load(self.data[index])
+        data = load_data_point(self.data, index)
         cond_item = self.prepare_data(data, conditioned=True)
         uncond_item = self.prepare_data(data, conditioned=False)
 
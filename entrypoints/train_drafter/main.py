@@ -17,7 +17,9 @@ from transformers import get_linear_schedule_with_warmup
 from models.configs.configs import EConfig
 
 from .data_utils import (
+    is_sharded_train_data,
     list_files,
+    TrainDataShards,
     AddGaussianNoise,
     AddUniformNoise,
     CustomDataset,
@@ -280,7 +282,10 @@ def run_train_drafter(args):
     else:
         aug = None
 
-    data_path = list_files(args.data_dir)
+    if is_sharded_train_data(args.data_dir):
+        data_path = TrainDataShards(args.data_dir)
+    else:
+        data_path = list_files(args.data_dir)
 
     train_data_path = data_path[:int(len(data_path) * args.train_data_ratio)]
     test_data_path = data_path[int(len(data_path) * args.train_data_ratio):]
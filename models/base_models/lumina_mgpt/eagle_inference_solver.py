@@ -1,5 +1,6 @@
 import argparse
 import copy
+import itertools
 import math
 import time
 from typing import List, Optional, Union
@@ -255,6 +256,7 @@ class FlexARInferenceSolver:
         )
 
         self.item_processor = FlexARItemProcessor(target_size=target_size)
+        self.generation_stats = None
 
     def get_streamer(self):
         return TextStreamer(self.item_processor.tokenizer)
@@ -272,6 +274,41 @@ class FlexARInferenceSolver:
         **kwargs,
     ):
 
+        prompt = self.build_prompt(images, qas)
+        prompt_len = len(prompt)
+        prompt = torch.tensor(prompt, dtype=torch.int64, device=self.model.base_model.device).unsqueeze(0)
+
+        if logits_processor is None:
+            logits_processor = self.create_logits_processor()
+
+        with torch.amp.autocast('cuda', dtype=self.dtype):
+            start = time.time()
+            generation_result, accept_length_list = self.model.generate(
+                prompt,
+                do_sample=True if temperature > 0 else False,
+                max_new_tokens=max_gen_len,
+                logits_processors=logits_processor,
+                eos_token_ids=[8710, 8196],
+                **kwargs,
+            )
+            end = time.time()
+            
+            step_compression = torch.tensor(accept_length_list, dtype=torch.float32).mean().item()
+            latency = end - start
+            print(f"Mean accept length: {step_compression:.4f} / Latency: {latency:.2f}s")
+            # statistics of the last generation that do not fit in the return values
+            self.generation_stats = {
+                "prefill_time": self.model.prefill_times[0],
+                "decode_steps": len(accept_length_list),
+            }
+
+            generation_result = generation_result[0][prompt_len:].tolist()
+            if len(generation_result) > 0 and generation_result[-1] == 8710:
+                generation_result = generation_result[:-1]
+
+        return generation_result, step_compression, latency
+
+    def build_prompt(self, images, qas):
         conversations = []
         for q, a in qas:
             conversations.append(
@@ -295,33 +332,166 @@ class FlexARInferenceSolver:
                 prompt.append(value)
             else:
                 prompt += value["input_ids"]
-        prompt_len = len(prompt)
-        prompt = torch.tensor(prompt, dtype=torch.int64, device=self.model.base_model.device).unsqueeze(0)
+        return prompt
+
+    @torch.no_grad()
+    def generate_batch(
+        self,
+        images,
+        qas_list,
+        max_gen_len,
+        temperature,
+        top_k,
+        logits_processor=None,
+        **kwargs,
+    ):
+        """
+        Generate one image per conversation of `qas_list` with a single batched speculative decoding.
+
+        The prompts are left-padded to the same length; the model must use the parallel CFG mode.
+
+        Returns:
+            tuple: The generated tokens of every prompt, their mean accept lengths and the total latency.
+        """
+        prompts = [self.build_prompt(images, qas) for qas in qas_list]
+        prompt_lens = [len(prompt) for prompt in prompts]
+        input_ids, attention_mask = self.pad_prompts(prompts)
 
         if logits_processor is None:
             logits_processor = self.create_logits_processor()
 
         with torch.amp.autocast('cuda', dtype=self.dtype):
             start = time.time()
-            generation_result, accept_length_list = self.model.generate(
-                prompt,
+            generation_results, accept_length_lists = self.model.generate(
+                input_ids,
+                attention_mask=attention_mask,
                 do_sample=True if temperature > 0 else False,
                 max_new_tokens=max_gen_len,
                 logits_processors=logits_processor,
-                eos_token_id=[8710, 8196],
+                eos_token_ids=[8710, 8196],
                 **kwargs,
             )
             end = time.time()
-            
-            step_compression = torch.tensor(accept_length_list, dtype=torch.float32).mean().item()
+            if len(prompts) == 1:
+                # a single prompt keeps the return values of the unbatched generation
+                accept_length_lists = [accept_length_lists]
+
+            step_compressions = [
+                torch.tensor(accept_length_list, dtype=torch.float32).mean().item()
+                for accept_length_list in accept_length_lists
+            ]
             latency = end - start
-            print(f"Mean accept length: {step_compression:.4f} / Latency: {latency:.2f}s")
+            print(f"Mean accept length: {sum(step_compressions) / len(step_compressions):.4f} / Latency: {latency:.2f}s")
 
-            generation_result = generation_result[0][prompt_len:].tolist()
-            if len(generation_result) > 0 and generation_result[-1] == 8710:
-                generation_result = generation_result[:-1]
+            outputs = []
+            for generation_result, prompt_len in zip(generation_results, prompt_lens):
+                generation_result = generation_result[prompt_len:].tolist()
+                if len(generation_result) > 0 and generation_result[-1] == 8710:
+                    generation_result = generation_result[:-1]
+                outputs.append(generation_result)
 
-        return generation_result, step_compression, latency
+        return outputs, step_compressions, latency
+
+    @torch.no_grad()
+    def generate_continuous(
+        self,
+        images,
+        requests,
+        output_queue,
+        batch_size,
+        max_gen_len,
+        temperature,
+        top_k,
+        **kwargs,
+    ):
+        """
+        Generate one image per request with continuous batching.
+
+        Up to `batch_size` prompts are decoded together; as soon as one of them finishes, the next request is
+        admitted into its free row so that the batch stays full. The model must use the parallel CFG mode.
+
+        Args:
+            requests (iterable): Pairs of (request_id, qas), e.g. read from a queue.
+            output_queue (queue.Queue): Receives (request_id, generated tokens, step compression, latency, statistics)
+                for every finished request, then None once all requests are done. The statistics hold the prefill
+                time and the number of decoding steps of the request, as `generation_stats` does for `generate`.
+        """
+        try:
+            self.decode_continuous(images, requests, output_queue, batch_size, max_gen_len, temperature, **kwargs)
+        finally:
+            # always close the output queue so that consumers are not left waiting
+            output_queue.put(None)
+
+    def decode_continuous(self, images, requests, output_queue, batch_size, max_gen_len, temperature, **kwargs):
+        requests = iter(requests)
+        pending = list(itertools.islice(requests, batch_size))
+        if len(pending) == 0:
+            return
+
+        prompts = [self.build_prompt(images, qas) for _, qas in pending]
+        input_ids, attention_mask = self.pad_prompts(prompts)
+
+        with torch.amp.autocast('cuda', dtype=self.dtype):
+            start = time.time()
+            state = self.model.start_generation(
+                input_ids,
+                attention_mask=attention_mask,
+                do_sample=True if temperature > 0 else False,
+                max_new_tokens=max_gen_len,
+                logits_processors=self.create_logits_processor(),
+                eos_token_ids=[8710, 8196],
+                **kwargs,
+            )
+            try:
+                # request_id, prompt length and start time of the request decoded in every row
+                slots = [(request_id, len(prompt), start) for (request_id, _), prompt in zip(pending, prompts)]
+
+                while any(slot is not None for slot in slots):
+                    for row in self.model.decode_step(state):
+                        request_id, prompt_len, start = slots[row]
+                        step_compression = torch.tensor(state.accept_length_list[row], dtype=torch.float32).mean().item()
+                        latency = time.time() - start
+                        print(f"Mean accept length: {step_compression:.4f} / Latency: {latency:.2f}s")
+                        generation_stats = {
+                            "prefill_time": state.prefill_times[row],
+                            "decode_steps": len(state.accept_length_list[row]),
+                        }
+
+                        generation_result = state.output(row)[prompt_len:].tolist()
+                        if len(generation_result) > 0 and generation_result[-1] == 8710:
+                            generation_result = generation_result[:-1]
+                        output_queue.put((request_id, generation_result, step_compression, latency, generation_stats))
+                        slots[row] = None
+
+                        # recycle the row for the next request; it idles until the batch is done if there is none
+                        request = next(requests, None)
+                        if request is not None:
+                            request_id, qas = request
+                            prompt = self.build_prompt(images, qas)
+                            self.model.admit(
+                                state,
+                                row,
+                                torch.tensor(prompt, dtype=torch.int64, device=input_ids.device).unsqueeze(0),
+                                logits_processors=self.create_logits_processor(),
+                            )
+                            slots[row] = (request_id, len(prompt), time.time())
+
+            finally:
+                # the KV pages of the batch are released even if decoding fails
+                self.model.finish_generation(state)
+
+
+    def pad_prompts(self, prompts):
+        """Left-pad tokenized prompts to the same length and build their attention mask."""
+        max_prompt_len = max(len(prompt) for prompt in prompts)
+
+        device = self.model.base_model.device
+        input_ids = torch.zeros((len(prompts), max_prompt_len), dtype=torch.int64, device=device)
+        attention_mask = torch.zeros((len(prompts), max_prompt_len), dtype=torch.bool, device=device)
+        for i, prompt in enumerate(prompts):
+            input_ids[i, max_prompt_len - len(prompt):] = torch.tensor(prompt, dtype=torch.int64, device=device)
+            attention_mask[i, max_prompt_len - len(prompt):] = True
+        return input_ids, attention_mask
 
     def decode_ids(self, tokens: List[int]):
         generated_images = []
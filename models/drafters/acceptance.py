@@ -0,0 +1,338 @@
+import torch
+
+
+def max_num_children(tree_choices):
+    """
+    Return the largest number of children of any node in a static tree.
+
+    Args:
+        tree_choices (list): Tree choices such as `mc_sim_7b_63`, where each entry is the path to one node.
+
+    Returns:
+        int: The maximum number of siblings that can be evaluated at one level of the tree.
+    """
+    num_children = {}
+    for path in tree_choices:
+        parent = tuple(path[:-1])
+        num_children[parent] = num_children.get(parent, 0) + 1
+    return max(num_children.values())
+
+
+def prefix_groups(candidates):
+    """
+    Group the root-to-leaf rows of `candidates` by their token prefixes.
+
+    Rows of `candidates` are sorted such that rows sharing a prefix are contiguous, hence the groups can be
+    found with a shifted comparison and a cumulative sum, without leaving the device.
+
+    Args:
+        candidates (torch.Tensor): Candidate paths of shape [..., num_paths, path_len], padded with -1.
+
+    Returns:
+        tuple:
+            - ranks (torch.Tensor): [..., num_paths, path_len], index of the prefix group of each row at each level.
+            - first_rows (torch.Tensor): [..., num_paths, path_len], first row of each prefix group at each level
+              (`num_paths` for unused group slots).
+    """
+    *batch_shape, num_paths, path_len = candidates.shape
+    device = candidates.device
+
+    same_prefix = torch.cumprod((candidates[..., 1:, :] == candidates[..., :-1, :]).long(), dim=-1).bool()
+    new_group = torch.ones(candidates.shape, dtype=torch.bool, device=device)
+    new_group[..., 1:, :] = ~same_prefix
+    ranks = torch.cumsum(new_group.long(), dim=-2) - 1
+
+    rows = torch.arange(num_paths, device=device)[:, None].expand(candidates.shape)
+    first_rows = torch.full((*batch_shape, num_paths + 1, path_len), num_paths, dtype=torch.long, device=device)
+    first_rows.scatter_(-2, torch.where(new_group, ranks, num_paths), rows)
+    return ranks, first_rows[..., :num_paths, :]
+
+
+def latent_neighbours(tokens, nearest_latents, num_neighbours, image_token_offset=0):
+    """
+    Look up the nearest latent tokens of `tokens` in a device-resident neighbour table.
+
+    Args:
+        tokens (torch.Tensor): Token ids of any shape. Ids outside the table are clamped into it.
+        nearest_latents (torch.Tensor): [num_latents, max_neighbours] table of nearest latents per image token.
+        num_neighbours (int): Number of neighbours to return per token.
+        image_token_offset (int): Token id of the first image token in `nearest_latents`.
+
+    Returns:
+        torch.Tensor: Token ids of the neighbours, of shape [*tokens.shape, num_neighbours].
+    """
+    latent = (tokens - image_token_offset).clamp(0, nearest_latents.shape[0] - 1)
+    return nearest_latents[latent, :num_neighbours] + image_token_offset
+
+
+def lantern_relaxed_probs(px, nearest_probs, lantern_delta):
+    """
+    Relax the acceptance mass of tokens with the probabilities of their latent neighbours (LANTERN).
+
+    The mass of a token is `px` plus the largest cumulative sum of its neighbour probabilities that stays within
+    the relaxation budget, i.e. `(lantern_delta - 1) * px` if `lantern_delta > 1` and `lantern_delta` otherwise.
+
+    Args:
+        px (torch.Tensor): Target probabilities of the tokens, of any shape.
+        nearest_probs (torch.Tensor): Target probabilities of their neighbours, of shape [*px.shape, k].
+        lantern_delta (float): LANTERN relaxation budget.
+
+    Returns:
+        tuple:
+            - px (torch.Tensor): Relaxed acceptance mass, same shape as `px`.
+            - relaxed (torch.Tensor): Whether at least one neighbour was merged into the mass of each token.
+    """
+    cumsum_nearest_probs = torch.cumsum(nearest_probs, dim=-1)
+    threshold = (lantern_delta - 1) * px[..., None] if lantern_delta > 1.0 else lantern_delta
+    num_within = (cumsum_nearest_probs <= threshold).sum(dim=-1, keepdim=True)
+    relaxed = num_within > 0
+    merged = torch.where(relaxed, cumsum_nearest_probs.gather(-1, (num_within - 1).clamp(min=0)), 0.0)
+    return px + merged[..., 0], relaxed[..., 0]
+
+
+@torch.no_grad()
+def lantern_relaxed_tree_probs(
+    logits,
+    candidates,
+    nearest_latents,
+    lantern_k=1000,
+    lantern_delta=0.1,
+    image_token_offset=0,
+    logits_processor=None,
+):
+    """
+    LANTERN acceptance mass of every candidate token of a draft tree at once.
+
+    The mass of `candidates[j, i]` is taken against the target distribution of its parent, `logits[j, i - 1]`.
+    Only the probabilities of the candidates and their neighbours are gathered, so the full softmax over the tree
+    is never materialized. The masses are valid as long as the distribution of a level has not been replaced by
+    a residual, i.e. until the first rejection at that level.
+
+    Args:
+        logits (torch.Tensor): Target logits of shape [num_paths, path_len, vocab_size].
+        candidates (torch.Tensor): Candidate paths of shape [num_paths, path_len], padded with -1.
+        nearest_latents (torch.Tensor): Device-resident latent neighbour table.
+        lantern_k (int): Number of latent neighbours considered by LANTERN.
+        lantern_delta (float): LANTERN relaxation budget.
+        image_token_offset (int): Token id of the first image token in `nearest_latents`.
+        logits_processor (LogitsProcessorList, optional): Processor applied to the target logits before softmax.
+
+    Returns:
+        tuple:
+            - px (torch.Tensor): [num_paths, path_len - 1], relaxed acceptance mass of `candidates[:, 1:]`.
+            - relaxed (torch.Tensor): [num_paths, path_len - 1], whether the mass of the candidate was relaxed.
+    """
+    logits = logits[:, :-1].float()
+    if logits_processor is not None:
+        logits = logits_processor(None, logits.flatten(0, 1)).view(logits.shape)
+    log_normalizer = torch.logsumexp(logits, dim=-1, keepdim=True)
+
+    tokens = candidates[:, 1:].to(logits.device).clamp(min=0)
+    neighbours = latent_neighbours(tokens, nearest_latents, lantern_k, image_token_offset)
+    px = torch.exp(logits.gather(-1, tokens[..., None]) - log_normalizer)[..., 0]
+    nearest_probs = torch.exp(logits.gather(-1, neighbours) - log_normalizer)
+    return lantern_relaxed_probs(px, nearest_probs, lantern_delta)
+
+
+@torch.no_grad()
+def evaluate_posterior_tensorized(
+    logits,
+    candidates,
+    num_slots,
+    image_token_mask,
+    image_syntax_token_mask,
+    cart_candidates_prob=None,
+    original_prob=None,
+    p_indices=None,
+    lantern=False,
+    lantern_k=1000,
+    lantern_delta=0.1,
+    nearest_latents=None,
+    image_token_offset=0,
+    tree_depths=None,
+):
+    """
+    Speculative sampling over the draft trees of a batch without per-candidate host synchronization.
+
+    Every row walks its own tree level by level and sibling by sibling with the acceptance rule of EAGLE, but
+    every decision is kept on the device as a masked update: all random draws are made up front, siblings are
+    located with `prefix_groups`, and the rows of the batch move together. The only host synchronization is the
+    final read of the accepted paths.
+
+    The residual distribution of a level is updated in place. With EAGLE v2, a rejection only zeroes the
+    rejected token (and its LANTERN neighbours), so the update is a scatter of a few entries and the mass left
+    is tracked from the gathered probabilities; the distribution is normalized once per level. With EAGLE v1, the
+    drafter distribution is subtracted from the residual, which costs one pass over the vocabulary per sibling.
+
+    Args:
+        logits (torch.Tensor): Target logits of shape [batch_size, num_paths, path_len, vocab_size].
+        candidates (torch.Tensor): Candidate paths of shape [batch_size, num_paths, path_len], padded with -1.
+        num_slots (int): Upper bound on the number of children of a node.
+        image_token_mask (torch.Tensor): [vocab_size] boolean mask of the image tokens.
+        image_syntax_token_mask (torch.Tensor): [vocab_size] boolean mask of the tokens accepted unconditionally.
+        cart_candidates_prob (torch.Tensor, optional): Drafter probabilities of the candidates, of shape
+            [batch_size, num_paths, path_len] (EAGLE v1 only).
+        original_prob (list, optional): Drafter distributions per depth, each of shape
+            [batch_size, num_nodes_at_depth, vocab_size] (EAGLE v1 only).
+        p_indices (torch.Tensor, optional): [num_paths, path_len], row of `original_prob` that drafted each
+            candidate (EAGLE v1 only).
+        lantern (bool): Whether to use the LANTERN relaxed acceptance.
+        lantern_k (int): Number of latent neighbours considered by LANTERN.
+        lantern_delta (float): LANTERN relaxation budget.
+        nearest_latents (torch.Tensor, optional): Device-resident latent neighbour table (required for LANTERN).
+        image_token_offset (int): Token id of the first image token in `nearest_latents`.
+        tree_depths (torch.Tensor, optional): [batch_size, >= path_len + 1], depth in the sequence of every depth
+            of the candidates, when the tokens forced between them are verified apart (see `splice_forced_tokens`).
+            The accepted lengths then count the forced tokens up to the next drafted depth.
+
+    Returns:
+        tuple:
+            - best_candidate (list): Accepted path of every row.
+            - accept_length (list): Number of accepted tokens of every row, excluding the root token.
+            - sample_p (torch.Tensor): [batch_size, vocab_size], distribution of the next token of every row.
+    """
+    batch_size, num_paths, path_len, vocab_size = logits.shape
+    device = logits.device
+    eagle_v1 = cart_candidates_prob is not None
+
+    candidates = candidates.to(device)
+    ranks, first_rows = prefix_groups(candidates)
+    draws = torch.rand((batch_size, path_len, num_slots), device=device)
+    if eagle_v1:
+        cart_candidates_prob = cart_candidates_prob.to(device)
+        p_indices = p_indices.to(device)
+
+    rows = torch.arange(batch_size, device=device)
+    slot_rows = rows[:, None]
+    slots = torch.arange(num_slots, device=device)
+
+    cur_row = torch.zeros(batch_size, dtype=torch.long, device=device)
+    accept_length = torch.ones(batch_size, dtype=torch.long, device=device)
+    alive = torch.ones(batch_size, dtype=torch.bool, device=device)
+    last_adjust = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    last_gtp = torch.zeros((batch_size, vocab_size), dtype=torch.float32, device=device)
+
+    for i in range(1, path_len):
+        # the siblings of the current node of every row, one prefix group per slot
+        group = ranks[rows, cur_row, i][:, None] + slots
+        j = first_rows[slot_rows, group.clamp(max=num_paths - 1), i]
+        exists = (group < num_paths) & (j < num_paths)
+        j = j.clamp(max=num_paths - 1)
+        x = candidates[slot_rows, j, i]
+        exists = exists & (ranks[slot_rows, j, i - 1] == ranks[rows, cur_row, i - 1][:, None]) & (x != -1)
+        x = x.clamp(min=0)
+        is_image = image_token_mask[x]
+        is_syntax = image_syntax_token_mask[x]
+        if lantern:
+            # [batch_size, num_slots, lantern_k + 1], the last neighbour is only zeroed on rejection
+            neighbours = latent_neighbours(x, nearest_latents, lantern_k + 1, image_token_offset)
+
+        # NOTE : the last column absorbs the writes of the rows that do not update the residual
+        gtp = torch.zeros((batch_size, vocab_size + 1), dtype=torch.float32, device=device)
+        gtp[:, :vocab_size] = torch.softmax(logits[rows, cur_row, i - 1].float(), dim=-1)
+        if eagle_v1:
+            q_rows = original_prob[i - 1]
+            q_work = q_rows[rows, p_indices[cur_row, i].clamp(0, q_rows.shape[1] - 1)].float()
+            q_mass = q_work.sum(dim=-1)
+        else:
+            # rejected tokens are marked with -(epoch + 1); a row moves to the next epoch when its residual
+            # vanishes, where the residual restarts from the uniform distribution
+            epoch = torch.zeros(batch_size, dtype=torch.float32, device=device)
+            mass = gtp.sum(dim=-1)
+
+        def residual_values(tokens):
+            values = gtp.gather(1, tokens)
+            if eagle_v1:
+                return values
+            return torch.where(epoch[:, None] == 0, values.clamp(min=0), (values != -(epoch[:, None] + 1)).float())
+
+        def residual_probs(tokens):
+            return residual_values(tokens) if eagle_v1 else residual_values(tokens) / mass[:, None]
+
+        accepted = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        adjust = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        next_row = cur_row
+
+        for s in range(num_slots):
+            xs = x[:, s:s + 1]
+            active = alive & ~accepted & exists[:, s]
+
+            px = residual_probs(xs)[:, 0]
+            if lantern:
+                nearest_probs = residual_probs(neighbours[:, s, :lantern_k])
+                px, relaxed = lantern_relaxed_probs(px, nearest_probs, lantern_delta)
+                zero_neighbours = relaxed & is_image[:, s]
+            px = torch.where(is_syntax[:, s], 1.0, torch.where(is_image[:, s], px, 0.0))
+
+            if eagle_v1:
+                qx = cart_candidates_prob[rows, j[:, s], i]
+                active = active & (qx > 0)
+                acp = px / qx
+            else:
+                acp = px
+
+            accept = active & (draws[:, i, s] <= acp)
+            reject = active & ~accept
+
+            if eagle_v1:
+                if lantern:
+                    gtp.scatter_(1, torch.where((reject & zero_neighbours)[:, None], neighbours[:, s], vocab_size), 0.0)
+                # the drafter distribution of the later siblings excludes the tokens drafted before them; it has no mass
+                # left once the drafter was certain of an earlier sibling, but the later ones are then never rejected
+                q_scale = torch.ones_like(q_mass) if s == 0 else q_mass
+                residual = gtp[:, :vocab_size]
+                residual.addcmul_(q_work, torch.where(reject, 1.0 / q_scale, 0.0)[:, None], value=-1).clamp_(min=0)
+                residual_mass = residual.sum(dim=-1)
+                vanished = reject & (residual_mass == 0)
+                residual.masked_fill_(vanished[:, None], 1.0)
+                residual_mass = torch.where(vanished, vocab_size, residual_mass)
+                residual.div_(torch.where(reject, residual_mass, 1.0)[:, None])
+
+                q_x = q_work.gather(1, xs)
+                q_mass = q_mass - torch.where(exists[:, s], q_x[:, 0], 0.0)
+                q_work.scatter_(1, xs, torch.where(exists[:, s:s + 1], 0.0, q_x))
+            else:
+                removed = torch.where(reject[:, None], xs, vocab_size)
+                if lantern:
+                    removed_neighbours = torch.where((reject & zero_neighbours)[:, None], neighbours[:, s], vocab_size)
+                    removed = torch.cat((removed, removed_neighbours), dim=-1)
+                # a token listed twice only gives its mass once
+                removed = removed.sort(dim=-1).values
+                unique = removed < vocab_size
+                unique[:, 1:] &= removed[:, 1:] != removed[:, :-1]
+                removed = torch.where(unique, removed, vocab_size)
+
+                mass = mass - (residual_values(removed.clamp(max=vocab_size - 1)) * unique).sum(dim=-1)
+                gtp.scatter_(1, removed, -(epoch[:, None] + 1).expand(removed.shape))
+                # NOTE : the mass is updated incrementally, so a vanished residual is detected up to rounding
+                vanished = reject & (mass <= 1e-6)
+                epoch = epoch + vanished
+                mass = torch.where(vanished, float(vocab_size), mass)
+
+            adjust = adjust | reject
+            next_row = torch.where(accept, j[:, s], next_row)
+            accepted = accepted | accept
+
+        if eagle_v1:
+            residual = gtp[:, :vocab_size]
+        else:
+            residual = residual_values(torch.arange(vocab_size, device=device).expand(batch_size, vocab_size))
+            residual_mass = residual.sum(dim=-1, keepdim=True)
+            residual = torch.where(residual_mass > 0, residual / residual_mass, 1.0 / vocab_size)
+
+        last_adjust = torch.where(alive, adjust, last_adjust)
+        last_gtp = torch.where(alive[:, None], residual, last_gtp)
+        alive = alive & accepted
+        cur_row = torch.where(alive, next_row, cur_row)
+        accept_length = accept_length + alive.long()
+
+    use_residual = last_adjust & (accept_length != path_len)
+    target_p = torch.softmax(logits[rows, cur_row, accept_length - 1].float(), dim=-1)
+    sample_p = torch.where(use_residual[:, None], last_gtp, target_p)
+    if tree_depths is not None:
+        # the tokens forced after the last accepted node are accepted as well; `sample_p` is the distribution of the
+        # next drafted depth
+        accept_length = tree_depths.to(device).gather(1, accept_length[:, None])[:, 0]
+
+    best_candidate, accept_length = torch.stack((cur_row, accept_length)).tolist()
+    return best_candidate, [length - 1 for length in accept_length], sample_p
@@ -31,7 +31,8 @@ from transformers.activations import ACT2FN
 from models.configs.configuration_anole import ChameleonConfig
 
 from models.configs.configs import EConfigAnole as EConfig
-from .choices import *
+from .kv_cache import KVCache, TreeAttentionMask
+from .tree_buffers import get_drafter_tree_buffers
 
 TOPK=10
 
@@ -47,135 +48,8 @@ def cfg_logit_process(combined_logits, cfg_scale=4.0):
     return logits
 
 
-class node:
-    def __init__(self,parent=None,value=None,dict_key=None):
-        self.parent=parent
-        self.value=value
-        if parent:
-            self.depth=parent.depth+1
-            parent.children.append(self)
-        else:
-            self.depth=0
-        self.children=[]
-        self.dict_key=dict_key
-    def is_leaf(self):
-        return len(self.children)==0
-
-    def all_index(self):
-        if not self.parent.parent:
-            return [self.index]
-        else:
-            return self.parent.all_index()+[self.index]
-
-class Tree:
-    def __init__(self,tree_list):
-        sorted_tree_list = sorted(tree_list, key=lambda x: (len(x), x))
-        self.root=node()
-        self.node_dic={}
-        for tree_node in sorted_tree_list:
-            cur_value=tree_node[-1]
-            if len(tree_node)==1:
-                cur_node=node(parent=self.root,value=cur_value,dict_key=tuple(tree_node))
-            else:
-                cur_parent=self.node_dic[tuple(tree_node[:-1])]
-                cur_node = node(parent=cur_parent, value=cur_value,dict_key=tuple(tree_node))
-            self.node_dic[tuple(tree_node)] = cur_node
-        self.indexnode()
-
-    def max_depth(self):
-        return max([item.depth for item in self.node_dic.values()])
-
-    def num_node_wchild(self):
-        num_c=0
-        for item in self.node_dic.values():
-            if not item.is_leaf():
-                num_c+=1
-        return num_c
-
-    def get_node_wchild(self):
-        ns=[]
-        for item in self.node_dic.values():
-            if not item.is_leaf():
-                ns.append(item)
-        return ns
-
-    def indexnode(self):
-        cur_index=0
-        for key in self.node_dic:
-            cur_node=self.node_dic[key]
-            if not cur_node.is_leaf():
-                cur_node.index=cur_index
-                cur_index+=1
-
 def generate_tree_buffers(tree_choices, device="cuda"):
-    tree=Tree(tree_choices)
-    sorted_tree_choices = sorted(tree_choices, key=lambda x: (len(x), x))
-    tree_len = tree.num_node_wchild()
-
-
-    max_depth=tree.max_depth()
-    nodes_wc=tree.get_node_wchild()
-
-    depth_counts=[0 for _ in range(max_depth-1)]
-    for x in nodes_wc:
-        depth_counts[x.depth-1]+=1
-    depth_counts_sum = [sum(depth_counts[:i + 1]) for i in range(len(depth_counts))]
-
-    tree_attn_mask = torch.eye(tree_len, tree_len)
-
-    for id,x in enumerate(nodes_wc):
-        tree_attn_mask[id,x.all_index()]=1
-
-    tree_attn_mask_list0=[tree_attn_mask[:ml,:ml] for ml in depth_counts_sum]
-    tree_attn_mask_list=[]
-    for id,x in enumerate(tree_attn_mask_list0):
-        x=x[-depth_counts[id]:]
-        tree_attn_mask_list.append(x)
-
-    tree_indices_list = [torch.zeros(ml, dtype=torch.long) for ml in depth_counts]
-    repeat_nums=[[] for _ in depth_counts]
-    start = 0
-    bias = 0
-    for i in range(len(depth_counts)):
-        bias = 0
-        repeat_j=0
-        for j in range(depth_counts[i]):
-            cur_node = nodes_wc[start + j]
-            cur_parent = cur_node.parent
-
-            if j != 0:
-                if cur_parent != parent:
-                    bias += 1
-                    parent = cur_parent
-                    repeat_nums[i].append(j-repeat_j)
-                    repeat_j=j
-            else:
-                parent = cur_parent
-            tree_indices_list[i][j] = cur_node.value + TOPK * (bias)
-        repeat_nums[i].append(j - repeat_j+1)
-        start += depth_counts[i]
-
-    position_ids = [torch.zeros(ml, dtype=torch.long) for ml in depth_counts]
-
-    tree_buffers = {
-        "attn_mask": [i.unsqueeze(0).unsqueeze(0) for i in tree_attn_mask_list],
-        "tree_indices": tree_indices_list,
-        "position_ids":position_ids,
-        "repeat_nums":repeat_nums
-    }
-
-    # Move the tensors in the dictionary to the specified device
-    tree_buffers = {
-        k: [i.clone().to(device) for i in v]
-        if isinstance(v[0], torch.Tensor)
-        else (
-            torch.tensor(v, device=device)
-            if isinstance(v, torch.Tensor)
-            else v
-        )
-        for k, v in tree_buffers.items()
-    }
-    return tree_buffers
+    return get_drafter_tree_buffers(tree_choices, device)
 
 # Copied from transformers.models.bart.modeling_bart._make_causal_mask
 def _make_causal_mask(
@@ -402,6 +276,7 @@ class ChameleonAttention(nn.Module):
         output_attentions: bool = False,
         use_cache: bool = True,
         cache_position: Optional[torch.LongTensor] = None,
+        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
         **kwargs,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         bsz, q_len, _ = hidden_states.size()
@@ -420,21 +295,29 @@ class ChameleonAttention(nn.Module):
         key_states = key_states.reshape(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
         value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
 
-        cos, sin = self.rotary_emb(value_states, position_ids)
+        if position_embeddings is not None:
+            # computed once per forward for all layers, see `Model.forward`
+            cos, sin = position_embeddings
+        else:
+            cos, sin = self.rotary_emb(value_states, position_ids)
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
         
         # [MODIFIED] Using KVCache mechanism for preallocated GPU memory optimization
         # past_key_value is utilized to leverage previously computed key and value states.
         # If past_key_value is available, reuse the states for k, v, and self_attention.
-        if past_key_value is not None:
-            # sin and cos are specific to RoPE models; position_ids needed for the static cache
-            # cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}
-            # key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
+        if past_key_value is not None and isinstance(past_key_value[0], KVCache):
+            # preallocated cache of `topK_genrate`, see `Model.init_kv`
+            key_states = past_key_value[0].cat(key_states, dim=2)
+            value_states = past_key_value[1].cat(value_states, dim=2)
+        elif past_key_value is not None:
+            # reuse k, v, self_attention
             key_states = torch.cat([past_key_value[0], key_states], dim=2)
             value_states = torch.cat([past_key_value[1], value_states], dim=2)
 
-        # past_key_value = None
-        past_key_value = (key_states, value_states) if use_cache else None
+        if not use_cache:
+            past_key_value = None
+        elif past_key_value is None or not isinstance(past_key_value[0], KVCache):
+            past_key_value = (key_states, value_states)
 
         key_states = repeat_kv(key_states, self.num_key_value_groups)
         value_states = repeat_kv(value_states, self.num_key_value_groups)
@@ -634,6 +517,10 @@ class Model(nn.Module):
         self.fc = nn.Linear(2 * config.hidden_size, config.hidden_size, bias=bias)
         self.act = ACT2FN[config.hidden_act]
         self.logsoftmax = nn.LogSoftmax(dim=-1)
+        # storage of the preallocated KV cache used by `topK_genrate`; see `init_kv`
+        self.kv_buffers = None
+        # masks of the drafting steps, updated in place; they are reset with the KV cache
+        self.tree_attention_mask = TreeAttentionMask()
         self.non_image_tokens = [i for i in range(0, 4)] + [i for i in range(8196, 65536)]
         self.non_image_tokens = torch.tensor(self.non_image_tokens).to(self.embed_tokens.weight.device)
         for param in self.embed_tokens.parameters():
@@ -648,6 +535,13 @@ class Model(nn.Module):
         self.tree_mask = None
 
     def _prepare_decoder_attention_mask(self, attention_mask, input_shape, inputs_embeds, past_key_values_length):
+        tree_mask = getattr(self, "tree_mask", None)
+        if tree_mask is not None and tree_mask.shape[-2] == input_shape[-1]:
+            # the drafting steps only write the new columns of the prefix and the tree block
+            return self.tree_attention_mask(
+                attention_mask, tree_mask, input_shape, past_key_values_length, torch.float32, inputs_embeds.device
+            )
+
         # create causal mask
         # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
         combined_attention_mask = None
@@ -743,6 +637,8 @@ class Model(nn.Module):
         # hidden_states=self.act(self.fc(torch.cat((inputs_embeds,hidden_states),dim=-1)))
         inputs_embeds = inputs_embeds.to(hidden_states.dtype)
         hidden_states = self.fc(torch.cat((inputs_embeds, hidden_states), dim=-1))
+        # the rotary embeddings of the positions are computed once and shared by all layers
+        position_embeddings = self.layers[0].self_attn.rotary_emb(hidden_states, position_ids)
 
         all_hidden_states = () if output_hidden_states else None
         next_decoder_cache = () if use_cache else None
@@ -776,6 +672,7 @@ class Model(nn.Module):
                     past_key_value=past_key_value,
                     output_attentions=output_attentions,
                     use_cache=use_cache,
+                    position_embeddings=position_embeddings,
                 )
 
             hidden_states = layer_outputs[0]
@@ -790,6 +687,43 @@ class Model(nn.Module):
 
     def reset_kv(self):
         self.stable_kv = None
+        self.tree_attention_mask.reset()
+
+    def init_kv(self, batch_size):
+        """
+        Initialize the KV cache of `topK_genrate` for a drafter batch, reusing the storage of the previous one if it
+        has the same shape.
+
+        The keys and values are written in place into a buffer of `max_position_embeddings` positions, so that the
+        drafter does not copy its whole cache at every step. The entries of the draft tree are appended after the
+        committed positions and rolled back at the end of `topK_genrate`.
+
+        Args:
+            batch_size (int): Number of rows of the drafter batch, i.e., the conditional and unconditional rows.
+
+        Returns:
+            list: A pair of KVCache (key and value) for each layer.
+        """
+        self_attn = self.layers[0].self_attn
+        shape = (
+            2 * len(self.layers),
+            batch_size,
+            self_attn.num_key_value_heads,
+            self_attn.max_position_embeddings,
+            self_attn.head_dim,
+        )
+        if self.kv_buffers is None or self.kv_buffers[0].shape != shape:
+            data = torch.zeros(shape, dtype=self.fc.weight.dtype, device=self.fc.weight.device)
+            # [IMPORTANT] the lengths are kept on CPU for quick access and updates
+            current_length_data = torch.zeros(2 * len(self.layers), dtype=torch.long, device="cpu")
+            self.kv_buffers = (data, current_length_data)
+
+        data, current_length_data = self.kv_buffers
+        current_length_data.zero_()
+        return [
+            [KVCache(data[2 * i + j], current_length_data[2 * i + j]) for j in range(2)]
+            for i in range(len(self.layers))
+        ]
 
     @torch.no_grad()
     def topK_genrate(self, hidden_states, input_ids, head, logits_processor, cfg_scale, input_position_diff, attention_mask= None):
@@ -812,24 +746,19 @@ class Model(nn.Module):
         self.reset()
 
         # with Timer("draft many"):
-        if hasattr(self, "stable_kv") and self.stable_kv is not None:
-            kv_len = self.stable_kv[0][0].shape[2]
-            position_ids = torch.arange(kv_len, input_ids.shape[1], device=hidden_states.device).unsqueeze(0)
-            uncond_position_ids = position_ids - input_position_diff
-            uncond_position_ids = torch.clamp(uncond_position_ids, 0)
-            uncond_position_ids = uncond_position_ids.to(hidden_states.device)
-            position_ids = torch.cat([position_ids, uncond_position_ids])
-            out_hidden, past_key_values = self(hidden_states, input_ids=input_ids[:, kv_len:],
-                                               past_key_values=self.stable_kv, use_cache=True, attention_mask=attention_mask, position_ids=position_ids)
-        else:
-            position_ids = torch.arange(input_ids.shape[1], device=hidden_states.device)
-            position_ids = position_ids.unsqueeze(0)
-            uncond_position_ids = position_ids - input_position_diff
-            uncond_position_ids = torch.clamp(uncond_position_ids, 0)
-            uncond_position_ids = uncond_position_ids.to(hidden_states.device)
-            position_ids = torch.cat([position_ids, uncond_position_ids])
-            out_hidden, past_key_values = self(hidden_states, input_ids=input_ids, use_cache=True, attention_mask=attention_mask, position_ids=position_ids)
-        self.stable_kv = past_key_values
+        if not hasattr(self, "stable_kv") or self.stable_kv is None:
+            self.stable_kv = self.init_kv(hidden_states.shape[0])
+        # the hidden states are only given for the positions that are not in the cache yet
+        kv_len = self.stable_kv[0][0].shape[2]
+        position_ids = torch.arange(kv_len, input_ids.shape[1], device=hidden_states.device).unsqueeze(0)
+        uncond_position_ids = position_ids - input_position_diff
+        uncond_position_ids = torch.clamp(uncond_position_ids, 0)
+        uncond_position_ids = uncond_position_ids.to(hidden_states.device)
+        position_ids = torch.cat([position_ids, uncond_position_ids])
+        out_hidden, past_key_values = self(hidden_states, input_ids=input_ids[:, kv_len:],
+                                           past_key_values=self.stable_kv, use_cache=True, attention_mask=attention_mask, position_ids=position_ids)
+        # the draft tree is appended after the committed positions and rolled back below
+        stable_kv_len = input_ids.shape[1]
         last_hidden = out_hidden[:, -1]
 
         last_headout = head(last_hidden)
@@ -910,10 +839,13 @@ class Model(nn.Module):
 
         # with Timer("post"):
 
+        self.kv_buffers[1].fill_(stable_kv_len)
+
         scores_list = torch.cat(scores_list, dim=0).view(-1)
         ss_token_list = torch.cat(ss_token, dim=0).view(-1)
-        top_scores = torch.topk(scores_list, total_tokens, dim=-1)
-        top_scores_index = top_scores.indices
+        # a confident child ties with its parent, which comes first in `scores_list`; the stable sort keeps the parent
+        # of every selected node
+        top_scores_index = torch.sort(scores_list, dim=-1, descending=True, stable=True).indices[:total_tokens]
         top_scores_index = torch.sort(top_scores_index).values
 
         draft_tokens = ss_token_list[top_scores_index]
@@ -1081,24 +1013,18 @@ class Model(nn.Module):
         len_posi=input_ids.shape[1]
         self.reset()
 
-        if hasattr(self, "stable_kv") and self.stable_kv is not None:
-            kv_len=self.stable_kv[0][0].shape[2]
-            position_ids = torch.arange(kv_len, input_ids.shape[1], device=hidden_states.device).unsqueeze(0)
-            uncond_position_ids = position_ids - input_position_diff
-            uncond_position_ids = torch.clamp(uncond_position_ids, 0)
-            uncond_position_ids = uncond_position_ids.to(hidden_states.device)
-            position_ids = torch.cat([position_ids, uncond_position_ids])
-            out_hidden, past_key_values = self(hidden_states, input_ids=input_ids[:,kv_len:], past_key_values=self.stable_kv,use_cache=True,
-                                               attention_mask=attention_mask,position_ids=position_ids)
-        else:
-            position_ids = torch.arange(input_ids.shape[1], device=hidden_states.device)
-            position_ids = position_ids.unsqueeze(0)
-            uncond_position_ids = position_ids - input_position_diff
-            uncond_position_ids = torch.clamp(uncond_position_ids, 0)
-            uncond_position_ids = uncond_position_ids.to(hidden_states.device)
-            position_ids = torch.cat([position_ids, uncond_position_ids])
-            out_hidden, past_key_values = self(hidden_states, input_ids=input_ids, use_cache=True, attention_mask=attention_mask,position_ids=position_ids)
-        self.stable_kv=past_key_values
+        if not hasattr(self, "stable_kv") or self.stable_kv is None:
+            self.stable_kv = self.init_kv(hidden_states.shape[0])
+        kv_len=self.stable_kv[0][0].shape[2]
+        position_ids = torch.arange(kv_len, input_ids.shape[1], device=hidden_states.device).unsqueeze(0)
+        uncond_position_ids = position_ids - input_position_diff
+        uncond_position_ids = torch.clamp(uncond_position_ids, 0)
+        uncond_position_ids = uncond_position_ids.to(hidden_states.device)
+        position_ids = torch.cat([position_ids, uncond_position_ids])
+        out_hidden, past_key_values = self(hidden_states, input_ids=input_ids[:,kv_len:], past_key_values=self.stable_kv,use_cache=True,
+                                           attention_mask=attention_mask,position_ids=position_ids)
+        # the draft tree is appended after the committed positions and rolled back below
+        stable_kv_len = input_ids.shape[1]
         last_hidden = out_hidden[:, -1]
         if not self.diff_device:
             last_headout = head(last_hidden)
@@ -1168,6 +1094,8 @@ class Model(nn.Module):
         ss_prob.append(topk_prob)
         ss_op.append(op)
 
+        self.kv_buffers[1].fill_(stable_kv_len)
+
         return (torch.cat(ss_token),torch.cat(ss_prob),ss_op)
 
 class Vhead(nn.Module):
@@ -33,6 +33,7 @@ from transformers.activations import ACT2FN
 from models.configs.configs import EConfig
 from .utils_c import *
 from .choices import *
+from .kv_cache import KVCache, TreeAttentionMask
 
 
 def cfg_logit_process(combined_logits, cfg_scale=4.0):
@@ -322,12 +323,19 @@ class LlamaAttention(nn.Module):
         query_states = apply_rotary_emb(query_states.transpose(1, 2), freqs_cis.to(query_states.device)).transpose(1, 2)
         key_states = apply_rotary_emb(key_states.transpose(1, 2), freqs_cis.to(key_states.device)).transpose(1, 2)
         
-        if past_key_value is not None:
+        if past_key_value is not None and isinstance(past_key_value[0], KVCache):
+            # preallocated cache of `topK_genrate`, see `Model.init_kv`
+            key_states = past_key_value[0].cat(key_states, dim=2)
+            value_states = past_key_value[1].cat(value_states, dim=2)
+        elif past_key_value is not None:
             # reuse k, v, self_attention
             key_states = torch.cat([past_key_value[0], key_states], dim=2)
             value_states = torch.cat([past_key_value[1], value_states], dim=2)
 
-        past_key_value = (key_states, value_states) if use_cache else None
+        if not use_cache:
+            past_key_value = None
+        elif past_key_value is None or not isinstance(past_key_value[0], KVCache):
+            past_key_value = (key_states, value_states)
 
         # repeat k/v heads if n_kv_heads < n_heads
         key_states = repeat_kv(key_states, self.num_key_value_groups)
@@ -556,6 +564,10 @@ class Model(nn.Module):
         self.fc = nn.Linear(2 * config.hidden_size, config.hidden_size, bias=bias)
         self.act = ACT2FN[config.hidden_act]
         self.logsoftmax = nn.LogSoftmax(dim=-1)
+        # storage of the preallocated KV cache used by `topK_genrate`; see `init_kv`
+        self.kv_buffers = None
+        # masks of the drafting steps, updated in place; they are reset with the KV cache
+        self.tree_attention_mask = TreeAttentionMask()
         for param in self.embed_tokens.parameters():
             param.requires_grad = False
         # ! manually set the block size
@@ -590,6 +602,13 @@ class Model(nn.Module):
         self.tree_mask = None
 
     def _prepare_decoder_attention_mask(self, attention_mask, input_shape, inputs_embeds, past_key_values_length):
+        tree_mask = getattr(self, "tree_mask", None)
+        if tree_mask is not None and tree_mask.shape[-2] == input_shape[-1]:
+            # the drafting steps only write the new columns of the prefix and the tree block
+            return self.tree_attention_mask(
+                attention_mask, tree_mask, input_shape, past_key_values_length, torch.float32, inputs_embeds.device
+            )
+
         # create causal mask
         # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
         combined_attention_mask = None
@@ -727,6 +746,43 @@ class Model(nn.Module):
 
     def reset_kv(self):
         self.stable_kv = None
+        self.tree_attention_mask.reset()
+
+    def init_kv(self, batch_size):
+        """
+        Initialize the KV cache of `topK_genrate` for a drafter batch, reusing the storage of the previous one if it
+        has the same shape.
+
+        The keys and values are written in place into a buffer of `max_position_embeddings` positions, so that the
+        drafter does not copy its whole cache at every step. The entries of the draft tree are appended after the
+        committed positions and rolled back at the end of `topK_genrate`.
+
+        Args:
+            batch_size (int): Number of rows of the drafter batch, i.e., the conditional and unconditional rows.
+
+        Returns:
+            list: A pair of KVCache (key and value) for each layer.
+        """
+        self_attn = self.layers[0].self_attn
+        shape = (
+            2 * len(self.layers),
+            batch_size,
+            self_attn.num_key_value_heads,
+            self_attn.max_position_embeddings,
+            self_attn.head_dim,
+        )
+        if self.kv_buffers is None or self.kv_buffers[0].shape != shape:
+            data = torch.zeros(shape, dtype=self.fc.weight.dtype, device=self.fc.weight.device)
+            # [IMPORTANT] the lengths are kept on CPU for quick access and updates
+            current_length_data = torch.zeros(2 * len(self.layers), dtype=torch.long, device="cpu")
+            self.kv_buffers = (data, current_length_data)
+
+        data, current_length_data = self.kv_buffers
+        current_length_data.zero_()
+        return [
+            [KVCache(data[2 * i + j], current_length_data[2 * i + j]) for j in range(2)]
+            for i in range(len(self.layers))
+        ]
 
     @torch.no_grad()
     def topK_genrate(self, hidden_states, input_ids, head, logits_processor, cfg_scale):
@@ -747,14 +803,15 @@ class Model(nn.Module):
         len_posi = input_ids.shape[1]
         self.reset()
         # with Timer("draft many"):
-        if hasattr(self, "stable_kv") and self.stable_kv is not None:
-            kv_len = self.stable_kv[0][0].shape[2]
-            position_ids = torch.arange(kv_len, input_ids.shape[1], device=hidden_states.device).unsqueeze(0)
-            out_hidden, past_key_values = self(hidden_states, input_ids=input_ids[:, kv_len:],
-                                               past_key_values=self.stable_kv, use_cache=True, position_ids=position_ids)
-        else:
-            out_hidden, past_key_values = self(hidden_states, input_ids=input_ids, use_cache=True)
-        self.stable_kv = past_key_values
+        if not hasattr(self, "stable_kv") or self.stable_kv is None:
+            self.stable_kv = self.init_kv(hidden_states.shape[0])
+        # the hidden states are only given for the positions that are not in the cache yet
+        kv_len = self.stable_kv[0][0].shape[2]
+        position_ids = torch.arange(kv_len, input_ids.shape[1], device=hidden_states.device).unsqueeze(0)
+        out_hidden, past_key_values = self(hidden_states, input_ids=input_ids[:, kv_len:],
+                                           past_key_values=self.stable_kv, use_cache=True, position_ids=position_ids)
+        # the draft tree is appended after the committed positions and rolled back below
+        stable_kv_len = input_ids.shape[1]
         last_hidden = out_hidden[:, -1]
 
         last_headout = head(last_hidden)
@@ -828,10 +885,13 @@ class Model(nn.Module):
 
         # with Timer("post"):
 
+        self.kv_buffers[1].fill_(stable_kv_len)
+
         scores_list = torch.cat(scores_list, dim=0).view(-1)
         ss_token_list = torch.cat(ss_token, dim=0).view(-1)
-        top_scores = torch.topk(scores_list, total_tokens, dim=-1)
-        top_scores_index = top_scores.indices
+        # a confident child ties with its parent, which comes first in `scores_list`; the stable sort keeps the parent
+        # of every selected node
+        top_scores_index = torch.sort(scores_list, dim=-1, descending=True, stable=True).indices[:total_tokens]
         top_scores_index = torch.sort(top_scores_index).values
 
         draft_tokens = ss_token_list[top_scores_index]
@@ -950,14 +1010,14 @@ class Model(nn.Module):
         len_posi=input_ids.shape[1]
         self.reset()
 
-        if hasattr(self, "stable_kv") and self.stable_kv is not None:
-            kv_len=self.stable_kv[0][0].shape[2]
-            position_ids = torch.arange(kv_len, input_ids.shape[1], device=hidden_states.device).unsqueeze(0)
-            out_hidden, past_key_values = self(hidden_states, input_ids=input_ids[:,kv_len:], position_ids=position_ids, 
-                                               past_key_values=self.stable_kv,use_cache=True)
-        else:
-            out_hidden, past_key_values = self(hidden_states, input_ids=input_ids, use_cache=True)
-        self.stable_kv=past_key_values
+        if not hasattr(self, "stable_kv") or self.stable_kv is None:
+            self.stable_kv = self.init_kv(hidden_states.shape[0])
+        kv_len=self.stable_kv[0][0].shape[2]
+        position_ids = torch.arange(kv_len, input_ids.shape[1], device=hidden_states.device).unsqueeze(0)
+        out_hidden, past_key_values = self(hidden_states, input_ids=input_ids[:,kv_len:], position_ids=position_ids,
+                                           past_key_values=self.stable_kv,use_cache=True)
+        # the draft tree is appended after the committed positions and rolled back below
+        stable_kv_len = input_ids.shape[1]
         last_hidden = out_hidden[:, -1]
         if not self.diff_device:
             last_headout = head(last_hidden)
@@ -1020,6 +1080,8 @@ class Model(nn.Module):
         ss_prob.append(topk_prob)
         ss_op.append(op)
 
+        self.kv_buffers[1].fill_(stable_kv_len)
+
         return (torch.cat(ss_token),torch.cat(ss_prob),ss_op)
 
     @torch.no_grad()
@@ -14,6 +14,8 @@ from models.configs.configuration_lumina_mgpt import ChameleonConfig
 from models.configs.configs import EConfig    
 # from .utils_c import *
 from .choices import *
+from .kv_cache import KVCache, TreeAttentionMask, restore_past_key_values
+from .tree_buffers import get_drafter_tree_buffers
 
 TOPK=10
 
@@ -43,135 +45,8 @@ def pad_path(path: List[int], length: int, pad_value: int = -2) -> List[int]:
     # Append the padding values to the original path and return the new list.
     return path + [pad_value] * (length - len(path))
 
-class node:
-    def __init__(self,parent=None,value=None,dict_key=None):
-        self.parent=parent
-        self.value=value
-        if parent:
-            self.depth=parent.depth+1
-            parent.children.append(self)
-        else:
-            self.depth=0
-        self.children=[]
-        self.dict_key=dict_key
-    def is_leaf(self):
-        return len(self.children)==0
-
-    def all_index(self):
-        if not self.parent.parent:
-            return [self.index]
-        else:
-            return self.parent.all_index()+[self.index]
-
-class Tree:
-    def __init__(self,tree_list):
-        sorted_tree_list = sorted(tree_list, key=lambda x: (len(x), x))
-        self.root=node()
-        self.node_dic={}
-        for tree_node in sorted_tree_list:
-            cur_value=tree_node[-1]
-            if len(tree_node)==1:
-                cur_node=node(parent=self.root,value=cur_value,dict_key=tuple(tree_node))
-            else:
-                cur_parent=self.node_dic[tuple(tree_node[:-1])]
-                cur_node = node(parent=cur_parent, value=cur_value,dict_key=tuple(tree_node))
-            self.node_dic[tuple(tree_node)] = cur_node
-        self.indexnode()
-
-    def max_depth(self):
-        return max([item.depth for item in self.node_dic.values()])
-
-    def num_node_wchild(self):
-        num_c=0
-        for item in self.node_dic.values():
-            if not item.is_leaf():
-                num_c+=1
-        return num_c
-
-    def get_node_wchild(self):
-        ns=[]
-        for item in self.node_dic.values():
-            if not item.is_leaf():
-                ns.append(item)
-        return ns
-
-    def indexnode(self):
-        cur_index=0
-        for key in self.node_dic:
-            cur_node=self.node_dic[key]
-            if not cur_node.is_leaf():
-                cur_node.index=cur_index
-                cur_index+=1
-
 def generate_tree_buffers(tree_choices, device="cuda"):
-    tree=Tree(tree_choices)
-    sorted_tree_choices = sorted(tree_choices, key=lambda x: (len(x), x))
-    tree_len = tree.num_node_wchild()
-
-
-    max_depth=tree.max_depth()
-    nodes_wc=tree.get_node_wchild()
-
-    depth_counts=[0 for _ in range(max_depth-1)]
-    for x in nodes_wc:
-        depth_counts[x.depth-1]+=1
-    depth_counts_sum = [sum(depth_counts[:i + 1]) for i in range(len(depth_counts))]
-
-    tree_attn_mask = torch.eye(tree_len, tree_len)
-
-    for id,x in enumerate(nodes_wc):
-        tree_attn_mask[id,x.all_index()]=1
-
-    tree_attn_mask_list0=[tree_attn_mask[:ml,:ml] for ml in depth_counts_sum]
-    tree_attn_mask_list=[]
-    for id,x in enumerate(tree_attn_mask_list0):
-        x=x[-depth_counts[id]:]
-        tree_attn_mask_list.append(x)
-
-    tree_indices_list = [torch.zeros(ml, dtype=torch.long) for ml in depth_counts]
-    repeat_nums=[[] for _ in depth_counts]
-    start = 0
-    bias = 0
-    for i in range(len(depth_counts)):
-        bias = 0
-        repeat_j=0
-        for j in range(depth_counts[i]):
-            cur_node = nodes_wc[start + j]
-            cur_parent = cur_node.parent
-
-            if j != 0:
-                if cur_parent != parent:
-                    bias += 1
-                    parent = cur_parent
-                    repeat_nums[i].append(j-repeat_j)
-                    repeat_j=j
-            else:
-                parent = cur_parent
-            tree_indices_list[i][j] = cur_node.value + TOPK * (bias)
-        repeat_nums[i].append(j - repeat_j+1)
-        start += depth_counts[i]
-
-    position_ids = [torch.zeros(ml, dtype=torch.long) for ml in depth_counts]
-
-    tree_buffers = {
-        "attn_mask": [i.unsqueeze(0).unsqueeze(0) for i in tree_attn_mask_list],
-        "tree_indices": tree_indices_list,
-        "position_ids":position_ids,
-        "repeat_nums":repeat_nums
-    }
-
-    # Move the tensors in the dictionary to the specified device
-    tree_buffers = {
-        k: [i.clone().to(device) for i in v]
-        if isinstance(v[0], torch.Tensor)
-        else (
-            torch.tensor(v, device=device)
-            if isinstance(v, torch.Tensor)
-            else v
-        )
-        for k, v in tree_buffers.items()
-    }
-    return tree_buffers
+    return get_drafter_tree_buffers(tree_choices, device)
 
 # Copied from transformers.models.bart.modeling_bart._make_causal_mask
 def _make_causal_mask(
@@ -297,6 +172,27 @@ class LlamaRotaryEmbedding(nn.Module):
             self.sin_cached[:, :, :seq_len, ...].to(dtype=x.dtype),
         )
 
+    def gather(self, position_ids, seq_len, dtype):
+        """
+        Gather the cosine and sine embeddings of the given positions from the cached table, once for all layers.
+
+        Args:
+            position_ids (torch.Tensor): Position IDs of shape [bs, seq_len].
+            seq_len (int): The sequence length with the past. If greater than the cached length, the cache will be
+                updated.
+            dtype: The data type of the embeddings.
+
+        Returns:
+            tuple: A tuple containing two tensors, the cosine and sine embeddings, both of shape [bs, 1, seq_len, dim].
+        """
+        if seq_len > self.max_seq_len_cached:
+            self._set_cos_sin_cache(seq_len=seq_len, device=position_ids.device, dtype=dtype)
+
+        return (
+            self.cos_cached[0, 0][position_ids].unsqueeze(1).to(dtype=dtype),
+            self.sin_cached[0, 0][position_ids].unsqueeze(1).to(dtype=dtype),
+        )
+
 # class ChameleonRotaryEmbedding(nn.Module):
 #     def __init__(self, dim, max_position_embeddings=2048, base=10000, device=None, scaling_factor=1.0):
 #         super().__init__()
@@ -332,7 +228,7 @@ def rotate_half(x):
     x2 = x[..., x.shape[-1] // 2 :]
     return torch.cat((-x2, x1), dim=-1)
 
-def apply_rotary_pos_emb(q, k, cos, sin, position_ids):
+def apply_rotary_pos_emb(q, k, cos, sin, position_ids=None):
     """
     Apply rotary position embeddings to query and key tensors.
 
@@ -341,15 +237,17 @@ def apply_rotary_pos_emb(q, k, cos, sin, position_ids):
         k (torch.Tensor): Key tensor.
         cos (torch.Tensor): Cosine values.
         sin (torch.Tensor): Sine values.
-        position_ids (torch.Tensor): Position IDs.
+        position_ids (torch.Tensor, optional): Position IDs. If None, `cos` and `sin` are already gathered at the
+            positions of the tokens (see `LlamaRotaryEmbedding.gather`).
 
     Returns:
         torch.Tensor: Query and key tensors with rotary position embeddings applied.
     """
-    cos = cos.squeeze(1).squeeze(0)
-    sin = sin.squeeze(1).squeeze(0)
-    cos = cos[position_ids].unsqueeze(1)
-    sin = sin[position_ids].unsqueeze(1)
+    if position_ids is not None:
+        cos = cos.squeeze(1).squeeze(0)
+        sin = sin.squeeze(1).squeeze(0)
+        cos = cos[position_ids].unsqueeze(1)
+        sin = sin[position_ids].unsqueeze(1)
     q_embed = (q * cos) + (rotate_half(q) * sin)
     k_embed = (k * cos) + (rotate_half(k) * sin)
     return q_embed, k_embed
@@ -475,6 +373,7 @@ class ChameleonAttention(nn.Module):
         output_attentions: bool = False,
         use_cache: bool = False,
         cache_position: Optional[torch.LongTensor] = None,
+        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
         **kwargs,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         bsz, q_len, _ = hidden_states.size()
@@ -493,20 +392,32 @@ class ChameleonAttention(nn.Module):
         key_states = key_states.reshape(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
         value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
 
-        kv_seq_len = key_states.shape[-2]
-        if past_key_value is not None:
-            kv_seq_len += past_key_value[0].shape[-2]
-        cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
-        query_states, key_states = apply_rotary_pos_emb(
-            query_states, key_states, cos, sin, position_ids
-        )
+        if position_embeddings is not None:
+            # gathered once per forward for all layers, see `LlamaRotaryEmbedding.gather`
+            cos, sin = position_embeddings
+            query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
+        else:
+            kv_seq_len = key_states.shape[-2]
+            if past_key_value is not None:
+                kv_seq_len += past_key_value[0].shape[-2]
+            cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
+            query_states, key_states = apply_rotary_pos_emb(
+                query_states, key_states, cos, sin, position_ids
+            )
 
-        if past_key_value is not None:
+        if past_key_value is not None and isinstance(past_key_value[0], KVCache):
+            # preallocated cache of `topK_generate`, see `Model.init_kv`
+            key_states = past_key_value[0].cat(key_states, dim=2)
+            value_states = past_key_value[1].cat(value_states, dim=2)
+        elif past_key_value is not None:
             # reuse k, v, self_attention
             key_states = torch.cat([past_key_value[0], key_states], dim=2)
             value_states = torch.cat([past_key_value[1], value_states], dim=2)
         
-        past_key_value = (key_states, value_states) if use_cache else None
+        if not use_cache:
+            past_key_value = None
+        elif past_key_value is None or not isinstance(past_key_value[0], KVCache):
+            past_key_value = (key_states, value_states)
 
         key_states = repeat_kv(key_states, self.num_key_value_groups)
         value_states = repeat_kv(value_states, self.num_key_value_groups)
@@ -674,6 +585,8 @@ class ChameleonSdpaAttention(ChameleonAttention):
         output_attentions: bool = False,
         use_cache: bool = False,
         cache_position: Optional[torch.LongTensor] = None,
+        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        **kwargs,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         if output_attentions:
             # TODO: Improve this warning with e.g. `model.config.attn_implementation = "manual"` once this is implemented.
@@ -689,6 +602,7 @@ class ChameleonSdpaAttention(ChameleonAttention):
                 output_attentions=output_attentions,
                 use_cache=use_cache,
                 cache_position=cache_position,
+                position_embeddings=position_embeddings,
             )
 
         bsz, q_len, _ = hidden_states.size()
@@ -707,20 +621,32 @@ class ChameleonSdpaAttention(ChameleonAttention):
         key_states = key_states.reshape(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
         value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
 
-        kv_seq_len = key_states.shape[-2]
-        if past_key_value is not None:
-            kv_seq_len += past_key_value[0].shape[-2]
-        cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
-        query_states, key_states = apply_rotary_pos_emb(
-            query_states, key_states, cos, sin, position_ids
-        )
+        if position_embeddings is not None:
+            # gathered once per forward for all layers, see `LlamaRotaryEmbedding.gather`
+            cos, sin = position_embeddings
+            query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
+        else:
+            kv_seq_len = key_states.shape[-2]
+            if past_key_value is not None:
+                kv_seq_len += past_key_value[0].shape[-2]
+            cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
+            query_states, key_states = apply_rotary_pos_emb(
+                query_states, key_states, cos, sin, position_ids
+            )
 
-        if past_key_value is not None:
+        if past_key_value is not None and isinstance(past_key_value[0], KVCache):
+            # preallocated cache of `topK_generate`, see `Model.init_kv`
+            key_states = past_key_value[0].cat(key_states, dim=2)
+            value_states = past_key_value[1].cat(value_states, dim=2)
+        elif past_key_value is not None:
             # reuse k, v, self_attention
             key_states = torch.cat([past_key_value[0], key_states], dim=2)
             value_states = torch.cat([past_key_value[1], value_states], dim=2)
         
-        past_key_value = (key_states, value_states) if use_cache else None
+        if not use_cache:
+            past_key_value = None
+        elif past_key_value is None or not isinstance(past_key_value[0], KVCache):
+            past_key_value = (key_states, value_states)
 
         key_states = repeat_kv(key_states, self.num_key_value_groups)
         value_states = repeat_kv(value_states, self.num_key_value_groups)
@@ -954,6 +880,183 @@ def sample(logits, k=1):
 
     return sampled_indices, sampled_probs, probabilities
 
+def stack_retrieve_indices(retrieve_indices_list):
+    # inputs:
+    #   - retrieve_indices_list: list of [num_leaves, max_depth] retrieve indices (tensors or nested lists), one per row
+    # Pads the retrieve indices of every row to the same shape; missing depths are filled with -1 and missing leaves
+    # repeat the last path of the row so that they are never visited by the posterior evaluation
+    device = retrieve_indices_list[0].device if isinstance(retrieve_indices_list[0], torch.Tensor) else "cpu"
+    retrieve_indices_list = [
+        indices.tolist() if isinstance(indices, torch.Tensor) else indices for indices in retrieve_indices_list
+    ]
+    max_depth = max(len(indices[0]) for indices in retrieve_indices_list)
+    max_leaves = max(len(indices) for indices in retrieve_indices_list)
+
+    retrieve_indices = []
+    for row_retrieve_indices in retrieve_indices_list:
+        row_retrieve_indices = [path + [-1] * (max_depth - len(path)) for path in row_retrieve_indices]
+        row_retrieve_indices += [row_retrieve_indices[-1]] * (max_leaves - len(row_retrieve_indices))
+        retrieve_indices.append(row_retrieve_indices)
+    return torch.tensor(retrieve_indices, dtype=torch.long, device=device) # [batch_size, max_leaves, max_depth]
+
+def splice_forced_tokens(tree_tokens, tree_position_ids, tree_mask, retrieve_indices, forced_tokens, tree_depths):
+    # inputs:
+    #   - tree_tokens: [B, num_nodes] drafted tree, the root first
+    #   - tree_position_ids: [B, num_nodes] drafted depth of every node
+    #   - tree_mask: [B, 1, num_nodes, num_nodes] ancestors of every node, itself included
+    #   - retrieve_indices: [B, num_paths, path_len] root-to-leaf paths of the drafted tree, padded with -1
+    #   - forced_tokens, tree_depths: the forced tokens and drafted depths of `Model.forced_depths`
+    # The tree is drafted without the new line and image end tokens, which are forced at known positions. They are
+    # inserted back for the verification as chains of fixed nodes: every drafted node is followed by the tokens forced
+    # before the next drafted depth, its children hang off the end of its chain, and the chain nodes come after the
+    # drafted nodes. Their number is rounded up to a power of two to bound the number of shapes of the verified tree.
+    # Returns the tokens [B, num_verified], depths [B, num_verified] and mask [B, 1, num_verified, num_verified] of
+    # the verified tree, its root-to-leaf paths [B, num_paths, verified_len] (padded with -1) and, for every node of
+    # `retrieve_indices`, the node of the verified tree whose logits predict the next drafted token
+    # [B, num_paths, path_len]
+    batch_size, num_nodes = tree_tokens.shape
+    num_paths, path_len = retrieve_indices.shape[1:]
+    device = tree_tokens.device
+
+    node_depths = tree_depths.gather(1, tree_position_ids) # [B, num_nodes]
+    chain_lengths = tree_depths.gather(1, tree_position_ids + 1) - node_depths - 1 # [B, num_nodes]
+    chain_offsets = num_nodes + chain_lengths.cumsum(dim=-1) - chain_lengths # [B, num_nodes]
+    # the only host synchronization, for the shape of the verified tree
+    num_chain_nodes, verified_len = torch.stack(
+        (chain_lengths.sum(dim=-1).max(), tree_depths[:, path_len].max())
+    ).tolist()
+    if num_chain_nodes == 0:
+        return tree_tokens, tree_position_ids, tree_mask, retrieve_indices, retrieve_indices
+
+    num_chain_nodes = 1 << (num_chain_nodes - 1).bit_length()
+    num_verified = num_nodes + num_chain_nodes
+
+    # the owner (the drafted node it follows) and rank in its chain of every node, -1 for the drafted nodes; the
+    # padding nodes are owned by the root and masked out
+    steps = torch.arange(verified_len, device=device)
+    in_chain = steps < chain_lengths[:, :, None] # [B, num_nodes, verified_len]
+    chain_nodes = torch.where(in_chain, chain_offsets[:, :, None] + steps, num_verified).flatten(1)
+    nodes = torch.arange(num_verified + 1, device=device)
+    owners = torch.where(nodes < num_nodes, nodes, 0).repeat(batch_size, 1)
+    owners.scatter_(1, chain_nodes, nodes[:num_nodes, None].expand(batch_size, -1, verified_len).flatten(1))
+    ranks = torch.full((batch_size, num_verified + 1), -1, dtype=torch.long, device=device)
+    ranks.scatter_(1, chain_nodes, steps.expand(batch_size, num_nodes, -1).flatten(1))
+    owners, ranks = owners[:, :num_verified], ranks[:, :num_verified]
+    valid = nodes[:num_verified] < num_nodes + chain_lengths.sum(dim=-1, keepdim=True)
+
+    chain_tokens = forced_tokens.gather(
+        1, (node_depths[:, :, None] + steps).clamp(max=forced_tokens.shape[1] - 1).flatten(1)
+    )
+    tokens = torch.cat((tree_tokens, tree_tokens.new_zeros(batch_size, num_chain_nodes + 1)), dim=1)
+    tokens.scatter_(1, chain_nodes, chain_tokens.to(tokens.dtype))
+    tokens = tokens[:, :num_verified]
+    position_ids = node_depths.gather(1, owners) + ranks + 1
+
+    # a drafted node sees the drafted ancestors of its owner and a chain node the strict ones, plus the nodes of
+    # its own chain up to itself
+    ancestors = tree_mask[:, 0] != 0
+    ancestors = ancestors.gather(1, owners[:, :, None].expand(-1, -1, num_nodes))
+    ancestors = ancestors.gather(2, owners[:, None, :].expand(-1, num_verified, -1)) # [B, num_verified, num_verified]
+    same_owner = owners[:, :, None] == owners[:, None, :]
+    is_chain = ranks[:, None, :] >= 0
+    mask = torch.where(
+        is_chain, (ancestors & ~same_owner) | (same_owner & (ranks[:, None, :] <= ranks[:, :, None])), ancestors
+    )
+    mask = mask & valid[:, None, :] & valid[:, :, None]
+    mask = mask | torch.eye(num_verified, dtype=torch.bool, device=device)
+
+    # the paths through the actual depths: the drafted node of every depth, or the node of its chain
+    levels = torch.searchsorted(tree_depths.contiguous(), steps.expand(batch_size, -1).contiguous(), right=True) - 1
+    chain_ranks = steps - tree_depths.gather(1, levels) - 1 # [B, verified_len], -1 at the drafted depths
+    path_nodes = retrieve_indices.gather(2, levels.clamp(max=path_len - 1)[:, None].expand(-1, num_paths, -1))
+    chain_path_nodes = chain_offsets.gather(1, path_nodes.clamp(min=0).flatten(1)).view(path_nodes.shape)
+    verified_retrieve_indices = torch.where(
+        chain_ranks[:, None] < 0, path_nodes, chain_path_nodes + chain_ranks[:, None]
+    ) # [B, num_paths, verified_len]
+    verified_retrieve_indices.masked_fill_((path_nodes < 0) | (levels[:, None] >= path_len), -1)
+
+    # the node right before every drafted depth predicts it
+    logits_indices = verified_retrieve_indices.gather(
+        2, (tree_depths[:, 1:path_len + 1] - 1)[:, None].expand(-1, num_paths, -1)
+    )
+    return tokens, position_ids, mask.to(tree_mask.dtype)[:, None], verified_retrieve_indices, logits_indices
+
+class ImageVocabHead(nn.Module):
+    """
+    LM head restricted to the tokens that can be sampled inside an image.
+
+    Inside an image, `MultiModalLogitsProcessor` masks every token except the image tokens, the new line token and the
+    image end token, hence only the rows of `lm_head.weight` of the allowed tokens are projected. The logits are
+    compact, of shape [..., num_tokens], and `token_ids` maps them back to the global vocabulary: the logits
+    processors constrain them through `token_ids`, the top-k and the sampling run over them (see
+    `global_token_ids` and `sample_head`), and `expand` scatters them into the global vocabulary where a full
+    distribution is needed. The head only covers the positions inside the image; the caller decides from the lengths
+    it knows on the host whether a step stays inside it (see `covers`) and falls back to the full head otherwise.
+
+    Args:
+        head (nn.Linear): The bias-free LM head of the base model.
+        token_ids (torch.Tensor): The tokens allowed inside an image.
+        h_latent_dim (int, optional): Height of the image in tokens. Default is 48.
+        w_latent_dim (int, optional): Width of the image in tokens, without the new line tokens. Default is 48.
+    """
+
+    def __init__(self, head, token_ids, h_latent_dim=48, w_latent_dim=48):
+        super().__init__()
+        self.head = head
+        self.vocab_size = head.weight.shape[0]
+        self.register_buffer("token_ids", token_ids.to(head.weight.device), persistent=False)
+        self.register_buffer("image_weight", head.weight.detach()[self.token_ids].clone(), persistent=False)
+
+        # the image end token is generated at the last constrained position
+        self.num_image_positions = (w_latent_dim + 1) * h_latent_dim + 1
+
+    def covers(self, max_position):
+        # inputs:
+        #   - max_position: host-side bound on the positions given to MultiModalLogitsProcessor for the logits of a
+        #     step, counted from the image start
+        return max_position - 1 <= self.num_image_positions
+
+    def forward(self, hidden_states):
+        # inputs:
+        #   - hidden_states: [..., hidden_size]
+        return nn.functional.linear(hidden_states, self.image_weight) # [..., num_tokens]
+
+    def expand(self, values, fill_value=-float("inf")):
+        # inputs:
+        #   - values: [..., num_tokens] compact logits or probabilities
+        expanded = values.new_full((*values.shape[:-1], self.vocab_size), fill_value)
+        expanded[..., self.token_ids] = values
+        return expanded # [..., vocab_size]
+
+def vocab_token_ids(head):
+    # the global token id of every logit of `head`, or None if its logits cover the global vocabulary
+    return head.token_ids if isinstance(head, ImageVocabHead) else None
+
+def global_token_ids(head, indices):
+    # maps indices into the logits of `head` (e.g., from top-k) to token ids of the global vocabulary
+    return head.token_ids[indices] if isinstance(head, ImageVocabHead) else indices
+
+def sample_head(head, logits, k=1):
+    # `sample` over the logits of `head`; the tokens and the distribution are returned in the global vocabulary
+    sampled_indices, sampled_probs, probabilities = sample(logits, k=k)
+    if isinstance(head, ImageVocabHead):
+        return head.token_ids[sampled_indices], sampled_probs, head.expand(probabilities, fill_value=0.0)
+    return sampled_indices, sampled_probs, probabilities
+
+def cfg_head(head, hidden_states, uncond_hidden_states, cfg_scale):
+    # inputs:
+    #   - hidden_states, uncond_hidden_states: [..., hidden_size] conditional and unconditional hidden states
+    # Since the LM head is linear and bias-free, head(u + s * (c - u)) == head(u) + s * (head(c) - head(u)); the
+    # guidance is applied to the hidden states so that the vocabulary projection runs once instead of twice
+    if getattr(head, "bias", None) is not None:
+        logits, uncond_logits = head(hidden_states), head(uncond_hidden_states)
+        return uncond_logits + (logits - uncond_logits) * cfg_scale
+
+    # the guidance is computed in float32 to avoid amplifying the rounding errors of half precision by cfg_scale
+    cfg_hidden_states = uncond_hidden_states.float() + (hidden_states.float() - uncond_hidden_states.float()) * cfg_scale
+    cfg_hidden_states = cfg_hidden_states.to(hidden_states.dtype)
+    return head(cfg_hidden_states) # [..., vocab_size], or [..., num_tokens] for an ImageVocabHead
+
 class Model(nn.Module):
     def __init__(self, config, load_emb=False, path=None, bias=True, total_tokens=63, depth=5, top_k=8, threshold=1.0, embed_upscale=1.0):
         super().__init__()
@@ -997,6 +1100,11 @@ class Model(nn.Module):
         for param in self.embed_tokens.parameters():
             param.requires_grad = False
 
+        # storage of the preallocated KV cache used by `topK_generate`; see `init_kv`
+        self.kv_buffers = None
+        # masks of the drafting steps, updated in place; they are reset whenever the KV cache is rewritten
+        self.tree_attention_mask = TreeAttentionMask()
+
     def init_tree(self, tree=None):
         if tree is not None:
             # EAGLE v1
@@ -1012,6 +1120,13 @@ class Model(nn.Module):
         self.tree_mask = None
 
     def _prepare_decoder_attention_mask(self, attention_mask, input_shape, inputs_embeds, past_key_values_length):
+        tree_mask = getattr(self, "tree_mask", None)
+        if tree_mask is not None and tree_mask.shape[-2] == input_shape[-1]:
+            # the drafting steps only write the new columns of the prefix and the tree block
+            return self.tree_attention_mask(
+                attention_mask, tree_mask, input_shape, past_key_values_length, torch.float32, inputs_embeds.device
+            )
+
         # create causal mask
         # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
         combined_attention_mask = None
@@ -1096,6 +1211,9 @@ class Model(nn.Module):
         if self.embed_upscale > 1.0:
             inputs_embeds = inputs_embeds * self.embed_upscale
         hidden_states = self.fc(torch.cat((inputs_embeds, hidden_states), dim=-1))
+        position_embeddings = self.layers[0].self_attn.rotary_emb.gather(
+            position_ids, seq_length_with_past, hidden_states.dtype
+        )
 
         all_hidden_states = () if output_hidden_states else None
         next_decoder_cache = () if use_cache else None
@@ -1129,6 +1247,7 @@ class Model(nn.Module):
                     past_key_value=past_key_value,
                     output_attentions=output_attentions,
                     use_cache=use_cache,
+                    position_embeddings=position_embeddings,
                 )
 
             hidden_states = layer_outputs[0]
@@ -1143,27 +1262,199 @@ class Model(nn.Module):
 
     def reset_kv(self):
         self.stable_kv = None
+        self.tree_attention_mask.reset()
+
+    def init_kv(self, batch_size):
+        """
+        Initialize the KV cache of `topK_generate` for a drafter batch, reusing the storage of the previous one if it
+        has the same shape.
+
+        The keys and values are written in place into a buffer of `max_position_embeddings` positions, so that the
+        drafter does not copy its whole cache at every step. The entries of the draft tree are appended after the
+        committed positions and rolled back at the end of `topK_generate`.
+
+        Args:
+            batch_size (int): Number of rows of the drafter batch, i.e., twice the number of prompts.
+
+        Returns:
+            list: A pair of KVCache (key and value) for each layer.
+        """
+        self_attn = self.layers[0].self_attn
+        shape = (
+            2 * len(self.layers),
+            batch_size,
+            self_attn.num_key_value_heads,
+            self_attn.max_position_embeddings,
+            self_attn.head_dim,
+        )
+        if self.kv_buffers is None or self.kv_buffers[0].shape != shape:
+            data = torch.zeros(shape, dtype=self.fc.weight.dtype, device=self.fc.weight.device)
+            # [IMPORTANT] the lengths are kept on CPU for quick access and updates
+            current_length_data = torch.zeros(2 * len(self.layers), dtype=torch.long, device="cpu")
+            self.kv_buffers = (data, current_length_data)
+
+        data, current_length_data = self.kv_buffers
+        current_length_data.zero_()
+        return [
+            [KVCache(data[2 * i + j], current_length_data[2 * i + j]) for j in range(2)]
+            for i in range(len(self.layers))
+        ]
+
+    def detach_kv(self, rows):
+        """
+        Set the drafter KV cache aside so that the next `topK_generate` prefills some of its rows as a batch of their
+        own, e.g., of a prompt admitted into a finished row.
+
+        The prefill writes in place into the given rows of the storage, with lengths of their own, instead of
+        allocating another `max_position_embeddings` buffer. It must leave them with the length of the detached cache.
+
+        Args:
+            rows (slice): Rows of the drafter batch to prefill.
+
+        Returns:
+            tuple: The detached KV cache, to be restored with `attach_kv`.
+        """
+        kv = (self.stable_kv, self.kv_buffers)
+        data, current_length_data = self.kv_buffers
+        self.stable_kv = None
+        self.kv_buffers = (data[:, rows], torch.zeros_like(current_length_data))
+        self.tree_attention_mask.reset()
+        return kv
+
+    def attach_kv(self, kv):
+        """Restore a drafter KV cache returned by `detach_kv`."""
+        self.stable_kv, self.kv_buffers = kv
+        self.tree_attention_mask.reset()
+
+    def compact_kv(self, indices):
+        """
+        Keep only the given positions of the drafter KV cache, in the given order.
+
+        Args:
+            indices (torch.Tensor): Positions to keep for every row of the drafter batch, of shape [2 * batch_size, n].
+        """
+        if not hasattr(self, "stable_kv") or self.stable_kv is None:
+            return
+        data, current_length_data = self.kv_buffers
+        length = self.stable_kv[0][0].shape[2]
+        indices = indices.to(data.device)
+
+        index = indices[None, :, None, :, None].expand(data.shape[0], -1, data.shape[2], -1, data.shape[4])
+        data[:, :, :, :indices.shape[1]] = data[:, :, :, :length].gather(3, index)
+        current_length_data.fill_(indices.shape[1])
+        self.tree_attention_mask.reset()
+
+    def build_dynamic_tree(self, scores_list, ss_token_list, parents_list, sample_token, num_depths, sort_leaves):
+        # inputs:
+        #   - scores_list: [B, num_scores], cumulative log-probabilities of all drafted tokens
+        #   - ss_token_list: [B, num_scores], drafted tokens
+        #   - parents_list: [B, num_parents], parent index of each group of top_k drafted tokens
+        #   - sample_token: [B, 1], the root of the tree
+        #   - num_depths: number of drafted depths, which bounds the depth of the tree
+        # The tree is assembled with tensor ops on the device of the drafter; the only host sync reads the number of
+        # leaves and the depth of the tree, which size the retrieve indices
+        total_tokens = self.total_tokens
+        top_k = self.top_k
+        batch_size = scores_list.shape[0]
+        device = scores_list.device
+
+        # a confident child ties with its parent, which comes first in `scores_list`; the stable sort keeps the parent
+        # of every selected node
+        top_scores_index = torch.sort(scores_list, dim=-1, descending=True, stable=True).indices[:, :total_tokens]
+        top_scores_index = torch.sort(top_scores_index, dim=-1).values # [B, total_tokens]
+
+        draft_tokens = ss_token_list.gather(1, top_scores_index)
+        draft_tokens = torch.cat((sample_token, draft_tokens), dim=1) # [B, total_tokens + 1]
+
+        draft_parents = parents_list.gather(1, top_scores_index // top_k).long()
+        mask_index = torch.searchsorted(top_scores_index, draft_parents - 1, right=False)
+
+        mask_index[draft_parents == 0] = -1
+        mask_index = mask_index + 1 # [B, total_tokens], parent node of every drafted node, 0 being the root
+
+        # the root is its own parent so that the ancestors of every node end at the root
+        parents = torch.cat((torch.zeros_like(mask_index[:, :1]), mask_index), dim=1) # [B, total_tokens + 1]
+        nodes = torch.arange(total_tokens + 1, device=device).expand(batch_size, -1)
+
+        # every node attends to itself and, hop by hop, to all its ancestors
+        tree_mask = torch.eye(total_tokens + 1, dtype=torch.bool, device=device).repeat(batch_size, 1, 1)
+        ancestors = parents
+        for _ in range(num_depths):
+            tree_mask.scatter_(2, ancestors[:, :, None], True)
+            ancestors = parents.gather(1, ancestors)
+
+        tree_position_ids = torch.sum(tree_mask, dim=-1) - 1 # [B, total_tokens + 1]
+        tree_mask = tree_mask.float()
+
+        # root-to-node path of every node; once the root is reached, the root is written again at depth 0
+        paths = torch.full((batch_size, total_tokens + 1, num_depths + 1), -1, dtype=torch.long, device=device)
+        ancestors = nodes
+        for hop in range(num_depths + 1):
+            paths.scatter_(2, (tree_position_ids - hop).clamp(min=0)[:, :, None], ancestors[:, :, None])
+            ancestors = parents.gather(1, ancestors)
+
+        is_leaf = torch.ones_like(tree_position_ids, dtype=torch.bool)
+        is_leaf.scatter_(1, mask_index, False) # [B, total_tokens + 1]
+
+        # order the paths by node index, or lexicographically with the padding last (least significant depth first)
+        order = nodes
+        if sort_leaves:
+            maxitem = total_tokens + 5
+            sort_keys = torch.where(paths >= 0, paths, maxitem)
+            for depth in reversed(range(num_depths + 1)):
+                keys = sort_keys[:, :, depth].gather(1, order)
+                order = order.gather(1, torch.sort(keys, dim=-1, stable=True).indices)
+
+        # leaves first; the other slots repeat the last leaf of the row so that the posterior never prefers them
+        order = order.gather(1, torch.sort((~is_leaf).gather(1, order).long(), dim=-1, stable=True).indices)
+        num_leaves = is_leaf.sum(dim=-1)
+        max_leaves, max_depth = torch.stack((num_leaves.max(), tree_position_ids.max())).tolist()
+
+        slots = torch.minimum(torch.arange(max_leaves, device=device)[None], num_leaves[:, None] - 1)
+        order = order.gather(1, slots) # [B, max_leaves]
+        retrieve_indices = paths.gather(1, order[:, :, None].expand(-1, -1, paths.shape[-1]))
+        retrieve_indices = retrieve_indices[:, :, :max_depth + 1] # [B, max_leaves, max_depth + 1]
+
+        return draft_tokens, retrieve_indices, tree_mask, tree_position_ids
+
+    def forced_depths(self, logits_processor, image_positions, num_depths):
+        # inputs:
+        #   - logits_processor: MultiModalLogitsProcessor of the drafter
+        #   - image_positions: [B], position given to the processor for the token after the root of each row
+        # The new line and image end tokens are forced at known positions, hence the tree is only drafted over the
+        # other positions, without a drafting step or LM head for the forced tokens; they are inserted back into
+        # the tree for the verification (see `splice_forced_tokens`). Returns the tokens forced after the root
+        # [B, 2 * (num_depths + 1)] (-1 where a token is drafted) and the depth of every drafted depth in the actual
+        # sequence [B, num_depths + 2] (0 for the root)
+        steps = torch.arange(2 * (num_depths + 1), device=image_positions.device)
+        forced_tokens = logits_processor.forced_tokens(image_positions[:, None] + steps) # [B, 2 * (num_depths + 1)]
+        drafted_steps = torch.sort((forced_tokens >= 0).long(), dim=-1, stable=True).indices[:, :num_depths + 1]
+        tree_depths = F.pad(drafted_steps + 1, (1, 0)) # [B, num_depths + 2]
+        return forced_tokens, tree_depths
 
     @torch.no_grad()
     def topK_generate(self, hidden_states, uncond_hidden_states, input_ids,
-                        head, logits_processors, attention_mask=None, tree_type="static"):
+                        head, logits_processors, attention_mask=None, tree_type="static", prefix_kv=None):
         # hidden_states = [batch_size, seq_len, hidden_size]
         # uncond_hidden_states = [batch_size, image_seq_len, hidden_size]
         # input_ids = [batch_size, seq_len]
+        # prefix_kv = cached keys and values of the first positions of a new sequence; hidden_states then start at
+        #             the first position that is not cached (see `PromptPrefixCache`)
+        # NOTE : the drafter batch is ordered as [cond_0, ..., cond_{B-1}, uncond_0, ..., uncond_{B-1}]
         
         # Assertions for the sanity of the input
         assert uncond_hidden_states is not None, "uncond_hidden_states should not be None since we always use CFG."
         assert tree_type in ["static", "dynamic"], "tree_type should be 'static' for EAGLE v1 or 'dynamic' for EAGLE v2."
         
         # Initalize the corresponding variables for each tree type
+        batch_size = hidden_states.shape[0]
         input_ids = input_ids[:, 1:].to(hidden_states.device) # [1, 45] -> [2, 45]
         if tree_type == "static":
             ss_token, ss_prob, ss_original_prob = [], [], []
         else:
-            total_tokens = self.total_tokens
             depth = self.depth
             top_k = self.top_k
-            sample_token = input_ids[:, -1]
+            sample_token = input_ids[:, -1:] # [B, 1]
             ss_token = []
             scores_list = []
             parents_list = []
@@ -1172,7 +1463,7 @@ class Model(nn.Module):
             # First time call with this sequence
             if hidden_states.shape[1] > uncond_hidden_states.shape[1]:
                 # Sequential CFG
-                zero_padding = torch.zeros((1, hidden_states.shape[1] - uncond_hidden_states.shape[1], uncond_hidden_states.shape[2]), dtype=torch.float, device=hidden_states.device)
+                zero_padding = torch.zeros((batch_size, hidden_states.shape[1] - uncond_hidden_states.shape[1], uncond_hidden_states.shape[2]), dtype=torch.float, device=hidden_states.device)
                 uncond_hidden_states = torch.cat((zero_padding, uncond_hidden_states), dim=1) # Add left zero padding to make the shape same
             else:
                 # Parallel CFG, no need to zero padding since the hidden states were already calculated by zero-padded input_ids
@@ -1181,8 +1472,12 @@ class Model(nn.Module):
             if tree_type == "static":
                 pass
             else:
-                # replicate the tree_mask_init
-                self.tree_mask_init = torch.cat([self.tree_mask_init, self.tree_mask_init], dim=0)
+                # replicate the tree_mask_init for every row of the drafter batch
+                self.tree_mask_init = self.tree_mask_init[:1].repeat(2 * batch_size, 1, 1, 1)
+
+            self.stable_kv = self.init_kv(2 * batch_size)
+            if prefix_kv is not None:
+                restore_past_key_values(self.stable_kv, prefix_kv)
 
         hidden_states = torch.cat((hidden_states, uncond_hidden_states), dim=0) # Add left zero padding to make the shape same
         input_ids = input_ids.repeat(2, 1)
@@ -1193,80 +1488,86 @@ class Model(nn.Module):
         position_ids = attention_mask.cumsum(-1) - 1
         
         len_posi = position_ids[:, -1] + 1 # len_posi need to be distinguished by conditional or not
-        len_posi = len_posi[:, None] # [2] -> [2, 1]
+        len_posi = len_posi[:, None] # [2B] -> [2B, 1]
 
         self.reset() # reset the tree mask
 
-        if hasattr(self, "stable_kv") and self.stable_kv is not None:
-            kv_len = self.stable_kv[0][0].shape[2]
-            out_hidden, past_key_values = self(hidden_states, input_ids[:, kv_len:],
-                                                attention_mask=attention_mask,
-                                                position_ids=position_ids[:, kv_len:] if position_ids is not None else None,
-                                                past_key_values=self.stable_kv,
-                                                use_cache=True)
-        else:
-            out_hidden, past_key_values = self(hidden_states, input_ids=input_ids,
-                                                attention_mask=attention_mask,
-                                                position_ids=position_ids,
-                                                use_cache=True)
+        # the hidden states are only given for the positions that are not in the cache yet
+        kv_len = self.stable_kv[0][0].shape[2]
+        out_hidden, past_key_values = self(hidden_states, input_ids[:, kv_len:],
+                                            attention_mask=attention_mask,
+                                            position_ids=position_ids[:, kv_len:] if position_ids is not None else None,
+                                            past_key_values=self.stable_kv,
+                                            use_cache=True)
         
-        self.stable_kv = past_key_values
+        # the draft tree is appended after the committed positions and rolled back below
+        stable_kv_len = input_ids.shape[1]
         last_hidden = out_hidden[:, -1]
 
-        last_headout = head(last_hidden)
-        last_headout = (last_headout[1] + (last_headout[0] - last_headout[1]) * self.cfg_scale).unsqueeze(0) # [1, 65536]
-        
+        if tree_type == "static":
+            num_iterations = len(self.tree_buffer['tree_indices'])
+        else:
+            num_iterations = depth
+
+        # the drafted depths skip the positions of the forced tokens; `depth_offsets` is the offset of the position of
+        # every drafted depth from `len_posi`
+        forced_tokens, tree_depths = self.forced_depths(
+            logits_processors[0], len_posi[batch_size:, 0], num_iterations + 1
+        )
+        depth_offsets = (tree_depths - 1).repeat(2, 1) # [2B, num_iterations + 3]
+
+        last_headout = cfg_head(head, *last_hidden.split(batch_size), self.cfg_scale) # [B, 65536]
+
         # MultiModalLogitsProcessor
         last_headout = logits_processors[0](
-            last_headout, position_ids=len_posi[1])
+            last_headout, position_ids=len_posi[batch_size:, 0] + depth_offsets[batch_size:, 1],
+            token_ids=vocab_token_ids(head),
+        )
 
         # InterleavedTopKLogitsWarper
         last_headout = logits_processors[1](last_headout)
 
         if tree_type == "static":
-            num_iterations = len(self.tree_buffer['tree_indices'])
+            pass
         else:
-            last_p = self.logsoftmax(last_headout) # [1, 65536]
+            last_p = self.logsoftmax(last_headout) # [B, 65536]
             top = torch.topk(last_p, top_k, dim=-1)
-            topk_index, topk_p = top.indices, top.values # [1, 10], [1, 10]
+            topk_index, topk_p = global_token_ids(head, top.indices), top.values # [B, 10], [B, 10]
 
-            scores = topk_p[0] # [10]
-            scores_list.append(scores[None]) # [1, 10]
-            parents_list.append(torch.zeros(1, dtype=torch.long, device=scores.device)) # [1]
-            ss_token.append(topk_index) # [1, 10]
-            
-            input_ids = topk_index # [1, 10]
-            input_hidden = last_hidden[:, None].repeat(1, top_k, 1) # [1, 10, 4096]
-            tree_mask = self.tree_mask_init # [1, 1, 10, 10]
-            topk_cs_index = torch.arange(top_k, device=self.embed_tokens.weight.device) # [10]
+            scores = topk_p # [B, 10]
+            scores_list.append(scores[:, None]) # [B, 1, 10]
+            parents_list.append(torch.zeros((batch_size, 1), dtype=torch.long, device=scores.device)) # [B, 1]
+            ss_token.append(topk_index[:, None]) # [B, 1, 10]
             
-            num_iterations = depth
+            input_ids = topk_index # [B, 10]
+            input_hidden = last_hidden[:, None].repeat(1, top_k, 1) # [2B, 10, 4096]
+            tree_mask = self.tree_mask_init # [2B, 1, 10, 10]
+            topk_cs_index = torch.arange(top_k, device=self.embed_tokens.weight.device).repeat(batch_size, 1) # [B, 10]
         
         for i in range(num_iterations):
             if tree_type == "static":
-                topk_index, topk_prob, original_prob = sample(last_headout, k=self.top_k)
-                ss_token.append(topk_index)
-                ss_prob.append(topk_prob)
-                ss_original_prob.append(original_prob)
+                topk_index, topk_prob, original_prob = sample_head(head, last_headout.flatten(0, -2), k=self.top_k)
+                ss_token.append(topk_index.view(batch_size, -1, self.top_k))
+                ss_prob.append(topk_prob.view(batch_size, -1, self.top_k))
+                ss_original_prob.append(original_prob.view(batch_size, -1, original_prob.shape[-1]))
 
-                topk_index = topk_index.view(-1) # flattening
-                select_index = topk_index[self.tree_buffer['tree_indices'][i]]
+                topk_index = topk_index.view(batch_size, -1) # flattening
+                select_index = topk_index[:, self.tree_buffer['tree_indices'][i]]
 
-                input_ids = select_index[None, :] # unsqueeze(0)
+                input_ids = select_index # [B, num_nodes]
                 if i == 0:
                     input_hidden = out_hidden[:, -1:]
                 else:
                     input_hidden = out_hidden
                 input_hidden = repeat_hidden(input_hidden, self.tree_buffer['repeat_nums'][i])
 
-                position_ids = len_posi + self.tree_buffer["position_ids"][i]
-                self.tree_mask = self.tree_buffer['attn_mask'][i]
-                self.tree_mask = torch.cat((self.tree_mask, self.tree_mask), dim=0)
+                position_ids = len_posi + depth_offsets[:, i + 1, None] + self.tree_buffer["position_ids"][i]
+                self.tree_mask = self.tree_buffer['attn_mask'][i].repeat(2 * batch_size, 1, 1, 1)
             else:
-                position_ids = len_posi + self.position_ids
+                position_ids = len_posi + depth_offsets[:, i + 1, None] + self.position_ids
                 self.tree_mask = tree_mask
             
-            input_ids = torch.cat((input_ids, input_ids), dim=0) # [2, 10]
+            input_ids = torch.cat((input_ids, input_ids), dim=0) # [2B, 10]
 
             out_hidden, past_key_values = self(input_hidden,
                                                 input_ids=input_ids,
@@ -1274,7 +1575,6 @@ class Model(nn.Module):
                                                 past_key_values=past_key_values,
                                                 position_ids=position_ids,
                                                 use_cache=True)
-            len_posi += 1
 
             if tree_type == "static":
                 pass
@@ -1283,16 +1583,18 @@ class Model(nn.Module):
                 bias2 = max(0, i-1)
                 bias = 1 + top_k ** 2 * bias2 + bias1
 
-                parents = (topk_cs_index + bias) # [1,2,3,...,10]
+                parents = (topk_cs_index + bias) # [B, 10]
                 parents_list.append(parents)
 
-            last_headout = head(out_hidden) # [2, 10, 65536]
-            last_headout = last_headout[1] + (last_headout[0] - last_headout[1]) * self.cfg_scale # [10, 65536]
-            
-            # MultiModalLogitsProcessor
+            last_headout = cfg_head(head, *out_hidden.split(batch_size), self.cfg_scale) # [B, 10, 65536]
+
+            # MultiModalLogitsProcessor, at the position of the next drafted depth
             # Here we reuse the image_start_token_id_index since it is the same for all subsequent tokens
+            next_offsets = depth_offsets[batch_size:, i + 2, None] - depth_offsets[batch_size:, i + 1, None]
             last_headout = logits_processors[0](
-                last_headout, position_ids=position_ids[1] + 1) # [10, 65536]
+                last_headout.flatten(0, 1), position_ids=(position_ids[batch_size:] + next_offsets).flatten(),
+                token_ids=vocab_token_ids(head),
+            ).view(last_headout.shape) # [B, 10, 65536]
 
             # InterleavedTopKLogitsWarper
             last_headout = logits_processors[1](last_headout)
@@ -1300,94 +1602,52 @@ class Model(nn.Module):
             if tree_type == "static":
                 pass
             else:
-                last_p = self.logsoftmax(last_headout) # [10, 65536]
+                last_p = self.logsoftmax(last_headout) # [B, 10, 65536]
 
                 top = torch.topk(last_p, top_k, dim=-1)
-                topk_index, topk_p = top.indices, top.values # [10, 10], [10, 10]
+                topk_index, topk_p = global_token_ids(head, top.indices), top.values # [B, 10, 10], [B, 10, 10]
 
-                cumulative_scores = topk_p + scores[:, None] # [10, 10]
-                topk_cs = torch.topk(cumulative_scores.view(-1), top_k, dim=-1)
-                topk_cs_index, topk_cs_p = topk_cs.indices, topk_cs.values # [10], [10]
+                cumulative_scores = topk_p + scores[:, :, None] # [B, 10, 10]
+                topk_cs = torch.topk(cumulative_scores.view(batch_size, -1), top_k, dim=-1)
+                topk_cs_index, topk_cs_p = topk_cs.indices, topk_cs.values # [B, 10], [B, 10]
                 scores = topk_cs_p
 
-                out_ids = topk_cs_index // top_k
-                input_hidden = out_hidden[:, out_ids] # [1, 10, 4096] -> [2, 10, 4096]
-                input_ids = topk_index.view(-1)[topk_cs_index][None] # [1, 10]
+                # the cond and uncond rows of a prompt follow the same branches
+                out_ids = (topk_cs_index // top_k).repeat(2, 1) # [2B, 10]
+                input_hidden = out_hidden.gather(1, out_ids[:, :, None].expand(-1, -1, out_hidden.shape[-1])) # [2B, 10, 4096]
+                input_ids = topk_index.view(batch_size, -1).gather(1, topk_cs_index) # [B, 10]
 
                 ss_token.append(topk_index)
                 scores_list.append(cumulative_scores)
 
-                tree_mask = torch.cat((tree_mask[:, :, out_ids], self.tree_mask_init), dim=-1)
+                parent_mask = tree_mask.gather(2, out_ids[:, None, :, None].expand(-1, 1, -1, tree_mask.shape[-1]))
+                tree_mask = torch.cat((parent_mask, self.tree_mask_init), dim=-1)
 
-        if tree_type == "static":
-            topk_index, topk_prob, original_prob = sample(last_headout, k=self.top_k)
-            ss_token.append(topk_index)
-            ss_prob.append(topk_prob)
-            ss_original_prob.append(original_prob)
+        self.kv_buffers[1].fill_(stable_kv_len)
 
-            return (torch.cat(ss_token), torch.cat(ss_prob), ss_original_prob)
+        if tree_type == "static":
+            topk_index, topk_prob, original_prob = sample_head(head, last_headout.flatten(0, -2), k=self.top_k)
+            ss_token.append(topk_index.view(batch_size, -1, self.top_k))
+            ss_prob.append(topk_prob.view(batch_size, -1, self.top_k))
+            ss_original_prob.append(original_prob.view(batch_size, -1, original_prob.shape[-1]))
+
+            # [B, num_nodes, top_k], [B, num_nodes, top_k], list of [B, num_nodes_at_depth, vocab_size], and the forced
+            # tokens and drafted depths of `forced_depths`
+            return (torch.cat(ss_token, dim=1), torch.cat(ss_prob, dim=1), ss_original_prob, forced_tokens, tree_depths)
         else:
-            scores_list = torch.cat(scores_list, dim=0).view(-1)
-            ss_token_list = torch.cat(ss_token, dim=0).view(-1)
-            top_scores = torch.topk(scores_list, total_tokens, dim=-1)
-            top_scores_index = top_scores.indices
-            top_scores_index = torch.sort(top_scores_index).values
-
-            draft_tokens = ss_token_list[top_scores_index]
-            draft_tokens = torch.cat((sample_token, draft_tokens), dim=0)
-
-            draft_parents = torch.cat(parents_list, dim=0)[top_scores_index // top_k].long()
-            mask_index = torch.searchsorted(top_scores_index, draft_parents - 1, right=False)
-
-            mask_index[draft_parents == 0] = -1
-            mask_index = mask_index + 1
-            mask_index_list = mask_index.tolist()
-
-            tree_mask = torch.eye(total_tokens + 1).bool()
-            tree_mask[:, 0] = True
-            for i in range(total_tokens):
-                tree_mask[i+1].add_(tree_mask[mask_index_list[i]])
-
-            tree_position_ids = torch.sum(tree_mask, dim=1) - 1
-            tree_mask = tree_mask.float()[None, None]
-            draft_tokens = draft_tokens[None]
-
-            del parents_list, scores_list, ss_token, ss_token_list, draft_parents
-
-            max_depth = torch.max(tree_position_ids) + 1
-            noleaf_index = torch.unique(mask_index).tolist()
-            noleaf_num = len(noleaf_index) - 1
-            leaf_num = total_tokens - noleaf_num
-
-            retrieve_indices = torch.zeros(leaf_num, max_depth.item(), dtype=torch.long) - 1
-            retrieve_indices = retrieve_indices.tolist()
-
-            rid = 0
-            position_ids_list = tree_position_ids.tolist()
-
-            for i in range(total_tokens + 1):
-                if i not in noleaf_index:
-                    cid = i
-                    depth = position_ids_list[i]
-                    for j in reversed(range(depth + 1)):
-                        retrieve_indices[rid][j] = cid
-                        cid = mask_index_list[cid - 1]
-                    rid += 1
-
-            if logits_processors is not None:
-                maxitem = total_tokens + 5
-
-                def custom_sort(lst):
-                    # sort_keys=[len(list)]
-                    sort_keys = []
-                    for i in range(len(lst)):
-                        sort_keys.append(lst[i] if lst[i] >= 0 else maxitem)
-                    return sort_keys
-
-                retrieve_indices = sorted(retrieve_indices, key=custom_sort)
-
-            retrieve_indices = torch.tensor(retrieve_indices, dtype=torch.long)
-            del mask_index, mask_index_list, noleaf_index, noleaf_num, leaf_num, max_depth, rid
-            tree_position_ids = tree_position_ids.to(hidden_states.device)
-
-            return draft_tokens, retrieve_indices, tree_mask, tree_position_ids
\ No newline at end of file
+            num_depths = len(scores_list)
+            scores_list = torch.cat(scores_list, dim=1).view(batch_size, -1)
+            ss_token_list = torch.cat(ss_token, dim=1).view(batch_size, -1)
+            parents_list = torch.cat(parents_list, dim=1)
+
+            draft_tokens, retrieve_indices, tree_mask, tree_position_ids = self.build_dynamic_tree(
+                scores_list, ss_token_list, parents_list, sample_token, num_depths,
+                sort_leaves=logits_processors is not None,
+            )
+            del parents_list, scores_list, ss_token, ss_token_list
+
+            # [B, total_tokens + 1], [B, num_leaves, max_depth], [B, 1, total_tokens + 1, total_tokens + 1], [B, total_tokens + 1]
+            tree_mask = tree_mask[:, None]
+
+            # the forced tokens are not part of the drafted tree, see `splice_forced_tokens`
+            return draft_tokens, retrieve_indices, tree_mask, tree_position_ids, forced_tokens, tree_depths
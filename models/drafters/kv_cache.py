@@ -1,4 +1,7 @@
+import weakref
+
 import torch
+import torch.nn.functional as F
 
 
 class KVCache:
@@ -66,7 +69,7 @@ class KVCache:
         return torch.narrow(self.data, 2, 0, self.current_length)
 
 
-def initialize_past_key_values(model, batch_size=1):
+def initialize_past_key_values(model, batch_size=1, max_length=None):
     """
     Initialize past key and value states for a given transformer model.
 
@@ -75,6 +78,8 @@ def initialize_past_key_values(model, batch_size=1):
 
     Args:
         model (nn.Module): The transformer model for which past key-value states need to be initialized.
+        batch_size (int, optional): Number of rows of the cache. Default is 1.
+        max_length (int, optional): Number of positions of the cache. Default is `max_position_embeddings`.
 
     Returns:
         tuple:
@@ -84,6 +89,8 @@ def initialize_past_key_values(model, batch_size=1):
     """
     # Extracting configuration from the model
     config = model.config
+    if max_length is None:
+        max_length = config.max_position_embeddings
     
     # Initializing a tensor to store past keys and values for all layers
     devices=[]
@@ -102,7 +109,7 @@ def initialize_past_key_values(model, batch_size=1):
                 startnum * 2,
                 batch_size,
                 config.num_key_value_heads,
-                config.max_position_embeddings,
+                max_length,
                 config.hidden_size // config.num_attention_heads,
                 device=startdevice,
                 dtype=model.dtype,
@@ -115,7 +122,7 @@ def initialize_past_key_values(model, batch_size=1):
         startnum * 2,
         batch_size,
         config.num_key_value_heads,
-        config.max_position_embeddings,
+        max_length,
         config.hidden_size // config.num_attention_heads,
         device=startdevice,
         dtype=model.dtype,
@@ -153,3 +160,690 @@ def initialize_past_key_values(model, batch_size=1):
             )
         bias+=1
     return past_key_values, past_key_values_data_list, current_length_data
+
+
+class KVPagePool:
+    """
+    A shared pool of fixed-size key-value pages.
+
+    Instead of reserving `max_position_embeddings` positions for every sequence, sequences draw pages of
+    `page_size` positions from the pool as they grow and give them back once they finish, so that many
+    concurrent sequences can share memory sized to the tokens they actually hold.
+
+    Attributes:
+        data_list (list): One tensor per device holding the pages of its layers, each of shape
+            [2 * num_layers_on_device, num_pages, num_key_value_heads, page_size, head_dim].
+        layer_slices (list): For each layer, the index into `data_list` and the row of its keys in that tensor.
+        page_size (int): Number of positions per page.
+        free_pages (list): Ids of the pages that are not held by any sequence.
+    """
+
+    def __init__(self, data_list, layer_slices, page_size):
+        """
+        Initialize the KVPagePool.
+
+        Args:
+            data_list (list): Page tensors, one per device.
+            layer_slices (list): (data index, key row) for each layer.
+            page_size (int): Number of positions per page.
+        """
+        self.data_list = data_list
+        self.layer_slices = layer_slices
+        self.page_size = page_size
+        self.num_pages = data_list[0].shape[1]
+        self.free_pages = list(range(self.num_pages))
+
+    def allocate(self, num_pages: int):
+        """
+        Take `num_pages` pages from the pool.
+
+        Args:
+            num_pages (int): Number of pages to take.
+
+        Returns:
+            list: Ids of the allocated pages.
+        """
+        if num_pages > len(self.free_pages):
+            raise RuntimeError(
+                f"KV page pool exhausted: requested {num_pages} pages but only {len(self.free_pages)} "
+                f"of {self.num_pages} are free"
+            )
+        pages = self.free_pages[:num_pages]
+        del self.free_pages[:num_pages]
+        return pages
+
+    def release(self, pages):
+        """
+        Give pages back to the pool.
+
+        Args:
+            pages (list): Ids of the pages to release.
+        """
+        self.free_pages.extend(pages)
+
+
+class PageTable:
+    """
+    The pages held by one sequence (with `batch_size` rows) across all layers of a KVPagePool.
+
+    All layers share the same page table, so that committing accepted tree tokens moves the keys and values of
+    every layer with a single indexing operation per device.
+
+    Attributes:
+        pool (KVPagePool): The pool the pages are drawn from.
+        batch_size (int): Number of rows of the sequence (2 for parallel CFG).
+        pages (list): Page ids of each row, in position order.
+        caches (list): The PagedKVCache objects of all layers backed by this table.
+    """
+
+    def __init__(self, pool, batch_size=1):
+        """
+        Initialize the PageTable.
+
+        Args:
+            pool (KVPagePool): The pool the pages are drawn from.
+            batch_size (int, optional): Number of rows of the sequence. Default is 1.
+        """
+        self.pool = pool
+        self.batch_size = batch_size
+        self.pages = [[] for _ in range(batch_size)]
+        self.caches = []
+        self._tables = {}
+        self._append_slots = {}
+
+    @property
+    def capacity(self):
+        """Return the number of positions that can be stored without allocating."""
+        return len(self.pages[0]) * self.pool.page_size
+
+    def reserve(self, length: int):
+        """
+        Make sure that `length` positions can be stored, allocating pages if needed.
+
+        Args:
+            length (int): Number of positions to store.
+        """
+        if length <= self.capacity:
+            return
+        num_pages = -(-length // self.pool.page_size) - len(self.pages[0])
+        for row in self.pages:
+            row.extend(self.pool.allocate(num_pages))
+        self._tables = {}
+        self._append_slots = {}
+
+    def select(self, rows):
+        """
+        View some rows of the page table as a smaller page table.
+
+        The view shares the page lists of the selected rows, hence writes through the view land in the pages of
+        this table. It must not allocate, i.e., this table has to be reserved for the positions written through it.
+
+        Args:
+            rows (slice): Rows to view.
+
+        Returns:
+            PageTable: The view of the selected rows.
+        """
+        pages = self.pages[rows]
+        view = PageTable(self.pool, batch_size=len(pages))
+        view.pages = pages
+        return view
+
+    def table(self, device):
+        """Return the page ids as a [batch_size, num_pages] tensor on `device`."""
+        if device not in self._tables:
+            self._tables[device] = torch.tensor(self.pages, dtype=torch.long, device=device)
+        return self._tables[device]
+
+    def slots(self, positions: torch.Tensor, device):
+        """
+        Locate positions in the pages.
+
+        Args:
+            positions (torch.Tensor): Positions of shape [num_positions], shared by all rows, or of shape
+                [batch_size, num_positions].
+            device (torch.device): Device of the pages.
+
+        Returns:
+            tuple: Page ids of shape [batch_size, num_positions] and offsets in the pages of the same shape as
+                `positions`.
+        """
+        positions = positions.to(device)
+        if positions.dim() == 1:
+            return self.table(device)[:, positions // self.pool.page_size], positions % self.pool.page_size
+        return self.table(device).gather(1, positions // self.pool.page_size), positions % self.pool.page_size
+
+    def append_slots(self, start: int, length: int, device):
+        """
+        Locate the positions `[start, length)` appended by a forward pass.
+
+        Every layer appends the same positions, so they are located once per forward pass and device.
+
+        Args:
+            start (int): First appended position.
+            length (int): End of the appended positions.
+            device (torch.device): Device of the pages.
+
+        Returns:
+            tuple: Page ids of shape [batch_size, length - start] and offsets of shape [length - start].
+        """
+        if self._append_slots.get("positions") != (start, length):
+            self._append_slots = {"positions": (start, length)}
+        if device not in self._append_slots:
+            self._append_slots[device] = self.slots(torch.arange(start, length), device)
+        return self._append_slots[device]
+
+    def copy(self, indices: torch.Tensor, prev_length: int):
+        """
+        Copy the keys and values of all layers at `indices` to the positions starting at `prev_length`.
+
+        This is the tree-commit path: `indices` are the positions of the accepted tree tokens.
+
+        Args:
+            indices (torch.Tensor): Positions to be copied, of shape [n] or [batch_size, n].
+            prev_length (int): Previous length before adding new data.
+        """
+        dst_positions = torch.arange(prev_length, prev_length + indices.shape[-1])
+        self.reserve(prev_length + indices.shape[-1])
+        for data in self.pool.data_list:
+            src_pages, src_offsets = self.slots(indices, data.device)
+            dst_pages, dst_offsets = self.slots(dst_positions, data.device)
+            data[:, dst_pages, :, dst_offsets] = data[:, src_pages, :, src_offsets]
+        for cache in self.caches:
+            cache.length = prev_length + indices.shape[-1]
+
+    def release(self):
+        """Give all pages back to the pool."""
+        for row in self.pages:
+            self.pool.release(row)
+        self.pages = [[] for _ in range(self.batch_size)]
+        self._tables = {}
+        self._append_slots = {}
+
+
+class PagedKVCache:
+    """
+    A key-value cache for one layer stored in the pages of a KVPagePool.
+
+    It follows the KVCache interface (`shape`, `cat` and `copy`), hence it can be used as a drop-in
+    replacement in the attention layers and in the tree-commit path.
+
+    NOTE : this is a memory-sharing mechanism, not a speedup. The attention layers take contiguous keys and values,
+    so `cat` writes only the appended positions into the pages but returns the whole cached sequence gathered out of
+    them (see `gather`). This copy of O(batch_size x num_key_value_heads x length x head_dim) per layer and step, which
+    the preallocated KVCache does not pay, is the price of sharing the pool without a paged attention kernel; only the
+    pages covering `length` are read, not the capacity of the table.
+
+    Attributes:
+        data (torch.Tensor): The pages of this layer, of shape [num_pages, num_key_value_heads, page_size, head_dim].
+        page_table (PageTable): The pages held by the sequence.
+        current_length (torch.Tensor): Current length of the data being stored, shared with the callers.
+        length (int): Host copy of `current_length`, so that appending does not read the tensor back.
+    """
+
+    def __init__(self, data, page_table, current_length):
+        """
+        Initialize the PagedKVCache.
+
+        Args:
+            data (torch.Tensor): The pages of this layer.
+            page_table (PageTable): The pages held by the sequence.
+            current_length (int): Initial length of the data.
+        """
+        self.data = data
+        self.page_table = page_table
+        self.current_length = current_length
+        self.length = int(current_length)
+        # the tree-commit path moves all layers through the page table, which keeps their lengths up to date
+        page_table.caches.append(self)
+
+    @property
+    def shape(self):
+        """Return the shape of the stored keys or values with updated length."""
+        return (
+            self.page_table.batch_size,
+            self.data.shape[1],
+            self.length,
+            self.data.shape[3],
+        )
+
+    def gather(self, length: int):
+        """
+        Gather the first `length` positions into a contiguous tensor.
+
+        Only the `ceil(length / page_size)` pages in use are indexed, with one gather over the page table; the
+        copy is proportional to `length`.
+
+        Args:
+            length (int): Number of positions to gather.
+
+        Returns:
+            torch.Tensor: Keys or values of shape [batch_size, num_key_value_heads, length, head_dim].
+        """
+        num_pages = -(-length // self.page_table.pool.page_size)
+        pages = self.data[self.page_table.table(self.data.device)[:, :num_pages]]
+        pages = pages.transpose(1, 2).flatten(2, 3)
+        return pages[:, :, :length]
+
+    def copy(self, indices: torch.Tensor, prev_length: int, dim: int = 2):
+        """
+        Copy values from the current data at specified indices to a new location.
+
+        Args:
+            indices (torch.Tensor): Positions to be copied.
+            prev_length (int): Previous length before adding new data.
+            dim (int, optional): Dimension along which copying should be performed. Only 2 is supported.
+        """
+        dst_positions = torch.arange(prev_length, prev_length + indices.shape[0])
+        src_pages, src_offsets = self.page_table.slots(indices, self.data.device)
+        dst_pages, dst_offsets = self.page_table.slots(dst_positions, self.data.device)
+        self.data[dst_pages, :, dst_offsets] = self.data[src_pages, :, src_offsets]
+        self.length = prev_length + indices.shape[0]
+        self.current_length.fill_(self.length)
+
+    def cat(self, tensor: torch.Tensor, dim: int = 2):
+        """
+        Append the given tensor to the current data.
+
+        Args:
+            tensor (torch.Tensor): The tensor to be appended, of shape [batch_size, num_key_value_heads, n, head_dim].
+            dim (int, optional): The dimension along which concatenation should be done. Only 2 is supported.
+
+        Returns:
+            torch.Tensor: The keys or values up to the current length.
+        """
+        start = self.length
+        length = start + tensor.shape[dim]
+        self.page_table.reserve(length)
+        pages, offsets = self.page_table.append_slots(start, length, self.data.device)
+        self.data[pages, :, offsets] = tensor.transpose(1, 2)
+        self.length = length
+        self.current_length.fill_(length)
+        return self.gather(length)
+
+
+def initialize_kv_page_pool(model, num_pages, page_size=64):
+    """
+    Initialize a pool of key-value pages for a given transformer model.
+
+    Pages are placed on the device of the layers they belong to, following `initialize_past_key_values`.
+
+    Args:
+        model (nn.Module): The transformer model for which the pool is initialized.
+        num_pages (int): Number of pages in the pool. A sequence with `batch_size` rows and `length` positions
+            holds `batch_size * ceil(length / page_size)` pages.
+        page_size (int, optional): Number of positions per page. Default is 64.
+
+    Returns:
+        KVPagePool: The pool of pages.
+    """
+    config = model.config
+
+    devices=[]
+    for i in range(config.num_hidden_layers):
+        try:
+            device = model.model.layers[i].self_attn.q_proj.weight.device
+        except:
+            device=model.layers[i].self_attn.q_proj.weight.device
+        devices.append(device)
+
+    # group consecutive layers on the same device into one tensor of pages
+    data_list=[]
+    layer_slices=[]
+    startnum=0
+    for id,i in enumerate(devices):
+        if id > 0 and devices[id - 1]!=i:
+            data_list.append((devices[id - 1], startnum))
+            startnum=0
+        layer_slices.append((len(data_list), 2 * startnum))
+        startnum += 1
+    data_list.append((devices[-1], startnum))
+
+    data_list = [
+        torch.zeros(
+            num * 2,
+            num_pages,
+            config.num_key_value_heads,
+            page_size,
+            config.hidden_size // config.num_attention_heads,
+            device=device,
+            dtype=model.dtype,
+        )
+        for device, num in data_list
+    ]
+    return KVPagePool(data_list, layer_slices, page_size)
+
+
+def initialize_paged_past_key_values(pool, batch_size=1):
+    """
+    Initialize past key and value states of one sequence backed by a KVPagePool.
+
+    The returned structures mirror `initialize_past_key_values`, with the page table in place of the
+    preallocated data tensors.
+
+    Args:
+        pool (KVPagePool): The pool the pages are drawn from.
+        batch_size (int, optional): Number of rows of the sequence. Default is 1.
+
+    Returns:
+        tuple:
+            - past_key_values (list): A list of PagedKVCache objects for each layer in the model.
+            - page_table (PageTable): The pages held by the sequence. Release it once the sequence is finished.
+            - current_length_data (torch.Tensor): A tensor tracking the current length of keys/values in the cache.
+    """
+    page_table = PageTable(pool, batch_size=batch_size)
+    num_layers = len(pool.layer_slices)
+    # [IMPORTANT] It needs to be kept on CPU for quick access and updates.
+    current_length_data = torch.zeros(num_layers * 2, dtype=torch.long, device="cpu")
+
+    past_key_values = []
+    for i, (data_index, row) in enumerate(pool.layer_slices):
+        past_key_values.append(
+            [
+                PagedKVCache(pool.data_list[data_index][row + j], page_table, current_length_data[i * 2 + j])
+                for j in range(2)
+            ]
+        )
+    return past_key_values, page_table, current_length_data
+
+
+def commit_past_key_values(past_key_values_data, indices, prev_length):
+    """
+    Move the keys and values of the accepted tree tokens right after the committed prefix, for all layers.
+
+    Args:
+        past_key_values_data (list or PageTable): The data returned by `initialize_past_key_values` or the page
+            table returned by `initialize_paged_past_key_values`.
+        indices (torch.Tensor): Positions of the accepted tokens, of shape [n] when they are shared by all rows
+            or of shape [batch_size, n] when every row accepted different positions.
+        prev_length (int or list): Length of the committed prefix, or of the committed prefix of every row when the
+            rows have different lengths (e.g., both branches of sequential CFG in one storage, see
+            `initialize_cfg_past_key_values`).
+
+    Returns:
+        int or list: The new length of the cache, or of every row.
+    """
+    if isinstance(prev_length, (list, tuple)):
+        # every row is written after its own prefix, with one gather and one scatter per device
+        num_tokens = indices.shape[-1]
+        dst_indices = torch.tensor(prev_length)[:, None] + torch.arange(num_tokens)[None]
+        for data in past_key_values_data:
+            shape = (data.shape[0], -1, data.shape[2], -1, data.shape[4])
+            index = indices.to(data.device)[None, :, None, :, None].expand(*shape)
+            tgt = data.gather(-2, index)
+            dst_index = dst_indices.to(data.device)[None, :, None, :, None].expand(*shape)
+            data.scatter_(-2, dst_index, tgt)
+        return [length + num_tokens for length in prev_length]
+
+    if isinstance(past_key_values_data, PageTable):
+        past_key_values_data.copy(indices, prev_length)
+    else:
+        for data in past_key_values_data:
+            if indices.dim() == 1:
+                tgt = data[..., indices.to(data.device), :]
+            else:
+                # [batch_size, n] -> [num_layers * 2, batch_size, num_key_value_heads, n, head_dim]
+                index = indices.to(data.device)[None, :, None, :, None]
+                index = index.expand(data.shape[0], -1, data.shape[2], -1, data.shape[4])
+                tgt = data.gather(-2, index)
+            dst = data[..., prev_length: prev_length + tgt.shape[-2], :]
+            dst.copy_(tgt, non_blocking=True)
+    return prev_length + indices.shape[-1]
+
+
+def initialize_cfg_past_key_values(model):
+    """
+    Initialize the key-value caches of both branches of sequential CFG as the two rows of one storage.
+
+    The branches keep their own caches and lengths, but their accepted tokens are committed together by
+    `commit_past_key_values` with a length per row.
+
+    Args:
+        model (nn.Module): The transformer model for which past key-value states need to be initialized.
+
+    Returns:
+        tuple:
+            - past_key_values (dict): The KVCache objects of each layer, under "cond" and "uncond".
+            - past_key_values_data (list): The storage shared by both branches, with the conditional branch in the
+                first row.
+            - current_length_data (dict): The tensors tracking the current length of each branch.
+    """
+    past_key_values, past_key_values_data, _ = initialize_past_key_values(model, batch_size=2)
+    cfg_past_key_values, cfg_current_length_data = {}, {}
+    for row, key in enumerate(["cond", "uncond"]):
+        cfg_past_key_values[key], cfg_current_length_data[key] = select_past_key_values_rows(
+            past_key_values, slice(row, row + 1)
+        )
+    return cfg_past_key_values, past_key_values_data, cfg_current_length_data
+
+
+def snapshot_past_key_values(past_key_values, length, start=0):
+    """
+    Copy the positions `[start, length)` of the key-value caches of all layers, e.g., to restore a prefix shared by
+    several sequences with `restore_past_key_values`.
+
+    Args:
+        past_key_values (list): KVCache or PagedKVCache objects for each layer.
+        length (int): End of the positions to copy.
+        start (int, optional): Start of the positions to copy. Default is 0.
+
+    Returns:
+        list: The keys and values of each layer, of shape [batch_size, num_key_value_heads, length - start, head_dim].
+    """
+    snapshot = []
+    for layer_past_key_values in past_key_values:
+        layer_snapshot = []
+        for cache in layer_past_key_values:
+            if isinstance(cache, PagedKVCache):
+                layer_snapshot.append(cache.gather(length)[:, :, start:].clone())
+            else:
+                layer_snapshot.append(cache.data[:, :, start:length].clone())
+        snapshot.append(layer_snapshot)
+    return snapshot
+
+
+def restore_past_key_values(past_key_values, snapshot):
+    """
+    Append the keys and values returned by `snapshot_past_key_values` to the key-value caches of all layers.
+
+    Args:
+        past_key_values (list): KVCache or PagedKVCache objects for each layer.
+        snapshot (list): The keys and values of each layer.
+    """
+    for layer_past_key_values, layer_snapshot in zip(past_key_values, snapshot):
+        for cache, tensor in zip(layer_past_key_values, layer_snapshot):
+            cache.cat(tensor.to(cache.data.device))
+
+
+def select_past_key_values_rows(past_key_values, rows):
+    """
+    View some rows of the key-value caches of a batch as the caches of a smaller batch.
+
+    This is used to prefill a single prompt into its rows of a running batch: the view starts empty and writes
+    through to the storage of the batch, while the other rows are left untouched.
+
+    Args:
+        past_key_values (list): KVCache or PagedKVCache objects for each layer.
+        rows (slice): Rows to view, e.g., `slice(b, None, batch_size)` for both CFG rows of the b-th prompt.
+
+    Returns:
+        tuple:
+            - past_key_values (list): The caches of the selected rows.
+            - current_length_data (torch.Tensor): A tensor tracking the current length of the view.
+    """
+    # [IMPORTANT] It needs to be kept on CPU for quick access and updates.
+    current_length_data = torch.zeros(len(past_key_values) * 2, dtype=torch.long, device="cpu")
+
+    page_tables = {}
+    past_key_values_rows = []
+    for i, layer_past_key_values in enumerate(past_key_values):
+        layer_rows = []
+        for j, cache in enumerate(layer_past_key_values):
+            if isinstance(cache, PagedKVCache):
+                if id(cache.page_table) not in page_tables:
+                    page_tables[id(cache.page_table)] = cache.page_table.select(rows)
+                layer_rows.append(
+                    PagedKVCache(cache.data, page_tables[id(cache.page_table)], current_length_data[i * 2 + j])
+                )
+            else:
+                layer_rows.append(KVCache(cache.data[rows], current_length_data[i * 2 + j]))
+        past_key_values_rows.append(layer_rows)
+    return past_key_values_rows, current_length_data
+
+
+class TreeAttentionMask:
+    """
+    Attention masks of the tree steps (verification in the base model, drafting in the drafter), built in place into
+    preallocated buffers.
+
+    The mask of a tree step is made of the committed prefix, visible to every query unless it is padded, and of the
+    tree block in its last columns. Between two steps the prefix only grows, so only its new columns and the tree block
+    are written: the cost of a step is O(tree_len x (new_tokens + tree_len)) instead of O(tree_len x total_kv).
+    There is one buffer per (KV cache, batch size, number of queries, dtype, device), sized to the longest KV seen so
+    far: the branches of sequential CFG take their steps in turn, each in its own cache and with its own prefix, and
+    would otherwise rewrite the prefix of the other branch at every step.
+
+    `reset` must be called whenever the attention mask of the prefix is rewritten rather than extended, e.g., when the
+    rows of a batch are compacted or a new prompt is admitted.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        self.lengths = {}
+        # the buffers and lengths of the steps given a KV cache, which go away with the cache
+        self.branches = weakref.WeakKeyDictionary()
+
+    def reset(self):
+        """Forget the prefix written into the buffers, which are kept allocated."""
+        self.lengths.clear()
+        for _, lengths in self.branches.values():
+            lengths.clear()
+
+    def __call__(self, attention_mask, tree_mask, input_shape, past_key_values_length, dtype, device, cache=None):
+        """
+        Return the mask of a tree step.
+
+        Args:
+            attention_mask (torch.Tensor): Padding mask of shape [bsz, seq_len], or None if nothing is padded. The
+                positions after `seq_len` are visible.
+            tree_mask (torch.Tensor): Tree mask of shape [1 or bsz, 1, tgt_seq_len, tree_len], nonzero where a query
+                attends to a tree token; the tree tokens are the last `tree_len` ones.
+            input_shape (tuple): The shape (bsz, tgt_seq_len) of the queries.
+            past_key_values_length (int): Length of the KV cache before the queries.
+            dtype (torch.dtype): torch.bool for a boolean mask (True where attention is allowed), or a float dtype for
+                an additive mask.
+            device (torch.device): Device of the mask.
+            cache (KVCache, optional): A KV cache of the step, e.g., the keys of its first layer, identifying the
+                branch whose prefix is kept in the buffer. The steps without a cache share one buffer.
+
+        Returns:
+            torch.Tensor: A view of shape [bsz, 1, tgt_seq_len, past_key_values_length + tgt_seq_len] of the buffer,
+                which is overwritten by the next step of the same shape and cache.
+        """
+        bsz, tgt_len = input_shape
+        src_len = past_key_values_length + tgt_len
+        prefix_len = src_len - tree_mask.shape[-1]
+        if dtype == torch.bool:
+            visible, masked = True, False
+        else:
+            visible, masked = 0.0, torch.finfo(dtype).min
+
+        if cache is None:
+            buffers, lengths = self.buffers, self.lengths
+        else:
+            if cache not in self.branches:
+                self.branches[cache] = ({}, {})
+            buffers, lengths = self.branches[cache]
+
+        key = (bsz, tgt_len, attention_mask is None, dtype, str(device))
+        buffer = buffers.get(key)
+        if buffer is None or buffer.shape[-1] < src_len:
+            max_len = max(src_len, 2 * buffer.shape[-1] if buffer is not None else 0)
+            buffer = torch.empty((bsz, 1, tgt_len, max_len), dtype=dtype, device=device)
+            buffers[key] = buffer
+            lengths[key] = 0
+
+        # the columns of the prefix written by the previous steps are still valid; the ones after them are new or
+        # held the previous tree block
+        length = min(lengths.get(key, 0), prefix_len)
+        if length < prefix_len:
+            if attention_mask is None:
+                buffer[:, :, :, length:prefix_len] = visible
+            else:
+                new_mask = attention_mask[:, length:prefix_len].to(device=device, dtype=torch.bool)
+                if new_mask.shape[1] < prefix_len - length:
+                    new_mask = F.pad(new_mask, (0, prefix_len - length - new_mask.shape[1]), "constant", True)
+                buffer[:, :, :, length:prefix_len] = torch.where(new_mask, visible, masked)[:, None, None, :]
+        lengths[key] = prefix_len
+
+        # the tree tokens are causal as well, which only matters for a tree block wider than the queries
+        tree_block = tree_mask.to(device) != 0
+        tree_block = tree_block & (
+            torch.arange(prefix_len, src_len, device=device)[None, :]
+            <= torch.arange(past_key_values_length, src_len, device=device)[:, None]
+        )
+        if attention_mask is not None and attention_mask.shape[1] > prefix_len:
+            tree_padding = attention_mask[:, prefix_len:src_len].to(device=device, dtype=torch.bool)
+            tree_padding = F.pad(tree_padding, (0, src_len - prefix_len - tree_padding.shape[1]), "constant", True)
+            tree_block = tree_block & tree_padding[:, None, None, :]
+        buffer[:, :, :, prefix_len:src_len] = torch.where(tree_block, visible, masked)
+        return buffer[:, :, :, :src_len]
+
+
+class TokenBuffer:
+    """
+    The committed tokens (or attention mask) of a batch, in a preallocated buffer with a write cursor.
+
+    The tokens accepted at a step are written in place after the cursor instead of concatenated to a new tensor, so
+    the cost of a step is O(new_tokens) instead of O(seq_len). The capacity is doubled if it is ever exceeded.
+
+    Attributes:
+        data (torch.Tensor): The buffer of shape [bsz, capacity].
+        length (int): Number of committed tokens per row.
+    """
+
+    def __init__(self, tokens, capacity=0):
+        self.data = tokens.new_zeros((tokens.shape[0], max(capacity, tokens.shape[1] + 1)))
+        self.length = 0
+        self.assign(tokens)
+
+    def view(self):
+        """Return the committed tokens, as a view of shape [bsz, length] of the buffer."""
+        return self.data[:, :self.length]
+
+    def reserve(self, length):
+        if length > self.data.shape[1]:
+            data = self.data.new_zeros((self.data.shape[0], max(length, 2 * self.data.shape[1])))
+            data[:, :self.length] = self.view()
+            self.data = data
+
+    def assign(self, tokens):
+        """Replace the committed tokens, e.g., when the rows of a batch are compacted or a new prompt is admitted."""
+        if tokens.shape[0] != self.data.shape[0]:
+            self.data = self.data.new_zeros((tokens.shape[0], max(self.data.shape[1], tokens.shape[1] + 1)))
+        self.reserve(tokens.shape[1] + 1)
+        # a view of the buffer (e.g., `view()` sliced or written in place) needs no copy
+        if not (
+            tokens.data_ptr() == self.data.data_ptr()
+            and tokens.shape[0] == self.data.shape[0]
+            and tokens.stride() == self.data.stride()
+        ):
+            self.data[:, :tokens.shape[1]] = tokens.to(self.data.device)
+        self.length = tokens.shape[1]
+        return self.view()
+
+    def append(self, tokens):
+        """Commit `tokens` of shape [bsz, n] after the cursor and return the committed tokens."""
+        self.reserve(self.length + tokens.shape[1] + 1)
+        self.data[:, self.length:self.length + tokens.shape[1]] = tokens.to(self.data.device)
+        self.length += tokens.shape[1]
+        return self.view()
+
+    def lookahead(self, tokens):
+        """
+        Return the committed tokens followed by `tokens` of shape [bsz, n], without committing them (e.g., the input of
+        the drafter, which ends with the sampled token). The view is overwritten by the next `append` or `lookahead`.
+        """
+        self.reserve(self.length + tokens.shape[1])
+        self.data[:, self.length:self.length + tokens.shape[1]] = tokens.to(self.data.device)
+        return self.data[:, :self.length + tokens.shape[1]]
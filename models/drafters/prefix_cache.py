@@ -0,0 +1,165 @@
+import heapq
+import itertools
+
+import torch
+
+
+def num_bytes(blocks):
+    # size of the tensors of nested dicts and lists of blocks
+    if isinstance(blocks, torch.Tensor):
+        return blocks.numel() * blocks.element_size()
+    if isinstance(blocks, dict):
+        return sum(num_bytes(v) for v in blocks.values())
+    if isinstance(blocks, (list, tuple)):
+        return sum(num_bytes(v) for v in blocks)
+    return 0
+
+
+def concat_kv_blocks(blocks):
+    """
+    Concatenate consecutive blocks of keys and values, as returned by `snapshot_past_key_values`, along the positions.
+    """
+    return [[torch.cat(kv, dim=2) for kv in zip(*layers)] for layers in zip(*blocks)]
+
+
+class PrefixCacheNode:
+    """
+    A block of prompt tokens in the radix tree of a PromptPrefixCache.
+
+    Attributes:
+        tokens (tuple): The tokens of the block.
+        parent (PrefixCacheNode): The node of the previous block, or the root.
+        children (dict): The nodes of the next blocks, keyed by their tokens.
+        blocks: The cached data of the block, e.g., its keys and values.
+        num_bytes (int): Size of the cached data.
+        last_access (int): Tick of the last lookup or insertion that used the node.
+    """
+
+    def __init__(self, tokens, parent, blocks=None):
+        self.tokens = tokens
+        self.parent = parent
+        self.children = {}
+        self.blocks = blocks
+        self.num_bytes = num_bytes(blocks)
+        self.last_access = 0
+
+
+class PromptPrefixCache:
+    """
+    A radix tree of prompt prefixes, split into blocks of `block_size` tokens, holding the data of their prefill.
+
+    A prompt reuses the blocks of the longest cached prefix and computes only the rest. Blocks are evicted in least
+    recently used order, leaves first, once the cached data exceeds `max_bytes`.
+
+    Attributes:
+        max_bytes (int): Memory budget of the cached data.
+        block_size (int): Number of tokens per block.
+        num_bytes (int): Size of the cached data.
+        hits (int): Number of lookups that reused at least one block.
+        misses (int): Number of lookups that reused no block.
+        hit_tokens (int): Number of prompt tokens reused by the lookups.
+        lookup_tokens (int): Number of prompt tokens looked up.
+    """
+
+    def __init__(self, max_bytes, block_size=16):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.root = PrefixCacheNode((), None)
+        self.num_bytes = 0
+        self.num_nodes = 0
+        self.clock = itertools.count(1)
+
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.lookup_tokens = 0
+
+    def lookup(self, tokens, max_length):
+        """
+        Find the longest cached prefix of a prompt.
+
+        Args:
+            tokens (list): Tokens of the prompt.
+            max_length (int): Maximum length of the prefix, e.g., to keep some tokens to compute.
+
+        Returns:
+            list: The nodes of the cached blocks of the prefix, in order.
+        """
+        tick = next(self.clock)
+        nodes = []
+        node = self.root
+        for start in range(0, max_length - self.block_size + 1, self.block_size):
+            node = node.children.get(tuple(tokens[start:start + self.block_size]))
+            if node is None:
+                break
+            node.last_access = tick
+            nodes.append(node)
+
+        if nodes:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.hit_tokens += len(nodes) * self.block_size
+        self.lookup_tokens += max_length
+        return nodes
+
+    def insert(self, nodes, tokens, blocks):
+        """
+        Add the blocks following a cached prefix, then evict blocks until the cache fits its budget.
+
+        Args:
+            nodes (list): The nodes of the cached prefix, as returned by `lookup`.
+            tokens (list): Tokens of the prompt.
+            blocks (list): The data of the next blocks, in order.
+        """
+        tick = next(self.clock)
+        node = nodes[-1] if nodes else self.root
+        start = len(nodes) * self.block_size
+        for i, block in enumerate(blocks):
+            key = tuple(tokens[start + i * self.block_size:start + (i + 1) * self.block_size])
+            if key not in node.children:
+                node.children[key] = PrefixCacheNode(key, node, block)
+                self.num_bytes += node.children[key].num_bytes
+                self.num_nodes += 1
+            node = node.children[key]
+            node.last_access = tick
+        self.evict()
+
+    def evict(self):
+        if self.num_bytes <= self.max_bytes:
+            return
+
+        # the leaves are evicted first so that every cached block keeps its prefix
+        leaves = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            if not node.children and node is not self.root:
+                leaves.append((node.last_access, id(node), node))
+        heapq.heapify(leaves)
+
+        while self.num_bytes > self.max_bytes and leaves:
+            _, _, node = heapq.heappop(leaves)
+            parent = node.parent
+            del parent.children[node.tokens]
+            self.num_bytes -= node.num_bytes
+            self.num_nodes -= 1
+            if not parent.children and parent is not self.root:
+                heapq.heappush(leaves, (parent.last_access, id(parent), parent))
+
+    def clear(self):
+        self.root = PrefixCacheNode((), None)
+        self.num_bytes = 0
+        self.num_nodes = 0
+
+    def stats(self):
+        """Return the counters of the cache."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_tokens": self.hit_tokens,
+            "lookup_tokens": self.lookup_tokens,
+            "num_blocks": self.num_nodes,
+            "num_bytes": self.num_bytes,
+        }
@@ -0,0 +1,244 @@
+import os
+import hashlib
+import functools
+
+import torch
+
+TOPK = 10  # topk for sparse tree
+
+# bump when the layout of the compiled buffers changes, so that stale files on disk are ignored
+TREE_BUFFERS_VERSION = 1
+TREE_BUFFERS_CACHE_DIR = os.getenv(
+    "TREE_BUFFERS_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "peanut", "tree_buffers")
+)
+
+
+def canonical_tree_choices(tree_choices):
+    """
+    Return the canonical form of a static tree: a tuple of paths sorted by depth and then lexicographically.
+
+    Args:
+        tree_choices (list): Paths of the tree, e.g., `mc_sim_7b_63`.
+
+    Returns:
+        tuple: The sorted paths as tuples.
+    """
+    return tuple(sorted((tuple(path) for path in tree_choices), key=lambda x: (len(x), x)))
+
+
+def tree_hash(tree_choices):
+    """Return a stable hash of a static tree, used to name its compiled buffers on disk."""
+    key = (TREE_BUFFERS_VERSION, TOPK, canonical_tree_choices(tree_choices))
+    return hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+
+
+def compile_tree_buffers(tree_choices):
+    """
+    Compile all buffers of a static tree (EAGLE v1) in a single pass over its paths.
+
+    The verifier buffers are the ones of `generate_tree_buffers` in the EAGLE models, and the drafter buffers
+    (under "drafter") are the ones of `generate_tree_buffers` in the drafters. All tensors are on CPU.
+
+    Args:
+        tree_choices (list): Paths of the tree, e.g., `mc_sim_7b_63`.
+
+    Returns:
+        dict: The verifier buffers ("tree_attn_mask", "tree_indices", "tree_position_ids", "retrieve_indices",
+            "p_indices", "b_indices") and the drafter buffers ("attn_mask", "tree_indices", "position_ids",
+            "repeat_nums").
+    """
+    sorted_tree_choices = canonical_tree_choices(tree_choices)
+    tree_len = len(sorted_tree_choices) + 1
+    path_index = {path: i for i, path in enumerate(sorted_tree_choices)}
+
+    depth_counts = [0 for _ in range(len(sorted_tree_choices[-1]))]
+    for path in sorted_tree_choices:
+        depth_counts[len(path) - 1] += 1
+
+    # verifier: every node attends to the root, its ancestors and itself
+    tree_attn_mask = torch.eye(tree_len, tree_len)
+    tree_attn_mask[:, 0] = 1
+    for i, path in enumerate(sorted_tree_choices):
+        ancestor_idx = [path_index[path[:c + 1]] + 1 for c in range(len(path) - 1)]
+        tree_attn_mask[i + 1, ancestor_idx] = 1
+
+    # verifier: position of every node in the drafted top-k tokens, and its siblings drafted before it
+    tree_indices = [0 for _ in range(tree_len)]
+    p_indices = [0 for _ in range(tree_len - 1)]
+    b_indices = [[] for _ in range(tree_len - 1)]
+    start = 0
+    bias = 0
+    for i in range(len(depth_counts)):
+        inlayer_bias = 0
+        b = []
+        for j in range(depth_counts[i]):
+            cur_tree_choice = sorted_tree_choices[start + j]
+            cur_parent = cur_tree_choice[:-1]
+            if j != 0:
+                if cur_parent != parent:
+                    bias += 1
+                    inlayer_bias += 1
+                    parent = cur_parent
+                    b = []
+            else:
+                parent = cur_parent
+            tree_indices[start + j + 1] = cur_tree_choice[-1] + TOPK * (i + bias) + 1
+            p_indices[start + j] = inlayer_bias
+            b_indices[start + j] = list(b)
+            b.append(cur_tree_choice[-1] + TOPK * (i + bias) + 1)
+        start += depth_counts[i]
+
+    p_indices = [-1] + p_indices
+    tree_position_ids = [0] + [len(path) for path in sorted_tree_choices]
+
+    # verifier: root-to-leaf paths, visiting the deepest paths first
+    retrieve_indices_nest = []
+    retrieve_paths = set()
+    for cur_tree_choice in reversed(sorted_tree_choices):
+        if cur_tree_choice in retrieve_paths:
+            continue
+        retrieve_indice = []
+        for c in range(len(cur_tree_choice)):
+            retrieve_indice.append(path_index[cur_tree_choice[:c + 1]] + 1)
+            retrieve_paths.add(cur_tree_choice[:c + 1])
+        retrieve_indices_nest.append(retrieve_indice)
+    max_length = max(len(x) for x in retrieve_indices_nest)
+    retrieve_indices = [[0] + path + [-1] * (max_length - len(path)) for path in retrieve_indices_nest]
+
+    maxitem = max(max(path) for path in retrieve_indices) + 5
+    retrieve_indices = sorted(retrieve_indices, key=lambda path: [x if x >= 0 else maxitem for x in path])
+    retrieve_indices = torch.tensor(retrieve_indices, dtype=torch.long)
+
+    p_indices_new = torch.tensor(p_indices)[retrieve_indices]
+
+    # the siblings are given by their position in the tree; the first node of a drafted index wins
+    tree_index_position = {}
+    for position, index in enumerate(tree_indices):
+        tree_index_position.setdefault(index, position)
+    b_indices = [[]] + b_indices
+    b_indices_new = []
+    for path in retrieve_indices.tolist():
+        iblist = []
+        for index in path:
+            b = b_indices[index] if index != -1 else []
+            if len(b) > 0:
+                iblist.append(torch.tensor([tree_index_position[bi] for bi in b]))
+            else:
+                iblist.append([])
+        b_indices_new.append(iblist)
+
+    # drafter: only the nodes with children are expanded, level by level
+    parent_paths = {path[:-1] for path in sorted_tree_choices if len(path) > 1}
+    nodes_wc = [path for path in sorted_tree_choices if path in parent_paths]
+    node_index = {path: i for i, path in enumerate(nodes_wc)}
+
+    drafter_depth_counts = [0 for _ in range(len(sorted_tree_choices[-1]) - 1)]
+    for path in nodes_wc:
+        drafter_depth_counts[len(path) - 1] += 1
+
+    drafter_attn_mask = torch.eye(len(nodes_wc), len(nodes_wc))
+    for i, path in enumerate(nodes_wc):
+        drafter_attn_mask[i, [node_index[path[:c + 1]] for c in range(len(path))]] = 1
+
+    drafter_attn_masks = []
+    drafter_tree_indices = []
+    repeat_nums = []
+    start = 0
+    for depth_count in drafter_depth_counts:
+        drafter_attn_masks.append(drafter_attn_mask[start:start + depth_count, :start + depth_count][None, None])
+
+        level_tree_indices = torch.zeros(depth_count, dtype=torch.long)
+        level_repeat_nums = []
+        bias = 0
+        repeat_j = 0
+        for j in range(depth_count):
+            cur_parent = nodes_wc[start + j][:-1]
+            if j != 0 and cur_parent != parent:
+                bias += 1
+                level_repeat_nums.append(j - repeat_j)
+                repeat_j = j
+            parent = cur_parent
+            level_tree_indices[j] = nodes_wc[start + j][-1] + TOPK * bias
+        level_repeat_nums.append(depth_count - repeat_j)
+
+        drafter_tree_indices.append(level_tree_indices)
+        repeat_nums.append(level_repeat_nums)
+        start += depth_count
+
+    return {
+        "tree_attn_mask": tree_attn_mask[None, None],
+        "tree_indices": torch.tensor(tree_indices, dtype=torch.long),
+        "tree_position_ids": torch.tensor(tree_position_ids, dtype=torch.long),
+        "retrieve_indices": retrieve_indices,
+        "p_indices": p_indices_new,
+        "b_indices": b_indices_new,
+        "drafter": {
+            "attn_mask": drafter_attn_masks,
+            "tree_indices": drafter_tree_indices,
+            "position_ids": [torch.zeros(depth_count, dtype=torch.long) for depth_count in drafter_depth_counts],
+            "repeat_nums": repeat_nums,
+        },
+    }
+
+
+def to_device(buffers, device):
+    # moves the tensors of nested dicts and lists of buffers to the given device
+    if isinstance(buffers, torch.Tensor):
+        return buffers.to(device)
+    if isinstance(buffers, dict):
+        return {k: to_device(v, device) for k, v in buffers.items()}
+    if isinstance(buffers, list):
+        return [to_device(v, device) for v in buffers]
+    return buffers
+
+
+@functools.lru_cache(maxsize=32)
+def load_tree_buffers(sorted_tree_choices):
+    """
+    Return the compiled buffers of a canonical static tree on CPU, compiling them only if they are neither in memory
+    nor on disk (under `TREE_BUFFERS_CACHE_DIR`).
+    """
+    path = os.path.join(TREE_BUFFERS_CACHE_DIR, f"{tree_hash(sorted_tree_choices)}.pt")
+    if os.path.exists(path):
+        try:
+            return torch.load(path)
+        except Exception:
+            # a corrupted or incompatible file is compiled again below
+            pass
+
+    tree_buffers = compile_tree_buffers(sorted_tree_choices)
+    try:
+        os.makedirs(TREE_BUFFERS_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(tree_buffers, tmp_path)
+        os.replace(tmp_path, path)
+    except OSError:
+        # the cache on disk is an optimization only
+        pass
+    return tree_buffers
+
+
+@functools.lru_cache(maxsize=32)
+def load_tree_buffers_on_device(sorted_tree_choices, device):
+    return to_device(load_tree_buffers(sorted_tree_choices), device)
+
+
+def get_tree_buffers(tree_choices, device="cuda"):
+    """
+    Return the verifier buffers of a static tree on the given device, memoized by the canonical form of the tree.
+
+    The returned dict is a new one at every call, so that callers can add their own entries; the buffers themselves
+    are shared and must not be modified in place.
+    """
+    tree_buffers = load_tree_buffers_on_device(canonical_tree_choices(tree_choices), str(device))
+    return {k: v for k, v in tree_buffers.items() if k != "drafter"}
+
+
+def get_drafter_tree_buffers(tree_choices, device="cuda"):
+    """
+    Return the drafter buffers of a static tree on the given device, memoized by the canonical form of the tree.
+
+    See `get_tree_buffers` for the sharing of the buffers.
+    """
+    tree_buffers = load_tree_buffers_on_device(canonical_tree_choices(tree_choices), str(device))
+    return dict(tree_buffers["drafter"])
@@ -1,4 +1,3 @@
-import copy
 import json
 import time
 from typing import List, Optional
@@ -14,7 +13,8 @@ import numpy as np
 
 from .kv_variants.modeling_llamagen_kv import LlamaForCausalLM as KVLlamaForCausalLM
 from .drafters.utils import *
-from .drafters.kv_cache import initialize_past_key_values
+from .drafters.kv_cache import commit_past_key_values, initialize_past_key_values, TokenBuffer
+from .drafters.acceptance import latent_neighbours, lantern_relaxed_probs, lantern_relaxed_tree_probs
 
 from .drafters.cnets_llamagen import Model
 from .configs.configs import EConfig
@@ -142,7 +142,11 @@ class EaModel(nn.Module):
         self.ea_layer.init_tree()
         ea_model_dir = os.path.dirname(ea_model_config_path)
         nearest_latents_path = hf_hub_download(ea_model_path, "top_16383_indices.npy")
-        self.nearest_latents = np.load(nearest_latents_path)
+        self.register_buffer(
+            "nearest_latents", torch.from_numpy(np.load(nearest_latents_path)).long().to(device), persistent=False
+        )
+        # statistics of the last generation that do not fit in the return values of `generate`
+        self.generation_stats = None
 
     # def get_tokenizer(self):
     #     """Get the tokenizer of the base model.
@@ -284,143 +288,7 @@ class EaModel(nn.Module):
         return path + [pad_value] * (length - len(path))
         
     def generate_tree_buffers(self, tree_choices, device="cuda"):
-        sorted_tree_choices = sorted(tree_choices, key=lambda x: (len(x), x))
-        tree_len = len(sorted_tree_choices) + 1
-
-        # Initialize depth_counts to keep track of how many choices have a particular depth
-        depth_counts = []
-        prev_depth = 0
-        for path in sorted_tree_choices:
-            depth = len(path)
-            if depth != prev_depth:
-                depth_counts.append(0)
-            depth_counts[depth - 1] += 1
-            prev_depth = depth
-
-        tree_attn_mask = torch.eye(tree_len, tree_len)
-        tree_attn_mask[:, 0] = 1
-        start = 0
-        for i in range(len(depth_counts)):
-            for j in range(depth_counts[i]):
-                cur_tree_choice = sorted_tree_choices[start + j]
-                # retrieve ancestor position
-                if len(cur_tree_choice) == 1:
-                    continue
-                ancestor_idx = []
-                for c in range(len(cur_tree_choice) - 1):
-                    ancestor_idx.append(sorted_tree_choices.index(cur_tree_choice[:c + 1]) + 1)
-                tree_attn_mask[j + start + 1, ancestor_idx] = 1
-            start += depth_counts[i]
-
-        tree_indices = torch.zeros(tree_len, dtype=torch.long)
-        p_indices = [0 for _ in range(tree_len - 1)]
-        b_indices = [[] for _ in range(tree_len - 1)]
-        tree_indices[0] = 0
-        start = 0
-        bias = 0
-        for i in range(len(depth_counts)):
-            inlayer_bias = 0
-            b = []
-            for j in range(depth_counts[i]):
-                cur_tree_choice = sorted_tree_choices[start + j]
-                cur_parent = cur_tree_choice[:-1]
-                if j != 0:
-                    if cur_parent != parent:
-                        bias += 1
-                        inlayer_bias += 1
-                        parent = cur_parent
-                        b = []
-                else:
-                    parent = cur_parent
-                tree_indices[start + j + 1] = cur_tree_choice[-1] + TOPK * (i + bias) + 1
-                p_indices[start + j] = inlayer_bias
-                if len(b) > 0:
-                    b_indices[start + j] = copy.deepcopy(b)
-                else:
-                    b_indices[start + j] = []
-                b.append(cur_tree_choice[-1] + TOPK * (i + bias) + 1)
-            start += depth_counts[i]
-
-        p_indices = [-1] + p_indices
-        tree_position_ids = torch.zeros(tree_len, dtype=torch.long)
-        start = 0
-        for i in range(len(depth_counts)):
-            tree_position_ids[start + 1: start + depth_counts[i] + 1] = i + 1
-            start += depth_counts[i]
-
-        retrieve_indices_nest = []
-        retrieve_paths = []
-        for i in range(len(sorted_tree_choices)):
-            cur_tree_choice = sorted_tree_choices[-i - 1]
-            retrieve_indice = []
-            if cur_tree_choice in retrieve_paths:
-                continue
-            else:
-                for c in range(len(cur_tree_choice)):
-                    retrieve_indice.append(sorted_tree_choices.index(cur_tree_choice[:c + 1]))
-                    retrieve_paths.append(cur_tree_choice[:c + 1])
-            retrieve_indices_nest.append(retrieve_indice)
-        max_length = max([len(x) for x in retrieve_indices_nest])
-        retrieve_indices = [self.pad_path(path, max_length) for path in retrieve_indices_nest]
-        retrieve_indices = torch.tensor(retrieve_indices, dtype=torch.long)
-        retrieve_indices = retrieve_indices + 1
-        retrieve_indices = torch.cat([torch.zeros((retrieve_indices.shape[0], 1), dtype=torch.long), retrieve_indices],
-                                    dim=1)
-
-        maxitem = retrieve_indices.max().item() + 5
-
-        def custom_sort(lst):
-            # sort_keys=[len(list)]
-            sort_keys = []
-            for i in range(len(lst)):
-                sort_keys.append(lst[i] if lst[i] >= 0 else maxitem)
-            return sort_keys
-
-        retrieve_indices = retrieve_indices.tolist()
-        retrieve_indices = sorted(retrieve_indices, key=custom_sort)
-        retrieve_indices = torch.tensor(retrieve_indices, dtype=torch.long)
-
-        p_indices = torch.tensor(p_indices)
-        p_indices_new = p_indices[retrieve_indices]
-        p_indices_new = p_indices_new.tolist()
-
-        b_indices = [[]] + b_indices
-        b_indices_new = []
-        for ib in range(retrieve_indices.shape[0]):
-            iblist = []
-            for jb in range(retrieve_indices.shape[1]):
-                index = retrieve_indices[ib, jb]
-                if index == -1:
-                    iblist.append([])
-                else:
-                    b = b_indices[index]
-                    if len(b) > 0:
-                        bt = []
-                        for bi in b:
-                            bt.append(torch.where(tree_indices == bi)[0].item())
-                        iblist.append(torch.tensor(bt, device=device))
-                    else:
-                        iblist.append(b)
-            b_indices_new.append(iblist)
-
-        # Aggregate the generated buffers into a dictionary
-        tree_buffers = {
-            "tree_attn_mask": tree_attn_mask.unsqueeze(0).unsqueeze(0),
-            "tree_indices": tree_indices,
-            "tree_position_ids": tree_position_ids,
-            "retrieve_indices": retrieve_indices,
-        }
-
-        # Move the tensors in the dictionary to the specified device
-        tree_buffers = {
-            k: v.clone().to(device)
-            if isinstance(v, torch.Tensor)
-            else torch.tensor(v, device=device)
-            for k, v in tree_buffers.items()
-        }
-        tree_buffers["p_indices"] = p_indices_new
-        tree_buffers["b_indices"] = b_indices_new
-        return tree_buffers
+        return generate_tree_buffers(tree_choices, device)
     
     @torch.no_grad()
     def initialize_tree(self, cond_combined, past_key_values, logits_processor, cfg_scale, attention_mask = None):
@@ -500,8 +368,6 @@ class EaModel(nn.Module):
             # Gather probabilities of xi
             px = gtp.gather(dim=-1, index=xi_valid.unsqueeze(-1)).squeeze(-1)  # Shape: (batch_size, seq_len)
             px = px * valid_mask  
-            if isinstance(self.nearest_latents, np.ndarray):
-                self.nearest_latents = torch.from_numpy(self.nearest_latents).to(device)
             if not lantern:
                 # Greedy decoding
                 top_tokens = torch.argmax(logits[:, :-1], dim=-1)  # Shape: (batch_size, seq_len)
@@ -599,6 +465,10 @@ class EaModel(nn.Module):
 
         else:
             cart_candidates_prob = cart_candidates_prob.to(logits.device)
+            if lantern:
+                lantern_px, lantern_relaxed = lantern_relaxed_tree_probs(
+                    logits, candidates, self.nearest_latents, lantern_k, lantern_delta, logits_processor=logits_processor
+                )
             accept_length = 1
             accept_cand = candidates[0][:1]
             best_candidate = 0
@@ -622,20 +492,11 @@ class EaModel(nn.Module):
                         r = random.random()
                         px = gtp[xi]
                         if lantern:
-                            nearest_probs = gtp[self.nearest_latents[xi, :lantern_k]].reshape(lantern_k, 1)
-                            cumsum_nearest_probs = torch.cumsum(nearest_probs, dim=0)
-                            if lantern_delta > 1.0:
-                                indices = (cumsum_nearest_probs <= (lantern_delta - 1) * px).nonzero(as_tuple=True)[0]
-                            else:
-                                indices = (cumsum_nearest_probs <= lantern_delta).nonzero(as_tuple=True)[0]
-                            if indices.numel() == 0:
-                                indices = -1
+                            if not adjustflag:
+                                px, relaxed = lantern_px[j, i - 1], lantern_relaxed[j, i - 1]
                             else:
-                                indices = indices[-1]
-                            if indices == -1:
-                                px = px
-                            else:
-                                px = px + cumsum_nearest_probs[indices]
+                                neighbours = latent_neighbours(x[None], self.nearest_latents, lantern_k)
+                                px, relaxed = lantern_relaxed_probs(px[None], gtp[neighbours], lantern_delta)
                         qx = cart_candidates_prob[j, i]
                         if qx <= 0:
                             continue
@@ -653,8 +514,8 @@ class EaModel(nn.Module):
                                 q[mask] = 0
                                 q = q / q.sum()
                             if lantern:
-                                if (indices != -1):
-                                    q[self.nearest_latents[xi, :lantern_k + 1]] = 0
+                                if relaxed:
+                                    q[latent_neighbours(x, self.nearest_latents, lantern_k + 1)] = 0
                             gtp = gtp - q
                             gtp[gtp < 0] = 0
 
@@ -675,6 +536,7 @@ class EaModel(nn.Module):
     def reset_tree_mode(self):
         self.base_model.model.tree_mode = True
         self.base_model.model.tree_mask = None
+        self.base_model.model.tree_attention_mask.reset()
     
     def generate_candidates(self, tree_logits, tree_indices, retrieve_indices, sample_token, logits_processor):
         sample_token = sample_token.to(tree_indices.device)
@@ -711,6 +573,10 @@ class EaModel(nn.Module):
     
     def evaluate_posterior(self, logits, candidates, logits_processor=None, lantern=False, lantern_k=1000, lantern_delta=0.1):
         if logits_processor is not None:
+            if lantern:
+                lantern_px, lantern_relaxed = lantern_relaxed_tree_probs(
+                    logits, candidates, self.nearest_latents, lantern_k, lantern_delta, logits_processor=logits_processor
+                )
             accept_length = 1
             accept_cand = candidates[0][:1]
             best_candidate = 0
@@ -744,21 +610,11 @@ class EaModel(nn.Module):
                         r = random.random()
                         px = gtp[xi]
                         if lantern:
-                            nearest_probs = gtp[self.nearest_latents[xi, :lantern_k]].reshape(lantern_k, 1)
-                            cumsum_nearest_probs = torch.cumsum(nearest_probs, dim=0)
-
-                            if lantern_delta > 1.0:
-                                indices = (cumsum_nearest_probs <= (lantern_delta - 1) * px).nonzero(as_tuple=True)[0]
-                            else:
-                                indices = (cumsum_nearest_probs <= lantern_delta).nonzero(as_tuple=True)[0]
-                            if indices.numel() == 0:
-                                indices = -1
+                            if not adjustflag:
+                                px, relaxed = lantern_px[j, i - 1], lantern_relaxed[j, i - 1]
                             else:
-                                indices = indices[-1]
-                            if indices == -1:
-                                px = px
-                            else:
-                                px = px + cumsum_nearest_probs[indices]
+                                neighbours = latent_neighbours(x[None], self.nearest_latents, lantern_k)
+                                px, relaxed = lantern_relaxed_probs(px[None], gtp[neighbours], lantern_delta)
                         
                         qx = 1.0
                         acp = px / qx
@@ -772,8 +628,8 @@ class EaModel(nn.Module):
                             gtp[xi] = 0
                             
                             if lantern:
-                                if (indices != -1):
-                                    gtp[self.nearest_latents[xi, :lantern_k+1]] = 0
+                                if relaxed:
+                                    gtp[latent_neighbours(x, self.nearest_latents, lantern_k + 1)] = 0
                             
                             if gtp.sum() == 0:
                                 gtp = torch.ones_like(gtp)
@@ -810,8 +666,6 @@ class EaModel(nn.Module):
             # Gather probabilities of xi
             px = gtp.gather(dim=-1, index=xi_valid.unsqueeze(-1)).squeeze(-1)  # Shape: (batch_size, seq_len)
             px = px * valid_mask  
-            if isinstance(self.nearest_latents, np.ndarray):
-                self.nearest_latents = torch.from_numpy(self.nearest_latents).to(device)
             if not lantern:
                 # Greedy decoding
                 top_tokens = torch.argmax(logits[:, :-1], dim=-1)  # Shape: (batch_size, seq_len)
@@ -937,7 +791,7 @@ class EaModel(nn.Module):
     @torch.no_grad()
     def update_inference_inputs(
         self,
-        input_ids,
+        token_buffer,
         candidates,
         best_candidate,
         accept_length,
@@ -951,29 +805,18 @@ class EaModel(nn.Module):
         cfg_scale,
         static_tree=False
     ):
-        prev_input_len = input_ids.shape[1]
+        prev_input_len = token_buffer.length
 
-        select_indices = (
-                retrieve_indices[best_candidate, : accept_length + 1] + prev_input_len
-        )
+        # only the accepted path of the tree is gathered, the other paths are never materialized
+        accept_indices = retrieve_indices[best_candidate, : accept_length + 1]
+        select_indices = accept_indices + prev_input_len
 
-        input_ids = torch.cat(
-            [input_ids, candidates[None, best_candidate, : accept_length + 1]], dim=-1
-        )
-        # Update the past key values based on the selected tokens
-        # Source tensor that contains relevant past information based on the selected candidate
-        for past_key_values_data in past_key_values_data_list:
-            tgt = past_key_values_data[..., select_indices.to(past_key_values_data.device), :]
-            # Destination tensor where the relevant past information will be stored
-            dst = past_key_values_data[..., prev_input_len: prev_input_len + tgt.shape[-2], :]
-            # Copy relevant past information from the source to the destination
-            dst.copy_(tgt, non_blocking=True)
-
-        # Update the current length tensor (currently only support batch size is 1)
-        current_length_data.fill_(prev_input_len + tgt.shape[-2])
-
-        retrieve_hidden_state_new = hidden_state_new[:, retrieve_indices]
-        accept_hidden_state_new = retrieve_hidden_state_new[:, best_candidate, : accept_length + 1]
+        input_ids = token_buffer.append(candidates[None, best_candidate, : accept_length + 1])
+        # Update the past key values of both CFG rows and all layers based on the selected tokens, with one gather
+        # per device (currently only support batch size is 1)
+        current_length_data.fill_(commit_past_key_values(past_key_values_data_list, select_indices, prev_input_len))
+
+        accept_hidden_state_new = hidden_state_new[:, accept_indices.to(hidden_state_new.device)]
         # token=model.base_model.lm_head(accept_hidden_state_new[:,-1]).argmax()
         # token=token[None,None]
         prob = sample_p
@@ -984,7 +827,8 @@ class EaModel(nn.Module):
             token = torch.argmax(prob)
             token = token[None, None]
         # hidden_state = torch.cat((hidden_state, accept_hidden_state_new), dim=1)
-        ea_input_ids = torch.cat((input_ids, token.to(input_ids.device)), dim=1).repeat(2, 1)
+        # both CFG rows of the drafter share the committed tokens
+        ea_input_ids = token_buffer.lookahead(token).expand(2, -1)
         
         if static_tree:
             tree_logits = self.ea_layer.topK_genrate_v1(accept_hidden_state_new,
@@ -1105,9 +949,16 @@ class EaModel(nn.Module):
             draft_tokens, retrieve_indices,tree_mask,tree_position_ids, logits, hidden_state, sample_token = self.initialize_tree(
                 cond_combined, past_key_values, logits_processor, cfg, attention_mask
             )
+        if sample_token.is_cuda:
+            torch.cuda.synchronize(sample_token.device)
+        prefill_time = time.time() - st
 
         max_steps = max_length
-        input_ids = torch.zeros((max_batch_size, 120), dtype=torch.long).to(cond_combined.device)
+        # the committed tokens are appended in place to a preallocated buffer
+        token_buffer = TokenBuffer(
+            torch.zeros((max_batch_size, 120), dtype=torch.long).to(cond_combined.device), 120 + max_length + 64
+        )
+        input_ids = token_buffer.view()
         new_token=0
         for idx in range(max_steps):
             if static_tree:
@@ -1122,7 +973,7 @@ class EaModel(nn.Module):
                     logits, candidates, logits_processor, cart_candidates_prob, tree_logits[2], tree_buffers["p_indices"], tree_candidates, tree_buffers["b_indices"], lantern, lantern_k, lantern_delta
                 )
                 input_ids, tree_logits, new_token, hidden_state, sample_token= self.update_inference_inputs(
-                    input_ids,
+                    token_buffer,
                     candidates,
                     best_candidate,
                     accept_length,
@@ -1151,7 +1002,7 @@ class EaModel(nn.Module):
                 best_candidate, accept_length, sample_p = self.evaluate_posterior(logits, candidates,  logits_processor, lantern=lantern, lantern_k=lantern_k, lantern_delta=lantern_delta)
                 
                 input_ids, draft_tokens, retrieve_indices,tree_mask,tree_position_ids, new_token, hidden_state, sample_token = self.update_inference_inputs(
-                    input_ids,
+                    token_buffer,
                     candidates,
                     best_candidate,
                     accept_length,
@@ -1170,6 +1021,7 @@ class EaModel(nn.Module):
                 accept_length_list.append(accept_length+1)
             if new_token > max_length:
                 break
+        self.generation_stats = {"prefill_time": prefill_time, "decode_steps": len(accept_length_list)}
         return input_ids[:, 120:120+max_length], sum(accept_length_list)/len(accept_length_list), time.time()-st
     
     @torch.no_grad()
@@ -2,8 +2,6 @@ import os
 import copy
 import json
 import time
-import math
-import random
 from tqdm import tqdm
 from typing import List, Tuple
 
@@ -14,8 +12,23 @@ from huggingface_hub import hf_hub_download
 from transformers.generation.logits_process import LogitsProcessor, LogitsWarper
 
 from .kv_variants.modeling_lumina_mgpt_kv import ChameleonForConditionalGeneration as KVChameleonForConditionalGeneration
-from .drafters.cnets_lumina_mgpt import Model
-from .drafters.kv_cache import initialize_past_key_values
+from .drafters.cnets_lumina_mgpt import (
+    ImageVocabHead, Model, cfg_head, splice_forced_tokens, stack_retrieve_indices, vocab_token_ids,
+)
+from .drafters.kv_cache import (
+    commit_past_key_values,
+    initialize_cfg_past_key_values,
+    initialize_kv_page_pool,
+    initialize_past_key_values,
+    initialize_paged_past_key_values,
+    restore_past_key_values,
+    select_past_key_values_rows,
+    snapshot_past_key_values,
+    TokenBuffer,
+)
+from .drafters.acceptance import evaluate_posterior_tensorized, max_num_children
+from .drafters.prefix_cache import PromptPrefixCache, concat_kv_blocks
+from .drafters.tree_buffers import get_tree_buffers
 from .drafters.choices import *
 
 from .configs.configs import EConfig
@@ -23,6 +36,18 @@ from .configs.configs import EConfig
 TOPK=10
 
 class MultiModalLogitsProcessor(LogitsProcessor):
+    """
+    Constrain the tokens sampled inside an image according to their position: image tokens, a new line token at the
+    end of every row and the image end token after the last row.
+
+    The scores are constrained in place, without full-vocabulary temporaries: the columns of the tokens that are not
+    image tokens are set to -inf in every row, then the rows of the new line and image end positions are set to -inf
+    except for their forced token, which keeps its score and leaves the (one-hot) distribution unchanged. Scores over
+    a subset of the vocabulary (e.g., the logits of an `ImageVocabHead`) are constrained through the token ids of
+    their columns.
+    """
+
+    IMAGE, NEW_LINE, IMAGE_END = 0, 1, 2
 
     def __init__(
         self,
@@ -33,25 +58,33 @@ class MultiModalLogitsProcessor(LogitsProcessor):
         self.image_next_line_token_id = image_next_line_token_id
         self.image_end_token_id = image_end_token_id
 
-        self.vocab_list = [i for i in range(voc_size)]
-        self.image_token_list = [i for i in range(4, 8195 + 1)]
-        self.suppress_tokens = torch.tensor(
-            [x for x in self.vocab_list if x not in self.image_token_list], device="cuda"
-        )
-
-        self.vocab_tensor = torch.arange(voc_size, device="cuda")
-        self.suppress_token_mask = torch.isin(self.vocab_tensor, self.suppress_tokens)
-
-    def __call__(self, scores, h_latent_dim=48, w_latent_dim=48,
-                    image_start_token_id_index=None, position_ids=None):
-        # inputs:
-        #   - scores: [seq_len, vocab_size]
-        #   - image_start_token_id_index: []
-        #   - position_ids: [seq_len]
-
-        if position_ids is None:
-            return scores
-
+        # [vocab_size], True for the tokens allowed at the image token positions
+        self.image_tokens = torch.zeros(voc_size, dtype=torch.bool)
+        self.image_tokens[4:8195 + 1] = True
+        # [num_position_classes], token forced at every position class (-1 if it is not forced)
+        self.class_forced_tokens = torch.tensor([-1, image_next_line_token_id, image_end_token_id])
+
+        # column indices of the constraints on the device of the scores
+        self.cached_constraints = {}
+
+    def get_constraints(self, scores, token_ids=None):
+        # Returns:
+        #   - masked_columns: [num_masked_columns], columns of the tokens that are not image tokens
+        #   - forced_columns: [num_position_classes], column of the forced token of every position class (-1 if the
+        #     token is not forced, or if it is not among the columns)
+        key = (scores.device, None if token_ids is None else token_ids.data_ptr())
+        if key not in self.cached_constraints:
+            image_tokens, forced_columns = self.image_tokens, self.class_forced_tokens
+            if token_ids is not None:
+                token_ids = token_ids.cpu()
+                image_tokens = image_tokens[token_ids]
+                matches = token_ids[None, :] == forced_columns[:, None] # [num_position_classes, num_tokens]
+                forced_columns = torch.where(matches.any(dim=1), matches.long().argmax(dim=1), -1)
+            masked_columns = (~image_tokens).nonzero().squeeze(1)
+            self.cached_constraints[key] = (masked_columns.to(scores.device), forced_columns.to(scores.device))
+        return self.cached_constraints[key]
+
+    def position_classes(self, position_ids, h_latent_dim=48, w_latent_dim=48, image_start_token_id_index=None):
         # num_generated_image_tokens indicates the number of pure image tokens
         # (i.e., number of tokens after 8197, 8828, 8828) generated so far
         if image_start_token_id_index is None:
@@ -65,26 +98,53 @@ class MultiModalLogitsProcessor(LogitsProcessor):
         
         # hence the num_generated_image_token + 1 indicates the position of the token
         # generated by the given `scores`
-        
-        image_constrained_mask = ((num_generated_image_tokens + 1) % (w_latent_dim + 1)) != 0
-        if image_constrained_mask.sum() > 0:
-            image_constrained_scores = torch.where(self.suppress_token_mask, -float('inf'), scores)
-            scores = torch.where(image_constrained_mask[:, None], image_constrained_scores, scores)
-
-        new_line_mask = ((num_generated_image_tokens + 1) % (w_latent_dim + 1)) == 0
-        if new_line_mask.sum() > 0:
-            new_line_constrained_scores = torch.full_like(scores, -math.inf)
-            new_line_constrained_scores[:, self.image_next_line_token_id] = 0
-            scores = torch.where(new_line_mask[:, None], new_line_constrained_scores, scores)
-
-        eos_image_mask = (num_generated_image_tokens + 1) == (w_latent_dim + 1) * h_latent_dim + 1
-        if eos_image_mask.sum() > 0:
-            eos_image_constrained_scores = torch.full_like(scores, -math.inf)
-            eos_image_constrained_scores[:, self.image_end_token_id] = 0
-            scores = torch.where(eos_image_mask[:, None], eos_image_constrained_scores, scores)
+        next_position = num_generated_image_tokens + 1
 
+        position_class = torch.where(
+            next_position % (w_latent_dim + 1) == 0, self.NEW_LINE, self.IMAGE
+        )
+        position_class = torch.where(
+            next_position == (w_latent_dim + 1) * h_latent_dim + 1, self.IMAGE_END, position_class
+        )
+        return position_class
+
+    def forced_tokens(self, position_ids, h_latent_dim=48, w_latent_dim=48, image_start_token_id_index=None):
+        # inputs:
+        #   - position_ids: [...], positions given to `__call__`
+        # Returns the token forced at every position (the new line or the image end token), or -1 if it is not forced
+        position_class = self.position_classes(position_ids, h_latent_dim, w_latent_dim, image_start_token_id_index)
+        forced_tokens = torch.where(position_class == self.NEW_LINE, self.image_next_line_token_id, -1)
+        forced_tokens = torch.where(position_class == self.IMAGE_END, self.image_end_token_id, forced_tokens)
+        return forced_tokens
+
+    def __call__(self, scores, h_latent_dim=48, w_latent_dim=48,
+                    image_start_token_id_index=None, position_ids=None, token_ids=None):
+        # inputs:
+        #   - scores: [seq_len, vocab_size], or [seq_len, num_tokens] for the tokens `token_ids`
+        #   - image_start_token_id_index: []
+        #   - position_ids: [seq_len]
+        #   - token_ids: [num_tokens], global token id of every column of `scores` (None for the whole vocabulary)
+        # NOTE : `scores` is modified in place
+
+        if position_ids is None:
+            return scores
+
+        position_class = self.position_classes(position_ids, h_latent_dim, w_latent_dim, image_start_token_id_index)
+        masked_columns, forced_columns = self.get_constraints(scores, token_ids)
+        forced_columns = forced_columns[position_class.to(scores.device)][:, None] # [seq_len, 1]
+        is_forced = position_class.to(scores.device)[:, None] != self.IMAGE # [seq_len, 1]
+
+        # the score of the forced token, -inf if it is not among the columns
+        forced_scores = scores.gather(1, forced_columns.clamp(min=0))
+        forced_scores.masked_fill_(forced_columns < 0, -float('inf'))
+
+        scores.index_fill_(1, masked_columns, -float('inf'))
+        scores.masked_fill_(is_forced, -float('inf'))
+        # the image token rows write back their (already constrained) score to the column they gather from
+        restored_scores = torch.where(is_forced, forced_scores, scores.gather(1, forced_columns.clamp(min=0)))
+        scores.scatter_(1, forced_columns.clamp(min=0), restored_scores)
         return scores
-        
+
 class InterleavedTopKLogitsWarper(LogitsWarper):
     r"""
     [`LogitsWarper`] that performs top-k, i.e. restricting to the k highest probability elements. Often used together
@@ -138,143 +198,94 @@ def pad_path(path: List[int], length: int, pad_value: int = -2) -> List[int]:
     return path + [pad_value] * (length - len(path))
 
 def generate_tree_buffers(tree_choices, device="cuda"):
-    sorted_tree_choices = sorted(tree_choices, key=lambda x: (len(x), x))
-    tree_len = len(sorted_tree_choices) + 1
-
-    # Initialize depth_counts to keep track of how many choices have a particular depth
-    depth_counts = []
-    prev_depth = 0
-    for path in sorted_tree_choices:
-        depth = len(path)
-        if depth != prev_depth:
-            depth_counts.append(0)
-        depth_counts[depth - 1] += 1
-        prev_depth = depth
-
-    tree_attn_mask = torch.eye(tree_len, tree_len)
-    tree_attn_mask[:, 0] = 1
-    start = 0
-    for i in range(len(depth_counts)):
-        for j in range(depth_counts[i]):
-            cur_tree_choice = sorted_tree_choices[start + j]
-            # retrieve ancestor position
-            if len(cur_tree_choice) == 1:
-                continue
-            ancestor_idx = []
-            for c in range(len(cur_tree_choice) - 1):
-                ancestor_idx.append(sorted_tree_choices.index(cur_tree_choice[:c + 1]) + 1)
-            tree_attn_mask[j + start + 1, ancestor_idx] = 1
-        start += depth_counts[i]
-
-    tree_indices = torch.zeros(tree_len, dtype=torch.long)
-    p_indices = [0 for _ in range(tree_len - 1)]
-    b_indices = [[] for _ in range(tree_len - 1)]
-    tree_indices[0] = 0
-    start = 0
-    bias = 0
-    for i in range(len(depth_counts)):
-        inlayer_bias = 0
-        b = []
-        for j in range(depth_counts[i]):
-            cur_tree_choice = sorted_tree_choices[start + j]
-            cur_parent = cur_tree_choice[:-1]
-            if j != 0:
-                if cur_parent != parent:
-                    bias += 1
-                    inlayer_bias += 1
-                    parent = cur_parent
-                    b = []
-            else:
-                parent = cur_parent
-            tree_indices[start + j + 1] = cur_tree_choice[-1] + TOPK * (i + bias) + 1
-            p_indices[start + j] = inlayer_bias
-            if len(b) > 0:
-                b_indices[start + j] = copy.deepcopy(b)
-            else:
-                b_indices[start + j] = []
-            b.append(cur_tree_choice[-1] + TOPK * (i + bias) + 1)
-        start += depth_counts[i]
-
-    p_indices = [-1] + p_indices
-    tree_position_ids = torch.zeros(tree_len, dtype=torch.long)
-    start = 0
-    for i in range(len(depth_counts)):
-        tree_position_ids[start + 1: start + depth_counts[i] + 1] = i + 1
-        start += depth_counts[i]
-
-    retrieve_indices_nest = []
-    retrieve_paths = []
-    for i in range(len(sorted_tree_choices)):
-        cur_tree_choice = sorted_tree_choices[-i - 1]
-        retrieve_indice = []
-        if cur_tree_choice in retrieve_paths:
-            continue
-        else:
-            for c in range(len(cur_tree_choice)):
-                retrieve_indice.append(sorted_tree_choices.index(cur_tree_choice[:c + 1]))
-                retrieve_paths.append(cur_tree_choice[:c + 1])
-        retrieve_indices_nest.append(retrieve_indice)
-    max_length = max([len(x) for x in retrieve_indices_nest])
-    retrieve_indices = [pad_path(path, max_length) for path in retrieve_indices_nest]
-    retrieve_indices = torch.tensor(retrieve_indices, dtype=torch.long)
-    retrieve_indices = retrieve_indices + 1
-    retrieve_indices = torch.cat([torch.zeros((retrieve_indices.shape[0], 1), dtype=torch.long), retrieve_indices],
-                                dim=1)
-
-    maxitem = retrieve_indices.max().item() + 5
-
-    def custom_sort(lst):
-        # sort_keys=[len(list)]
-        sort_keys = []
-        for i in range(len(lst)):
-            sort_keys.append(lst[i] if lst[i] >= 0 else maxitem)
-        return sort_keys
-
-    retrieve_indices = retrieve_indices.tolist()
-    retrieve_indices = sorted(retrieve_indices, key=custom_sort)
-    retrieve_indices = torch.tensor(retrieve_indices, dtype=torch.long)
-
-    p_indices = torch.tensor(p_indices)
-    p_indices_new = p_indices[retrieve_indices]
-    p_indices_new = p_indices_new.tolist()
-
-    b_indices = [[]] + b_indices
-    b_indices_new = []
-    for ib in range(retrieve_indices.shape[0]):
-        iblist = []
-        for jb in range(retrieve_indices.shape[1]):
-            index = retrieve_indices[ib, jb]
-            if index == -1:
-                iblist.append([])
-            else:
-                b = b_indices[index]
-                if len(b) > 0:
-                    bt = []
-                    for bi in b:
-                        bt.append(torch.where(tree_indices == bi)[0].item())
-                    iblist.append(torch.tensor(bt, device=device))
-                else:
-                    iblist.append(b)
-        b_indices_new.append(iblist)
-
-    # Aggregate the generated buffers into a dictionary
-    tree_buffers = {
-        "tree_attn_mask": tree_attn_mask.unsqueeze(0).unsqueeze(0),
-        "tree_indices": tree_indices,
-        "tree_position_ids": tree_position_ids,
-        "retrieve_indices": retrieve_indices,
-    }
-
-    # Move the tensors in the dictionary to the specified device
-    tree_buffers = {
-        k: v.clone().to(device)
-        if isinstance(v, torch.Tensor)
-        else torch.tensor(v, device=device)
-        for k, v in tree_buffers.items()
-    }
-    tree_buffers["p_indices"] = p_indices_new
-    tree_buffers["b_indices"] = b_indices_new
-    return tree_buffers
+    return get_tree_buffers(tree_choices, device)
+
+class GenerationState:
+    """
+    Decoding state of a batch of prompts in EaLumina_mGPT.
+
+    The rows of a batch are decoded in lockstep by `EaLumina_mGPT.decode_step`, and a finished row can be handed a
+    new prompt with `EaLumina_mGPT.admit` so that the batch size stays fixed. Note that the drafter KV cache is held
+    by the model, hence only one state can be decoded at a time.
+    """
+
+    def __init__(self, do_sample, max_new_tokens, max_length, eos_token_ids, lantern, lantern_k, lantern_delta):
+        # sampling settings shared by all rows
+        self.do_sample = do_sample
+        self.max_new_tokens = max_new_tokens
+        self.max_length = max_length
+        self.eos_token_ids = eos_token_ids
+        self.lantern = lantern
+        self.lantern_k = lantern_k
+        self.lantern_delta = lantern_delta
+
+        # KV cache of the base model
+        self.past_key_values = None
+        self.past_key_values_data = None
+        self.current_length_data = None
+        self.page_tables = []
+
+        # committed tokens [batch_size, seq_len] and attention mask of both CFG rows [2 * batch_size, seq_len], in
+        # preallocated buffers that the accepted tokens are appended to
+        self.token_buffer = None
+        self.mask_buffer = None
+        self.eos_token_tensor = None
+
+        # drafted trees; `tree_logits` and `sample_token` are used by EAGLE v1 and the tree tensors by EAGLE v2
+        self.tree_buffers = None
+        self.tree_attn_mask = None
+        self.tree_logits = None
+        self.sample_token = None
+        self.tree_candidates = None
+        self.retrieve_indices = None
+        self.tree_mask = None
+        self.tree_position_ids = None
+        # the tokens forced after the root of every tree and the depths of its drafted nodes in the sequence, see
+        # `Model.forced_depths`
+        self.forced_tokens = None
+        self.tree_depths = None
+
+        # per-row bookkeeping
+        self.new_token = []
+        self.valid_lengths = []
+        self.output_lengths = []
+        self.accept_length_list = []
+        # time spent prefilling the prompt of every row and drafting its first tree, in seconds
+        self.prefill_times = []
+
+    @property
+    def input_ids(self):
+        return self.token_buffer.view()
+
+    @input_ids.setter
+    def input_ids(self, input_ids):
+        self.token_buffer.assign(input_ids)
+
+    @property
+    def attn_mask(self):
+        return self.mask_buffer.view()
+
+    @attn_mask.setter
+    def attn_mask(self, attn_mask):
+        self.mask_buffer.assign(attn_mask)
+
+    @property
+    def batch_size(self):
+        return self.token_buffer.data.shape[0]
+
+    @property
+    def finished(self):
+        return [length is not None for length in self.output_lengths]
+
+    @property
+    def max_new_token(self):
+        # tokens generated by the longest unfinished row, which bounds the positions drafted and verified at a step
+        return max((num_tokens for num_tokens, length in zip(self.new_token, self.output_lengths) if length is None), default=0)
+
+    def output(self, row):
+        """Return the committed tokens of a row without the left padding, the holes and the tokens after its end."""
+        tokens = self.input_ids[row][self.attn_mask[row].to(self.input_ids.device)]
+        return tokens[:self.output_lengths[row]]
 
 class EaLumina_mGPT(nn.Module):
 
@@ -302,6 +313,8 @@ class EaLumina_mGPT(nn.Module):
         self.base_model_name_or_path = base_model_name_or_path
         self.cfg_mode = cfg_mode
         self.eagle_version = eagle_version
+        if cfg_mode == "ragged":
+            self.check_ragged_cfg_attention()
         
         config = EConfig.from_pretrained(ea_model_path)
         with open(ea_model_path,"r") as f:
@@ -318,10 +331,19 @@ class EaLumina_mGPT(nn.Module):
                                 threshold=threshold
                         )
 
-        self.nearest_latents = np.load("ckpts/lumina_mgpt/vq_distances/top_8191_indices.npy")
+        # keep the latent neighbour table on the device so that LANTERN never copies indices from the host
+        self.nearest_latents = torch.from_numpy(
+            np.load("ckpts/lumina_mgpt/vq_distances/top_8191_indices.npy")
+        ).long().to("cuda")
         self.image_token_offset = 4 # image token offset; image tokens are from 4 to 8195
         self.image_tokens = torch.arange(4, 8196, device="cuda")
         self.image_syntax_tokens = torch.tensor([8196, 8197, 8803, 8828], device="cuda")
+
+        # vocabulary-sized lookup tables used by the tensorized acceptance
+        self.image_token_mask = torch.zeros(self.vocab_size, dtype=torch.bool, device="cuda")
+        self.image_token_mask[self.image_tokens] = True
+        self.image_syntax_token_mask = torch.zeros(self.vocab_size, dtype=torch.bool, device="cuda")
+        self.image_syntax_token_mask[self.image_syntax_tokens] = True
         self.image_start_token_id = 8197
 
         low_memory=False
@@ -340,12 +362,24 @@ class EaLumina_mGPT(nn.Module):
         self.ea_layer.to(self.dtype).to(device)
         self.ea_layer.init_tree()
 
-        # preemptive initialization of the logits processors since MultiModalLogitsProcessor requires significant time to initialize
+        # preemptive initialization of the logits processors
         self.internal_logits_processors = [
             MultiModalLogitsProcessor(),
         ]
         self.drafter_logits_processors = copy.deepcopy(self.internal_logits_processors)
 
+        # paged KV cache shared by concurrent generations; see `init_kv_page_pool`
+        self.kv_page_pool = None
+
+        # LM head restricted to the image vocabulary for drafting and verification; see `init_image_vocab_head`
+        self.image_vocab_head = None
+
+        # keys, values and hidden states of the unconditional prefix of sequential CFG; see `prefill_uncond_prefix`
+        self.uncond_prefix_cache = None
+
+        # prefill of the prompt prefixes shared by generations; see `init_prompt_prefix_cache`
+        self.prompt_prefix_cache = None
+
     @classmethod
     def from_pretrained(
             cls,
@@ -454,42 +488,264 @@ class EaLumina_mGPT(nn.Module):
     def reset_tree_mode(self):
         self.base_model.model.tree_mode = True
         self.base_model.model.tree_mask = None
+
+    def init_kv_page_pool(self, num_pages, page_size=64):
+        """
+        Back the KV cache of the base model with a shared pool of pages instead of a preallocated
+        `max_position_embeddings` buffer per generation.
+
+        An image takes about `prompt_len + 2357` positions (plus the draft tree) per CFG row, hence the pool
+        can be sized to the number of concurrent images rather than to the context window. This trades speed for
+        memory: every layer gathers its keys and values out of the pages at every step (see `PagedKVCache`), so
+        a single generation that fits the preallocated cache is slower with the pool, which is why it is opt-in.
+
+        Args:
+            num_pages (int): Number of pages in the pool.
+            page_size (int, optional): Number of positions per page. Default is 64.
+        """
+        self.kv_page_pool = initialize_kv_page_pool(self.base_model, num_pages, page_size=page_size)
     
+    def init_image_vocab_head(self):
+        """
+        Project the hidden states of drafting and tree verification onto the tokens allowed inside an image only
+        (image tokens and image syntax tokens) instead of the whole vocabulary. The sampling distributions are
+        unchanged since `MultiModalLogitsProcessor` masks the other tokens anyway.
+        """
+        token_ids = torch.cat((self.image_tokens, self.image_syntax_tokens)).unique()
+        self.image_vocab_head = ImageVocabHead(self.base_model.lm_head, token_ids)
+
+    def init_prompt_prefix_cache(self, max_bytes, block_size=16):
+        """
+        Cache the prefill of the prompt prefixes shared by generations, e.g., the conversation template of Lumina-mGPT,
+        so that only the rest of every prompt is prefilled by the base model and the drafter.
+
+        The prefixes are kept in a radix tree of blocks of `block_size` tokens, evicted in least recently used order
+        beyond `max_bytes`. Only sequential and ragged CFG use it, since every prompt starts at position 0 of its cache.
+
+        Args:
+            max_bytes (int): Memory budget of the cached keys, values and hidden states.
+            block_size (int, optional): Number of tokens per block. Default is 16.
+        """
+        self.prompt_prefix_cache = PromptPrefixCache(max_bytes, block_size=block_size)
+
+    def restore_prompt_prefix(self, input_ids, past_key_values):
+        """
+        Copy the longest cached prefix of a prompt into the conditional cache of the base model.
+
+        Args:
+            input_ids (torch.Tensor): The prompt with the image start tokens of shape [1, seq_len].
+            past_key_values (list): KVCache or PagedKVCache objects holding the conditional branch.
+
+        Returns:
+            tuple: The nodes of the cached prefix, its length, the hidden state of its last position and the keys and
+                values of the drafter before that position (both None if nothing is cached).
+        """
+        if self.prompt_prefix_cache is None or self.cfg_mode == "parallel":
+            return [], 0, None, None
+
+        # the image start tokens are always prefilled, see `prefill_uncond_prefix`
+        nodes = self.prompt_prefix_cache.lookup(input_ids[0].tolist(), self.image_start_token_id_index)
+        if not nodes:
+            return nodes, 0, None, None
+
+        restore_past_key_values(past_key_values, concat_kv_blocks([node.blocks["base"] for node in nodes]))
+        prefix_kv = concat_kv_blocks([node.blocks["drafter"] for node in nodes])
+        return nodes, len(nodes) * self.prompt_prefix_cache.block_size, nodes[-1].blocks["hidden_states"], prefix_kv
+
+    def cache_prompt_prefix(self, input_ids, nodes, past_key_values, hidden_states):
+        """
+        Add the blocks of a prefilled prompt that follow its cached prefix to the prompt prefix cache.
+
+        Args:
+            input_ids (torch.Tensor): The prompt with the image start tokens of shape [1, seq_len].
+            nodes (list): The nodes of the cached prefix, as returned by `restore_prompt_prefix`.
+            past_key_values (list): KVCache or PagedKVCache objects holding the conditional branch.
+            hidden_states (torch.Tensor): Hidden states of the conditional branch given to the drafter, i.e., from
+                the last position of the cached prefix, if any.
+        """
+        if self.prompt_prefix_cache is None or self.cfg_mode == "parallel":
+            return
+
+        block_size = self.prompt_prefix_cache.block_size
+        start = len(nodes) * block_size
+        offset = max(start - 1, 0) # position of `hidden_states[:, 0]`
+        blocks = []
+        for end in range(start + block_size, self.image_start_token_id_index + 1, block_size):
+            blocks.append({
+                "base": snapshot_past_key_values(past_key_values, end, start=end - block_size),
+                "hidden_states": hidden_states[:, end - 1 - offset:end - offset].clone(),
+                # the drafter pairs the hidden state of a position with the next token, hence its block is shifted
+                "drafter": snapshot_past_key_values(self.ea_layer.stable_kv, end - 1, start=max(end - block_size - 1, 0)),
+            })
+        self.prompt_prefix_cache.insert(nodes, input_ids[0].tolist(), blocks)
+
+    def head_for(self, max_new_token):
+        """
+        Return the LM head used for drafting and tree verification at a step where the rows have generated at most
+        `max_new_token` tokens.
+
+        The decision is made on the host: the image vocabulary head is used as long as every token drafted or verified
+        by the step stays inside the image, i.e., within the tree depth of the next token to generate (plus the
+        forced new line and image end tokens, which do not count towards the depth of dynamic trees).
+        """
+        if self.image_vocab_head is None:
+            return self.base_model.lm_head
+
+        if self.eagle_version == 1:
+            depth = max(len(path) for path in self.tree_choices)
+        else:
+            depth = self.ea_layer.depth
+        # the step verifies the drafted tree and drafts the next one
+        max_position = max_new_token + 2 * (depth + 4)
+        if self.image_vocab_head.covers(max_position):
+            return self.image_vocab_head
+        return self.base_model.lm_head
+
+    def prefill_uncond_prefix(self, uncond_input_ids, past_key_values):
+        """
+        Prefill the unconditional branch of sequential CFG, i.e., the image start tokens.
+
+        These tokens are the same for every prompt, hence their keys, values and hidden states are computed once per
+        model and copied into the empty unconditional cache of the later generations.
+
+        Args:
+            uncond_input_ids (torch.Tensor): The image start tokens of shape [1, n].
+            past_key_values (list): KVCache or PagedKVCache objects of the unconditional branch.
+
+        Returns:
+            torch.Tensor: The hidden states of the unconditional tokens.
+        """
+        key = tuple(uncond_input_ids[0].tolist())
+        if self.uncond_prefix_cache is not None and self.uncond_prefix_cache[0] == key:
+            _, snapshot, hidden_states = self.uncond_prefix_cache
+            restore_past_key_values(past_key_values, snapshot)
+            return hidden_states
+
+        _, hidden_states = self(
+            input_ids=uncond_input_ids,
+            past_key_values=past_key_values,
+        )
+        snapshot = snapshot_past_key_values(past_key_values, uncond_input_ids.shape[1])
+        self.uncond_prefix_cache = (key, snapshot, hidden_states)
+        return hidden_states
+
+    def check_ragged_cfg_attention(self):
+        # the branches of ragged CFG are separated by a 4D boolean mask, which flash attention would silently ignore
+        attn_implementation = getattr(self.config, "_attn_implementation", "eager")
+        if attn_implementation not in ["eager", "sdpa"]:
+            raise ValueError(
+                f"cfg_mode='ragged' requires attn_implementation 'eager' or 'sdpa', but got '{attn_implementation}'"
+            )
+
+    def ragged_cfg_forward(self, input_ids, uncond_input_ids, past_key_values, position_ids, uncond_position_ids,
+                           tree_mask=None):
+        """
+        Run both branches of CFG in a single forward of the base model, packed into one row (ragged CFG).
+
+        Unlike parallel CFG, the unconditional branch holds its image tokens only, hence no KV is stored for a masked
+        prompt. `self.kv_uncond_mask` marks the cached positions of the unconditional branch; every token attends to
+        the positions of its own branch only.
+
+        Args:
+            input_ids (torch.Tensor): New tokens of the conditional branch of shape [1, n].
+            uncond_input_ids (torch.Tensor): New tokens of the unconditional branch of shape [1, m].
+            past_key_values (list): KVCache objects of the packed row.
+            position_ids (torch.Tensor): Positions of the new conditional tokens within their branch.
+            uncond_position_ids (torch.Tensor): Positions of the new unconditional tokens within their branch.
+            tree_mask (torch.Tensor, optional): Tree attention mask of shape [1, 1, n, n] when both branches verify
+                the same draft tree.
+
+        Returns:
+            tuple: The hidden states of the conditional and unconditional tokens.
+        """
+        self.check_ragged_cfg_attention()
+        device = input_ids.device
+        num_cond, num_uncond = input_ids.shape[1], uncond_input_ids.shape[1]
+        prefix_len = self.kv_uncond_mask.shape[0]
+
+        new_uncond_mask = torch.arange(num_cond + num_uncond, device=device) >= num_cond
+        kv_uncond_mask = torch.cat((self.kv_uncond_mask, new_uncond_mask))
+
+        # causal within each branch; the tree block follows the tree mask of each branch
+        query_positions = torch.arange(prefix_len, kv_uncond_mask.shape[0], device=device)
+        key_positions = torch.arange(kv_uncond_mask.shape[0], device=device)
+        attention_mask = (key_positions[None] <= query_positions[:, None]) & (
+            kv_uncond_mask[None] == new_uncond_mask[:, None]
+        )
+        if tree_mask is not None:
+            tree_mask = tree_mask[0, 0].to(device) != 0
+            attention_mask[:, prefix_len:] = torch.block_diag(tree_mask, tree_mask)
+
+        _, hidden_states = self(
+            input_ids=torch.cat((input_ids, uncond_input_ids), dim=-1),
+            attention_mask=attention_mask[None, None],
+            past_key_values=past_key_values,
+            position_ids=torch.cat((position_ids, uncond_position_ids), dim=-1),
+        )
+        return torch.split(hidden_states, [num_cond, num_uncond], dim=1)
+
     def initialize_tree(self, input_ids, past_key_values, logits_processors,
-                        attention_mask=None, tree_attn_mask=None):
+                        attention_mask=None, position_ids=None, tree_attn_mask=None):
+        # cached prefix of the prompt, see `init_prompt_prefix_cache`
+        prefix_nodes, prefix_hidden_states, prefix_kv = [], None, None
+
         if self.cfg_mode == "parallel":
-            # NOTE : position_ids will be set automatically according to the attn_mask as position_ids = attn_mask.cumsum(dim=-1) - 1
-            _, logits, hidden_states = self(
+            # NOTE : position_ids are computed in `prepare_prompt` from the attention mask so that left-padded prompts
+            # of a batch start at position 0, and the unconditional rows at their image start token
+            _, hidden_states = self(
                 input_ids=input_ids,
                 attention_mask=attention_mask,
                 past_key_values=past_key_values,
-                output_orig=True,
+                position_ids=position_ids,
             )
 
-            logits, uncond_logits = torch.split(logits, [1, 1])
-            hidden_states, uncond_hidden_states = torch.split(hidden_states, [1, 1])
+            batch_size = input_ids.shape[0] // 2
+            hidden_states, uncond_hidden_states = torch.split(hidden_states, [batch_size, batch_size])
 
-            # reduces the input_ids to a single tensor
-            input_ids = input_ids[:-1] # [1, seq_len]
+            # reduces the input_ids to the conditional rows
+            input_ids = input_ids[:batch_size] # [batch_size, seq_len]
+        elif self.cfg_mode == "ragged":
+            # the unconditional branch starts at the image start token, right after the prompt in the packed row
+            self.image_start_token_id_index = torch.where(input_ids[0] == 8197)[0][-1].item()
+            uncond_input_ids = input_ids[:, self.image_start_token_id_index:]
+            prefix_nodes, prefix_length, prefix_hidden_states, prefix_kv = self.restore_prompt_prefix(
+                input_ids, past_key_values
+            )
+            self.kv_uncond_mask = torch.zeros(prefix_length, dtype=torch.bool, device=input_ids.device)
+
+            hidden_states, uncond_hidden_states = self.ragged_cfg_forward(
+                input_ids=input_ids[:, prefix_length:],
+                uncond_input_ids=uncond_input_ids,
+                past_key_values=past_key_values,
+                position_ids=torch.arange(prefix_length, input_ids.shape[1], device=input_ids.device)[None],
+                uncond_position_ids=torch.arange(uncond_input_ids.shape[1], device=input_ids.device)[None],
+            )
+            self.kv_uncond_mask = torch.arange(
+                input_ids.shape[1] + uncond_input_ids.shape[1], device=input_ids.device
+            ) >= input_ids.shape[1]
         else:
             # For sequential CFG, we don't need to pass attention_mask since we manually separated the input_ids
             # However, note that we need to pass attention_mask to the drafter forward (topK_generate) since it
             # uses parallel CFG regardless of the CFG mode.
-            _, logits, hidden_states = self(
-                input_ids=input_ids,
+            self.image_start_token_id_index = torch.where(input_ids[0] == 8197)[0][-1].item()
+            prefix_nodes, prefix_length, prefix_hidden_states, prefix_kv = self.restore_prompt_prefix(
+                input_ids, past_key_values["cond"]
+            )
+
+            _, hidden_states = self(
+                input_ids=input_ids[:, prefix_length:],
                 past_key_values=past_key_values["cond"],
-                output_orig=True
             )
 
-            self.image_start_token_id_index = torch.where(input_ids[0] == 8197)[0][-1].item()
             uncond_input_ids = input_ids[:, self.image_start_token_id_index:]
-            _, uncond_logits, uncond_hidden_states = self(
-                input_ids=uncond_input_ids,
-                past_key_values=past_key_values["uncond"],
-                output_orig=True
-            )
+            uncond_hidden_states = self.prefill_uncond_prefix(uncond_input_ids, past_key_values["uncond"])
+
+        if prefix_hidden_states is not None:
+            # the drafter resumes at the last cached position, whose hidden state is paired with the next token
+            hidden_states = torch.cat((prefix_hidden_states, hidden_states), dim=1)
 
-        cfg_logits = uncond_logits[:, -1] + self.cfg_scale * (logits[:, -1] - uncond_logits[:, -1])
+        # only the logits of the last position are needed, and CFG is folded into the hidden states
+        cfg_logits = cfg_head(self.base_model.lm_head, hidden_states[:, -1], uncond_hidden_states[:, -1], self.cfg_scale)
         for logits_processor in logits_processors[1:]:
             # NOTE : `input_ids[0]` produces better images but `input_ids` is the correct way to do it
             cfg_logits = logits_processor(input_ids, cfg_logits)
@@ -511,11 +767,20 @@ class EaLumina_mGPT(nn.Module):
             uncond_hidden_states=uncond_hidden_states,
             input_ids=input_ids,
             attention_mask=attention_mask,
-            head=self.base_model.lm_head,
+            head=self.head_for(0),
             logits_processors=self.drafter_logits_processors,
             tree_type="static" if self.eagle_version == 1 else "dynamic",
+            prefix_kv=prefix_kv,
         )
 
+        if self.cfg_mode != "parallel":
+            self.cache_prompt_prefix(
+                input_ids[:, :-1],
+                prefix_nodes,
+                past_key_values if self.cfg_mode == "ragged" else past_key_values["cond"],
+                hidden_states,
+            )
+
         if self.eagle_version == 1:
             return output, token
         else:
@@ -523,285 +788,337 @@ class EaLumina_mGPT(nn.Module):
 
     # Only for EAGLE v1
     def generate_candidates(self, tree_logits, tree_indices, retrieve_indices, sample_token):
+        # inputs:
+        #   - tree_logits: drafted tokens [batch_size, num_nodes, top_k], their probabilities and the drafter distributions
+        #   - sample_token: [batch_size, 1]
         sample_token = sample_token.to(tree_indices.device)
+        batch_size = sample_token.shape[0]
         
-        candidates_logit = sample_token[0]
+        candidates_logit = sample_token
         candidates_tree_logits = tree_logits[0]
-        candidates = torch.cat([candidates_logit, candidates_tree_logits.view(-1)], dim=-1)
+        candidates = torch.cat([candidates_logit, candidates_tree_logits.view(batch_size, -1)], dim=-1)
 
-        tree_candidates = candidates[tree_indices]
+        tree_candidates = candidates[:, tree_indices]
         tree_candidates_ext = torch.cat(
-            [tree_candidates, torch.zeros((1), dtype=torch.long, device=tree_candidates.device) - 1],
-            dim = 0
+            [tree_candidates, torch.zeros((batch_size, 1), dtype=torch.long, device=tree_candidates.device) - 1],
+            dim = 1
         )
 
-        cart_candidates = tree_candidates_ext[retrieve_indices]
+        cart_candidates = tree_candidates_ext[:, retrieve_indices]
 
         candidates_tree_prob = tree_logits[1]
         candidates_prob = torch.cat(
-            [torch.ones(1, device=candidates_tree_prob.device, dtype=torch.float32), candidates_tree_prob.view(-1)],
+            [torch.ones((batch_size, 1), device=candidates_tree_prob.device, dtype=torch.float32),
+             candidates_tree_prob.view(batch_size, -1)],
             dim=-1
         )
 
-        tree_candidates_prob = candidates_prob[tree_indices]
+        tree_candidates_prob = candidates_prob[:, tree_indices]
         tree_candidates_prob_ext = torch.cat(
-            [tree_candidates_prob, torch.ones((1), dtype=torch.float32, device=tree_candidates_prob.device)],
-            dim = 0
+            [tree_candidates_prob, torch.ones((batch_size, 1), dtype=torch.float32, device=tree_candidates_prob.device)],
+            dim = 1
         )
-        cart_candidates_prob = tree_candidates_prob_ext[retrieve_indices]
+        cart_candidates_prob = tree_candidates_prob_ext[:, retrieve_indices]
 
-        tree_candidates = tree_candidates.unsqueeze(0)
+        # [batch_size, num_paths, path_len], [batch_size, num_paths, path_len], [batch_size, tree_len]
         return cart_candidates, cart_candidates_prob, tree_candidates
 
     def tree_decoding(self, tree_candidates, attention_mask, past_key_values, tree_position_ids, 
-                        input_ids, retrieve_indices):
-        
-        position_ids = tree_position_ids + input_ids.shape[1]
+                        input_ids, retrieve_indices, head):
+        # inputs:
+        #   - tree_candidates: [batch_size, tree_len]
+        #   - tree_position_ids: [tree_len] (EAGLE v1) or [batch_size, tree_len] (EAGLE v2)
+        #   - retrieve_indices: [num_paths, path_len] (EAGLE v1) or [batch_size, num_paths, path_len] (EAGLE v2)
+        batch_size = tree_candidates.shape[0]
         
         if self.cfg_mode == "parallel":
             # replicate the input_ids for the parallel CFG
-            tree_candidates = torch.cat((tree_candidates, tree_candidates), dim=0)
-            position_ids = torch.cat((position_ids[None], position_ids[None] - self.image_start_token_id_index), dim=0)
+            tree_candidates = tree_candidates.repeat(2, 1)
+            if tree_position_ids.dim() == 1:
+                tree_position_ids = tree_position_ids[None].expand(batch_size, -1)
 
-            _, tree_logits, hidden_states = self(
+            # the tree continues right after the committed tokens of each row, where the unconditional rows do not
+            # count the prompt since it is masked out
+            position_ids = attention_mask.sum(dim=-1, keepdim=True) + tree_position_ids.repeat(2, 1)
+
+            _, hidden_states = self(
                 input_ids=tree_candidates,
                 attention_mask=attention_mask,
-                output_orig=True,
                 past_key_values=past_key_values,
                 position_ids=position_ids,
             )
 
-            tree_logits, uncond_tree_logits = torch.split(tree_logits, [1, 1])
-            hidden_states, uncond_hidden_states = torch.split(hidden_states, [1, 1])
+            hidden_states, uncond_hidden_states = torch.split(hidden_states, [batch_size, batch_size])
+
+            # reduce the position_ids to the image tokens, i.e., the unconditional rows
+            position_ids = position_ids[batch_size:]
 
-            # reduce the position_ids to a single tensor
-            position_ids = position_ids[0]
+        elif self.cfg_mode == "ragged":
+            position_ids = tree_position_ids + input_ids.shape[1]
+            uncond_position_ids = position_ids - self.image_start_token_id_index
+
+            # both branches verify the same tree in one forward, see `ragged_cfg_forward`
+            hidden_states, uncond_hidden_states = self.ragged_cfg_forward(
+                input_ids=tree_candidates,
+                uncond_input_ids=tree_candidates,
+                past_key_values=past_key_values,
+                position_ids=position_ids,
+                uncond_position_ids=uncond_position_ids,
+                tree_mask=self.base_model.model.tree_mask,
+            )
+
+            position_ids = uncond_position_ids
         
         else:
+            position_ids = tree_position_ids + input_ids.shape[1]
+
             # For sequential CFG, we don't need to pass attention_mask since the input_ids are already separated
-            _, tree_logits, hidden_states = self(
+            _, hidden_states = self(
                 input_ids=tree_candidates,
-                output_orig=True,
                 past_key_values=past_key_values["cond"],
                 position_ids=position_ids,
             )
 
-            # unconditional logits
-            _, uncond_tree_logits, uncond_hidden_states = self(
+            # unconditional hidden states
+            _, uncond_hidden_states = self(
                 input_ids=tree_candidates,
-                output_orig=True,
                 past_key_values=past_key_values["uncond"],
                 position_ids=position_ids - self.image_start_token_id_index,
             )
 
-        cfg_tree_logits = uncond_tree_logits + self.cfg_scale * (tree_logits - uncond_tree_logits)
+            position_ids = position_ids - self.image_start_token_id_index
+
+        cfg_tree_logits = cfg_head(head, hidden_states, uncond_hidden_states, self.cfg_scale)
 
-        # MultiModalLogitsProcessor
+        # MultiModalLogitsProcessor, over the positions of the unconditional rows, which count the image tokens from
+        # the image start token as the drafter's do (see `topK_generate`)
         cfg_tree_logits = self.internal_logits_processors[0](
-            cfg_tree_logits[0], image_start_token_id_index=self.image_start_token_id_index, position_ids=position_ids + 1
-        )
+            cfg_tree_logits.flatten(0, 1), position_ids=position_ids.flatten(), token_ids=vocab_token_ids(head)
+        ).view(cfg_tree_logits.shape)
 
         # InterleavedTopKLogitsWarper
         cfg_tree_logits = self.internal_logits_processors[1](cfg_tree_logits)
+        if isinstance(head, ImageVocabHead):
+            # the acceptance works on distributions over the global vocabulary
+            cfg_tree_logits = head.expand(cfg_tree_logits)
         
-        logits = cfg_tree_logits[retrieve_indices]
+        batch_index = torch.arange(batch_size, device=retrieve_indices.device)[:, None, None]
+        logits = cfg_tree_logits[batch_index, retrieve_indices] # [batch_size, num_paths, path_len, vocab_size]
         return logits, hidden_states, uncond_hidden_states
 
-    def evaluate_posterior(self, logits, candidates, cart_candidates_prob=None, original_prob=None,
-                            p_indices=None, tree_candidates=None, b_indices=None,
-                            do_sample=True, lantern=False, lantern_k=1000, lantern_delta=0.1):
+    def evaluate_posterior(self, logits, candidates, num_slots, cart_candidates_prob=None, original_prob=None,
+                            p_indices=None, do_sample=True, lantern=False, lantern_k=1000, lantern_delta=0.1,
+                            tree_depths=None):
+        # inputs:
+        #   - logits: [batch_size, num_paths, path_len, vocab_size]
+        #   - candidates: [batch_size, num_paths, path_len]
+        #   - cart_candidates_prob: [batch_size, num_paths, path_len] (EAGLE v1 only)
+        #   - original_prob: list of [batch_size, num_nodes_at_depth, vocab_size] (EAGLE v1 only)
+        #   - tree_depths: [batch_size, num_depths + 2], depths in the sequence of the drafted depths
         if do_sample:
-            accept_length = 1
-            accept_cand = candidates[0][:1]
-            best_candidate = 0
-
             if self.eagle_version == 1:
                 assert cart_candidates_prob is not None, "Cartesian candidate probabilities are required for EAGLE v1"
                 assert original_prob is not None, "Original probabilities are required for EAGLE v1"
-                assert tree_candidates is not None, "Tree candidates are required for EAGLE v1"
                 assert p_indices is not None, "Parent indices are required for EAGLE v1"
-                assert b_indices is not None, "B indices are required for EAGLE v1"
-                
-                cart_candidates_prob = cart_candidates_prob.to(logits.device)
-
-            # for-loop over levels
-            for i in range(1, candidates.shape[1]):
-                if i != accept_length:
-                    break
-                
-                adjustflag = False
-                is_eq = (candidates[:, :accept_length] == accept_cand).all(dim=1)
-                fi = torch.nonzero(is_eq, as_tuple=True)[0][0]
-                
-                gt_logits = logits[fi, i-1]
-                gtp = torch.softmax(gt_logits, dim=0)
-                
-                candidates_set = []
-
-                # for-loop within a level
-                for j in range(candidates.shape[0]):
-                    if is_eq[j]:
-                        x = candidates[j, i]
-                        xi = x.item()
-
-                        if xi in candidates_set or xi == -1:
-                            continue
-                        
-                        candidates_set.append(xi)
-
-                        r = random.random()
-                        px = gtp[xi]
-                        if xi in self.image_syntax_tokens:
-                            # accept immediately
-                            px = 1.0
-                        elif not xi in self.image_tokens:
-                            # reject immediately
-                            px = 0.0
-                        else:
-                            if lantern:
-                                nearest_probs = gtp[self.nearest_latents[xi - self.image_token_offset, :lantern_k]+self.image_token_offset].reshape(lantern_k, 1)
-                                cumsum_nearest_probs = torch.cumsum(nearest_probs, dim=0)
-
-                                if lantern_delta > 1.0:
-                                    indices = (cumsum_nearest_probs <= (lantern_delta - 1) * px).nonzero(as_tuple=True)[0]
-                                else:
-                                    indices = (cumsum_nearest_probs <= lantern_delta).nonzero(as_tuple=True)[0]
-                                
-                                if indices.numel() == 0:
-                                    indices = -1
-                                else:
-                                    indices = indices[-1]
-                                if indices == -1:
-                                    px = px
-                                else:
-                                    px = px + cumsum_nearest_probs[indices]
-                        
-                        if self.eagle_version == 1:
-                            qx = cart_candidates_prob[j, i]
-                            if qx <= 0:
-                                continue
-                        else:
-                            qx = 1.0
-                        
-                        acp = px / qx
-
-                        if r <= acp:
-                            accept_cand = torch.cat((accept_cand, x[None]), dim=0)
-                            accept_length += 1
-                            best_candidate = j
-                            break
-                        else:
-                            assert not xi in self.image_syntax_tokens, "Image syntax tokens should not be rejected"
-                            
-                            if self.eagle_version == 1:
-                                q = original_prob[i - 1][p_indices[j][i]].clone()
-                                b = b_indices[j][i]
-                                if len(b) > 0:
-                                    mask = tree_candidates[0][b]
-                                    q[mask] = 0
-                                    q = q / q.sum()
-                            
-                            if lantern and (xi in self.image_tokens):
-                                if (indices != -1):
-                                    gtp[self.nearest_latents[xi-self.image_token_offset, :lantern_k+1]+self.image_token_offset] = 0
-                            
-                            if self.eagle_version == 1:
-                                gtp = gtp - q
-                                gtp[gtp < 0] = 0
-                            else:
-                                gtp[xi] = 0
-
-                            if gtp.sum() == 0:
-                                gtp = torch.ones_like(gtp)
-                            
-                            gtp /= gtp.sum()
-                            adjustflag = True
-
-            if adjustflag and accept_length != candidates.shape[1]:
-                sample_p = gtp
-            else:
-                gt_logits = logits[best_candidate, accept_length-1]
-                sample_p = torch.softmax(gt_logits, dim=0)
-            
-            return torch.tensor(best_candidate), accept_length-1, sample_p
-        
+
+            # every row of the batch walks its own tree, all rows at once
+            best_candidate, accept_length, sample_p = evaluate_posterior_tensorized(
+                logits=logits,
+                candidates=candidates,
+                num_slots=num_slots,
+                image_token_mask=self.image_token_mask,
+                image_syntax_token_mask=self.image_syntax_token_mask,
+                cart_candidates_prob=cart_candidates_prob if self.eagle_version == 1 else None,
+                original_prob=original_prob if self.eagle_version == 1 else None,
+                p_indices=p_indices,
+                lantern=lantern,
+                lantern_k=lantern_k,
+                lantern_delta=lantern_delta,
+                nearest_latents=self.nearest_latents,
+                image_token_offset=self.image_token_offset,
+                tree_depths=tree_depths,
+            )
+
+            # [batch_size], [batch_size], [batch_size, vocab_size]
+            return best_candidate, accept_length, sample_p
+
         else:
             raise NotImplementedError("Greedy decoding is not implemented yet")
 
-    def update_inference_inputs(self, input_ids, attention_mask,candidates, best_candidate, accept_length,
+    def update_inference_inputs(self, token_buffer, mask_buffer, candidates, best_candidate, accept_length,
                                 retrieve_indices, do_sample, new_token, past_key_values_data,
-                                current_length_data, hidden_states_new, uncond_hidden_states_new, sample_p):
-        
+                                current_length_data, hidden_states_new, uncond_hidden_states_new, sample_p, head):
+        # NOTE : every row commits the same number of positions so that the batch stays rectangular. The accepted
+        # tokens of a row are placed at the end of the chunk and the chunk is left-padded with masked holes, hence
+        # the last token of every row is always a valid one and the drafter keeps pairing each hidden state with
+        # the following token.
+        batch_size = token_buffer.data.shape[0]
+        device = candidates.device
+        prev_input_len = token_buffer.length
+        num_accepted = max(accept_length) + 1
+
+        num_holes = num_accepted - 1 - torch.tensor(accept_length, device=device)[:, None] # [batch_size, 1]
+        offsets = torch.arange(num_accepted, device=device)[None] # [1, num_accepted]
+        valid = offsets >= num_holes # [batch_size, num_accepted]
+        depth = (offsets - num_holes).clamp(min=0) # holes repeat the root of the tree
+
+        batch_index = torch.arange(batch_size, device=device)[:, None]
+        best_index = torch.tensor(best_candidate, device=device)[:, None]
+        if retrieve_indices.dim() == 2:
+            retrieve_indices = retrieve_indices[None].expand(batch_size, -1, -1)
+        selected_tree_indices = retrieve_indices.to(device)[batch_index, best_index, depth] # [batch_size, num_accepted]
+        accepted_tokens = torch.where(valid, candidates[batch_index, best_index, depth], 0)
+
         if self.cfg_mode == "parallel":
-            prev_input_len = input_ids.shape[1]
-            selected_indices = (
-                retrieve_indices[best_candidate, : accept_length + 1] + prev_input_len
-            )
+            selected_indices = selected_tree_indices + prev_input_len
+            if batch_size == 1:
+                # a single row never has holes, which allows the cheaper slicing commit
+                selected_indices = selected_indices[0]
+            else:
+                selected_indices = selected_indices.repeat(2, 1)
 
-            for data in past_key_values_data:
-                tgt = data[..., selected_indices.to(data.device), :]
-                dst = data[..., prev_input_len: prev_input_len + tgt.shape[-2], :]
-                dst.copy_(tgt, non_blocking=True)
-            
-            current_length_data.fill_(prev_input_len + tgt.shape[-2])
+            current_length_data.fill_(commit_past_key_values(past_key_values_data, selected_indices, prev_input_len))
 
-            input_ids = torch.cat(
-                [input_ids[None, 0], candidates[None, best_candidate, : accept_length + 1].to(input_ids.device)], dim=-1
-            )
+        elif self.cfg_mode == "ragged":
+            # the accepted tokens of the conditional branch are followed by the ones of the unconditional branch
+            prev_len = self.kv_uncond_mask.shape[0]
+            selected_indices = selected_tree_indices[0] + prev_len
+            selected_indices = torch.cat((selected_indices, selected_indices + hidden_states_new.shape[1]))
 
-        else:
-            for key in ["cond", "uncond"]:
-                if key == "cond":
-                    prev_input_len = input_ids.shape[1]
-                else:
-                    prev_input_len = input_ids.shape[1] - self.image_start_token_id_index
-                
-                selected_indices = (
-                    retrieve_indices[best_candidate, : accept_length + 1] + prev_input_len
-                )
+            current_length_data.fill_(commit_past_key_values(past_key_values_data, selected_indices, prev_len))
+            committed_uncond_mask = torch.arange(2 * num_accepted, device=self.kv_uncond_mask.device) >= num_accepted
+            self.kv_uncond_mask = torch.cat((self.kv_uncond_mask, committed_uncond_mask))
 
-                for data in past_key_values_data[key]:
-                    tgt = data[..., selected_indices.to(data.device), :]
-                    dst = data[..., prev_input_len: prev_input_len + tgt.shape[-2], :]
-                    dst.copy_(tgt, non_blocking=True)
-                current_length_data[key].fill_(prev_input_len + tgt.shape[-2])
-            
-            input_ids = torch.cat(
-                [input_ids, candidates[None, best_candidate, : accept_length + 1].to(input_ids.device)], dim=-1
-            )
+        else:
+            prev_lens = [prev_input_len, prev_input_len - self.image_start_token_id_index]
+            if isinstance(past_key_values_data, dict):
+                # the branches drawn from the KV page pool have page tables of their own
+                for key, prev_len in zip(["cond", "uncond"], prev_lens):
+                    selected_indices = selected_tree_indices[0] + prev_len
+                    current_length_data[key].fill_(
+                        commit_past_key_values(past_key_values_data[key], selected_indices, prev_len)
+                    )
+            else:
+                # both branches are rows of one storage, committed with a single gather and scatter
+                selected_indices = torch.stack([selected_tree_indices[0] + prev_len for prev_len in prev_lens])
+                lengths = commit_past_key_values(past_key_values_data, selected_indices, prev_lens)
+                for key, length in zip(["cond", "uncond"], lengths):
+                    current_length_data[key].fill_(length)
 
-        retrieve_hidden_states_new = hidden_states_new[:, retrieve_indices]
-        accept_hidden_states_new = retrieve_hidden_states_new[:, best_candidate, : accept_length + 1]
+        # the accepted tokens are written in place after the committed ones
+        input_ids = token_buffer.append(accepted_tokens)
+        attention_mask = mask_buffer.append(valid.repeat(2, 1))
 
-        retrieve_uncond_hidden_states_new = uncond_hidden_states_new[:, retrieve_indices]
-        accept_uncond_hidden_states_new = retrieve_uncond_hidden_states_new[:, best_candidate, : accept_length + 1]
+        accept_hidden_states_new = hidden_states_new[batch_index, selected_tree_indices]
+        accept_uncond_hidden_states_new = uncond_hidden_states_new[batch_index, selected_tree_indices]
 
         prob = sample_p
         if do_sample:
             token = torch.multinomial(prob, 1)
-            token = token[None]
         else:
-            token = torch.argmax(prob)
-            token = token[None, None]
+            token = torch.argmax(prob, dim=-1, keepdim=True)
         
         output = self.ea_layer.topK_generate(
             hidden_states=accept_hidden_states_new,
             uncond_hidden_states=accept_uncond_hidden_states_new,
-            input_ids=torch.cat((input_ids, token.to(input_ids.device)), dim=-1),
+            input_ids=token_buffer.lookahead(token),
             attention_mask=attention_mask,
-            head=self.base_model.lm_head,
+            head=head,
             logits_processors=self.drafter_logits_processors,
             tree_type="static" if self.eagle_version == 1 else "dynamic",
         )
 
-        new_token += accept_length + 1
+        new_token = [num_tokens + length + 1 for num_tokens, length in zip(new_token, accept_length)]
+
+        return input_ids, attention_mask, output, new_token, token
+
+    def compact_inference_inputs(self, input_ids, attention_mask, past_key_values_data, current_length_data,
+                                 min_length=0):
+        """
+        Drop the left padding and the holes shared by all rows of a batch from the caches of parallel CFG.
+
+        Rows that accept fewer tokens than the others leave masked holes behind (see `update_inference_inputs`).
+        The valid positions of every row are moved to the end of a shorter, left-padded layout; positions ids are
+        derived from the attention mask, hence they are not affected.
+
+        Args:
+            input_ids (torch.Tensor): Committed tokens of shape [batch_size, seq_len].
+            attention_mask (torch.Tensor): Attention mask of shape [2 * batch_size, seq_len].
+            past_key_values_data (list or PageTable): Storage of the KV cache of the base model.
+            current_length_data (torch.Tensor): Current length of the KV cache of the base model.
+            min_length (int, optional): Minimum length of the new layout; it is padded with holes on the left if
+                needed. Default is 0.
+
+        Returns:
+            tuple: The compacted input_ids and attention_mask.
+        """
+        keep = attention_mask[:input_ids.shape[0]]
+        num_valid = keep.sum(dim=-1, keepdim=True)
+        length = max(num_valid.max().item(), min_length)
+
+        # the stable sort moves the dropped positions first and keeps the order of the valid ones
+        indices = torch.sort(keep.long(), dim=-1, stable=True).indices
+        if length > indices.shape[1]:
+            indices = torch.nn.functional.pad(indices, (length - indices.shape[1], 0))
+        indices = indices[:, -length:]
+        valid = torch.arange(length, device=keep.device)[None] >= length - num_valid
+        cfg_indices = indices.repeat(2, 1)
+
+        current_length_data.fill_(commit_past_key_values(past_key_values_data, cfg_indices, 0))
+        self.ea_layer.compact_kv(cfg_indices)
+        self.base_model.model.tree_attention_mask.reset()
+
+        input_ids = input_ids.gather(1, indices.to(input_ids.device))
+        attention_mask = attention_mask.gather(1, cfg_indices) & valid.repeat(2, 1)
+        return input_ids, attention_mask
+
+    def prepare_prompt(self, input_ids, attention_mask=None):
+        """
+        Append the image start tokens to (left-padded) prompts and build the attention masks of CFG.
+
+        Args:
+            input_ids (torch.Tensor): Prompts of shape [batch_size, prompt_len].
+            attention_mask (torch.Tensor, optional): Attention mask of the prompts, False on the left padding.
+
+        Returns:
+            tuple: The input_ids with the image start tokens, the attention mask of the conditional and unconditional
+                rows of shape [2 * batch_size, seq_len], and the input_ids and position_ids of the prefill.
+        """
+        batch_size = input_ids.shape[0]
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids, dtype=torch.bool)
 
-        return input_ids, output, new_token, token
+        # manually set the first three tokens since it is fixed for all images
+        image_start_sequence = torch.tensor([[8197, 8828, 8828]], dtype=torch.long).to(input_ids.device)
+        image_start_sequence = image_start_sequence.repeat(batch_size, 1)
+        input_ids = torch.cat((input_ids, image_start_sequence), dim=-1)
+
+        # compute the attention mask for drafter (for sequential CFG mode) or both (for parallel CFG mode)
+        num_image_tokens = image_start_sequence.shape[1] # designed to be 3
+        prompt_length = input_ids.shape[1] - num_image_tokens
+
+        zero_padding = torch.zeros((batch_size, prompt_length), dtype=torch.bool, device=input_ids.device)
+        image_attn_mask = torch.ones((batch_size, num_image_tokens), dtype=torch.bool, device=input_ids.device)
+        cond_attn_mask = torch.cat((attention_mask.bool().to(input_ids.device), image_attn_mask), dim=-1)
+        uncond_attn_mask = torch.cat((zero_padding, image_attn_mask), dim=-1)
+        attn_mask = torch.cat([cond_attn_mask, uncond_attn_mask], dim=0) # [2 * batch_size, seq_len]
+
+        if self.cfg_mode == "parallel":
+            # left padding is skipped by the positions, and the unconditional rows start at the image start token as
+            # in sequential CFG, where the tree positions continue them (see `tree_decoding`)
+            prefill_input_ids = input_ids.repeat(2, 1)
+            prefill_position_ids = (attn_mask.long().cumsum(dim=-1) - 1).clamp(min=0)
+        else:
+            prefill_input_ids = input_ids
+            prefill_position_ids = None
+
+        return input_ids, attn_mask, prefill_input_ids, prefill_position_ids
 
     @torch.no_grad()
-    def generate(
+    def start_generation(
         self,
         input_ids,
+        attention_mask=None,
         do_sample=True,
         max_new_tokens=2353,
         max_length=4096,
@@ -815,6 +1132,15 @@ class EaLumina_mGPT(nn.Module):
         tree_choices=mc_sim_7b_63,
         **kwargs
     ):
+        """
+        Prefill a batch of (left-padded) prompts and draft their first trees.
+
+        The arguments follow `generate`. The returned state is advanced with `decode_step`, refilled with `admit`
+        and released with `finish_generation`.
+
+        Returns:
+            GenerationState: The decoding state of the batch.
+        """
         # initialize the logits processors
         self.cfg_scale = cfg_scale
         self.ea_layer.cfg_scale = cfg_scale
@@ -831,15 +1157,29 @@ class EaLumina_mGPT(nn.Module):
                 InterleavedTopKLogitsWarper(image_top_k=top_k)
             )
         
-        # manually set the first three tokens since it is fixed for all images
-        image_start_sequence = torch.tensor([[8197, 8828, 8828]], dtype=torch.long).to(input_ids.device)
-        input_ids = torch.cat((input_ids, image_start_sequence), dim=-1)
+        # a batch of prompts is decoded in lockstep, which relies on the batched forward of parallel CFG
+        batch_size = input_ids.shape[0]
+        if batch_size > 1 and self.cfg_mode != "parallel":
+            raise ValueError(f"Batched generation requires cfg_mode='parallel', but got cfg_mode='{self.cfg_mode}'")
+
+        if eos_token_ids is not None and not isinstance(eos_token_ids, (list, tuple)):
+            eos_token_ids = [eos_token_ids]
 
         self.eval()
-        accept_length_list = []
+        prefill_start = time.time()
+        state = GenerationState(
+            do_sample=do_sample,
+            max_new_tokens=max_new_tokens,
+            max_length=max_length,
+            eos_token_ids=eos_token_ids,
+            lantern=lantern,
+            lantern_k=lantern_k,
+            lantern_delta=lantern_delta,
+        )
         
         input_ids = input_ids.clone()
         self.ea_layer.reset_kv()
+        self.base_model.model.tree_attention_mask.reset()
 
         if self.eagle_version == 1:
             if hasattr(self, "tree_choices") and self.tree_choices == tree_choices:
@@ -849,16 +1189,30 @@ class EaLumina_mGPT(nn.Module):
                     tree_choices, device=self.base_model.model.layers[-1].self_attn.q_proj.weight.device
                 )
                 tree_buffers["retrieve_indices_head"] = tree_buffers["retrieve_indices"].to(self.base_model.lm_head.weight.device)
-
-                if self.cfg_mode == "parallel":
-                    # double the tree buffers for parallel mode
-                    tree_buffers["tree_attn_mask"] = torch.cat((tree_buffers["tree_attn_mask"], tree_buffers["tree_attn_mask"]), dim=0)
+                tree_buffers["num_slots"] = max_num_children(tree_choices)
 
             self.tree_buffers = tree_buffers
             self.tree_choices = tree_choices
+            state.tree_buffers = tree_buffers
         
-        if hasattr(self, "past_key_values"):
-            if self.cfg_mode == "parallel":
+        # parallel CFG keeps a row per branch and prompt, ragged CFG packs both branches of the prompt into one row
+        num_rows = 2 * batch_size if self.cfg_mode == "parallel" else 1
+
+        if self.kv_page_pool is not None:
+            # draw the pages of this generation from the shared pool; they are released once it is finished
+            if self.cfg_mode != "sequential":
+                (past_key_values, past_key_values_data, current_length_data) = initialize_paged_past_key_values(self.kv_page_pool, batch_size=num_rows)
+                state.page_tables = [past_key_values_data]
+            else:
+                past_key_values, past_key_values_data, current_length_data = {}, {}, {}
+                for key in ["cond", "uncond"]:
+                    (past_key_values[key], past_key_values_data[key], current_length_data[key]) = initialize_paged_past_key_values(self.kv_page_pool)
+                state.page_tables = list(past_key_values_data.values())
+
+        elif hasattr(self, "past_key_values") and (
+            self.cfg_mode == "sequential" or self.past_key_values_data[0].shape[1] == num_rows
+        ):
+            if self.cfg_mode != "sequential":
                 past_key_values = self.past_key_values
                 past_key_values_data = self.past_key_values_data
                 current_length_data = self.current_length_data
@@ -868,151 +1222,375 @@ class EaLumina_mGPT(nn.Module):
 
             else:
                 # keep the past key values for the conditional and unconditional inputs separately
-                past_key_values, past_key_values_data, current_length_data = {}, {}, {}
+                past_key_values, current_length_data = {}, {}
+                past_key_values_data = self.past_key_values_data
                 for key in ["cond", "uncond"]:
                     past_key_values[key] = self.past_key_values[key]
-                    past_key_values_data[key] = self.past_key_values_data[key]
                     current_length_data[key] = self.current_length_data[key]
                     
                     # Reset the past key and value states
                     current_length_data[key].zero_()
 
         else:
-            if self.cfg_mode == "parallel":
-                (past_key_values, past_key_values_data, current_length_data) = initialize_past_key_values(self.base_model, batch_size=2)
+            if self.cfg_mode != "sequential":
+                # the packed row of ragged CFG holds the tokens of both branches
+                max_length = 2 * self.config.max_position_embeddings if self.cfg_mode == "ragged" else None
+                (past_key_values, past_key_values_data, current_length_data) = initialize_past_key_values(self.base_model, batch_size=num_rows, max_length=max_length)
                 self.past_key_values = past_key_values
                 self.past_key_values_data = past_key_values_data
                 self.current_length_data = current_length_data
 
             else:
-                self.past_key_values, self.past_key_values_data, self.current_length_data = {}, {}, {}
-                past_key_values, past_key_values_data, current_length_data = {}, {}, {}
-                
-                for key in ["cond", "uncond"]:
-                    (past_key_values[key], past_key_values_data[key], current_length_data[key]) = initialize_past_key_values(self.base_model)
-                    self.past_key_values[key] = past_key_values[key]
-                    self.past_key_values_data[key] = past_key_values_data[key]
-                    self.current_length_data[key] = current_length_data[key]
+                # the conditional and unconditional caches are the two rows of one storage
+                (past_key_values, past_key_values_data, current_length_data) = initialize_cfg_past_key_values(self.base_model)
+                self.past_key_values = past_key_values
+                self.past_key_values_data = past_key_values_data
+                self.current_length_data = current_length_data
+
+        state.past_key_values = past_key_values
+        state.past_key_values_data = past_key_values_data
+        state.current_length_data = current_length_data
 
-        input_len = input_ids.shape[1]
         self.reset_tree_mode()
 
-        # compute the attention mask for drafter (for sequential CFG mode) or both (for parallel CFG mode)
+        input_ids, attn_mask, prefill_input_ids, prefill_position_ids = self.prepare_prompt(input_ids, attention_mask)
         self.image_start_token_id_index = torch.where(input_ids[0] == self.image_start_token_id)[0][-1].item()
-        prompt_length = torch.where(input_ids == self.image_start_token_id)[-1].item()
-        num_image_tokens = input_ids.shape[1] - prompt_length # designed to be 3
-
-        zero_padding = torch.zeros((prompt_length), dtype=torch.bool, device=input_ids.device)
-        cond_attn_mask = torch.ones((input_ids.shape[1]), dtype=torch.bool, device=input_ids.device)
-        uncond_attn_mask = torch.cat((zero_padding, torch.ones((num_image_tokens), dtype=torch.bool, device=input_ids.device)), dim=-1)
-        attn_mask = torch.stack([cond_attn_mask, uncond_attn_mask], dim=0)
-
-        if self.cfg_mode == "parallel":
-            input_ids = input_ids.repeat(2, 1)
         
         if self.eagle_version == 1:
-            tree_logits, sample_token = self.initialize_tree(
-                input_ids=input_ids,
+            tree_attn_mask = tree_buffers["tree_attn_mask"]
+            if self.cfg_mode == "parallel":
+                # replicate the tree mask for every row of parallel mode
+                tree_attn_mask = tree_attn_mask.repeat(2 * batch_size, 1, 1, 1)
+            state.tree_attn_mask = tree_attn_mask
+
+            output, state.sample_token = self.initialize_tree(
+                input_ids=prefill_input_ids,
                 attention_mask=attn_mask,
-                tree_attn_mask=tree_buffers["tree_attn_mask"],
+                position_ids=prefill_position_ids,
+                tree_attn_mask=tree_attn_mask,
                 past_key_values=past_key_values,
                 logits_processors=logits_processors,
             )
-            tree_position_ids = tree_buffers["tree_position_ids"]
-            retrieve_indices = tree_buffers["retrieve_indices_head"]
+            state.tree_logits, (state.forced_tokens, state.tree_depths) = output[:3], output[3:]
+            state.tree_position_ids = tree_buffers["tree_position_ids"]
+            state.retrieve_indices = tree_buffers["retrieve_indices_head"]
 
         else:
-            tree_candidates, retrieve_indices, tree_mask, tree_position_ids = self.initialize_tree(
-                input_ids=input_ids,
+            (
+                state.tree_candidates, state.retrieve_indices, state.tree_mask, state.tree_position_ids,
+                state.forced_tokens, state.tree_depths,
+            ) = self.initialize_tree(
+                input_ids=prefill_input_ids,
                 attention_mask=attn_mask,
+                position_ids=prefill_position_ids,
                 past_key_values=past_key_values,
                 logits_processors=logits_processors,
             )
-            if self.cfg_mode == "parallel":
-                tree_mask = tree_mask.repeat(2, 1, 1, 1)
 
-        new_token = 0
-        pbar = tqdm(total=max_new_tokens)
-        while new_token < max_new_tokens:
-            if self.eagle_version == 1:
-                candidates, cart_candidates_prob, tree_candidates = self.generate_candidates(
-                    tree_logits=tree_logits,
-                    tree_indices=tree_buffers["tree_indices"],
-                    retrieve_indices=tree_buffers["retrieve_indices"],
-                    sample_token=sample_token
-                )
-            else:
-                self.base_model.model.tree_mask = tree_mask
-                tree_candidates = tree_candidates.to(input_ids.device)
-            
-            logits, hidden_states_new, uncond_hidden_states_new = self.tree_decoding(
-                tree_candidates=tree_candidates,
-                attention_mask=attn_mask,
-                past_key_values=past_key_values,
-                tree_position_ids=tree_position_ids,
-                input_ids=input_ids,
-                retrieve_indices=retrieve_indices,
+        # the buffers have room for the tokens of the whole image, plus the overshoot of the last step
+        capacity = input_ids.shape[1] + max_new_tokens + 64
+        state.token_buffer = TokenBuffer(input_ids, capacity)
+        state.mask_buffer = TokenBuffer(attn_mask, capacity)
+        if eos_token_ids is not None:
+            state.eos_token_tensor = torch.tensor(eos_token_ids, dtype=torch.long, device=input_ids.device)
+        state.valid_lengths = attn_mask[:batch_size].sum(dim=-1).tolist()
+        # the rows are prefilled together; `tolist` above waits for the device
+        state.prefill_times = [time.time() - prefill_start] * batch_size
+        state.new_token = [0] * batch_size
+        state.output_lengths = [None] * batch_size
+        state.accept_length_list = [[] for _ in range(batch_size)]
+        return state
+
+    @torch.no_grad()
+    def decode_step(self, state):
+        """
+        Verify the drafted trees of all rows of a batch, commit the accepted tokens and draft the next trees.
+
+        Finished rows keep decoding with the others, but their extra tokens are discarded (see
+        `GenerationState.output`).
+
+        Args:
+            state (GenerationState): The decoding state of the batch.
+
+        Returns:
+            list: The rows that finished at this step.
+        """
+        batch_size = state.batch_size
+        input_ids = state.input_ids
+        device = input_ids.device
+        batch_index = torch.arange(batch_size, device=device)[:, None, None]
+        padding = torch.full((batch_size, 1), -1, dtype=torch.long, device=device)
+
+        if self.eagle_version == 1:
+            candidates, cart_candidates_prob, tree_candidates = self.generate_candidates(
+                tree_logits=state.tree_logits,
+                tree_indices=state.tree_buffers["tree_indices"],
+                retrieve_indices=state.tree_buffers["retrieve_indices"],
+                sample_token=state.sample_token
             )
-            
-            if self.eagle_version == 1:
-                original_prob = tree_logits[2]
-                p_indices = tree_buffers["p_indices"]
-                b_indices = tree_buffers["b_indices"]
-            else:
-                padding = (torch.zeros(1, 1, dtype=torch.long) - 1).to(input_ids.device)
-                tree_candidates = torch.cat((tree_candidates, padding), dim=1)
-                candidates = tree_candidates[0, retrieve_indices]
-                cart_candidates_prob = None
-                original_prob = None
-                p_indices = None
-                b_indices = None
-
-            best_candidate, accept_length, sample_p = self.evaluate_posterior(
-                logits=logits,
-                candidates=candidates,
-                cart_candidates_prob=cart_candidates_prob,
-                original_prob=original_prob,
-                tree_candidates=tree_candidates,
-                p_indices=p_indices,
-                b_indices=b_indices,
-                do_sample=do_sample,
-                lantern=lantern,
-                lantern_k=lantern_k,
-                lantern_delta=lantern_delta,
+            tree_candidates = tree_candidates.to(device)
+            tree_position_ids = state.tree_position_ids.to(device)[None].expand(batch_size, -1)
+            tree_mask = state.tree_buffers["tree_attn_mask"].to(device).expand(batch_size, -1, -1, -1)
+            retrieve_indices = state.retrieve_indices.to(device)[None].expand(batch_size, -1, -1)
+            original_prob = state.tree_logits[2]
+            p_indices = state.tree_buffers["p_indices"]
+            num_slots = state.tree_buffers["num_slots"]
+        else:
+            tree_candidates = state.tree_candidates.to(device)
+            tree_position_ids = state.tree_position_ids.to(device)
+            tree_mask = state.tree_mask.to(device)
+            retrieve_indices = state.retrieve_indices.to(device)
+            candidates = torch.cat((tree_candidates, padding), dim=1)[batch_index, retrieve_indices]
+            cart_candidates_prob = None
+            original_prob = None
+            p_indices = None
+            num_slots = self.ea_layer.top_k
+
+        # the drafted tree is accepted over the drafted depths, and verified with the forced tokens spliced in
+        tree_depths = state.tree_depths.to(device)
+        (
+            verified_candidates, verified_position_ids, verified_mask, verified_retrieve_indices, logits_indices,
+        ) = splice_forced_tokens(
+            tree_candidates, tree_position_ids, tree_mask, retrieve_indices, state.forced_tokens.to(device),
+            tree_depths,
+        )
+        if self.cfg_mode == "parallel":
+            verified_mask = verified_mask.repeat(2, 1, 1, 1)
+        self.base_model.model.tree_mask = verified_mask
+
+        # chosen from the host-side token counts, so that no device value is read to pick the head
+        head = self.head_for(state.max_new_token)
+
+        logits, hidden_states_new, uncond_hidden_states_new = self.tree_decoding(
+            tree_candidates=verified_candidates,
+            attention_mask=state.attn_mask,
+            past_key_values=state.past_key_values,
+            tree_position_ids=verified_position_ids,
+            input_ids=input_ids,
+            retrieve_indices=logits_indices.to(self.base_model.lm_head.weight.device),
+            head=head,
+        )
+
+        best_candidate, accept_length, sample_p = self.evaluate_posterior(
+            logits=logits,
+            candidates=candidates,
+            num_slots=num_slots,
+            cart_candidates_prob=cart_candidates_prob,
+            original_prob=original_prob,
+            p_indices=p_indices,
+            do_sample=state.do_sample,
+            lantern=state.lantern,
+            lantern_k=state.lantern_k,
+            lantern_delta=state.lantern_delta,
+            tree_depths=tree_depths,
+        )
+
+        # the accepted paths are committed with their forced tokens
+        verified_candidates = torch.cat((verified_candidates, padding), dim=1)[batch_index, verified_retrieve_indices]
+        input_ids, attn_mask, output, state.new_token, sample_token = self.update_inference_inputs(
+            token_buffer=state.token_buffer,
+            mask_buffer=state.mask_buffer,
+            candidates=verified_candidates,
+            best_candidate=best_candidate,
+            accept_length=accept_length,
+            retrieve_indices=verified_retrieve_indices,
+            do_sample=state.do_sample,
+            new_token=state.new_token,
+            past_key_values_data=state.past_key_values_data,
+            current_length_data=state.current_length_data,
+            hidden_states_new=hidden_states_new,
+            uncond_hidden_states_new=uncond_hidden_states_new,
+            sample_p=sample_p,
+            head=head,
+        )
+
+        if self.eagle_version == 1:
+            state.tree_logits, (state.forced_tokens, state.tree_depths) = output[:3], output[3:]
+            state.sample_token = sample_token
+        else:
+            (
+                state.tree_candidates, state.retrieve_indices, state.tree_mask, state.tree_position_ids,
+                state.forced_tokens, state.tree_depths,
+            ) = output
+        
+        # only the tokens accepted at this step are checked, so that the bookkeeping does not grow with the sequence
+        valid_lengths = [length + accepted + 1 for length, accepted in zip(state.valid_lengths, accept_length)]
+        state.valid_lengths = valid_lengths
+        if state.eos_token_tensor is not None:
+            num_accepted = max(accept_length) + 1
+            accepted_tokens = input_ids[:, -num_accepted:]
+            eos_found = torch.isin(accepted_tokens, state.eos_token_tensor.to(accepted_tokens.device))
+            eos_found = (eos_found & attn_mask[:batch_size, -num_accepted:].to(eos_found.device)).any(dim=-1).tolist()
+        else:
+            eos_found = [False] * batch_size
+
+        finished_rows = []
+        for b in range(batch_size):
+            if state.output_lengths[b] is not None:
+                continue
+            state.accept_length_list[b].append(accept_length[b] + 1)
+
+            finished = state.new_token[b] >= state.max_new_tokens or valid_lengths[b] > state.max_length
+            if finished or eos_found[b]:
+                state.output_lengths[b] = valid_lengths[b]
+                finished_rows.append(b)
+
+        if batch_size > 1 and input_ids.shape[1] - max(valid_lengths) > 256:
+            # too many holes are shared by the rows; squeeze them out of the caches
+            state.input_ids, state.attn_mask = self.compact_inference_inputs(
+                input_ids, attn_mask, state.past_key_values_data, state.current_length_data
             )
 
-            input_ids, output, new_token, sample_token = self.update_inference_inputs(
-                input_ids=input_ids,
-                attention_mask=attn_mask,
-                candidates=candidates,
-                best_candidate=best_candidate,
-                accept_length=accept_length,
-                retrieve_indices=retrieve_indices,
-                do_sample=do_sample,
-                new_token=new_token,
-                past_key_values_data=past_key_values_data,
-                current_length_data=current_length_data,
-                hidden_states_new=hidden_states_new,
-                uncond_hidden_states_new=uncond_hidden_states_new,
-                sample_p=sample_p
+        return finished_rows
+
+    @torch.no_grad()
+    def admit(self, state, row, input_ids, logits_processors=None):
+        """
+        Start decoding a new prompt in a finished row of a batch while the other rows keep running.
+
+        The prompt is left-padded to the current length of the batch and prefilled into the rows of its CFG pair
+        through views of the KV caches, then its first tree replaces the tree of the finished row.
+
+        Args:
+            state (GenerationState): The decoding state of the batch.
+            row (int): A finished row of the batch.
+            input_ids (torch.Tensor): The new prompt of shape [1, prompt_len].
+            logits_processors (list, optional): Logits processors of the new prompt, see `generate`.
+        """
+        if self.cfg_mode != "parallel":
+            raise ValueError(f"Admitting prompts requires cfg_mode='parallel', but got cfg_mode='{self.cfg_mode}'")
+        assert state.output_lengths[row] is not None, "A new prompt can only be admitted into a finished row."
+
+        prefill_start = time.time()
+        batch_size = state.batch_size
+        num_image_tokens = 3
+        prompt_length = input_ids.shape[1]
+        if state.input_ids.shape[1] < prompt_length + num_image_tokens:
+            # widen the batch with holes so that the prompt fits
+            state.input_ids, state.attn_mask = self.compact_inference_inputs(
+                state.input_ids, state.attn_mask, state.past_key_values_data, state.current_length_data,
+                min_length=prompt_length + num_image_tokens,
             )
 
-            if self.eagle_version == 1:
-                tree_logits = output
-            else:
-                tree_candidates, retrieve_indices, tree_mask, tree_position_ids = output
-                if self.cfg_mode == "parallel":
-                    tree_mask = tree_mask.repeat(2, 1, 1, 1)
-            
-            accept_length_list.append(accept_length+1)
-            pbar.update(accept_length+1)
+        width = state.input_ids.shape[1] - num_image_tokens
+        padded_input_ids = torch.zeros((1, width), dtype=torch.long, device=state.input_ids.device)
+        padded_input_ids[:, width - prompt_length:] = input_ids.to(state.input_ids.device)
+        attention_mask = torch.zeros((1, width), dtype=torch.bool, device=state.input_ids.device)
+        attention_mask[:, width - prompt_length:] = True
+        input_ids, attn_mask, prefill_input_ids, prefill_position_ids = self.prepare_prompt(padded_input_ids, attention_mask)
+
+        # prefill the prompt and draft its first tree as a batch of its own, writing through to its rows of the batch
+        rows = slice(row, None, batch_size)
+        past_key_values, _ = select_past_key_values_rows(state.past_key_values, rows)
 
-            if eos_token_ids is not None:
-                if eos_token_ids in input_ids[0, input_len:].tolist():
-                    break
+        # the drafter prefills them in place as well, in the rows of its own cache
+        drafter_kv = self.ea_layer.detach_kv(rows)
+        tree_mask_init = getattr(self.ea_layer, "tree_mask_init", None)
+        self.base_model.model.tree_mask = None
+
+        output = self.initialize_tree(
+            input_ids=prefill_input_ids,
+            attention_mask=attn_mask,
+            position_ids=prefill_position_ids,
+            tree_attn_mask=state.tree_attn_mask,
+            past_key_values=past_key_values,
+            logits_processors=logits_processors,
+        )
+
+        self.ea_layer.attach_kv(drafter_kv)
+
+        if self.eagle_version == 1:
+            (ss_token, ss_prob, original_prob, forced_tokens, tree_depths), sample_token = output
+            state.tree_logits[0][row] = ss_token[0]
+            state.tree_logits[1][row] = ss_prob[0]
+            for prob, row_prob in zip(state.tree_logits[2], original_prob):
+                prob[row] = row_prob[0]
+            state.sample_token[row] = sample_token[0].to(state.sample_token.device)
+        else:
+            self.ea_layer.tree_mask_init = tree_mask_init
+
+            tree_candidates, retrieve_indices, tree_mask, tree_position_ids, forced_tokens, tree_depths = output
+            state.tree_candidates[row] = tree_candidates[0]
+            retrieve_indices_list = list(state.retrieve_indices.unbind(0))
+            retrieve_indices_list[row] = retrieve_indices[0]
+            state.retrieve_indices = stack_retrieve_indices(retrieve_indices_list)
+            state.tree_mask[row] = tree_mask[0]
+            state.tree_position_ids[row] = tree_position_ids[0]
+        state.forced_tokens[row] = forced_tokens[0]
+        state.tree_depths[row] = tree_depths[0]
+
+        state.input_ids[row] = input_ids[0]
+        state.attn_mask[rows] = attn_mask
+        state.valid_lengths[row] = prompt_length + num_image_tokens
+        # the masks of the next tree steps are rebuilt from the new attention mask of the row
+        self.base_model.model.tree_attention_mask.reset()
+        self.ea_layer.tree_attention_mask.reset()
+        state.new_token[row] = 0
+        state.output_lengths[row] = None
+        state.accept_length_list[row] = []
+        if state.input_ids.is_cuda:
+            torch.cuda.synchronize(state.input_ids.device)
+        state.prefill_times[row] = time.time() - prefill_start
+
+    def finish_generation(self, state):
+        """
+        Give the pages of a finished batch back to the KV page pool, if any.
+
+        Args:
+            state (GenerationState): The decoding state of the batch.
+        """
+        for page_table in state.page_tables:
+            page_table.release()
+        state.page_tables = []
+
+    @torch.no_grad()
+    def generate(
+        self,
+        input_ids,
+        attention_mask=None,
+        do_sample=True,
+        max_new_tokens=2353,
+        max_length=4096,
+        cfg_scale=3.0,
+        top_k=2000,
+        logits_processors=None,
+        eos_token_ids=None,
+        lantern=False,
+        lantern_k=1000,
+        lantern_delta=0.1,
+        tree_choices=mc_sim_7b_63,
+        **kwargs
+    ):
+        state = self.start_generation(
+            input_ids,
+            attention_mask=attention_mask,
+            do_sample=do_sample,
+            max_new_tokens=max_new_tokens,
+            max_length=max_length,
+            cfg_scale=cfg_scale,
+            top_k=top_k,
+            logits_processors=logits_processors,
+            eos_token_ids=eos_token_ids,
+            lantern=lantern,
+            lantern_k=lantern_k,
+            lantern_delta=lantern_delta,
+            tree_choices=tree_choices,
+            **kwargs
+        )
 
-            if input_ids.shape[1] > max_length:
-                break
+        pbar = tqdm(total=max_new_tokens)
+        while not all(state.finished):
+            self.decode_step(state)
+            pbar.update(min(min(state.new_token), max_new_tokens) - pbar.n)
         pbar.close()
+
+        self.finish_generation(state)
+        # the prefill times of the rows, see `GenerationState.prefill_times`
+        self.prefill_times = state.prefill_times
         
-        return input_ids, accept_length_list
\ No newline at end of file
+        if state.batch_size == 1:
+            return state.input_ids, state.accept_length_list[0]
+
+        # drop the left padding and the holes, and the tokens generated after a row was finished
+        outputs = [state.output(b) for b in range(state.batch_size)]
+        return outputs, state.accept_length_list
@@ -47,7 +47,8 @@ from transformers.utils import (
 )
 from models.configs.configuration_anole import ChameleonConfig, ChameleonVQVAEConfig
 from models.base_models.anole.chameleon.chameleon import TokenManager
-from models.drafters.kv_cache import initialize_past_key_values
+from models.drafters.kv_cache import TreeAttentionMask, initialize_past_key_values
+from models.kv_variants.sdpa_utils import prepare_boolean_attention_mask, sdpa_attention
 
 
 if is_flash_attn_2_available():
@@ -379,6 +380,7 @@ class ChameleonAttention(nn.Module):
         output_attentions: bool = False,
         use_cache: bool = False,
         cache_position: Optional[torch.LongTensor] = None,
+        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
         **kwargs,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         bsz, q_len, _ = hidden_states.size()
@@ -397,7 +399,11 @@ class ChameleonAttention(nn.Module):
         key_states = key_states.reshape(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
         value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
 
-        cos, sin = self.rotary_emb(value_states, position_ids)
+        if position_embeddings is not None:
+            # computed once per forward for all layers, see `ChameleonModel.forward`
+            cos, sin = position_embeddings
+        else:
+            cos, sin = self.rotary_emb(value_states, position_ids)
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
         
         # [MODIFIED] Using KVCache mechanism for preallocated GPU memory optimization
@@ -412,19 +418,35 @@ class ChameleonAttention(nn.Module):
         
         past_key_value = None
 
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
+        if attention_mask is not None and attention_mask.dtype == torch.bool and not output_attentions:
+            # boolean masks are built with `config.tree_attn_implementation == "sdpa"`; the key/value heads are
+            # broadcast by SDPA, without `repeat_kv` copies
+            attn_output = sdpa_attention(
+                query_states,
+                key_states,
+                value_states,
+                attention_mask=attention_mask,
+                num_key_value_groups=self.num_key_value_groups,
+                dropout_p=self.attention_dropout if self.training else 0.0,
+            )
+            attn_weights = None
+        else:
+            key_states = repeat_kv(key_states, self.num_key_value_groups)
+            value_states = repeat_kv(value_states, self.num_key_value_groups)
 
-        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+            attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
 
-        if attention_mask is not None:  # no matter the length, we just slice it
-            causal_mask = attention_mask[:, :, :, : key_states.shape[-2]]
-            attn_weights = attn_weights + causal_mask
+            if attention_mask is not None:  # no matter the length, we just slice it
+                causal_mask = attention_mask[:, :, :, : key_states.shape[-2]]
+                if causal_mask.dtype == torch.bool:
+                    attn_weights = attn_weights.masked_fill(~causal_mask, torch.finfo(attn_weights.dtype).min)
+                else:
+                    attn_weights = attn_weights + causal_mask
 
-        # upcast attention to fp32
-        attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
-        attn_weights = nn.functional.dropout(attn_weights, p=self.attention_dropout, training=self.training)
-        attn_output = torch.matmul(attn_weights, value_states)
+            # upcast attention to fp32
+            attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
+            attn_weights = nn.functional.dropout(attn_weights, p=self.attention_dropout, training=self.training)
+            attn_output = torch.matmul(attn_weights, value_states)
 
         if attn_output.size() != (bsz, self.num_heads, q_len, self.head_dim):
             raise ValueError(
@@ -469,6 +491,7 @@ class ChameleonFlashAttention2(ChameleonAttention):
         output_attentions: bool = False,
         use_cache: bool = False,
         cache_position: Optional[torch.LongTensor] = None,
+        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
         **kwargs,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         if isinstance(past_key_value, StaticCache):
@@ -498,7 +521,11 @@ class ChameleonFlashAttention2(ChameleonAttention):
         key_states = key_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
         value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
 
-        cos, sin = self.rotary_emb(value_states, position_ids)
+        if position_embeddings is not None:
+            # computed once per forward for all layers, see `ChameleonModel.forward`
+            cos, sin = position_embeddings
+        else:
+            cos, sin = self.rotary_emb(value_states, position_ids)
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
 
         if past_key_value is not None:
@@ -582,6 +609,8 @@ class ChameleonSdpaAttention(ChameleonAttention):
         output_attentions: bool = False,
         use_cache: bool = False,
         cache_position: Optional[torch.LongTensor] = None,
+        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        **kwargs,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         if output_attentions:
             # TODO: Improve this warning with e.g. `model.config.attn_implementation = "manual"` once this is implemented.
@@ -597,6 +626,7 @@ class ChameleonSdpaAttention(ChameleonAttention):
                 output_attentions=output_attentions,
                 use_cache=use_cache,
                 cache_position=cache_position,
+                position_embeddings=position_embeddings,
             )
 
         bsz, q_len, _ = hidden_states.size()
@@ -615,7 +645,11 @@ class ChameleonSdpaAttention(ChameleonAttention):
         key_states = key_states.reshape(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
         value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
 
-        cos, sin = self.rotary_emb(value_states, position_ids)
+        if position_embeddings is not None:
+            # computed once per forward for all layers, see `ChameleonModel.forward`
+            cos, sin = position_embeddings
+        else:
+            cos, sin = self.rotary_emb(value_states, position_ids)
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, None)
 
         if past_key_value is not None:
@@ -1298,6 +1332,8 @@ class ChameleonModel(ChameleonPreTrainedModel):
         self.norm = ChameleonRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
         self.vqmodel = ChameleonVQVAE(config.vq_config)
         self.gradient_checkpointing = False
+        # masks of the tree verification steps, updated in place; see `_update_causal_mask`
+        self.tree_attention_mask = TreeAttentionMask()
 
         # Initialize weights and apply final processing
         self.post_init()
@@ -1399,6 +1435,8 @@ class ChameleonModel(ChameleonPreTrainedModel):
 
         # embed positions
         hidden_states = inputs_embeds
+        # the rotary embeddings of the positions are computed once and shared by all layers
+        position_embeddings = self.layers[0].self_attn.rotary_emb(hidden_states, position_ids)
 
         # decoder layers
         all_hidden_states = () if output_hidden_states else None
@@ -1431,6 +1469,7 @@ class ChameleonModel(ChameleonPreTrainedModel):
                     output_attentions=output_attentions,
                     use_cache=use_cache,
                     cache_position=cache_position,
+                    position_embeddings=position_embeddings,
                 )
 
             hidden_states = layer_outputs[0]
@@ -1475,6 +1514,31 @@ class ChameleonModel(ChameleonPreTrainedModel):
                 return attention_mask
             return None
 
+        tree_mask = getattr(self, "tree_mask", None)
+        if tree_mask is not None and tree_mask.shape[-2] == input_tensor.shape[1] and (
+            attention_mask is None or attention_mask.dim() == 2
+        ):
+            # the tree verification steps only write the new columns of the prefix and the tree block
+            tree_sdpa = getattr(self.config, "tree_attn_implementation", "eager") == "sdpa"
+            return self.tree_attention_mask(
+                attention_mask,
+                tree_mask,
+                input_tensor.shape[:2],
+                past_key_values[0][0].shape[2] if past_key_values is not None else 0,
+                torch.bool if tree_sdpa else input_tensor.dtype,
+                input_tensor.device,
+            )
+
+        if getattr(self.config, "tree_attn_implementation", "eager") == "sdpa":
+            # SDPA takes a boolean mask with the tree mask applied, without the float causal and padding masks
+            return prepare_boolean_attention_mask(
+                attention_mask,
+                input_tensor.shape[:2],
+                past_key_values[0][0].shape[2] if past_key_values is not None else 0,
+                input_tensor.device,
+                tree_mask=getattr(self, "tree_mask", None),
+            )
+
         # For SDPA, when possible, we will rely on its `is_causal` argument instead of its `attn_mask` argument, in
         # order to dispatch on Flash Attention 2. This feature is not compatible with static cache, as SDPA will fail
         # to infer the attention mask.
@@ -45,7 +45,8 @@ from models.base_models.llamagen.vq_model import VQ_16
 from models.base_models.llamagen.t5 import T5Embedder
 
 import time
-from models.drafters.kv_cache import initialize_past_key_values
+from models.drafters.kv_cache import TreeAttentionMask, initialize_past_key_values
+from models.kv_variants.sdpa_utils import prepare_boolean_attention_mask, sdpa_attention
 
 
 # if is_flash_attn_2_available():
@@ -555,27 +556,43 @@ class LlamaAttention(nn.Module):
 
         past_key_value = (key_states, value_states) if use_cache else None
 
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
-
-        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
-
-        if attn_weights.size() != (bsz, self.num_heads, q_len, kv_seq_len):
+        if attention_mask is not None and attention_mask.size() != (bsz, 1, q_len, kv_seq_len):
             raise ValueError(
-                f"Attention weights should be of size {(bsz, self.num_heads, q_len, kv_seq_len)}, but is"
-                f" {attn_weights.size()}"
+                f"Attention mask should be of size {(bsz, 1, q_len, kv_seq_len)}, but is {attention_mask.size()}"
             )
 
-        if attention_mask is not None:
-            if attention_mask.size() != (bsz, 1, q_len, kv_seq_len):
+        if attention_mask is not None and attention_mask.dtype == torch.bool and not output_attentions:
+            # boolean masks are built with `config.tree_attn_implementation == "sdpa"`; the key/value heads are
+            # broadcast by SDPA, without `repeat_kv` copies
+            attn_output = sdpa_attention(
+                query_states,
+                key_states,
+                value_states,
+                attention_mask=attention_mask,
+                num_key_value_groups=self.num_key_value_groups,
+            )
+            attn_weights = None
+        else:
+            key_states = repeat_kv(key_states, self.num_key_value_groups)
+            value_states = repeat_kv(value_states, self.num_key_value_groups)
+
+            attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+
+            if attn_weights.size() != (bsz, self.num_heads, q_len, kv_seq_len):
                 raise ValueError(
-                    f"Attention mask should be of size {(bsz, 1, q_len, kv_seq_len)}, but is {attention_mask.size()}"
+                    f"Attention weights should be of size {(bsz, self.num_heads, q_len, kv_seq_len)}, but is"
+                    f" {attn_weights.size()}"
                 )
-            attn_weights = attn_weights + attention_mask
 
-        # upcast attention to fp32
-        attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
-        attn_output = torch.matmul(attn_weights, value_states)
+            if attention_mask is not None:
+                if attention_mask.dtype == torch.bool:
+                    attn_weights = attn_weights.masked_fill(~attention_mask, torch.finfo(attn_weights.dtype).min)
+                else:
+                    attn_weights = attn_weights + attention_mask
+
+            # upcast attention to fp32
+            attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
+            attn_output = torch.matmul(attn_weights, value_states)
 
         if attn_output.size() != (bsz, self.num_heads, q_len, self.head_dim):
             raise ValueError(
@@ -993,6 +1010,8 @@ class LlamaModel(LlamaPreTrainedModel):
         self.norm = LlamaRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
 
         self.gradient_checkpointing = False
+        # masks of the tree verification steps, updated in place; see `_prepare_decoder_attention_mask`
+        self.tree_attention_mask = TreeAttentionMask()
         grid_size = int(config.block_size ** 0.5)
         assert grid_size ** 2 == config.block_size, "block_size must be a perfect square"
         self.freqs_cis = precompute_freqs_cis_2d(grid_size, config.hidden_size//config.num_attention_heads, config.rope_base, config.cls_token_num)
@@ -1007,6 +1026,28 @@ class LlamaModel(LlamaPreTrainedModel):
 
     # Copied from transformers.models.bart.modeling_bart.BartDecoder._prepare_decoder_attention_mask
     def _prepare_decoder_attention_mask(self, attention_mask, input_shape, inputs_embeds, past_key_values_length):
+        tree_mask = getattr(self, "tree_mask", None)
+        if tree_mask is not None and tree_mask.shape[-2] == input_shape[-1]:
+            # the tree verification steps only write the new columns of the prefix and the tree block
+            return self.tree_attention_mask(
+                attention_mask,
+                tree_mask,
+                input_shape,
+                past_key_values_length,
+                torch.bool if getattr(self.config, "tree_attn_implementation", "eager") == "sdpa" else torch.float32,
+                inputs_embeds.device,
+            )
+
+        if getattr(self.config, "tree_attn_implementation", "eager") == "sdpa":
+            # SDPA takes a boolean mask with the tree mask applied, without the float32 causal and padding masks
+            return prepare_boolean_attention_mask(
+                attention_mask,
+                input_shape,
+                past_key_values_length,
+                inputs_embeds.device,
+                tree_mask=getattr(self, "tree_mask", None),
+            )
+
         # create causal mask
         # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
         combined_attention_mask = None
@@ -41,6 +41,8 @@ from transformers.utils import (
 )
 
 from models.configs.configuration_lumina_mgpt import ChameleonConfig, ChameleonVQVAEConfig
+from models.kv_variants.sdpa_utils import prepare_boolean_attention_mask, sdpa_attention
+from models.drafters.kv_cache import TreeAttentionMask
 
 if is_flash_attn_2_available():
     from flash_attn.bert_padding import index_first_axis, pad_input, unpad_input  # noqa
@@ -214,6 +216,27 @@ class LlamaRotaryEmbedding(nn.Module):
             self.sin_cached[:, :, :seq_len, ...].to(dtype=x.dtype),
         )
 
+    def gather(self, position_ids, seq_len, dtype):
+        """
+        Gather the cosine and sine embeddings of the given positions from the cached table, once for all layers.
+
+        Args:
+            position_ids (torch.Tensor): Position IDs of shape [bs, seq_len].
+            seq_len (int): The sequence length with the past. If greater than the cached length, the cache will be
+                updated.
+            dtype: The data type of the embeddings.
+
+        Returns:
+            tuple: A tuple containing two tensors, the cosine and sine embeddings, both of shape [bs, 1, seq_len, dim].
+        """
+        if seq_len > self.max_seq_len_cached:
+            self._set_cos_sin_cache(seq_len=seq_len, device=position_ids.device, dtype=dtype)
+
+        return (
+            self.cos_cached[0, 0][position_ids].unsqueeze(1).to(dtype=dtype),
+            self.sin_cached[0, 0][position_ids].unsqueeze(1).to(dtype=dtype),
+        )
+
 class ChameleonRotaryEmbedding(nn.Module):
     def __init__(self, dim, max_position_embeddings=2048, base=10000, device=None, scaling_factor=1.0):
         super().__init__()
@@ -249,7 +272,7 @@ def rotate_half(x):
     x2 = x[..., x.shape[-1] // 2 :]
     return torch.cat((-x2, x1), dim=-1)
 
-def apply_rotary_pos_emb(q, k, cos, sin, position_ids):
+def apply_rotary_pos_emb(q, k, cos, sin, position_ids=None):
     """
     Apply rotary position embeddings to query and key tensors.
 
@@ -258,15 +281,17 @@ def apply_rotary_pos_emb(q, k, cos, sin, position_ids):
         k (torch.Tensor): Key tensor.
         cos (torch.Tensor): Cosine values.
         sin (torch.Tensor): Sine values.
-        position_ids (torch.Tensor): Position IDs.
+        position_ids (torch.Tensor, optional): Position IDs. If None, `cos` and `sin` are already gathered at the
+            positions of the tokens (see `LlamaRotaryEmbedding.gather`).
 
     Returns:
         torch.Tensor: Query and key tensors with rotary position embeddings applied.
     """
-    cos = cos.squeeze(1).squeeze(0)
-    sin = sin.squeeze(1).squeeze(0)
-    cos = cos[position_ids].unsqueeze(1)
-    sin = sin[position_ids].unsqueeze(1)
+    if position_ids is not None:
+        cos = cos.squeeze(1).squeeze(0)
+        sin = sin.squeeze(1).squeeze(0)
+        cos = cos[position_ids].unsqueeze(1)
+        sin = sin[position_ids].unsqueeze(1)
     q_embed = (q * cos) + (rotate_half(q) * sin)
     k_embed = (k * cos) + (rotate_half(k) * sin)
     return q_embed, k_embed
@@ -391,6 +416,7 @@ class ChameleonAttention(nn.Module):
         output_attentions: bool = False,
         use_cache: bool = False,
         cache_position: Optional[torch.LongTensor] = None,
+        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
         **kwargs,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         bsz, q_len, _ = hidden_states.size()
@@ -409,13 +435,18 @@ class ChameleonAttention(nn.Module):
         key_states = key_states.reshape(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
         value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
 
-        kv_seq_len = key_states.shape[-2]
-        if past_key_value is not None:
-            kv_seq_len += past_key_value[0].shape[-2]
-        cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
-        query_states, key_states = apply_rotary_pos_emb(
-            query_states, key_states, cos, sin, position_ids
-        )
+        if position_embeddings is not None:
+            # gathered once per forward for all layers, see `LlamaRotaryEmbedding.gather`
+            cos, sin = position_embeddings
+            query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
+        else:
+            kv_seq_len = key_states.shape[-2]
+            if past_key_value is not None:
+                kv_seq_len += past_key_value[0].shape[-2]
+            cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
+            query_states, key_states = apply_rotary_pos_emb(
+                query_states, key_states, cos, sin, position_ids
+            )
 
         # [MODIFIED] Using KVCache mechanism for preallocated GPU memory optimization
         # past_key_value is utilized to leverage previously computed key and value states.
@@ -434,7 +465,11 @@ class ChameleonAttention(nn.Module):
 
         if attention_mask is not None:  # no matter the length, we just slice it
             causal_mask = attention_mask[:, :, :, : key_states.shape[-2]]
-            attn_weights = attn_weights + causal_mask
+            if causal_mask.dtype == torch.bool:
+                # boolean masks are built for ChameleonSdpaAttention, which falls back here with output_attentions
+                attn_weights = attn_weights.masked_fill(~causal_mask, torch.finfo(attn_weights.dtype).min)
+            else:
+                attn_weights = attn_weights + causal_mask
 
         # upcast attention to fp32
         attn_weights = nn.functional.softmax(attn_weights, dim=-1).to(query_states.dtype)
@@ -483,6 +518,7 @@ class ChameleonFlashAttention2(ChameleonAttention):
         output_attentions: bool = False,
         use_cache: bool = False,
         cache_position: Optional[torch.LongTensor] = None,
+        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
         **kwargs,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         if isinstance(past_key_value, StaticCache):
@@ -512,13 +548,24 @@ class ChameleonFlashAttention2(ChameleonAttention):
         key_states = key_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
         value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
 
-        cos, sin = self.rotary_emb(value_states, position_ids)
-        query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
+        if position_embeddings is not None:
+            # gathered once per forward for all layers, see `LlamaRotaryEmbedding.gather`
+            cos, sin = position_embeddings
+            query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
+        else:
+            kv_seq_len = key_states.shape[-2]
+            if past_key_value is not None:
+                kv_seq_len += past_key_value[0].shape[-2]
+            cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
+            query_states, key_states = apply_rotary_pos_emb(
+                query_states, key_states, cos, sin, position_ids
+            )
 
+        # [MODIFIED] Using KVCache mechanism for preallocated GPU memory optimization
         if past_key_value is not None:
-            # sin and cos are specific to RoPE models; position_ids needed for the static cache
-            cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}
-            key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
+            key_states = past_key_value[0].cat(key_states, dim=2)
+            value_states = past_key_value[1].cat(value_states, dim=2)
+        past_key_value = None
 
         # TODO: These transpose are quite inefficient but Flash Attention requires the layout [batch_size, sequence_length, num_heads, head_dim].
         # We would need to refactor the KV cache to be able to avoid many of these transpose/reshape/view.
@@ -592,6 +639,8 @@ class ChameleonSdpaAttention(ChameleonAttention):
         output_attentions: bool = False,
         use_cache: bool = False,
         cache_position: Optional[torch.LongTensor] = None,
+        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        **kwargs,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         if output_attentions:
             # TODO: Improve this warning with e.g. `model.config.attn_implementation = "manual"` once this is implemented.
@@ -607,6 +656,7 @@ class ChameleonSdpaAttention(ChameleonAttention):
                 output_attentions=output_attentions,
                 use_cache=use_cache,
                 cache_position=cache_position,
+                position_embeddings=position_embeddings,
             )
 
         bsz, q_len, _ = hidden_states.size()
@@ -625,13 +675,18 @@ class ChameleonSdpaAttention(ChameleonAttention):
         key_states = key_states.reshape(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
         value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
 
-        kv_seq_len = key_states.shape[-2]
-        if past_key_value is not None:
-            kv_seq_len += past_key_value[0].shape[-2]
-        cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
-        query_states, key_states = apply_rotary_pos_emb(
-            query_states, key_states, cos, sin, position_ids
-        )
+        if position_embeddings is not None:
+            # gathered once per forward for all layers, see `LlamaRotaryEmbedding.gather`
+            cos, sin = position_embeddings
+            query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
+        else:
+            kv_seq_len = key_states.shape[-2]
+            if past_key_value is not None:
+                kv_seq_len += past_key_value[0].shape[-2]
+            cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
+            query_states, key_states = apply_rotary_pos_emb(
+                query_states, key_states, cos, sin, position_ids
+            )
 
         # [MODIFIED] Using KVCache mechanism for preallocated GPU memory optimization
         # past_key_value is utilized to leverage previously computed key and value states.
@@ -643,29 +698,17 @@ class ChameleonSdpaAttention(ChameleonAttention):
         # past_key_value = (key_states, value_states) if use_cache else None
         past_key_value = None
 
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
-
-        causal_mask = attention_mask
-        if attention_mask is not None and cache_position is not None:
-            causal_mask = causal_mask[:, :, :, : key_states.shape[-2]]
-
-        # SDPA with memory-efficient backend is currently (torch==2.1.2) bugged with non-contiguous inputs with custom attn_mask,
-        # Reference: https://github.com/pytorch/pytorch/issues/112577.
-        if query_states.device.type == "cuda" and causal_mask is not None:
-            query_states = query_states.contiguous()
-            key_states = key_states.contiguous()
-            value_states = value_states.contiguous()
-
         # We dispatch to SDPA's Flash Attention or Efficient kernels via this `is_causal` if statement instead of an inline conditional assignment
         # in SDPA to support both torch.compile's dynamic shapes and full graph options. An inline conditional prevents dynamic shapes from compiling.
-        is_causal = True if causal_mask is None and q_len > 1 else False
+        is_causal = True if attention_mask is None and q_len > 1 else False
 
-        attn_output = torch.nn.functional.scaled_dot_product_attention(
+        # the key/value heads are broadcast by SDPA, without `repeat_kv` copies
+        attn_output = sdpa_attention(
             query_states,
             key_states,
             value_states,
-            attn_mask=causal_mask,
+            attention_mask=attention_mask,
+            num_key_value_groups=self.num_key_value_groups,
             dropout_p=self.attention_dropout if self.training else 0.0,
             is_causal=is_causal,
         )
@@ -1318,6 +1361,8 @@ class ChameleonModel(ChameleonPreTrainedModel):
         self.norm = ChameleonRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
         self.vqmodel = ChameleonVQVAE(config.vq_config)
         self.gradient_checkpointing = False
+        # masks of the tree verification steps, updated in place; see `_prepare_decoder_attention_mask`
+        self.tree_attention_mask = TreeAttentionMask()
 
         # Initialize weights and apply final processing
         self.post_init()
@@ -1430,10 +1475,14 @@ class ChameleonModel(ChameleonPreTrainedModel):
             (batch_size, seq_length),
             inputs_embeds,
             past_key_values_length,
+            past_key_values=past_key_values,
         )
 
         # embed positions
         hidden_states = inputs_embeds
+        position_embeddings = self.layers[0].self_attn.rotary_emb.gather(
+            position_ids, seq_length_with_past, hidden_states.dtype
+        )
 
         if self.gradient_checkpointing and self.training:
             if use_cache:
@@ -1475,6 +1524,7 @@ class ChameleonModel(ChameleonPreTrainedModel):
                     output_attentions=output_attentions,
                     use_cache=use_cache,
                     cache_position=cache_position,
+                    position_embeddings=position_embeddings,
                 )
 
             hidden_states = layer_outputs[0]
@@ -1506,8 +1556,41 @@ class ChameleonModel(ChameleonPreTrainedModel):
         )
 
     def _prepare_decoder_attention_mask(
-            self, attention_mask, input_shape, inputs_embeds, past_key_values_length
+            self, attention_mask, input_shape, inputs_embeds, past_key_values_length, past_key_values=None
     ):
+        if attention_mask is not None and attention_mask.dim() == 4:
+            # a complete boolean mask, e.g., of the packed branches of ragged CFG, is used as is
+            if self.config._attn_implementation not in ["eager", "sdpa"]:
+                raise ValueError(
+                    f"A 4D attention mask requires attn_implementation 'eager' or 'sdpa', but got "
+                    f"'{self.config._attn_implementation}'"
+                )
+            return attention_mask.to(inputs_embeds.device)
+
+        tree_mask = getattr(self, "tree_mask", None)
+        if tree_mask is not None and tree_mask.shape[-2] == input_shape[-1]:
+            # the tree verification steps only write the new columns of the prefix and the tree block, in a mask per
+            # cache, i.e., per branch of sequential CFG
+            return self.tree_attention_mask(
+                attention_mask,
+                tree_mask,
+                input_shape,
+                past_key_values_length,
+                torch.bool if self.config._attn_implementation == "sdpa" else torch.float32,
+                inputs_embeds.device,
+                cache=past_key_values[0][0] if past_key_values is not None else None,
+            )
+
+        if self.config._attn_implementation == "sdpa":
+            # SDPA takes a boolean mask with the tree mask applied, without the float32 causal and padding masks
+            return prepare_boolean_attention_mask(
+                attention_mask,
+                input_shape,
+                past_key_values_length,
+                inputs_embeds.device,
+                tree_mask=getattr(self, "tree_mask", None),
+            )
+
         # create causal mask
         # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
         combined_attention_mask = None
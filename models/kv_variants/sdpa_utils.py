@@ -0,0 +1,98 @@
+# SDPA attention with boolean tree masks for the KV-variant base models. It is selected with
+# `attn_implementation="sdpa"` in lumina-mGPT, and with `tree_attn_implementation="sdpa"` in the anole and llamagen
+# configs (e.g., as a keyword argument of `from_pretrained`); the eager path stays the default there.
+import torch
+import torch.nn.functional as F
+
+# `enable_gqa` lets SDPA broadcast the key/value heads without materializing `repeat_kv` copies
+SDPA_SUPPORTS_GQA = tuple(int(v) for v in torch.__version__.split("+")[0].split(".")[:2]) >= (2, 5)
+
+
+def prepare_boolean_attention_mask(attention_mask, input_shape, past_key_values_length, device, tree_mask=None):
+    """
+    Build the attention mask of the KV-variant base models as a boolean `[bsz, 1, tgt_seq_len, src_seq_len]` tensor
+    (True where attention is allowed) instead of the float32 causal mask plus the expanded padding mask.
+
+    The cached prefix is visible to every query unless it is padded, the new tokens are causal, and the last
+    `tree_len` tokens follow `tree_mask` when a draft tree is verified. Every query attends at least to itself, so
+    that fully padded rows (e.g., the first rows of a left-padded prompt) do not produce NaNs in SDPA; their outputs
+    are never attended by the other tokens.
+
+    Args:
+        attention_mask (torch.Tensor): Padding mask of shape `[bsz, seq_len]`, shorter than the KV if the tree tokens
+            are not included, or None.
+        input_shape (tuple): The shape `(bsz, tgt_seq_len)` of the new tokens.
+        past_key_values_length (int): Length of the cached prefix.
+        device (torch.device): Device of the mask.
+        tree_mask (torch.Tensor, optional): Tree attention mask of shape `[1 or bsz, 1, tree_len, tree_len]`.
+
+    Returns:
+        torch.Tensor: The boolean attention mask.
+    """
+    bsz, tgt_len = input_shape
+    src_len = tgt_len + past_key_values_length
+
+    query_positions = torch.arange(past_key_values_length, src_len, device=device)
+    key_positions = torch.arange(src_len, device=device)
+    causal_mask = key_positions[None, :] <= query_positions[:, None]
+    if tree_mask is not None:
+        tree_len = tree_mask.size(-1)
+        causal_mask = causal_mask[None, None].repeat(tree_mask.size(0), 1, 1, 1)
+        causal_mask[:, :, -tree_len:, -tree_len:] = tree_mask.to(device) != 0
+    else:
+        causal_mask = causal_mask[None, None]
+
+    if attention_mask is None:
+        return causal_mask.expand(bsz, 1, tgt_len, src_len)
+
+    attention_mask = attention_mask.to(device=device, dtype=torch.bool)
+    if attention_mask.shape[1] < src_len:
+        # NOTE : when the key-value cache is used, the attention mask need to be padded to the same length
+        attention_mask = F.pad(attention_mask, (0, src_len - attention_mask.shape[1]), "constant", True)
+    mask = causal_mask & attention_mask[:, None, None, :]
+    return mask | (key_positions[None, :] == query_positions[:, None])
+
+
+def sdpa_attention(
+    query_states, key_states, value_states, attention_mask=None, num_key_value_groups=1, dropout_p=0.0, is_causal=False
+):
+    """
+    Compute the attention of `[bsz, num_heads, q_len, head_dim]` queries over `[bsz, num_key_value_heads, kv_len,
+    head_dim]` keys and values with `scaled_dot_product_attention`.
+
+    Args:
+        attention_mask (torch.Tensor, optional): Boolean (True where attention is allowed) or additive float mask
+            broadcastable to `[bsz, num_heads, q_len, kv_len]`; it is sliced to the length of the keys.
+        num_key_value_groups (int): Number of query heads sharing a key/value head.
+        is_causal (bool): Whether to apply a causal mask when `attention_mask` is None.
+
+    Returns:
+        torch.Tensor: The attention output of shape `[bsz, num_heads, q_len, head_dim]`.
+    """
+    if attention_mask is not None:
+        attention_mask = attention_mask[:, :, :, : key_states.shape[-2]]
+
+    # SDPA with memory-efficient backend is currently (torch==2.1.2) bugged with non-contiguous inputs with custom attn_mask,
+    # Reference: https://github.com/pytorch/pytorch/issues/112577.
+    if query_states.device.type == "cuda" and attention_mask is not None:
+        query_states = query_states.contiguous()
+        key_states = key_states.contiguous()
+        value_states = value_states.contiguous()
+
+    kwargs = {}
+    if num_key_value_groups > 1:
+        if SDPA_SUPPORTS_GQA:
+            kwargs["enable_gqa"] = True
+        else:
+            key_states = torch.repeat_interleave(key_states, num_key_value_groups, dim=1)
+            value_states = torch.repeat_interleave(value_states, num_key_value_groups, dim=1)
+
+    return F.scaled_dot_product_attention(
+        query_states,
+        key_states,
+        value_states,
+        attn_mask=attention_mask,
+        dropout_p=dropout_p,
+        is_causal=is_causal,
+        **kwargs,
+    )
@@ -0,0 +1,55 @@
+import os
+import ast
+import math
+import types
+import importlib.util
+
+import torch
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_module(relative_path):
+    """
+    Load a module of the repository from its path.
+
+    `models/__init__.py` imports the full EAGLE models (and thus `transformers`), so the torch-only modules under
+    test are loaded from their files instead of through the package.
+    """
+    name = os.path.splitext(relative_path)[0].replace(os.sep, ".").replace("/", ".")
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_ROOT, relative_path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_definitions(relative_path, names, namespace=None):
+    """
+    Execute only the top-level functions, classes and assignments `names` of a module, in order.
+
+    This is used for the modules that import `transformers` at the top while the definitions under test only need
+    torch. A name `Class.method` loads a single method of a class, e.g., to borrow it in a toy model; it is returned
+    under the name of the method. `namespace` holds the other globals the definitions refer to.
+    """
+    path = os.path.join(REPO_ROOT, relative_path)
+    with open(path) as f:
+        tree = ast.parse(f.read(), filename=path)
+
+    definitions = {}
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            definitions[node.name] = node
+            if isinstance(node, ast.ClassDef):
+                for method in node.body:
+                    if isinstance(method, ast.FunctionDef):
+                        definitions[f"{node.name}.{method.name}"] = method
+        elif isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            definitions[node.targets[0].id] = node
+    missing = set(names) - set(definitions)
+    assert not missing, f"{relative_path} does not define {sorted(missing)}"
+    body = sorted((definitions[name] for name in names), key=lambda node: node.lineno)
+
+    globals_ = {"torch": torch, "nn": torch.nn, "F": torch.nn.functional, "math": math}
+    globals_.update(namespace or {})
+    exec(compile(ast.Module(body=body, type_ignores=[]), path, "exec"), globals_)
+    return types.SimpleNamespace(**{name.split(".")[-1]: globals_[name.split(".")[-1]] for name in names})
@@ -0,0 +1,323 @@
+import random
+
+import pytest
+import torch
+
+from module_loader import load_module
+
+acceptance = load_module("models/drafters/acceptance.py")
+tree_buffers = load_module("models/drafters/tree_buffers.py")
+choices = load_module("models/drafters/choices.py")
+
+VOCAB_SIZE = 16
+IMAGE_TOKEN_OFFSET = 4
+IMAGE_TOKENS = torch.arange(IMAGE_TOKEN_OFFSET, 14)
+IMAGE_SYNTAX_TOKENS = torch.tensor([14])
+LANTERN_K = 3
+LANTERN_DELTA = 0.3
+NUM_TRIALS = 3000
+
+
+def nearest_latents():
+    # image tokens lie on a line, their neighbours are the closest ones (themselves first)
+    latents = torch.arange(len(IMAGE_TOKENS)).float()
+    distances = (latents[:, None] - latents[None, :]).abs() + latents[None, :] * 1e-3
+    return distances.argsort(dim=-1)
+
+
+def evaluate_posterior_loop(logits, candidates, image_tokens, image_syntax_tokens, nearest_latents,
+                            image_token_offset, eagle_version, cart_candidates_prob=None, original_prob=None,
+                            p_indices=None, tree_candidates=None, b_indices=None,
+                            lantern=False, lantern_k=1000, lantern_delta=0.1):
+    # The original acceptance of `EaLumina_mGPT`, which walks the tree of a single row on the host
+    accept_length = 1
+    accept_cand = candidates[0][:1]
+    best_candidate = 0
+
+    # for-loop over levels
+    for i in range(1, candidates.shape[1]):
+        if i != accept_length:
+            break
+
+        adjustflag = False
+        is_eq = (candidates[:, :accept_length] == accept_cand).all(dim=1)
+        fi = torch.nonzero(is_eq, as_tuple=True)[0][0]
+
+        gt_logits = logits[fi, i-1]
+        gtp = torch.softmax(gt_logits, dim=0)
+
+        candidates_set = []
+
+        # for-loop within a level
+        for j in range(candidates.shape[0]):
+            if is_eq[j]:
+                x = candidates[j, i]
+                xi = x.item()
+
+                if xi in candidates_set or xi == -1:
+                    continue
+
+                candidates_set.append(xi)
+
+                r = random.random()
+                px = gtp[xi]
+                if xi in image_syntax_tokens:
+                    # accept immediately
+                    px = 1.0
+                elif not xi in image_tokens:
+                    # reject immediately
+                    px = 0.0
+                else:
+                    if lantern:
+                        nearest_probs = gtp[nearest_latents[xi - image_token_offset, :lantern_k]+image_token_offset].reshape(lantern_k, 1)
+                        cumsum_nearest_probs = torch.cumsum(nearest_probs, dim=0)
+
+                        if lantern_delta > 1.0:
+                            indices = (cumsum_nearest_probs <= (lantern_delta - 1) * px).nonzero(as_tuple=True)[0]
+                        else:
+                            indices = (cumsum_nearest_probs <= lantern_delta).nonzero(as_tuple=True)[0]
+
+                        if indices.numel() == 0:
+                            indices = -1
+                        else:
+                            indices = indices[-1]
+                        if indices == -1:
+                            px = px
+                        else:
+                            px = px + cumsum_nearest_probs[indices]
+
+                if eagle_version == 1:
+                    qx = cart_candidates_prob[j, i]
+                    if qx <= 0:
+                        continue
+                else:
+                    qx = 1.0
+
+                acp = px / qx
+
+                if r <= acp:
+                    accept_cand = torch.cat((accept_cand, x[None]), dim=0)
+                    accept_length += 1
+                    best_candidate = j
+                    break
+                else:
+                    if eagle_version == 1:
+                        q = original_prob[i - 1][p_indices[j][i]].clone()
+                        b = b_indices[j][i]
+                        if len(b) > 0:
+                            mask = tree_candidates[0][b]
+                            q[mask] = 0
+                            q = q / q.sum()
+
+                    if lantern and (xi in image_tokens):
+                        if (indices != -1):
+                            gtp[nearest_latents[xi-image_token_offset, :lantern_k+1]+image_token_offset] = 0
+
+                    if eagle_version == 1:
+                        gtp = gtp - q
+                        gtp[gtp < 0] = 0
+                    else:
+                        gtp[xi] = 0
+
+                    if gtp.sum() == 0:
+                        gtp = torch.ones_like(gtp)
+
+                    gtp /= gtp.sum()
+                    adjustflag = True
+
+    if adjustflag and accept_length != candidates.shape[1]:
+        sample_p = gtp
+    else:
+        gt_logits = logits[best_candidate, accept_length-1]
+        sample_p = torch.softmax(gt_logits, dim=0)
+
+    return best_candidate, accept_length-1, sample_p
+
+
+def random_tree(seed, tree_choices=choices.mc_sim_7b_63):
+    """A static tree with drafted tokens and target logits, laid out as in `EaLumina_mGPT.generate_candidates`."""
+    generator = torch.Generator().manual_seed(seed)
+    buffers = tree_buffers.compile_tree_buffers(tree_choices)
+    tree_indices = buffers["tree_indices"]
+    retrieve_indices = buffers["retrieve_indices"]
+    depths = buffers["tree_position_ids"]
+    tree_len = len(tree_indices)
+
+    # the target prefers image tokens, and the drafter is a noisy copy of the target at the parent
+    node_logits = torch.randn((tree_len, VOCAB_SIZE), generator=generator) * 1.5
+    node_logits[:, IMAGE_TOKENS] += 2.0
+    parents = {}
+    for path in retrieve_indices.tolist():
+        for parent, node in zip(path[:-1], path[1:]):
+            if node != -1:
+                parents[node] = parent
+
+    num_rows = (tree_indices.max().item() - 1) // tree_buffers.TOPK + 1
+    draft_probs = torch.zeros((num_rows, VOCAB_SIZE))
+    row_depths = [None] * num_rows
+    for node, parent in parents.items():
+        row = (tree_indices[node].item() - 1) // tree_buffers.TOPK
+        noise = torch.randn(VOCAB_SIZE, generator=generator)
+        draft_probs[row] = torch.softmax(node_logits[parent] + noise, dim=0)
+        row_depths[row] = depths[node].item() - 1
+    draft_top_probs, draft_top_tokens = draft_probs.topk(tree_buffers.TOPK, dim=-1)
+
+    root_token = IMAGE_TOKENS[0]
+    tokens = torch.cat((root_token[None], draft_top_tokens.flatten()))
+    token_probs = torch.cat((torch.ones(1), draft_top_probs.flatten()))
+    tree_candidates = tokens[tree_indices][None]
+    candidates = torch.cat((tree_candidates[0], torch.tensor([-1])))[retrieve_indices]
+    cart_candidates_prob = torch.cat((token_probs[tree_indices], torch.ones(1)))[retrieve_indices]
+    original_prob = [
+        draft_probs[[row for row in range(num_rows) if row_depths[row] == depth]]
+        for depth in range(max(row_depths) + 1)
+    ]
+
+    return {
+        "logits": node_logits[retrieve_indices],
+        "candidates": candidates,
+        "cart_candidates_prob": cart_candidates_prob,
+        "original_prob": original_prob,
+        "p_indices": buffers["p_indices"],
+        "b_indices": buffers["b_indices"],
+        "tree_candidates": tree_candidates,
+        "num_slots": acceptance.max_num_children(tree_choices),
+    }
+
+
+def emitted_distribution(tree, best_candidates, accept_lengths, sample_ps):
+    # distribution of the first token emitted after the root: the accepted candidate or a sample of `sample_p`
+    emitted = torch.zeros(VOCAB_SIZE)
+    for best_candidate, accept_length, sample_p in zip(best_candidates, accept_lengths, sample_ps):
+        if accept_length > 0:
+            emitted[tree["candidates"][best_candidate, 1]] += 1
+        else:
+            emitted += sample_p
+    return emitted / len(accept_lengths)
+
+
+def run_loop(tree, eagle_version, lantern, num_trials=NUM_TRIALS):
+    random.seed(0)
+    results = [
+        evaluate_posterior_loop(
+            tree["logits"], tree["candidates"], IMAGE_TOKENS, IMAGE_SYNTAX_TOKENS, nearest_latents(),
+            IMAGE_TOKEN_OFFSET, eagle_version,
+            cart_candidates_prob=tree["cart_candidates_prob"],
+            original_prob=tree["original_prob"],
+            p_indices=tree["p_indices"],
+            tree_candidates=tree["tree_candidates"],
+            b_indices=tree["b_indices"],
+            lantern=lantern,
+            lantern_k=LANTERN_K,
+            lantern_delta=LANTERN_DELTA,
+        )
+        for _ in range(num_trials)
+    ]
+    return [list(values) for values in zip(*results)]
+
+
+def run_tensorized(tree, eagle_version, lantern, num_trials=NUM_TRIALS):
+    torch.manual_seed(0)
+    image_token_mask = torch.zeros(VOCAB_SIZE, dtype=torch.bool)
+    image_token_mask[IMAGE_TOKENS] = True
+    image_syntax_token_mask = torch.zeros(VOCAB_SIZE, dtype=torch.bool)
+    image_syntax_token_mask[IMAGE_SYNTAX_TOKENS] = True
+
+    # every row of the batch evaluates the same tree
+    def expand(tensor):
+        return tensor[None].expand(num_trials, *tensor.shape)
+
+    return acceptance.evaluate_posterior_tensorized(
+        logits=expand(tree["logits"]),
+        candidates=expand(tree["candidates"]),
+        num_slots=tree["num_slots"],
+        image_token_mask=image_token_mask,
+        image_syntax_token_mask=image_syntax_token_mask,
+        cart_candidates_prob=expand(tree["cart_candidates_prob"]) if eagle_version == 1 else None,
+        original_prob=[expand(prob) for prob in tree["original_prob"]] if eagle_version == 1 else None,
+        p_indices=tree["p_indices"] if eagle_version == 1 else None,
+        lantern=lantern,
+        lantern_k=LANTERN_K,
+        lantern_delta=LANTERN_DELTA,
+        nearest_latents=nearest_latents(),
+        image_token_offset=IMAGE_TOKEN_OFFSET,
+    )
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+@pytest.mark.parametrize("lantern", [False, True])
+@pytest.mark.parametrize("eagle_version", [1, 2])
+def test_tensorized_matches_loop(eagle_version, lantern, seed):
+    tree = random_tree(seed)
+    loop = run_loop(tree, eagle_version, lantern)
+    tensorized = run_tensorized(tree, eagle_version, lantern)
+
+    # acceptance rates
+    loop_lengths = torch.tensor(loop[1], dtype=torch.float32)
+    tensorized_lengths = torch.tensor(tensorized[1], dtype=torch.float32)
+    assert abs(loop_lengths.mean() - tensorized_lengths.mean()) < 0.1
+    max_length = tree["candidates"].shape[1]
+    loop_histogram = torch.bincount(loop_lengths.long(), minlength=max_length) / NUM_TRIALS
+    tensorized_histogram = torch.bincount(tensorized_lengths.long(), minlength=max_length) / NUM_TRIALS
+    assert 0.5 * (loop_histogram - tensorized_histogram).abs().sum() < 0.05
+
+    # token distributions
+    loop_emitted = emitted_distribution(tree, *loop)
+    tensorized_emitted = emitted_distribution(tree, *tensorized)
+    assert 0.5 * (loop_emitted - tensorized_emitted).abs().sum() < 0.05
+
+    # the next-token distributions are valid
+    sample_p = tensorized[2]
+    assert sample_p.shape == (NUM_TRIALS, VOCAB_SIZE)
+    assert torch.allclose(sample_p.sum(dim=-1), torch.ones(NUM_TRIALS), atol=1e-5)
+    assert (sample_p >= 0).all()
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_tensorized_is_unbiased_on_image_tokens(seed):
+    # without LANTERN, EAGLE v2 emits the first token from the target distribution
+    tree = random_tree(seed)
+    tree["logits"][..., :IMAGE_TOKEN_OFFSET] = -float("inf")
+    tree["logits"][..., IMAGE_SYNTAX_TOKENS] = -float("inf")
+    tree["candidates"] = torch.where(
+        tree["candidates"] >= 0, IMAGE_TOKEN_OFFSET + tree["candidates"] % len(IMAGE_TOKENS), tree["candidates"]
+    )
+    tensorized = run_tensorized(tree, eagle_version=2, lantern=False, num_trials=20000)
+
+    target = torch.softmax(tree["logits"][0, 0], dim=0)
+    emitted = emitted_distribution(tree, *tensorized)
+    assert 0.5 * (emitted - target).abs().sum() < 0.02
+
+
+def test_tensorized_handles_certain_drafters():
+    # an EAGLE v1 drafter that is certain of its first token: the later siblings have no drafter mass left
+    tree = random_tree(0)
+    tree["original_prob"] = [
+        torch.nn.functional.one_hot(prob.argmax(dim=-1), VOCAB_SIZE).float() for prob in tree["original_prob"]
+    ]
+    candidates, p_indices = tree["candidates"], tree["p_indices"]
+    for i in range(1, candidates.shape[1]):
+        valid = candidates[:, i] >= 0
+        q = tree["original_prob"][i - 1][p_indices[:, i].clamp(0, len(tree["original_prob"][i - 1]) - 1)]
+        tree["cart_candidates_prob"][:, i] = torch.where(
+            valid, q.gather(1, candidates[:, i:i + 1].clamp(min=0))[:, 0], 1.0
+        )
+    tensorized = run_tensorized(tree, eagle_version=1, lantern=False, num_trials=200)
+
+    sample_p = tensorized[2]
+    assert not sample_p.isnan().any()
+    assert torch.allclose(sample_p.sum(dim=-1), torch.ones(200), atol=1e-5)
+
+
+def test_prefix_groups_batched():
+    candidates = torch.tensor([
+        [[1, 2, 3], [1, 2, 4], [1, 5, -1]],
+        [[1, 6, 6], [1, 7, -1], [1, 7, -1]],
+    ])
+    ranks, first_rows = acceptance.prefix_groups(candidates)
+    for row in range(candidates.shape[0]):
+        row_ranks, row_first_rows = acceptance.prefix_groups(candidates[row])
+        assert torch.equal(ranks[row], row_ranks)
+        assert torch.equal(first_rows[row], row_first_rows)
+    assert ranks[1, :, 1].tolist() == [0, 1, 1]
+    assert first_rows[1, :, 1].tolist() == [0, 1, 3]
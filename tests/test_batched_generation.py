@@ -0,0 +1,121 @@
+import pytest
+import torch
+
+import toy_lumina_mgpt
+
+MAX_NEW_TOKENS = 64
+MAX_LENGTH = 256
+# prompts of different lengths, left-padded in a batch
+PROMPT_LENGTHS = [4, 7, 2]
+
+
+def prompts(seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return [torch.randint(8200, 8800, (1, length), generator=generator) for length in PROMPT_LENGTHS]
+
+
+def left_pad(prompts):
+    width = max(prompt.shape[1] for prompt in prompts)
+    input_ids = torch.zeros((len(prompts), width), dtype=torch.long)
+    attention_mask = torch.zeros((len(prompts), width), dtype=torch.bool)
+    for row, prompt in enumerate(prompts):
+        input_ids[row, width - prompt.shape[1]:] = prompt[0]
+        attention_mask[row, width - prompt.shape[1]:] = True
+    return input_ids, attention_mask
+
+
+def decode(model, input_ids, attention_mask=None, compact=False, eos_token_ids=None):
+    # the loop of `generate`, optionally squeezing the holes out of the caches after every step
+    state = model.start_generation(
+        input_ids, attention_mask=attention_mask, max_new_tokens=MAX_NEW_TOKENS, max_length=MAX_LENGTH,
+        logits_processors=[None], eos_token_ids=eos_token_ids,
+    )
+    while not all(state.finished):
+        model.decode_step(state)
+        if compact:
+            state.input_ids, state.attn_mask = model.compact_inference_inputs(
+                state.input_ids, state.attn_mask, state.past_key_values_data, state.current_length_data
+            )
+    model.finish_generation(state)
+    return [state.output(row) for row in range(state.batch_size)], state.accept_length_list
+
+
+def eos_tokens(outputs, fractions):
+    # for every row of `fractions`, a token that only this prompt generates, that far into its image
+    eos_token_ids = []
+    for row, fraction in fractions.items():
+        others = torch.cat([output for other, output in enumerate(outputs) if other != row])
+        generated = outputs[row][-MAX_NEW_TOKENS:]
+        start = int(fraction * MAX_NEW_TOKENS)
+        eos_token_ids.append(next(
+            token for token in generated[start:].tolist()
+            if token not in others.tolist() and token not in generated[:start].tolist()
+        ))
+    return eos_token_ids
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("eagle_version", [1, 2])
+def test_batch_matches_the_prompts_decoded_alone(eagle_version, compact):
+    model = toy_lumina_mgpt.ToyEaLumina_mGPT(eagle_version=eagle_version)
+    outputs = [decode(model, prompt)[0][0] for prompt in prompts()]
+    # the first and the last rows stop at their EOS tokens at different steps, the middle one runs to its length
+    eos_token_ids = eos_tokens(outputs, {0: 1 / 3, 2: 2 / 3})
+
+    isolated = [decode(model, prompt, eos_token_ids=eos_token_ids) for prompt in prompts()]
+    batched_outputs, batched_accept_lengths = decode(
+        model, *left_pad(prompts()), compact=compact, eos_token_ids=eos_token_ids
+    )
+
+    for row, ((output,), (accept_lengths,)) in enumerate(isolated):
+        assert torch.equal(batched_outputs[row], output)
+        assert batched_accept_lengths[row] == accept_lengths
+    # the rows finished at different steps, by their EOS tokens or their length, and accepted different lengths at
+    # the same steps, which left holes in the batch
+    num_steps = [len(accept_lengths) for accept_lengths in batched_accept_lengths]
+    assert len(set(num_steps)) == len(PROMPT_LENGTHS)
+    assert len(batched_outputs[1]) - PROMPT_LENGTHS[1] - 3 >= MAX_NEW_TOKENS
+    assert any(
+        len(set(lengths)) > 1 for lengths in zip(*batched_accept_lengths)
+    )
+    # the images crossed a row end, whose new line token was accepted with the drafted tokens around it
+    assert (batched_outputs[1] == 8803).any()
+
+
+@pytest.mark.parametrize("eagle_version", [1, 2])
+def test_admitted_prompt_matches_the_prompt_decoded_alone(eagle_version):
+    model = toy_lumina_mgpt.ToyEaLumina_mGPT(eagle_version=eagle_version)
+    first, second, admitted = prompts(seed=1)
+    outputs = [decode(model, prompt)[0][0] for prompt in (first, second, admitted)]
+    # the first prompt finishes early, and its row is recycled for the admitted one while the second one decodes
+    eos_token_ids = eos_tokens(outputs, {0: 1 / 4})
+    isolated = [decode(model, prompt, eos_token_ids=eos_token_ids) for prompt in (first, second, admitted)]
+
+    model.init_kv_page_pool(num_pages=128, page_size=16)
+    state = model.start_generation(
+        *left_pad([first, second]), max_new_tokens=MAX_NEW_TOKENS, max_length=MAX_LENGTH, logits_processors=[None],
+        eos_token_ids=eos_token_ids,
+    )
+    first_output = None
+    while not all(state.finished):
+        finished_rows = model.decode_step(state)
+        if 0 in finished_rows and first_output is None:
+            assert not state.finished[1]
+            first_output, first_accept_lengths = state.output(0), state.accept_length_list[0]
+            model.admit(state, 0, admitted, logits_processors=[None])
+    pool = model.kv_page_pool
+    assert len(pool.free_pages) < pool.num_pages
+    model.finish_generation(state)
+
+    # the pages of the batch are back in the pool
+    assert sorted(pool.free_pages) == list(range(pool.num_pages))
+    assert state.page_tables == []
+
+    batched = [
+        (first_output, first_accept_lengths),
+        (state.output(1), state.accept_length_list[1]),
+        (state.output(0), state.accept_length_list[0]),
+    ]
+    for (output, accept_lengths), ((isolated_output,), (isolated_accept_lengths,)) in zip(batched, isolated):
+        assert torch.equal(output, isolated_output)
+        assert accept_lengths == isolated_accept_lengths
@@ -0,0 +1,86 @@
+import pytest
+import torch
+
+from module_loader import load_definitions
+
+cnets = load_definitions(
+    "models/drafters/cnets_lumina_mgpt.py", ["sample", "ImageVocabHead", "cfg_head"]
+)
+
+HIDDEN_SIZE = 256
+VOCAB_SIZE = 4096
+NUM_TOKENS = 64
+TOP_K = 10
+CFG_SCALE = 3.0
+
+# (logits atol, minimal argmax agreement, minimal top-k overlap)
+TOLERANCES = {
+    torch.float32: (1e-4, 1.0, 1.0),
+    torch.bfloat16: (0.1, 0.9, 0.9),
+}
+
+
+def inputs(dtype, seed=0):
+    torch.manual_seed(seed)
+    lm_head = torch.nn.Linear(HIDDEN_SIZE, VOCAB_SIZE, bias=False).to(dtype)
+    hidden_states = torch.randn(NUM_TOKENS, HIDDEN_SIZE)
+    # the unconditional branch stays close to the conditional one, as it does in practice
+    uncond_hidden_states = hidden_states + 0.3 * torch.randn(NUM_TOKENS, HIDDEN_SIZE)
+    return lm_head, hidden_states.to(dtype), uncond_hidden_states.to(dtype)
+
+
+def two_projection_cfg(head, hidden_states, uncond_hidden_states, cfg_scale):
+    # the reference: both branches projected to the vocabulary, guidance applied to the logits in float32
+    logits, uncond_logits = head(hidden_states).float(), head(uncond_hidden_states).float()
+    return uncond_logits + (logits - uncond_logits) * cfg_scale
+
+
+def assert_equivalent(logits, reference, dtype):
+    atol, min_argmax, min_topk = TOLERANCES[dtype]
+    assert logits.shape == reference.shape
+    assert (logits - reference).abs().max().item() <= atol
+
+    argmax = logits.argmax(-1)
+    argmax_agreement = (argmax == reference.argmax(-1)).float().mean().item()
+    assert argmax_agreement >= min_argmax
+    # a different argmax is only allowed for near ties of the reference logits
+    gap = reference.max(-1).values - reference.gather(-1, argmax.unsqueeze(-1)).squeeze(-1)
+    assert gap.max().item() <= 2 * atol
+
+    top, reference_top = logits.topk(TOP_K, dim=-1).indices, reference.topk(TOP_K, dim=-1).indices
+    overlap = (top.unsqueeze(-1) == reference_top.unsqueeze(-2)).any(-1).float().mean().item()
+    assert overlap >= min_topk
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_cfg_head_matches_two_projections(dtype):
+    lm_head, hidden_states, uncond_hidden_states = inputs(dtype)
+    with torch.no_grad():
+        logits = cnets.cfg_head(lm_head, hidden_states, uncond_hidden_states, CFG_SCALE)
+        reference = two_projection_cfg(lm_head, hidden_states, uncond_hidden_states, CFG_SCALE)
+
+    assert logits.dtype == dtype
+    assert_equivalent(logits.float(), reference, dtype)
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_cfg_head_matches_two_projections_in_the_image_vocabulary(dtype):
+    lm_head, hidden_states, uncond_hidden_states = inputs(dtype, seed=1)
+    token_ids = torch.arange(VOCAB_SIZE // 2, VOCAB_SIZE)
+    head = cnets.ImageVocabHead(lm_head, token_ids, h_latent_dim=4, w_latent_dim=4)
+    with torch.no_grad():
+        logits = cnets.cfg_head(head, hidden_states, uncond_hidden_states, CFG_SCALE)
+        reference = two_projection_cfg(lm_head, hidden_states, uncond_hidden_states, CFG_SCALE)[..., token_ids]
+
+    assert_equivalent(logits.float(), reference, dtype)
+
+
+def test_cfg_head_with_bias_falls_back_to_two_projections():
+    torch.manual_seed(2)
+    lm_head = torch.nn.Linear(HIDDEN_SIZE, VOCAB_SIZE)
+    hidden_states, uncond_hidden_states = torch.randn(2, NUM_TOKENS, HIDDEN_SIZE).unbind(0)
+    with torch.no_grad():
+        logits = cnets.cfg_head(lm_head, hidden_states, uncond_hidden_states, CFG_SCALE)
+        reference = two_projection_cfg(lm_head, hidden_states, uncond_hidden_states, CFG_SCALE)
+
+    assert torch.allclose(logits, reference, atol=1e-4)
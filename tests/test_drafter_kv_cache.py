@@ -0,0 +1,224 @@
+from types import SimpleNamespace
+from typing import Optional, Tuple
+
+import pytest
+import torch
+
+from module_loader import load_definitions, load_module
+
+kv_cache = load_module("models/drafters/kv_cache.py")
+NAMESPACE = {
+    "Optional": Optional, "Tuple": Tuple, "ChameleonConfig": object, "Cache": object, "KVCache": kv_cache.KVCache,
+    "logger": SimpleNamespace(warning_once=lambda *args, **kwargs: None),
+}
+KV_METHODS = ["Model.init_kv"]
+DRAFTERS = {
+    "lumina_mgpt": load_definitions(
+        "models/drafters/cnets_lumina_mgpt.py",
+        ["LlamaRotaryEmbedding", "rotate_half", "apply_rotary_pos_emb", "ChameleonLayerNorm", "repeat_kv",
+         "ChameleonAttention", "Model.compact_kv", "Model.detach_kv", "Model.attach_kv"] + KV_METHODS,
+        NAMESPACE,
+    ),
+    "anole": load_definitions(
+        "models/drafters/cnets_anole.py",
+        ["repeat_kv", "rotate_half", "apply_rotary_pos_emb", "ChameleonRotaryEmbedding", "ChameleonLayerNorm",
+         "ChameleonAttention"] + KV_METHODS,
+        NAMESPACE,
+    ),
+    "llamagen": load_definitions(
+        "models/drafters/cnets_llamagen.py",
+        ["precompute_freqs_cis_2d", "apply_rotary_emb", "repeat_kv", "rotate_half", "LlamaRotaryEmbedding",
+         "LlamaAttention"] + KV_METHODS,
+        NAMESPACE,
+    ),
+}
+lumina_mgpt = DRAFTERS["lumina_mgpt"]
+
+HIDDEN_SIZE = 32
+
+
+class ToyDrafter(torch.nn.Module):
+    """
+    The attention layers of a drafter, chained, with its KV cache methods: the keys and values go to the preallocated
+    KVCache of `init_kv`, or are concatenated to tuples as the reference.
+    """
+
+    compact_kv = lumina_mgpt.compact_kv
+    detach_kv = lumina_mgpt.detach_kv
+    attach_kv = lumina_mgpt.attach_kv
+
+    def __init__(self, name, num_layers=2, seed=0):
+        super().__init__()
+        torch.manual_seed(seed)
+        self.name = name
+        drafter = DRAFTERS[name]
+        config = SimpleNamespace(
+            hidden_size=HIDDEN_SIZE, num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=64,
+            rope_theta=10000.0, rope_scaling=None, attention_dropout=0.0, attention_bias=False, model_parallel_size=1,
+            pretraining_tp=1,
+        )
+        if name == "llamagen":
+            layers = [drafter.LlamaAttention(config) for _ in range(num_layers)]
+            self.freqs_cis = drafter.precompute_freqs_cis_2d(6, HIDDEN_SIZE // 4, cls_token_num=0)
+        else:
+            layers = [drafter.ChameleonAttention(config, layer_idx) for layer_idx in range(num_layers)]
+        self.layers = torch.nn.ModuleList([torch.nn.Module() for _ in layers])
+        for layer, self_attn in zip(self.layers, layers):
+            layer.self_attn = self_attn
+        self.fc = torch.nn.Linear(2 * HIDDEN_SIZE, HIDDEN_SIZE)
+        self.kv_buffers = None
+        self.stable_kv = None
+        self.tree_attention_mask = kv_cache.TreeAttentionMask()
+        self.eval()
+
+    def init_kv(self, batch_size):
+        return DRAFTERS[self.name].init_kv(self, batch_size)
+
+    @torch.no_grad()
+    def forward(self, hidden_states, allowed, position_ids, past_key_values):
+        # allowed: [bsz, tgt_len, past_len + tgt_len], True where a query attends to a key
+        attention_mask = torch.zeros(allowed.shape, dtype=torch.float32).masked_fill(
+            ~allowed, torch.finfo(torch.float32).min
+        )[:, None]
+        presents = []
+        for layer, past_key_value in zip(self.layers, past_key_values or [None] * len(self.layers)):
+            if self.name == "llamagen":
+                hidden_states, _, present = layer.self_attn(
+                    hidden_states, attention_mask=attention_mask, freqs_cis=self.freqs_cis[position_ids[0]],
+                    past_key_value=past_key_value, use_cache=True,
+                )
+            else:
+                hidden_states, _, present = layer.self_attn(
+                    hidden_states, attention_mask=attention_mask, position_ids=position_ids,
+                    past_key_value=past_key_value, use_cache=True,
+                )
+            presents.append(present)
+        return hidden_states, presents
+
+
+def causal(bsz, past_len, tgt_len):
+    return torch.ones(tgt_len, past_len + tgt_len, dtype=torch.bool).tril(past_len).expand(bsz, -1, -1)
+
+
+def tree_block(bsz, past_len, tgt_len, generator):
+    # the queries see the whole prefix, themselves and a random subset of the tree entries before them
+    allowed = causal(bsz, past_len, tgt_len).clone()
+    allowed[:, :, -tgt_len - 4:-tgt_len] = torch.rand(bsz, tgt_len, 4, generator=generator) < 0.5
+    return allowed
+
+
+def positions(start, length):
+    return torch.arange(start, start + length)[None]
+
+
+def inputs(bsz, length, generator):
+    return torch.randn(bsz, length, HIDDEN_SIZE, generator=generator)
+
+
+def to_tuples(past_key_values):
+    return [tuple(cache.data[:, :, :cache.current_length].clone() for cache in layer) for layer in past_key_values]
+
+
+@pytest.mark.parametrize("name", ["lumina_mgpt", "anole", "llamagen"])
+def test_draft_tree_is_rolled_back_in_place(name):
+    # the steps of two `topK_genrate` calls: the committed tokens, then a draft tree of two depths rolled back
+    generator = torch.Generator().manual_seed(0)
+    drafter = ToyDrafter(name)
+    stable_kv = drafter.init_kv(2)
+    reference_kv = None
+    stable_len = 0
+    for new_tokens in (6, 3):
+        hidden_states = inputs(2, new_tokens, generator)
+        allowed = causal(2, stable_len, new_tokens)
+        out, _ = drafter(hidden_states, allowed, positions(stable_len, new_tokens), stable_kv)
+        reference_out, reference_kv = drafter(hidden_states, allowed, positions(stable_len, new_tokens), reference_kv)
+        torch.testing.assert_close(out, reference_out)
+        stable_len += new_tokens
+
+        # the tree entries are appended to the stable cache in place, and to copies of the tuples
+        past_kv, reference_past_kv = stable_kv, reference_kv
+        for depth in range(2):
+            hidden_states = inputs(2, 4, generator)
+            allowed = tree_block(2, stable_len + 4 * depth, 4, generator)
+            out, past_kv = drafter(hidden_states, allowed, positions(stable_len + depth, 4), past_kv)
+            reference_out, reference_past_kv = drafter(
+                hidden_states, allowed, positions(stable_len + depth, 4), reference_past_kv
+            )
+            torch.testing.assert_close(out, reference_out)
+        assert stable_kv[0][0].shape[2] == stable_len + 8
+
+        drafter.kv_buffers[1].fill_(stable_len)
+        for layer, reference_layer in zip(to_tuples(stable_kv), reference_kv):
+            for cache, reference_cache in zip(layer, reference_layer):
+                torch.testing.assert_close(cache, reference_cache)
+
+    # the next batch of the same size reuses the storage
+    data = drafter.kv_buffers[0]
+    assert drafter.init_kv(2)[0][0].data.data_ptr() == data.data_ptr()
+    assert drafter.kv_buffers[1].sum() == 0
+
+
+def test_compact_kv_matches_the_gathered_reference():
+    generator = torch.Generator().manual_seed(1)
+    drafter = ToyDrafter("lumina_mgpt")
+    drafter.stable_kv = drafter.init_kv(4)
+    hidden_states = inputs(4, 8, generator)
+    _, reference_kv = drafter(hidden_states, causal(4, 0, 8), positions(0, 8), None)
+    drafter(hidden_states, causal(4, 0, 8), positions(0, 8), drafter.stable_kv)
+
+    # the positions kept by every row of the drafter batch, e.g., with the holes removed
+    indices = torch.stack([torch.randperm(8, generator=generator)[:5].sort().values for _ in range(4)])
+    drafter.compact_kv(indices)
+    reference_kv = [
+        tuple(cache.gather(2, indices[:, None, :, None].expand(-1, cache.shape[1], -1, cache.shape[3]))
+              for cache in layer)
+        for layer in reference_kv
+    ]
+    for layer, reference_layer in zip(to_tuples(drafter.stable_kv), reference_kv):
+        for cache, reference_cache in zip(layer, reference_layer):
+            torch.testing.assert_close(cache, reference_cache)
+
+    hidden_states = inputs(4, 2, generator)
+    out, _ = drafter(hidden_states, causal(4, 5, 2), positions(5, 2), drafter.stable_kv)
+    reference_out, _ = drafter(hidden_states, causal(4, 5, 2), positions(5, 2), reference_kv)
+    torch.testing.assert_close(out, reference_out)
+
+
+def test_admitted_prompt_is_prefilled_into_its_rows():
+    # a batch of two prompts, i.e., four drafter rows [cond_0, cond_1, uncond_0, uncond_1], admits into row 1
+    generator = torch.Generator().manual_seed(2)
+    drafter = ToyDrafter("lumina_mgpt")
+    drafter.stable_kv = drafter.init_kv(4)
+    hidden_states = inputs(4, 6, generator)
+    drafter(hidden_states, causal(4, 0, 6), positions(0, 6), drafter.stable_kv)
+    _, reference_kv = drafter(hidden_states, causal(4, 0, 6), positions(0, 6), None)
+    stable_kv, data = drafter.stable_kv, drafter.kv_buffers[0]
+
+    rows = slice(1, None, 2)
+    detached = drafter.detach_kv(rows)
+    assert drafter.stable_kv is None
+    # the prefill of `topK_generate` writes into the rows of the storage instead of a new buffer
+    row_kv = drafter.init_kv(2)
+    assert row_kv[0][0].data.untyped_storage().data_ptr() == data.untyped_storage().data_ptr()
+    row_hidden_states = inputs(2, 6, generator)
+    drafter(row_hidden_states, causal(2, 0, 6), positions(0, 6), row_kv)
+    # and its draft tree, rolled back
+    drafter(inputs(2, 4, generator), tree_block(2, 6, 4, generator), positions(6, 4), row_kv)
+    assert row_kv[0][0].shape[2] == 10 and stable_kv[0][0].shape[2] == 6
+    drafter.kv_buffers[1].fill_(6)
+    _, row_reference_kv = drafter(row_hidden_states, causal(2, 0, 6), positions(0, 6), None)
+    drafter.attach_kv(detached)
+
+    assert drafter.stable_kv is stable_kv and drafter.kv_buffers[0] is data
+    assert stable_kv[0][0].shape[2] == 6
+    for layer, row_layer in zip(reference_kv, row_reference_kv):
+        for cache, row_cache in zip(layer, row_layer):
+            cache[rows] = row_cache
+    for layer, reference_layer in zip(to_tuples(stable_kv), reference_kv):
+        for cache, reference_cache in zip(layer, reference_layer):
+            torch.testing.assert_close(cache, reference_cache)
+
+    hidden_states = inputs(4, 2, generator)
+    out, _ = drafter(hidden_states, causal(4, 6, 2), positions(6, 2), stable_kv)
+    reference_out, _ = drafter(hidden_states, causal(4, 6, 2), positions(6, 2), reference_kv)
+    torch.testing.assert_close(out, reference_out)
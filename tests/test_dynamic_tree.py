@@ -0,0 +1,142 @@
+from types import SimpleNamespace
+from typing import List, Optional, Tuple
+
+import pytest
+import torch
+
+from module_loader import load_definitions
+
+cnets = load_definitions(
+    "models/drafters/cnets_lumina_mgpt.py",
+    ["Model", "stack_retrieve_indices"],
+    namespace={"List": List, "Optional": Optional, "Tuple": Tuple},
+)
+
+TOP_K = 4
+TOTAL_TOKENS = 20
+DEPTH = 4
+
+
+def build_dynamic_tree_loop(scores_list, ss_token_list, parents_list, sample_token, sort_leaves):
+    # the reference: the tree of a single row assembled on the host, node by node
+    top_scores_index = torch.sort(
+        torch.sort(scores_list, descending=True, stable=True).indices[:TOTAL_TOKENS]
+    ).values
+
+    draft_tokens = torch.cat((sample_token, ss_token_list[top_scores_index]), dim=0)
+
+    draft_parents = parents_list[top_scores_index // TOP_K].long()
+    mask_index = torch.searchsorted(top_scores_index, draft_parents - 1, right=False)
+    mask_index[draft_parents == 0] = -1
+    mask_index = mask_index + 1
+    mask_index_list = mask_index.tolist()
+
+    tree_mask = torch.eye(TOTAL_TOKENS + 1).bool()
+    tree_mask[:, 0] = True
+    for i in range(TOTAL_TOKENS):
+        tree_mask[i + 1].add_(tree_mask[mask_index_list[i]])
+
+    tree_position_ids = torch.sum(tree_mask, dim=1) - 1
+    tree_mask = tree_mask.float()
+
+    max_depth = torch.max(tree_position_ids) + 1
+    noleaf_index = torch.unique(mask_index).tolist()
+    leaf_num = TOTAL_TOKENS - (len(noleaf_index) - 1)
+
+    retrieve_indices = (torch.zeros(leaf_num, max_depth.item(), dtype=torch.long) - 1).tolist()
+    rid = 0
+    position_ids_list = tree_position_ids.tolist()
+    for i in range(TOTAL_TOKENS + 1):
+        if i not in noleaf_index:
+            cid = i
+            depth = position_ids_list[i]
+            for j in reversed(range(depth + 1)):
+                retrieve_indices[rid][j] = cid
+                cid = mask_index_list[cid - 1]
+            rid += 1
+
+    if sort_leaves:
+        maxitem = TOTAL_TOKENS + 5
+        retrieve_indices = sorted(retrieve_indices, key=lambda path: [i if i >= 0 else maxitem for i in path])
+
+    return draft_tokens, retrieve_indices, tree_mask, tree_position_ids
+
+
+def random_drafts(batch_size, seed, forced_depths=()):
+    # the scores, tokens and parents accumulated by the dynamic drafting of `topK_generate`
+    generator = torch.Generator().manual_seed(seed)
+
+    def topk(shape, forced):
+        if forced:
+            # a forced token: log-probability 0 followed by impossible tokens
+            topk_p = torch.full(shape, -float("inf"))
+            topk_p[..., 0] = 0
+        else:
+            topk_p = torch.sort(torch.log_softmax(torch.randn(*shape[:-1], 32, generator=generator), -1), -1,
+                                descending=True).values[..., :TOP_K]
+        return torch.randint(4, 100, shape, generator=generator), topk_p
+
+    topk_index, scores = topk((batch_size, TOP_K), 0 in forced_depths)
+    scores_list, ss_token = [scores[:, None]], [topk_index[:, None]]
+    parents_list = [torch.zeros((batch_size, 1), dtype=torch.long)]
+    topk_cs_index = torch.arange(TOP_K).repeat(batch_size, 1)
+    for i in range(DEPTH):
+        bias = 1 + TOP_K ** 2 * max(0, i - 1) + (TOP_K if i > 0 else 0)
+        parents_list.append(topk_cs_index + bias)
+
+        topk_index, topk_p = topk((batch_size, TOP_K, TOP_K), i + 1 in forced_depths)
+        cumulative_scores = topk_p + scores[:, :, None]
+        topk_cs = torch.topk(cumulative_scores.view(batch_size, -1), TOP_K, dim=-1)
+        topk_cs_index, scores = topk_cs.indices, topk_cs.values
+        ss_token.append(topk_index)
+        scores_list.append(cumulative_scores)
+
+    num_depths = len(scores_list)
+    sample_token = torch.randint(4, 100, (batch_size, 1), generator=generator)
+    return (
+        torch.cat(scores_list, dim=1).view(batch_size, -1),
+        torch.cat(ss_token, dim=1).view(batch_size, -1),
+        torch.cat(parents_list, dim=1),
+        sample_token,
+        num_depths,
+    )
+
+
+@pytest.mark.parametrize("sort_leaves", [True, False])
+@pytest.mark.parametrize("forced_depths", [(), (2,), (0, 3)])
+def test_batched_tree_matches_the_row_loop(sort_leaves, forced_depths):
+    batch_size = 3
+    scores_list, ss_token_list, parents_list, sample_token, num_depths = random_drafts(
+        batch_size, seed=len(forced_depths) + 7 * sort_leaves, forced_depths=forced_depths
+    )
+    drafter = SimpleNamespace(total_tokens=TOTAL_TOKENS, top_k=TOP_K)
+    draft_tokens, retrieve_indices, tree_mask, tree_position_ids = cnets.Model.build_dynamic_tree(
+        drafter, scores_list, ss_token_list, parents_list, sample_token, num_depths, sort_leaves=sort_leaves
+    )
+
+    trees = [
+        build_dynamic_tree_loop(scores_list[b], ss_token_list[b], parents_list[b], sample_token[b], sort_leaves)
+        for b in range(batch_size)
+    ]
+    assert torch.equal(draft_tokens, torch.stack([tree[0] for tree in trees]))
+    assert torch.equal(retrieve_indices, cnets.stack_retrieve_indices([tree[1] for tree in trees]))
+    assert torch.equal(tree_mask, torch.stack([tree[2] for tree in trees]))
+    assert torch.equal(tree_position_ids, torch.stack([tree[3] for tree in trees]))
+
+
+def test_confident_children_keep_their_parents():
+    # every drafted token of the depths after the first is certain, hence a child ties with its parent: the tree
+    # holds the chains of the three best first depth tokens and the start of the chain of the last one
+    batch_size = 2
+    scores_list, ss_token_list, parents_list, sample_token, num_depths = random_drafts(
+        batch_size, seed=3, forced_depths=tuple(range(1, DEPTH + 1))
+    )
+    drafter = SimpleNamespace(total_tokens=3 * (DEPTH + 1) + 2, top_k=TOP_K)
+    _, retrieve_indices, tree_mask, tree_position_ids = cnets.Model.build_dynamic_tree(
+        drafter, scores_list, ss_token_list, parents_list, sample_token, num_depths, sort_leaves=True
+    )
+
+    # every node descends from the root, within the drafted depths
+    assert (tree_mask[:, :, 0] == 1).all() and (retrieve_indices[:, :, 0] == 0).all()
+    assert tree_position_ids.max() <= num_depths
+    assert torch.equal(tree_position_ids, tree_mask.sum(dim=-1).long() - 1)
@@ -0,0 +1,194 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+import toy_lumina_mgpt
+from module_loader import load_definitions, load_module
+
+acceptance = load_module("models/drafters/acceptance.py")
+cnets = load_definitions(
+    "models/drafters/cnets_lumina_mgpt.py", ["stack_retrieve_indices", "splice_forced_tokens", "Model.forced_depths"]
+)
+ea_model = load_definitions(
+    "models/ea_model_lumina_mgpt.py", ["MultiModalLogitsProcessor"], namespace={"LogitsProcessor": object}
+)
+
+NEW_LINE_TOKEN_ID = 8803
+IMAGE_END_TOKEN_ID = 8196
+H_LATENT_DIM, W_LATENT_DIM = 3, 4
+# the position of the token after the root of every row: the tree crosses a row end after the first drafted depth,
+# the last row end and the image end after the second one, and a row end after the fourth one
+IMAGE_POSITIONS = torch.tensor([5, 14, 7])
+NUM_DEPTHS = 4
+
+
+def forced_depths():
+    processor = ea_model.MultiModalLogitsProcessor(NEW_LINE_TOKEN_ID, IMAGE_END_TOKEN_ID, voc_size=9000)
+    logits_processor = SimpleNamespace(
+        forced_tokens=lambda position_ids: processor.forced_tokens(position_ids, H_LATENT_DIM, W_LATENT_DIM)
+    )
+    return cnets.forced_depths(None, logits_processor, IMAGE_POSITIONS, NUM_DEPTHS)
+
+
+def random_tree(num_nodes, generator):
+    # a drafted tree with the root first and every node after its parent, at most NUM_DEPTHS deep
+    parents, depths = [-1], [0]
+    for _ in range(1, num_nodes):
+        candidates = [node for node, depth in enumerate(depths) if depth < NUM_DEPTHS]
+        parent = candidates[torch.randint(len(candidates), (1,), generator=generator).item()]
+        parents.append(parent)
+        depths.append(depths[parent] + 1)
+
+    ancestors = torch.eye(num_nodes, dtype=torch.bool)
+    for node in range(1, num_nodes):
+        ancestors[node] |= ancestors[parents[node]]
+    leaves = [node for node in range(num_nodes) if node not in parents]
+    paths = [ancestors[leaf].nonzero().squeeze(1).tolist() for leaf in leaves]
+    tokens = torch.randint(4, 8000, (num_nodes,), generator=generator)
+    return tokens, torch.tensor(depths), ancestors.float(), paths, parents
+
+
+def reference_sequences(tokens, parents, depths, forced_tokens, tree_depths):
+    # the tokens from the root to every drafted node and to the end of the chain of forced tokens that follows it
+    def chain(node):
+        depth = depths[node]
+        return forced_tokens[tree_depths[depth]:tree_depths[depth + 1] - 1]
+
+    sequences, chained = [], []
+    for node in range(len(tokens)):
+        parent = parents[node]
+        sequence = [tokens[node]] if parent < 0 else chained[parent] + [tokens[node]]
+        sequences.append(sequence)
+        chained.append(sequence + chain(node))
+    return sequences, chained
+
+
+def test_forced_depths_skip_the_row_end_and_the_image_end():
+    forced_tokens, tree_depths = forced_depths()
+
+    assert forced_tokens.shape == (3, 2 * (NUM_DEPTHS + 1)) and tree_depths.shape == (3, NUM_DEPTHS + 2)
+    assert tree_depths.tolist() == [[0, 1, 3, 4, 5, 6], [0, 1, 2, 5, 6, 7], [0, 1, 2, 3, 4, 6]]
+    assert forced_tokens[0, 1] == NEW_LINE_TOKEN_ID
+    assert forced_tokens[1, 2:4].tolist() == [NEW_LINE_TOKEN_ID, IMAGE_END_TOKEN_ID]
+    assert forced_tokens[2, 4] == NEW_LINE_TOKEN_ID
+    # the drafted depths are exactly the positions that are not forced
+    steps = torch.arange(forced_tokens.shape[1])[None]
+    drafted = (forced_tokens < 0) & (steps < tree_depths[:, -1:])
+    assert torch.equal(drafted.sum(dim=-1), torch.full((3,), NUM_DEPTHS + 1))
+    assert (forced_tokens.gather(1, tree_depths[:, 1:] - 1) < 0).all()
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_forced_tokens_are_spliced_into_the_tree_at_no_cost(seed):
+    generator = torch.Generator().manual_seed(seed)
+    forced_tokens, tree_depths = forced_depths()
+    num_nodes = 12
+    trees = [random_tree(num_nodes, generator) for _ in range(3)]
+    tree_tokens = torch.stack([tree[0] for tree in trees])
+    tree_position_ids = torch.stack([tree[1] for tree in trees])
+    tree_mask = torch.stack([tree[2] for tree in trees])[:, None]
+    retrieve_indices = cnets.stack_retrieve_indices([tree[3] for tree in trees])
+    path_len = retrieve_indices.shape[-1]
+
+    tokens, position_ids, mask, verified_retrieve_indices, logits_indices = cnets.splice_forced_tokens(
+        tree_tokens, tree_position_ids, tree_mask, retrieve_indices, forced_tokens, tree_depths
+    )
+
+    # the drafted nodes are kept as they are, the forced tokens come on top of them
+    assert torch.equal(tokens[:, :num_nodes], tree_tokens)
+    num_verified = tokens.shape[1]
+    assert num_verified - num_nodes & num_verified - num_nodes - 1 == 0
+    mask = mask[:, 0] != 0
+    assert torch.equal(position_ids, mask.sum(dim=-1) - 1)
+
+    for row, (row_tokens, depths, _, paths, parents) in enumerate(trees):
+        sequences, chained = reference_sequences(
+            row_tokens.tolist(), parents, depths.tolist(), forced_tokens[row].tolist(), tree_depths[row].tolist()
+        )
+        expected = sorted(chained[node][:length] for node in range(num_nodes)
+                          for length in range(len(sequences[node]), len(chained[node]) + 1))
+        num_forced = sum(len(chained[node]) - len(sequences[node]) for node in range(num_nodes))
+        assert num_forced > 0
+
+        # every node sees the nodes before it in the actual sequence, at their positions
+        node_sequences = []
+        for node in range(num_nodes + num_forced):
+            ancestors = mask[row, node].nonzero().squeeze(1)
+            ancestors = ancestors[position_ids[row, ancestors].argsort()]
+            assert torch.equal(position_ids[row, ancestors], torch.arange(len(ancestors)))
+            node_sequences.append(tokens[row, ancestors].tolist())
+        assert node_sequences[:num_nodes] == sequences
+        assert sorted(node_sequences) == expected
+        # the padding nodes only see themselves
+        assert torch.equal(mask[row, num_nodes + num_forced:], torch.eye(num_verified, dtype=torch.bool)[
+            num_nodes + num_forced:])
+
+        for path, verified_path, path_logits_indices in zip(
+            retrieve_indices[row].tolist(), verified_retrieve_indices[row], logits_indices[row]
+        ):
+            path = [node for node in path if node >= 0]
+            verified_path = verified_path[verified_path >= 0]
+            # the path goes through the forced tokens after every node, its leaf included
+            assert tokens[row, verified_path].tolist() == chained[path[-1]]
+            assert torch.equal(position_ids[row, verified_path], torch.arange(len(verified_path)))
+            # and the logits of the last node before every drafted depth predict it
+            for node, logits_index in zip(path, path_logits_indices):
+                assert node_sequences[logits_index] == chained[node]
+
+
+def test_accept_length_counts_the_forced_tokens():
+    vocab_size = 16
+    image_token_mask = torch.zeros(vocab_size, dtype=torch.bool)
+    image_token_mask[4:14] = True
+    # a single path of drafted tokens that the target distribution always accepts
+    candidates = torch.tensor([[[5, 6, 7]]])
+    logits = torch.full((1, 1, 3, vocab_size), -1e4)
+    logits[0, 0, 0, 6] = logits[0, 0, 1, 7] = logits[0, 0, 2, 8] = 0
+    tree_depths = torch.tensor([[0, 1, 3, 5, 6]])
+
+    best_candidate, accept_length, sample_p = acceptance.evaluate_posterior_tensorized(
+        logits, candidates, 1, image_token_mask, torch.zeros(vocab_size, dtype=torch.bool), tree_depths=tree_depths
+    )
+    # the root, two drafted tokens and the forced tokens after each of them
+    assert best_candidate == [0] and accept_length == [4]
+    assert sample_p[0].argmax() == 8
+
+
+def autoregressive_decoding(model, prompt, num_tokens):
+    # one forward of the whole sequence per token, with CFG and the processor; the first token is only constrained by
+    # the logits processors of the caller (none here), as in `initialize_tree`
+    input_ids = torch.cat((prompt[0], torch.tensor([8197, 8828, 8828])))
+    image_start = prompt.shape[1]
+    base_model = model.base_model
+    base_model.model.tree_mask = None
+    processor = ea_model.MultiModalLogitsProcessor(voc_size=9000)
+    for step in range(num_tokens):
+        hidden_states = base_model.model(input_ids=input_ids[None])[0][0, -1]
+        uncond_hidden_states = base_model.model(input_ids=input_ids[None, image_start:])[0][0, -1]
+        logits = toy_lumina_mgpt.drafter.cfg_head(
+            base_model.lm_head, hidden_states[None], uncond_hidden_states[None], model.cfg_scale
+        )
+        if step > 0:
+            logits = processor(logits, position_ids=torch.tensor([len(input_ids) - image_start - 1]))
+        input_ids = torch.cat((input_ids, logits.argmax(dim=-1)))
+    return input_ids
+
+
+@pytest.mark.parametrize("eagle_version", [1, 2])
+@torch.no_grad()
+def test_speculative_decoding_matches_autoregressive_decoding(eagle_version):
+    # the toy target is one-hot, hence the speculative decoding must commit the tokens of plain decoding, across the
+    # end of the first row of the image
+    model = toy_lumina_mgpt.ToyEaLumina_mGPT(eagle_version=eagle_version)
+    prompt = torch.randint(8200, 8800, (1, 5), generator=torch.Generator().manual_seed(0))
+    output, accept_lengths = model.generate(prompt, max_new_tokens=64, max_length=256, logits_processors=[None])
+
+    output = output[0]
+    assert torch.equal(output, autoregressive_decoding(model, prompt, len(output) - prompt.shape[1] - 3))
+    # the new line token after the first 48 image tokens was accepted with drafted tokens
+    new_line = prompt.shape[1] + 3 + 48
+    assert output[new_line] == NEW_LINE_TOKEN_ID
+    ends = torch.tensor(accept_lengths).cumsum(dim=0) + prompt.shape[1] + 3 - 1
+    step = torch.searchsorted(ends, new_line)
+    assert accept_lengths[step] > 1
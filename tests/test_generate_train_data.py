@@ -0,0 +1,79 @@
+import pytest
+import torch
+
+from module_loader import load_definitions
+
+generate_train_data = load_definitions(
+    "entrypoints/generate_train_data.py", ["length_buckets", "cfg_input_ids", "generate_data"]
+)
+
+HIDDEN_SIZE = 8
+
+
+class ToyCausalDecoder(torch.nn.Module):
+    """A single causal attention layer standing in for the decoder of the base model."""
+
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.embed_tokens = torch.nn.Embedding(9000, HIDDEN_SIZE)
+        self.embed_positions = torch.nn.Embedding(64, HIDDEN_SIZE)
+        self.qkv_proj = torch.nn.Linear(HIDDEN_SIZE, 3 * HIDDEN_SIZE)
+
+    def forward(self, input_ids):
+        hidden_states = self.embed_tokens(input_ids) + self.embed_positions(torch.arange(input_ids.shape[1]))
+        query, key, value = self.qkv_proj(hidden_states).chunk(3, dim=-1)
+        return (torch.nn.functional.scaled_dot_product_attention(query, key, value, is_causal=True),)
+
+
+def test_length_buckets():
+    generator = torch.Generator().manual_seed(0)
+    lengths = torch.randint(1, 100, (23,), generator=generator).tolist()
+    batches = list(generate_train_data.length_buckets(lengths, batch_size=4, window=2))
+
+    # every sample is in one batch, and the windows keep their order
+    assert sorted(i for batch in batches for i in batch) == list(range(23))
+    assert [len(batch) for batch in batches] == [4, 4, 4, 4, 4, 3]
+    for window_start, window in zip(range(0, 23, 8), (batches[0:2], batches[2:4], batches[4:6])):
+        indices = [i for batch in window for i in batch]
+        assert sorted(indices) == list(range(window_start, min(window_start + 8, 23)))
+        # the samples of a window are sorted by length
+        assert [lengths[i] for i in indices] == sorted(lengths[i] for i in indices)
+
+
+@pytest.mark.parametrize("model_type", ["lumina_mgpt", "anole"])
+def test_padded_batch_matches_separate_forwards(model_type, monkeypatch):
+    # the toy decoder runs on the CPU
+    monkeypatch.setattr(torch.Tensor, "cuda", lambda self, *args, **kwargs: self)
+    model = torch.nn.Module()
+    model.model = ToyCausalDecoder()
+
+    generator = torch.Generator().manual_seed(1)
+    batch = []
+    for prompt_length, out_length in ((5, 9), (12, 4), (3, 14)):
+        out_token_ids = torch.randint(4, 8000, (1, out_length), generator=generator)
+        if model_type == "lumina_mgpt":
+            out_token_ids[0, :3] = torch.tensor([8197, 8828, 8828])
+        batch.append({
+            "prompt_token_ids": torch.randint(4, 8000, (1, prompt_length), generator=generator),
+            "out_token_ids": out_token_ids,
+        })
+    if model_type == "lumina_mgpt":
+        # a sample without the image start tokens is skipped
+        batch.insert(1, {"prompt_token_ids": torch.tensor([[5, 6]]), "out_token_ids": torch.tensor([[7, 8, 9]])})
+
+    outputs = generate_train_data.generate_data(model, batch, model_type)
+    assert len(outputs) == len(batch)
+    if model_type == "lumina_mgpt":
+        assert outputs.pop(1) is None
+    samples = [generate_train_data.cfg_input_ids(data, model_type) for data in batch]
+    samples = [sample for sample in samples if sample is not None]
+    assert len(outputs) == len(samples) == 3
+    for output, (cond_input_ids, uncond_input_ids) in zip(outputs, samples):
+        assert torch.equal(output["cond_input_ids"], cond_input_ids)
+        assert torch.equal(output["uncond_input_ids"], uncond_input_ids)
+        with torch.no_grad():
+            cond_hidden_states = model.model(cond_input_ids[None])[0][0]
+            uncond_hidden_states = model.model(uncond_input_ids[None])[0][0]
+        assert torch.allclose(output["cond_hidden_states"], cond_hidden_states, atol=1e-6)
+        assert torch.allclose(output["uncond_hidden_states"], uncond_hidden_states, atol=1e-6)
@@ -0,0 +1,96 @@
+from typing import List, Optional, Tuple
+
+import pytest
+import torch
+
+from module_loader import load_definitions, load_module
+
+choices = load_module("models/drafters/choices.py")
+cnets = load_definitions(
+    "models/drafters/cnets_lumina_mgpt.py", ["ImageVocabHead", "vocab_token_ids", "cfg_head"]
+)
+ea_model = load_definitions(
+    "models/ea_model_lumina_mgpt.py",
+    ["MultiModalLogitsProcessor", "EaLumina_mGPT"],
+    namespace={
+        **{name: getattr(choices, name) for name in dir(choices) if not name.startswith("_")},
+        **vars(cnets),
+        "List": List, "Optional": Optional, "Tuple": Tuple, "LogitsProcessor": object,
+    },
+)
+
+VOCAB_SIZE = 9000
+HIDDEN_SIZE = 8
+# the default latent size of the processor: a new line token follows every 48 image tokens
+W_LATENT_DIM = 48
+
+
+class RecordingProcessor(ea_model.MultiModalLogitsProcessor):
+    def __call__(self, scores, *args, position_ids=None, **kwargs):
+        self.position_ids = position_ids
+        return super().__call__(scores, *args, position_ids=position_ids, **kwargs)
+
+
+class ToyVerifier:
+    """
+    The tree decoding of `EaLumina_mGPT` over a stand-in base model that only records the positions of its inputs.
+    """
+
+    tree_decoding = ea_model.EaLumina_mGPT.tree_decoding
+    prepare_prompt = ea_model.EaLumina_mGPT.prepare_prompt
+
+    def __init__(self, cfg_mode):
+        self.cfg_mode = cfg_mode
+        self.cfg_scale = 3.0
+        self.processor = RecordingProcessor(voc_size=VOCAB_SIZE)
+        self.internal_logits_processors = [self.processor, lambda scores: scores]
+        self.head = torch.nn.Linear(HIDDEN_SIZE, VOCAB_SIZE, bias=False)
+        self.position_ids = []
+
+    def __call__(self, input_ids, past_key_values, position_ids, attention_mask=None):
+        self.position_ids.append(position_ids)
+        return None, torch.zeros(*input_ids.shape, HIDDEN_SIZE)
+
+
+def drafter_positions(attention_mask, batch_size):
+    # the position `topK_generate` gives to the processor for the first drafted token of every row
+    position_ids = attention_mask.cumsum(-1) - 1
+    return (position_ids[:, -1] + 1)[batch_size:]
+
+
+@pytest.mark.parametrize("cfg_mode", ["parallel", "sequential"])
+def test_tree_is_constrained_at_the_drafter_positions(cfg_mode):
+    batch_size = 2 if cfg_mode == "parallel" else 1
+    prompt_lengths = [5, 3][:batch_size]
+    prompts = torch.randint(0, 8000, (batch_size, 5), generator=torch.Generator().manual_seed(0))
+    attention_mask = torch.arange(5)[None] >= 5 - torch.tensor(prompt_lengths)[:, None]
+
+    verifier = ToyVerifier(cfg_mode)
+    input_ids, attn_mask, _, prefill_position_ids = verifier.prepare_prompt(prompts, attention_mask)
+    verifier.image_start_token_id_index = 5
+    # the root of the tree is the 48-th image token, hence the token after it is a new line token
+    num_committed = W_LATENT_DIM - 1
+    input_ids = torch.cat((input_ids, torch.randint(4, 8000, (batch_size, num_committed))), dim=1)
+    attn_mask = torch.cat((attn_mask, attn_mask.new_ones(2 * batch_size, num_committed)), dim=1)
+
+    tree_position_ids = torch.tensor([0, 1, 1, 2])
+    tree_candidates = torch.randint(4, 8000, (batch_size, len(tree_position_ids)))
+    retrieve_indices = torch.tensor([[0, 1, 3], [0, 2, -1]])[None].expand(batch_size, -1, -1)
+    past_key_values = {"cond": None, "uncond": None} if cfg_mode == "sequential" else None
+    logits, _, _ = verifier.tree_decoding(
+        tree_candidates, attn_mask, past_key_values, tree_position_ids, input_ids, retrieve_indices, verifier.head
+    )
+
+    position_ids = verifier.processor.position_ids.view(batch_size, -1)
+    assert torch.equal(position_ids[:, 0], drafter_positions(attn_mask, batch_size))
+    assert torch.equal(
+        verifier.processor.forced_tokens(position_ids)[:, 0], torch.full((batch_size,), 8803)
+    )
+    assert (logits[:, 0, 0].argmax(dim=-1) == 8803).all() and (logits[:, 0, 1:].argmax(dim=-1) != 8803).all()
+
+    if cfg_mode == "parallel":
+        # the tree continues the positions of the prefill of both branches
+        tree_start = verifier.position_ids[0][:, 0]
+        prefill_end = prefill_position_ids[:, -1] + num_committed + 1
+        assert torch.equal(tree_start, prefill_end)
+        assert torch.equal(prefill_position_ids[batch_size:, -3], torch.zeros(batch_size, dtype=torch.long))
@@ -0,0 +1,69 @@
+import torch
+
+from module_loader import load_definitions
+
+cnets = load_definitions(
+    "models/drafters/cnets_lumina_mgpt.py",
+    ["sample", "ImageVocabHead", "vocab_token_ids", "global_token_ids", "sample_head", "cfg_head"],
+)
+
+HIDDEN_SIZE = 16
+VOCAB_SIZE = 64
+TOKEN_IDS = torch.cat((torch.arange(4, 20), torch.tensor([30, 31])))
+
+
+def heads(seed=0):
+    torch.manual_seed(seed)
+    lm_head = torch.nn.Linear(HIDDEN_SIZE, VOCAB_SIZE, bias=False)
+    return lm_head, cnets.ImageVocabHead(lm_head, TOKEN_IDS, h_latent_dim=4, w_latent_dim=4)
+
+
+def masked_logits(lm_head, hidden_states):
+    # the full head followed by the mask of the tokens outside the image vocabulary
+    logits = lm_head(hidden_states)
+    mask = torch.full((VOCAB_SIZE,), -float("inf"))
+    mask[TOKEN_IDS] = 0
+    return logits + mask
+
+
+def test_compact_logits_match_the_full_head():
+    lm_head, head = heads()
+    hidden_states = torch.randn(3, 5, HIDDEN_SIZE)
+    with torch.no_grad():
+        compact = head(hidden_states)
+        full = masked_logits(lm_head, hidden_states)
+
+    assert compact.shape == (3, 5, len(TOKEN_IDS))
+    assert torch.allclose(compact, full[..., TOKEN_IDS], atol=1e-6)
+    assert torch.allclose(head.expand(compact), full, atol=1e-6)
+    assert cnets.vocab_token_ids(head) is head.token_ids
+    assert cnets.vocab_token_ids(lm_head) is None
+
+
+def test_topk_and_sampling_in_the_compact_vocabulary():
+    lm_head, head = heads(1)
+    hidden_states = torch.randn(4, HIDDEN_SIZE)
+    with torch.no_grad():
+        compact = head(hidden_states)
+        full = masked_logits(lm_head, hidden_states)
+
+    top = torch.topk(torch.log_softmax(compact, dim=-1), 5, dim=-1)
+    full_top = torch.topk(torch.log_softmax(full, dim=-1), 5, dim=-1)
+    assert torch.equal(cnets.global_token_ids(head, top.indices), full_top.indices)
+    assert torch.allclose(top.values, full_top.values, atol=1e-5)
+    assert torch.equal(cnets.global_token_ids(lm_head, full_top.indices), full_top.indices)
+
+    torch.manual_seed(0)
+    tokens, probs, distribution = cnets.sample_head(head, compact, k=3)
+    assert torch.isin(tokens, TOKEN_IDS).all()
+    assert distribution.shape == (4, VOCAB_SIZE)
+    assert torch.allclose(distribution, torch.softmax(full, dim=-1), atol=1e-6)
+    assert torch.allclose(probs[:, 0], distribution.gather(1, tokens[:, :1])[:, 0], atol=1e-6)
+
+
+def test_covers_the_image_positions_only():
+    _, head = heads()
+    # a 4 x 4 image with new line tokens, followed by the image end token
+    assert head.num_image_positions == 21
+    assert head.covers(head.num_image_positions + 1)
+    assert not head.covers(head.num_image_positions + 2)
@@ -0,0 +1,118 @@
+import collections
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from module_loader import load_definitions
+
+generate_images = load_definitions(
+    "entrypoints/generate_images.py",
+    ["ImageWriter", "decode_and_save_image"],
+    namespace={
+        "collections": collections, "os": os, "threading": threading, "time": time,
+        "ThreadPoolExecutor": ThreadPoolExecutor,
+    },
+)
+
+
+class FakeImage:
+    def __init__(self, content, delay):
+        self.content = content
+        self.delay = delay
+
+    def save(self, path, format):
+        time.sleep(self.delay)
+        with open(path, "w") as f:
+            f.write(self.content)
+
+
+class FakeModel:
+    """
+    Stands in for the model of an anole run: `decode_ids` maps the "tokens" (a name, a delay and an optional gate)
+    to an image whose save takes that delay, and fails for the name "error".
+    """
+
+    def __init__(self):
+        self.decoded = []
+
+    def decode_ids(self, generated_tokens):
+        name, delay, gate = generated_tokens
+        if gate is not None:
+            gate.wait()
+        self.decoded.append(name)
+        if name == "error":
+            raise RuntimeError("decoding failed")
+        return None, [FakeImage(name, delay)]
+
+
+class FakeMetricsLog:
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+
+def test_images_are_saved_by_the_pool(tmp_path):
+    metrics_log = FakeMetricsLog()
+    writer = generate_images.ImageWriter(FakeModel(), "anole", num_workers=3, max_pending=4, metrics_log=metrics_log)
+    # the first images take the longest
+    for i in range(6):
+        writer.submit((f"image {i}", 0.05 * (5 - i), None), str(tmp_path / f"{i}.png"), record={"prompt_idx": i})
+    writer.close()
+
+    for i in range(6):
+        assert (tmp_path / f"{i}.png").read_text() == f"image {i}"
+    assert sorted(record["prompt_idx"] for record in metrics_log.records) == list(range(6))
+    assert all(record["decode_time"] >= 0 for record in metrics_log.records)
+    # no temporary file is left behind
+    assert sorted(os.listdir(tmp_path)) == [f"{i}.png" for i in range(6)]
+
+
+def test_submit_blocks_once_the_queue_is_full(tmp_path):
+    gate = threading.Event()
+    writer = generate_images.ImageWriter(FakeModel(), "anole", num_workers=1, max_pending=2)
+    writer.submit(("image 0", 0.0, gate), str(tmp_path / "0.png"))
+    writer.submit(("image 1", 0.0, gate), str(tmp_path / "1.png"))
+
+    third = threading.Thread(target=writer.submit, args=(("image 2", 0.0, None), str(tmp_path / "2.png")))
+    third.start()
+    third.join(timeout=0.2)
+    assert third.is_alive()
+
+    # a slot frees up once the first images are saved
+    gate.set()
+    third.join(timeout=5.0)
+    assert not third.is_alive()
+    writer.close()
+    assert (tmp_path / "2.png").read_text() == "image 2"
+
+
+def test_failed_save_is_raised_in_submission_order(tmp_path):
+    model = FakeModel()
+    writer = generate_images.ImageWriter(model, "anole", num_workers=2, max_pending=8)
+    writer.submit(("image 0", 0.2, None), str(tmp_path / "0.png"))
+    writer.submit(("error", 0.0, None), str(tmp_path / "1.png"))
+    writer.submit(("image 2", 0.0, None), str(tmp_path / "2.png"))
+    with pytest.raises(RuntimeError, match="decoding failed"):
+        writer.close()
+
+    # the images before the failed one are retired first
+    assert (tmp_path / "0.png").exists()
+    assert not (tmp_path / "1.png").exists()
+    # the pool is shut down nonetheless
+    with pytest.raises(RuntimeError):
+        writer.executor.submit(print)
+
+
+def test_synchronous_saving(tmp_path):
+    model = FakeModel()
+    writer = generate_images.ImageWriter(model, "anole", num_workers=0)
+    writer.submit(("image 0", 0.0, None), str(tmp_path / "0.png"))
+    assert (tmp_path / "0.png").read_text() == "image 0"
+    with pytest.raises(RuntimeError, match="decoding failed"):
+        writer.submit(("error", 0.0, None), str(tmp_path / "1.png"))
+    writer.close()
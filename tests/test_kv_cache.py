@@ -0,0 +1,173 @@
+import torch
+
+from module_loader import load_module
+
+kv_cache = load_module("models/drafters/kv_cache.py")
+
+NUM_LAYERS = 2
+NUM_HEADS = 2
+HEAD_DIM = 4
+PAGE_SIZE = 4
+
+
+def contiguous_cache(batch_size, max_length=64):
+    data = torch.zeros(NUM_LAYERS * 2, batch_size, NUM_HEADS, max_length, HEAD_DIM)
+    current_length_data = torch.zeros(NUM_LAYERS * 2, dtype=torch.long)
+    past_key_values = [
+        [kv_cache.KVCache(data[2 * i + j], current_length_data[2 * i + j]) for j in range(2)]
+        for i in range(NUM_LAYERS)
+    ]
+    return past_key_values, [data], current_length_data
+
+
+def paged_pool(num_pages=32):
+    data = torch.zeros(NUM_LAYERS * 2, num_pages, NUM_HEADS, PAGE_SIZE, HEAD_DIM)
+    layer_slices = [(0, 2 * i) for i in range(NUM_LAYERS)]
+    return kv_cache.KVPagePool([data], layer_slices, PAGE_SIZE)
+
+
+def append(past_key_values, tensors):
+    return [[cache.cat(tensor) for cache, tensor in zip(layer, layer_tensors)]
+            for layer, layer_tensors in zip(past_key_values, tensors)]
+
+
+def random_step(batch_size, num_tokens, generator):
+    return [[torch.randn((batch_size, NUM_HEADS, num_tokens, HEAD_DIM), generator=generator) for _ in range(2)]
+            for _ in range(NUM_LAYERS)]
+
+
+def test_paged_cache_matches_contiguous_cache():
+    generator = torch.Generator().manual_seed(0)
+    batch_size = 2
+    pool = paged_pool()
+    paged, page_table, paged_length = kv_cache.initialize_paged_past_key_values(pool, batch_size=batch_size)
+    contiguous, contiguous_data, contiguous_length = contiguous_cache(batch_size)
+
+    prev_length = 0
+    for num_tokens, accepted in [(7, [6]), (5, [0, 2, 3]), (9, [1, 4, 5, 8])]:
+        step = random_step(batch_size, num_tokens, generator)
+        paged_states = append(paged, step)
+        contiguous_states = append(contiguous, step)
+        for paged_layer, contiguous_layer in zip(paged_states, contiguous_states):
+            for paged_state, contiguous_state in zip(paged_layer, contiguous_layer):
+                assert torch.equal(paged_state, contiguous_state)
+        assert paged[0][0].shape == contiguous[0][0].shape
+
+        # commit the accepted tree tokens right after the prefix
+        indices = torch.tensor(accepted) + prev_length
+        paged_length.fill_(kv_cache.commit_past_key_values(page_table, indices, prev_length))
+        prev_length = kv_cache.commit_past_key_values(contiguous_data, indices, prev_length)
+        contiguous_length.fill_(prev_length)
+        for layer in paged:
+            for cache in layer:
+                assert cache.length == prev_length
+                assert cache.current_length.item() == prev_length
+
+    for paged_layer, contiguous_layer in zip(paged, contiguous):
+        for paged_cache, contiguous_cache_ in zip(paged_layer, contiguous_layer):
+            assert torch.equal(paged_cache.gather(prev_length), contiguous_cache_.data[:, :, :prev_length])
+
+
+def test_paged_cache_locates_appended_positions_once():
+    generator = torch.Generator().manual_seed(1)
+    pool = paged_pool()
+    paged, page_table, _ = kv_cache.initialize_paged_past_key_values(pool, batch_size=1)
+    append(paged, random_step(1, 5, generator))
+
+    slots = page_table.append_slots(5, 8, torch.device("cpu"))
+    assert page_table.append_slots(5, 8, torch.device("cpu")) is slots
+    pages, offsets = slots
+    assert offsets.tolist() == [1, 2, 3]
+    assert pages[0].tolist() == [page_table.pages[0][1]] * 3
+
+
+def test_page_table_rows_and_release():
+    generator = torch.Generator().manual_seed(2)
+    pool = paged_pool(num_pages=8)
+    paged, page_table, _ = kv_cache.initialize_paged_past_key_values(pool, batch_size=2)
+    page_table.reserve(8)
+    assert len(pool.free_pages) == 4
+
+    # a prompt prefilled into the second row does not touch the first one
+    rows, _ = kv_cache.select_past_key_values_rows(paged, slice(1, 2))
+    step = random_step(1, 6, generator)
+    append(rows, step)
+    assert paged[0][0].length == 0
+    assert torch.equal(rows[0][0].gather(6), step[0][0])
+    assert torch.equal(paged[0][0].gather(6)[1:], step[0][0])
+
+    page_table.release()
+    assert sorted(pool.free_pages) == list(range(8))
+
+
+def test_snapshot_restores_a_prefix_into_new_caches():
+    generator = torch.Generator().manual_seed(3)
+    source, _, source_length = contiguous_cache(batch_size=1)
+    append(source, random_step(1, 7, generator))
+    snapshot = kv_cache.snapshot_past_key_values(source, 3)
+    assert snapshot[0][0].shape == (1, NUM_HEADS, 3, HEAD_DIM)
+
+    # the source keeps decoding; the snapshot is a copy
+    append(source, random_step(1, 2, generator))
+
+    contiguous, _, contiguous_length = contiguous_cache(batch_size=1)
+    paged, _, paged_length = kv_cache.initialize_paged_past_key_values(paged_pool(), batch_size=1)
+    for past_key_values, current_length_data in [(contiguous, contiguous_length), (paged, paged_length)]:
+        kv_cache.restore_past_key_values(past_key_values, snapshot)
+        assert (current_length_data == 3).all()
+        for layer, source_layer in zip(past_key_values, source):
+            for cache, source_cache in zip(layer, source_layer):
+                restored = cache.gather(3) if isinstance(cache, kv_cache.PagedKVCache) else cache.data[:, :, :3]
+                assert torch.equal(restored, source_cache.data[:, :, :3])
+
+        # the next tokens are appended after the restored prefix
+        step = random_step(1, 2, generator)
+        states = append(past_key_values, step)
+        assert torch.equal(states[0][0][:, :, 3:], step[0][0])
+
+
+def test_snapshot_of_a_range_of_positions():
+    generator = torch.Generator().manual_seed(4)
+    paged, _, _ = kv_cache.initialize_paged_past_key_values(paged_pool(), batch_size=2)
+    step = random_step(2, 10, generator)
+    append(paged, step)
+
+    snapshot = kv_cache.snapshot_past_key_values(paged, 9, start=5)
+    for layer_snapshot, layer_step in zip(snapshot, step):
+        for tensor, step_tensor in zip(layer_snapshot, layer_step):
+            assert torch.equal(tensor, step_tensor[:, :, 5:9])
+
+
+def test_commit_with_a_length_per_row_matches_row_commits():
+    # both branches of sequential CFG as the two rows of one storage, with different prefix lengths
+    generator = torch.Generator().manual_seed(5)
+    past_key_values, past_key_values_data, _ = contiguous_cache(batch_size=2)
+    branches = [kv_cache.select_past_key_values_rows(past_key_values, slice(row, row + 1)) for row in range(2)]
+    prev_lengths = [12, 7]
+    num_tree_tokens = 6
+    for (branch, _), prev_length in zip(branches, prev_lengths):
+        append(branch, random_step(1, prev_length + num_tree_tokens, generator))
+
+    path = torch.tensor([0, 2, 5])
+    indices = torch.stack([path + prev_length for prev_length in prev_lengths])
+    reference = [data.clone() for data in past_key_values_data]
+    lengths = kv_cache.commit_past_key_values(past_key_values_data, indices, prev_lengths)
+    assert lengths == [15, 10]
+
+    for row, prev_length in enumerate(prev_lengths):
+        row_data = [data[:, row:row + 1] for data in reference]
+        assert kv_cache.commit_past_key_values(row_data, indices[row], prev_length) == lengths[row]
+        assert torch.equal(past_key_values_data[0][:, row, :, :lengths[row]], row_data[0][:, 0, :, :lengths[row]])
+
+
+def test_commit_of_different_positions_per_row():
+    generator = torch.Generator().manual_seed(6)
+    past_key_values, past_key_values_data, _ = contiguous_cache(batch_size=3)
+    append(past_key_values, random_step(3, 14, generator))
+
+    indices = torch.tensor([[8, 9, 12], [8, 10, 11], [8, 13, 13]])
+    reference = past_key_values_data[0].clone()
+    assert kv_cache.commit_past_key_values(past_key_values_data, indices, 8) == 11
+    for row in range(3):
+        assert torch.equal(past_key_values_data[0][:, row, :, 8:11], reference[:, row, :, indices[row]])
+        assert torch.equal(past_key_values_data[0][:, row, :, :8], reference[:, row, :, :8])
@@ -0,0 +1,82 @@
+import pytest
+import torch
+
+from module_loader import load_definitions
+
+ea_model = load_definitions(
+    "models/ea_model_lumina_mgpt.py", ["MultiModalLogitsProcessor"], namespace={"LogitsProcessor": object}
+)
+
+VOCAB_SIZE = 9000
+NEW_LINE_TOKEN_ID = 8803
+IMAGE_END_TOKEN_ID = 8196
+H_LATENT_DIM, W_LATENT_DIM = 3, 4
+
+
+def processor():
+    return ea_model.MultiModalLogitsProcessor(NEW_LINE_TOKEN_ID, IMAGE_END_TOKEN_ID, voc_size=VOCAB_SIZE)
+
+
+def additive_constraints(scores, position_ids, token_ids=None):
+    # the reference: one additive mask per position class, gathered for every row and added to the scores
+    constraint_masks = torch.full((3, VOCAB_SIZE), -float("inf"))
+    constraint_masks[0, 4:8195 + 1] = 0
+    constraint_masks[1, NEW_LINE_TOKEN_ID] = 0
+    constraint_masks[2, IMAGE_END_TOKEN_ID] = 0
+    if token_ids is not None:
+        constraint_masks = constraint_masks[:, token_ids]
+    position_class = processor().position_classes(position_ids, H_LATENT_DIM, W_LATENT_DIM)
+    return scores + constraint_masks.to(scores.dtype)[position_class]
+
+
+def all_positions():
+    # every position of the image, from the first image token to the image end token
+    return torch.arange(2, (W_LATENT_DIM + 1) * H_LATENT_DIM + 3)
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_constraints_match_the_additive_masks(dtype):
+    torch.manual_seed(0)
+    position_ids = all_positions()
+    scores = torch.randn(len(position_ids), VOCAB_SIZE).to(dtype)
+    reference = additive_constraints(scores, position_ids)
+
+    constrained = processor()(scores, H_LATENT_DIM, W_LATENT_DIM, position_ids=position_ids)
+    assert constrained.data_ptr() == scores.data_ptr()
+    assert torch.equal(constrained, reference)
+
+    forced = processor().forced_tokens(position_ids, H_LATENT_DIM, W_LATENT_DIM)
+    assert forced[-1] == IMAGE_END_TOKEN_ID and (forced == NEW_LINE_TOKEN_ID).sum() == H_LATENT_DIM
+    assert torch.equal(constrained.argmax(dim=-1)[forced >= 0], forced[forced >= 0])
+
+
+def test_constraints_over_a_subset_of_the_vocabulary():
+    torch.manual_seed(1)
+    token_ids = torch.cat((torch.arange(4, 8196), torch.tensor([IMAGE_END_TOKEN_ID, NEW_LINE_TOKEN_ID, 8900])))
+    position_ids = all_positions()
+    scores = torch.randn(len(position_ids), len(token_ids))
+    reference = additive_constraints(scores, position_ids, token_ids)
+
+    logits_processor = processor()
+    constrained = logits_processor(scores, H_LATENT_DIM, W_LATENT_DIM, position_ids=position_ids, token_ids=token_ids)
+    assert torch.equal(constrained, reference)
+
+    # the constraints of the columns are cached per set of token ids
+    assert logits_processor.get_constraints(scores, token_ids) is logits_processor.get_constraints(scores, token_ids)
+
+
+def test_forced_token_outside_the_columns_masks_the_whole_row():
+    token_ids = torch.arange(4, 8196)
+    # an image token position followed by the first new line position
+    position_ids = torch.tensor([W_LATENT_DIM + 1, W_LATENT_DIM + 2])
+    scores = torch.randn(2, len(token_ids))
+    reference = additive_constraints(scores, position_ids, token_ids)
+
+    constrained = processor()(scores, H_LATENT_DIM, W_LATENT_DIM, position_ids=position_ids, token_ids=token_ids)
+    assert torch.equal(constrained, reference)
+    assert torch.isinf(constrained[1]).all()
+
+
+def test_scores_without_positions_are_unchanged():
+    scores = torch.randn(2, VOCAB_SIZE)
+    assert processor()(scores.clone()).equal(scores)
@@ -0,0 +1,51 @@
+import collections
+import json
+import math
+
+import torch
+
+from module_loader import load_definitions
+
+generate_images = load_definitions(
+    "entrypoints/generate_images.py",
+    ["make_metrics_record", "RollingSummary"],
+    namespace={"collections": collections},
+)
+
+
+def test_record_uses_the_generator_statistics():
+    generation_stats = {"prefill_time": 0.25, "decode_steps": 7}
+    record = generate_images.make_metrics_record(3, "a cat", torch.zeros(1, 20), 2.9, 2.0, generation_stats)
+    assert record["num_tokens"] == 20
+    assert record["decode_steps"] == 7
+    assert record["prefill_time"] == 0.25
+    assert record["tokens_per_second"] == 10.0
+
+
+def test_record_without_statistics():
+    record = generate_images.make_metrics_record(0, "a dog", list(range(12)), 3.0, 1.5)
+    assert record["decode_steps"] == 4
+    assert record["prefill_time"] is None
+
+
+def test_record_guards_degenerate_values():
+    record = generate_images.make_metrics_record(0, "a dog", [], math.nan, 0.0)
+    assert record["decode_steps"] is None
+    assert record["step_compression"] is None
+    assert record["tokens_per_second"] is None
+    # the record stays valid JSON
+    json.loads(json.dumps(record, allow_nan=False))
+
+
+def test_rolling_summary_skips_missing_values():
+    summary = generate_images.RollingSummary(["latency", "prefill_time"], window=2)
+    summary.update({"latency": 2.0, "prefill_time": None, "time": 0.0})
+    assert "mean_prefill_time" not in summary.summary()
+
+    summary.update({"latency": 4.0, "prefill_time": 0.5, "time": 1.0})
+    summary.update({"latency": 6.0, "prefill_time": 1.5, "time": 3.0})
+    result = summary.summary()
+    assert result["num_images"] == 3
+    assert result["mean_latency"] == 4.0
+    assert result["mean_prefill_time"] == 1.0
+    assert result["images_per_second"] == 0.5
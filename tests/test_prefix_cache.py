@@ -0,0 +1,85 @@
+import torch
+
+from module_loader import load_module
+
+prefix_cache = load_module("models/drafters/prefix_cache.py")
+
+BLOCK_SIZE = 4
+BLOCK_BYTES = 4 * BLOCK_SIZE * 4
+
+
+def make_blocks(num_blocks, value=0.0):
+    # the data of a block: one float32 tensor of 4 values per token
+    return [torch.full((BLOCK_SIZE, 4), value + i) for i in range(num_blocks)]
+
+
+def test_lookup_reuses_the_longest_cached_prefix():
+    cache = prefix_cache.PromptPrefixCache(max_bytes=10 * BLOCK_BYTES, block_size=BLOCK_SIZE)
+    prompt = list(range(14))
+    assert cache.lookup(prompt, len(prompt)) == []
+
+    blocks = make_blocks(3)
+    cache.insert([], prompt, blocks)
+    assert cache.num_nodes == 3 and cache.num_bytes == 3 * BLOCK_BYTES
+
+    # a prompt sharing the first two blocks, then diverging
+    other = prompt[:8] + [99] * 6
+    nodes = cache.lookup(other, len(other))
+    assert [node.tokens for node in nodes] == [tuple(prompt[:4]), tuple(prompt[4:8])]
+    assert all(node.blocks is block for node, block in zip(nodes, blocks))
+
+    # the maximum length keeps the last tokens out of the prefix
+    assert len(cache.lookup(prompt, 11)) == 2
+    assert len(cache.lookup(prompt, 12)) == 3
+
+    # the divergent block is inserted after the shared ones
+    cache.insert(nodes, other, make_blocks(1, value=10.0))
+    assert cache.num_nodes == 4
+    assert len(cache.lookup(other, len(other))) == 3
+
+
+def test_counters():
+    cache = prefix_cache.PromptPrefixCache(max_bytes=10 * BLOCK_BYTES, block_size=BLOCK_SIZE)
+    prompt = list(range(12))
+    cache.lookup(prompt, 12)
+    cache.insert([], prompt, make_blocks(3))
+    cache.lookup(prompt, 10)
+    assert cache.stats() == {
+        "hits": 1,
+        "misses": 1,
+        "hit_tokens": 8,
+        "lookup_tokens": 22,
+        "num_blocks": 3,
+        "num_bytes": 3 * BLOCK_BYTES,
+    }
+
+
+def test_eviction_is_least_recently_used_and_leaves_first():
+    cache = prefix_cache.PromptPrefixCache(max_bytes=4 * BLOCK_BYTES, block_size=BLOCK_SIZE)
+    first = list(range(8))
+    second = list(range(4)) + [50, 51, 52, 53]
+    cache.insert([], first, make_blocks(2))
+    cache.insert(cache.lookup(second, 4), second, make_blocks(1))
+    assert cache.num_nodes == 3
+
+    # the first prompt is used again, so the leaf of the second one is the least recently used
+    cache.lookup(first, 8)
+    third = [70 + i for i in range(8)]
+    cache.insert([], third, make_blocks(2))
+    assert cache.num_bytes <= cache.max_bytes
+    assert len(cache.lookup(first, 8)) == 2
+    assert len(cache.lookup(second, 8)) == 1
+    assert len(cache.lookup(third, 8)) == 2
+
+    # a parent left without children becomes a leaf and can be evicted in turn
+    cache.max_bytes = BLOCK_BYTES
+    cache.lookup(third, 8)
+    cache.evict()
+    assert cache.num_nodes == 1 and cache.num_bytes == BLOCK_BYTES
+    assert len(cache.lookup(third, 8)) == 1
+    assert cache.lookup(first, 8) == []
+
+
+def test_num_bytes_of_nested_blocks():
+    blocks = {"kv": [(torch.zeros(2, 3), torch.zeros(2, 3))], "hidden": torch.zeros(5, dtype=torch.bfloat16)}
+    assert prefix_cache.num_bytes(blocks) == 2 * 6 * 4 + 5 * 2
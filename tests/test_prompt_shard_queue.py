@@ -0,0 +1,105 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+
+from module_loader import load_definitions
+
+generate_images = load_definitions(
+    "entrypoints/generate_images.py",
+    ["PromptShardQueue", "write_chunk_statistics"],
+    namespace={"json": json, "os": os, "sqlite3": sqlite3, "time": time, "contextmanager": contextmanager},
+)
+
+
+def test_chunks_are_claimed_in_order_until_done(tmp_path):
+    queue = generate_images.PromptShardQueue(str(tmp_path / "queue.db"), 10, 45, chunk_size=16)
+    claimed = []
+    while (chunk := queue.claim("worker")) is not None:
+        claimed.append(chunk[1:])
+        queue.complete(chunk[0])
+    assert claimed == [(10, 26), (26, 42), (42, 45)]
+    assert queue.progress() == {"done": 3}
+    queue.close()
+
+
+def test_a_restarted_worker_resumes_its_chunk(tmp_path):
+    path = str(tmp_path / "queue.db")
+    queue = generate_images.PromptShardQueue(path, 0, 40, chunk_size=10)
+    first = queue.claim("a")
+    assert queue.claim("b")[1:] == (10, 20)
+    queue.close()
+
+    # the workers reopen the queue of the same run
+    queue = generate_images.PromptShardQueue(path, 0, 40, chunk_size=10)
+    assert queue.claim("a") == first
+    assert queue.claim("c")[1:] == (20, 30)
+    assert queue.progress() == {"claimed": 3, "pending": 1}
+
+    with pytest.raises(AssertionError, match="covers the prompts 0-40"):
+        generate_images.PromptShardQueue(path, 0, 50, chunk_size=10)
+    queue.close()
+
+
+def test_expired_chunks_are_taken_over(tmp_path):
+    queue = generate_images.PromptShardQueue(str(tmp_path / "queue.db"), 0, 20, chunk_size=10, lease=0.1)
+    stale = queue.claim("a")
+    queue.complete(queue.claim("b")[0])
+    # the lease of the chunk of "a" has not expired yet
+    assert queue.claim("b") is None
+
+    time.sleep(0.2)
+    assert queue.claim("b") == stale
+    queue.complete(stale[0])
+    assert queue.claim("a") is None
+    queue.close()
+
+
+def test_concurrent_workers_never_share_a_chunk(tmp_path):
+    path = str(tmp_path / "queue.db")
+    generate_images.PromptShardQueue(path, 0, 200, chunk_size=5).close()
+    claimed = {}
+
+    def work(worker_id):
+        queue = generate_images.PromptShardQueue(path, 0, 200, chunk_size=5)
+        claimed[worker_id] = []
+        while (chunk := queue.claim(worker_id)) is not None:
+            claimed[worker_id].append(chunk[0])
+            queue.complete(chunk[0])
+        queue.close()
+
+    workers = [threading.Thread(target=work, args=(f"worker {i}",)) for i in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    chunk_ids = [chunk_id for chunks in claimed.values() for chunk_id in chunks]
+    assert sorted(chunk_ids) == list(range(1, 41))
+
+
+def test_resumed_chunk_keeps_the_statistics_of_its_saved_images(tmp_path):
+    metrics_path = tmp_path / "metrics.jsonl"
+    # the prompts 10 and 11 were saved before the interruption, the last line was cut by the kill
+    records = [
+        {"prompt_idx": idx, "prompt": f"prompt {idx}", "step_compression": 2.0, "latency": 1.0, "time": 0.0}
+        for idx in (3, 10, 11)
+    ]
+    metrics_path.write_text("".join(json.dumps(record) + "\n" for record in records) + '{"prompt_idx": 12, "pro')
+
+    path = tmp_path / "global_statistics_10_14.json"
+    new_statistics = {
+        f"prompt_{idx}": {"prompt": f"prompt {idx}", "step_compression": 3.0, "latency": 2.0} for idx in (12, 13)
+    }
+    generate_images.write_chunk_statistics(str(path), range(10, 14), new_statistics, str(metrics_path))
+    statistics = json.loads(path.read_text())
+    assert list(statistics) == ["prompt_10", "prompt_11", "prompt_12", "prompt_13"]
+    assert statistics["prompt_10"] == {"prompt": "prompt 10", "step_compression": 2.0, "latency": 1.0}
+    assert statistics["prompt_12"]["step_compression"] == 3.0
+
+    # a chunk whose statistics were written but which was not completed generates nothing when it is claimed again
+    generate_images.write_chunk_statistics(str(path), range(10, 14), {}, None)
+    assert json.loads(path.read_text()) == statistics
@@ -0,0 +1,197 @@
+from types import SimpleNamespace
+from typing import List, Optional, Tuple
+
+import pytest
+import torch
+
+import toy_lumina_mgpt
+from module_loader import load_definitions, load_module
+
+kv_cache = load_module("models/drafters/kv_cache.py")
+choices = load_module("models/drafters/choices.py")
+ea_model = load_definitions(
+    "models/ea_model_lumina_mgpt.py",
+    ["EaLumina_mGPT"],
+    namespace={
+        **{name: getattr(choices, name) for name in dir(choices) if not name.startswith("_")},
+        "List": List, "Optional": Optional, "Tuple": Tuple,
+    },
+)
+
+VOCAB_SIZE = 9000
+HIDDEN_SIZE = 8
+IMAGE_START_TOKEN_ID = 8197
+
+
+class ToyRaggedModel:
+    """
+    A single attention layer standing in for the base model: every token attends, through the given boolean mask, to
+    the keys and values cached in `past_key_values` and to the new tokens.
+    """
+
+    ragged_cfg_forward = ea_model.EaLumina_mGPT.ragged_cfg_forward
+    check_ragged_cfg_attention = ea_model.EaLumina_mGPT.check_ragged_cfg_attention
+    config = SimpleNamespace(_attn_implementation="eager")
+
+    def __init__(self, seed=0):
+        torch.manual_seed(seed)
+        self.embed_tokens = torch.nn.Embedding(VOCAB_SIZE, HIDDEN_SIZE)
+        self.embed_positions = torch.nn.Embedding(256, HIDDEN_SIZE)
+        self.q_proj, self.k_proj, self.v_proj = (torch.nn.Linear(HIDDEN_SIZE, HIDDEN_SIZE) for _ in range(3))
+        self.kv_uncond_mask = None
+
+    @torch.no_grad()
+    def __call__(self, input_ids, attention_mask, past_key_values, position_ids):
+        hidden_states = self.embed_tokens(input_ids) + self.embed_positions(position_ids)
+        key_cache, value_cache = past_key_values[0]
+        key_states = key_cache.cat(self.k_proj(hidden_states)[:, None])
+        value_states = value_cache.cat(self.v_proj(hidden_states)[:, None])
+        attn_weights = self.q_proj(hidden_states)[:, None] @ key_states.transpose(-1, -2)
+        attn_weights = attn_weights.masked_fill(~attention_mask, -float("inf"))
+        return None, (torch.softmax(attn_weights, dim=-1) @ value_states)[:, 0]
+
+    def empty_cache(self, max_length=64):
+        data = torch.zeros(2, 1, 1, max_length, HIDDEN_SIZE)
+        current_length_data = torch.zeros(2, dtype=torch.long)
+        past_key_values = [[kv_cache.KVCache(data[j], current_length_data[j]) for j in range(2)]]
+        return past_key_values, [data], current_length_data
+
+    def sequential_forward(self, input_ids, cache, position_ids, tree_mask=None):
+        # the reference: a branch of sequential CFG in its own cache, causal or following the tree mask
+        past_key_values, _, current_length_data = cache
+        prefix_len, num_tokens = current_length_data[0].item(), input_ids.shape[1]
+        if tree_mask is None:
+            mask = torch.ones(num_tokens, num_tokens, dtype=torch.bool).tril()
+        else:
+            mask = tree_mask[0, 0] != 0
+        mask = torch.cat((torch.ones(num_tokens, prefix_len, dtype=torch.bool), mask), dim=1)
+        return self(input_ids, mask[None, None], past_key_values, position_ids)[1]
+
+
+class ToyDecoderRaggedModel:
+    """
+    The decoder of the Lumina-mGPT KV variant at a toy size, through its real mask preparation and attention classes.
+    The sequential reference goes through the causal and tree masks of the decoder instead of the ragged mask.
+    """
+
+    ragged_cfg_forward = ea_model.EaLumina_mGPT.ragged_cfg_forward
+    check_ragged_cfg_attention = ea_model.EaLumina_mGPT.check_ragged_cfg_attention
+
+    def __init__(self, attn_implementation):
+        self.decoder = toy_lumina_mgpt.ToyChameleonModel(toy_lumina_mgpt.toy_config(attn_implementation))
+        self.config = self.decoder.config
+        self.kv_uncond_mask = None
+
+    @torch.no_grad()
+    def __call__(self, input_ids, attention_mask, past_key_values, position_ids):
+        self.decoder.tree_mask = None
+        outputs = self.decoder(
+            input_ids=input_ids, attention_mask=attention_mask, past_key_values=past_key_values, position_ids=position_ids
+        )
+        return None, outputs[0]
+
+    def empty_cache(self, max_length=64):
+        return toy_lumina_mgpt.empty_cache(self.config, max_length=max_length)
+
+    @torch.no_grad()
+    def sequential_forward(self, input_ids, cache, position_ids, tree_mask=None):
+        self.decoder.tree_mask = tree_mask
+        return self.decoder(input_ids=input_ids, past_key_values=cache[0], position_ids=position_ids)[0]
+
+
+def random_tree(num_nodes, generator):
+    # a tree mask, the depth of every node and the root-to-node path of its last node
+    parents = [-1] + [torch.randint(0, node, (1,), generator=generator).item() for node in range(1, num_nodes)]
+    tree_mask = torch.eye(num_nodes)
+    for node in range(1, num_nodes):
+        tree_mask[node] += tree_mask[parents[node]]
+    path = tree_mask[-1].nonzero().squeeze(1)
+    return tree_mask[None, None], tree_mask.sum(dim=-1).long() - 1, path
+
+
+@pytest.mark.parametrize("make_model, atol", [
+    (ToyRaggedModel, 1e-6),
+    (lambda: ToyDecoderRaggedModel("eager"), 1e-5),
+    (lambda: ToyDecoderRaggedModel("sdpa"), 1e-5),
+], ids=["toy", "eager", "sdpa"])
+def test_ragged_cfg_matches_sequential_cfg(make_model, atol):
+    generator = torch.Generator().manual_seed(0)
+    model = make_model()
+    input_ids = torch.tensor([[0, 17, 42, 8, IMAGE_START_TOKEN_ID, 8828, 8828]])
+    image_start_token_id_index = 4
+    uncond_input_ids = input_ids[:, image_start_token_id_index:]
+
+    # prefill of both branches into the packed row, as in `initialize_tree`
+    ragged_cache = model.empty_cache(max_length=128)
+    model.kv_uncond_mask = torch.zeros(0, dtype=torch.bool)
+    hidden_states, uncond_hidden_states = model.ragged_cfg_forward(
+        input_ids, uncond_input_ids, ragged_cache[0],
+        torch.arange(input_ids.shape[1])[None], torch.arange(uncond_input_ids.shape[1])[None],
+    )
+    model.kv_uncond_mask = torch.arange(input_ids.shape[1] + uncond_input_ids.shape[1]) >= input_ids.shape[1]
+
+    cond_cache, uncond_cache = model.empty_cache(), model.empty_cache()
+    assert torch.allclose(
+        hidden_states, model.sequential_forward(input_ids, cond_cache, torch.arange(input_ids.shape[1])[None]),
+        atol=atol,
+    )
+    assert torch.allclose(
+        uncond_hidden_states,
+        model.sequential_forward(uncond_input_ids, uncond_cache, torch.arange(uncond_input_ids.shape[1])[None]),
+        atol=atol,
+    )
+
+    cond_len = input_ids.shape[1]
+    for _ in range(3):
+        tree_mask, tree_position_ids, path = random_tree(6, generator)
+        tree_candidates = torch.randint(4, 8196, (1, 6), generator=generator)
+        position_ids = (tree_position_ids + cond_len)[None]
+        uncond_position_ids = position_ids - image_start_token_id_index
+
+        # both branches verify the tree in one forward
+        hidden_states, uncond_hidden_states = model.ragged_cfg_forward(
+            tree_candidates, tree_candidates, ragged_cache[0], position_ids, uncond_position_ids, tree_mask=tree_mask
+        )
+        assert torch.allclose(
+            hidden_states, model.sequential_forward(tree_candidates, cond_cache, position_ids, tree_mask), atol=atol
+        )
+        assert torch.allclose(
+            uncond_hidden_states,
+            model.sequential_forward(tree_candidates, uncond_cache, uncond_position_ids, tree_mask),
+            atol=atol,
+        )
+
+        # the accepted path of the conditional branch, then the one of the unconditional branch, as in
+        # `update_inference_inputs`
+        prev_len = model.kv_uncond_mask.shape[0]
+        selected_indices = path + prev_len
+        selected_indices = torch.cat((selected_indices, selected_indices + tree_candidates.shape[1]))
+        ragged_cache[2].fill_(kv_cache.commit_past_key_values(ragged_cache[1], selected_indices, prev_len))
+        model.kv_uncond_mask = torch.cat((model.kv_uncond_mask, torch.arange(2 * len(path)) >= len(path)))
+
+        for cache in (cond_cache, uncond_cache):
+            prev_len = cache[2][0].item() - tree_candidates.shape[1]
+            cache[2].fill_(kv_cache.commit_past_key_values(cache[1], path + prev_len, prev_len))
+        cond_len += len(path)
+
+    # the packed row holds the committed tokens of both branches, and no KV of the masked prompt
+    assert ragged_cache[2][0].item() == cond_cache[2][0].item() + uncond_cache[2][0].item()
+    packed = ragged_cache[1][0][0, 0, 0, :ragged_cache[2][0].item()]
+    cond_keys = cond_cache[1][0][0, 0, 0, :cond_cache[2][0].item()]
+    uncond_keys = uncond_cache[1][0][0, 0, 0, :uncond_cache[2][0].item()]
+    assert torch.allclose(packed[~model.kv_uncond_mask], cond_keys, atol=atol)
+    assert torch.allclose(packed[model.kv_uncond_mask], uncond_keys, atol=atol)
+
+
+def test_ragged_cfg_requires_a_masked_attention():
+    model = ToyDecoderRaggedModel("flash_attention_2")
+    model.kv_uncond_mask = torch.zeros(0, dtype=torch.bool)
+    input_ids = torch.tensor([[0, 17, IMAGE_START_TOKEN_ID]])
+    with pytest.raises(ValueError, match="requires attn_implementation"):
+        model.ragged_cfg_forward(input_ids, input_ids[:, 2:], model.empty_cache()[0],
+                                 torch.arange(3)[None], torch.arange(1)[None])
+
+    # nor does the decoder pass a 4D mask on to flash attention
+    attention_mask = torch.ones(1, 1, 3, 3, dtype=torch.bool)
+    with pytest.raises(ValueError, match="4D attention mask"):
+        model.decoder._prepare_decoder_attention_mask(attention_mask, (1, 3), torch.zeros(1, 3, 32), 0)
@@ -0,0 +1,92 @@
+from types import SimpleNamespace
+from typing import Optional, Tuple
+
+import pytest
+import torch
+
+import toy_lumina_mgpt
+from module_loader import load_definitions, load_module
+
+sdpa_utils = load_module("models/kv_variants/sdpa_utils.py")
+
+ANOLE_DEFINITIONS = [
+    "repeat_kv", "rotate_half", "apply_rotary_pos_emb", "ChameleonRotaryEmbedding",
+    "ChameleonLinearScalingRotaryEmbedding", "ChameleonDynamicNTKScalingRotaryEmbedding", "ChameleonLayerNorm",
+    "ChameleonAttention",
+]
+ANOLE_NAMESPACE = {
+    "Optional": Optional, "Tuple": Tuple, "ChameleonConfig": object, "Cache": object,
+    "logger": SimpleNamespace(warning_once=lambda *args, **kwargs: None),
+    "prepare_boolean_attention_mask": sdpa_utils.prepare_boolean_attention_mask,
+    "sdpa_attention": sdpa_utils.sdpa_attention,
+}
+anole_kv = load_definitions(
+    "models/kv_variants/modeling_anole_kv.py", ANOLE_DEFINITIONS + ["ChameleonSdpaAttention"], ANOLE_NAMESPACE
+)
+anole_drafter = load_definitions("models/drafters/cnets_anole.py", ANOLE_DEFINITIONS, ANOLE_NAMESPACE)
+
+
+def run_decoder(model, config, input_ids, attention_mask, position_ids, steps):
+    # a left-padded prefill followed by single-token steps, in one KV cache
+    past_key_values, _, _ = toy_lumina_mgpt.empty_cache(
+        config, batch_size=input_ids.shape[0], dtype=model.norm.weight.dtype
+    )
+    outputs = [model(input_ids=input_ids, attention_mask=attention_mask, past_key_values=past_key_values,
+                     position_ids=position_ids)[0]]
+    for step in range(steps):
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones(attention_mask.shape[0], 1)], dim=1)
+        position_ids = position_ids[:, -1:] + 1
+        outputs.append(model(input_ids=input_ids[:, -1:] + step + 1, attention_mask=attention_mask,
+                             past_key_values=past_key_values, position_ids=position_ids)[0])
+    return torch.cat(outputs, dim=1)
+
+
+@pytest.mark.parametrize("attn_implementation", ["eager", "sdpa"])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_lumina_mgpt_shared_rotary_matches_per_layer(monkeypatch, attn_implementation, dtype):
+    config = toy_lumina_mgpt.toy_config(attn_implementation, num_hidden_layers=3)
+    # the prompt and the decoded tokens outgrow the table built at initialization
+    config.max_position_embeddings = 16
+    input_ids = torch.randint(0, config.vocab_size, (2, 14), generator=torch.Generator().manual_seed(0))
+    attention_mask = torch.ones(2, 14, dtype=torch.long)
+    attention_mask[1, :5] = 0
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+    shared = toy_lumina_mgpt.ToyChameleonModel(config).to(dtype)
+    with torch.no_grad():
+        expected = run_decoder(shared, config, input_ids, attention_mask, position_ids, steps=6)
+    assert shared.layers[0].self_attn.rotary_emb.max_seq_len_cached == 20
+
+    # without the gathered table every layer computes its own cos and sin from the position ids
+    monkeypatch.setattr(toy_lumina_mgpt.modeling.LlamaRotaryEmbedding, "gather", lambda *args: None)
+    per_layer = toy_lumina_mgpt.ToyChameleonModel(config).to(dtype)
+    with torch.no_grad():
+        actual = run_decoder(per_layer, config, input_ids, attention_mask, position_ids, steps=6)
+
+    torch.testing.assert_close(actual, expected, rtol=0, atol=0)
+
+
+@pytest.mark.parametrize(
+    "attention_class",
+    [anole_kv.ChameleonAttention, anole_kv.ChameleonSdpaAttention, anole_drafter.ChameleonAttention],
+    ids=["anole_kv_eager", "anole_kv_sdpa", "anole_drafter"],
+)
+@pytest.mark.parametrize("rope_scaling", [None, {"type": "linear", "factor": 2.0}])
+def test_anole_shared_rotary_matches_per_layer(attention_class, rope_scaling):
+    config = toy_lumina_mgpt.toy_config()
+    config.max_position_embeddings = 16
+    config.rope_scaling = rope_scaling
+    torch.manual_seed(0)
+    layers = [attention_class(config, layer_idx) for layer_idx in range(2)]
+    hidden_states = torch.randn(2, 7, config.hidden_size)
+    position_ids = torch.tensor([[0, 1, 2, 3, 4, 5, 6], [0, 0, 0, 1, 2, 30, 31]])
+
+    # the table of the first layer, as `ChameleonModel.forward` and the drafter's `Model.forward` compute it
+    position_embeddings = layers[0].rotary_emb(hidden_states, position_ids)
+    with torch.no_grad():
+        for layer in layers:
+            expected = layer(hidden_states, position_ids=position_ids, use_cache=False)[0]
+            actual = layer(
+                hidden_states, position_ids=position_ids, use_cache=False, position_embeddings=position_embeddings
+            )[0]
+            torch.testing.assert_close(actual, expected, rtol=0, atol=0)
@@ -0,0 +1,134 @@
+import math
+from typing import Optional
+
+import pytest
+import torch
+
+from module_loader import load_definitions, load_module
+
+sdpa_utils = load_module("models/kv_variants/sdpa_utils.py")
+eager = load_definitions(
+    "models/kv_variants/modeling_llamagen_kv.py",
+    ["_make_causal_mask", "_expand_mask", "repeat_kv"],
+    namespace={"Optional": Optional},
+)
+
+NUM_HEADS = 4
+HEAD_DIM = 8
+
+
+def eager_attention_mask(attention_mask, input_shape, past_key_values_length, tree_mask=None):
+    # the float32 causal mask plus the expanded padding mask, as in `_prepare_decoder_attention_mask`
+    combined_attention_mask = None
+    if input_shape[-1] > 1:
+        combined_attention_mask = eager._make_causal_mask(
+            input_shape, torch.float32, device=torch.device("cpu"), past_key_values_length=past_key_values_length
+        )
+    if attention_mask is not None:
+        expanded_attn_mask = eager._expand_mask(attention_mask, torch.float32, tgt_len=input_shape[-1])
+        combined_attention_mask = (
+            expanded_attn_mask if combined_attention_mask is None else expanded_attn_mask + combined_attention_mask
+        )
+    if tree_mask is not None:
+        tree_mask = tree_mask.repeat(combined_attention_mask.size(0), 1, 1, 1)
+        tree_len = tree_mask.size(-1)
+        combined_attention_mask[:, :, -tree_len:, -tree_len:][tree_mask == 0] = combined_attention_mask.min()
+    return combined_attention_mask
+
+
+def eager_attention(query_states, key_states, value_states, attention_mask, num_key_value_groups):
+    key_states = eager.repeat_kv(key_states, num_key_value_groups)
+    value_states = eager.repeat_kv(value_states, num_key_value_groups)
+    attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(HEAD_DIM)
+    attn_weights = attn_weights + attention_mask
+    attn_weights = torch.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
+    return torch.matmul(attn_weights, value_states)
+
+
+def random_tree_mask(tree_len, generator):
+    # every node attends to itself and to a random ancestor chain
+    tree_mask = torch.eye(tree_len)
+    for node in range(1, tree_len):
+        parent = torch.randint(0, node, (1,), generator=generator).item()
+        tree_mask[node] += tree_mask[parent]
+    return tree_mask[None, None]
+
+
+def left_padding_mask(lengths, src_len):
+    positions = torch.arange(src_len)
+    return (positions[None, :] >= src_len - torch.tensor(lengths)[:, None]).long()
+
+
+@pytest.mark.parametrize("num_key_value_groups", [1, 2])
+@pytest.mark.parametrize(
+    "past_key_values_length, tgt_len, tree_len",
+    [
+        (0, 9, 0),  # left-padded prefill
+        (6, 1, 0),  # single token decoding after a cached prefix
+        (7, 5, 5),  # tree verification after a cached prefix
+        (0, 8, 4),  # tree appended to the prefilled tokens
+    ],
+)
+def test_sdpa_matches_the_eager_float_mask(num_key_value_groups, past_key_values_length, tgt_len, tree_len):
+    generator = torch.Generator().manual_seed(num_key_value_groups * 100 + past_key_values_length + tgt_len)
+    bsz = 3
+    src_len = past_key_values_length + tgt_len
+    attention_mask = left_padding_mask([src_len, src_len - 2, src_len - 4], src_len)
+    tree_mask = random_tree_mask(tree_len, generator) if tree_len else None
+
+    num_key_value_heads = NUM_HEADS // num_key_value_groups
+    query_states = torch.randn(bsz, NUM_HEADS, tgt_len, HEAD_DIM, generator=generator)
+    key_states = torch.randn(bsz, num_key_value_heads, src_len, HEAD_DIM, generator=generator)
+    value_states = torch.randn(bsz, num_key_value_heads, src_len, HEAD_DIM, generator=generator)
+
+    float_mask = eager_attention_mask(attention_mask, (bsz, tgt_len), past_key_values_length, tree_mask=tree_mask)
+    reference = eager_attention(query_states, key_states, value_states, float_mask, num_key_value_groups)
+
+    boolean_mask = sdpa_utils.prepare_boolean_attention_mask(
+        attention_mask, (bsz, tgt_len), past_key_values_length, torch.device("cpu"), tree_mask=tree_mask
+    )
+    assert boolean_mask.dtype == torch.bool
+    assert boolean_mask.shape == (bsz, 1, tgt_len, src_len)
+    output = sdpa_utils.sdpa_attention(
+        query_states, key_states, value_states, boolean_mask, num_key_value_groups=num_key_value_groups
+    )
+    assert not output.isnan().any()
+
+    # the padded queries are never attended by the other tokens, only the valid ones are compared
+    valid_queries = attention_mask[:, past_key_values_length:].bool()
+    assert torch.allclose(output.transpose(1, 2)[valid_queries], reference.transpose(1, 2)[valid_queries], atol=1e-5)
+
+    # the boolean mask allows attention exactly where the float mask does not mask it out
+    allowed = float_mask > torch.finfo(torch.float32).min / 2
+    assert torch.equal(boolean_mask[valid_queries[:, None, :, None].expand_as(allowed)],
+                       allowed[valid_queries[:, None, :, None].expand_as(allowed)])
+
+
+def test_padding_mask_without_the_tree_tokens():
+    # the padding mask of the verification step does not cover the tree tokens yet
+    generator = torch.Generator().manual_seed(0)
+    past_key_values_length, tree_len = 6, 4
+    attention_mask = left_padding_mask([6, 3], past_key_values_length)
+    tree_mask = random_tree_mask(tree_len, generator)
+
+    mask = sdpa_utils.prepare_boolean_attention_mask(
+        attention_mask, (2, tree_len), past_key_values_length, torch.device("cpu"), tree_mask=tree_mask
+    )
+    full_mask = sdpa_utils.prepare_boolean_attention_mask(
+        torch.nn.functional.pad(attention_mask, (0, tree_len), value=1),
+        (2, tree_len),
+        past_key_values_length,
+        torch.device("cpu"),
+        tree_mask=tree_mask,
+    )
+    assert torch.equal(mask, full_mask)
+    assert torch.equal(mask[:, 0, :, past_key_values_length:], tree_mask[0, 0].bool().expand(2, -1, -1))
+
+
+def test_sdpa_without_mask_is_causal():
+    generator = torch.Generator().manual_seed(1)
+    query_states, key_states, value_states = torch.randn(3, 2, NUM_HEADS, 5, HEAD_DIM, generator=generator)
+    float_mask = eager._make_causal_mask((2, 5), torch.float32, torch.device("cpu"))
+    reference = eager_attention(query_states, key_states, value_states, float_mask, 1)
+    output = sdpa_utils.sdpa_attention(query_states, key_states, value_states, is_causal=True)
+    assert torch.allclose(output, reference, atol=1e-5)
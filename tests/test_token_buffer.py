@@ -0,0 +1,49 @@
+import torch
+
+from module_loader import load_module
+
+kv_cache = load_module("models/drafters/kv_cache.py")
+
+
+def test_append_matches_concatenation():
+    generator = torch.Generator().manual_seed(0)
+    tokens = torch.randint(0, 100, (2, 5), generator=generator)
+    buffer = kv_cache.TokenBuffer(tokens.clone(), capacity=8)
+    for num_tokens in (1, 3, 2, 4, 1):
+        accepted = torch.randint(0, 100, (2, num_tokens), generator=generator)
+        tokens = torch.cat((tokens, accepted), dim=1)
+        assert torch.equal(buffer.append(accepted), tokens)
+    assert torch.equal(buffer.view(), tokens)
+    # the capacity doubled past the initial 8 tokens
+    assert buffer.data.shape[1] >= tokens.shape[1] + 1
+
+
+def test_lookahead_does_not_commit():
+    buffer = kv_cache.TokenBuffer(torch.tensor([[1, 2, 3]]))
+    assert torch.equal(buffer.lookahead(torch.tensor([[9]])), torch.tensor([[1, 2, 3, 9]]))
+    assert torch.equal(buffer.view(), torch.tensor([[1, 2, 3]]))
+
+    # the next append overwrites the looked-ahead token
+    assert torch.equal(buffer.append(torch.tensor([[4, 5]])), torch.tensor([[1, 2, 3, 4, 5]]))
+    assert torch.equal(buffer.lookahead(torch.tensor([[6, 7]])), torch.tensor([[1, 2, 3, 4, 5, 6, 7]]))
+
+
+def test_assign_replaces_the_rows():
+    buffer = kv_cache.TokenBuffer(torch.arange(12).view(3, 4), capacity=4)
+    # a compaction keeps two rows and drops the trailing padding
+    compacted = buffer.view()[[0, 2], :3]
+    assert torch.equal(buffer.assign(compacted), torch.tensor([[0, 1, 2], [8, 9, 10]]))
+    assert buffer.data.shape[0] == 2
+    assert torch.equal(buffer.append(torch.tensor([[20], [21]])), torch.tensor([[0, 1, 2, 20], [8, 9, 10, 21]]))
+
+
+def test_assign_of_a_view_of_the_buffer():
+    buffer = kv_cache.TokenBuffer(torch.arange(6).view(2, 3))
+    # the rows of the view are written in place, as by `admit`
+    view = buffer.view()
+    view[1] = torch.tensor([7, 8, 9])
+    assert torch.equal(buffer.assign(view), torch.tensor([[0, 1, 2], [7, 8, 9]]))
+
+    # a shorter view moves the cursor back
+    assert torch.equal(buffer.assign(buffer.view()[:, :2]), torch.tensor([[0, 1], [7, 8]]))
+    assert torch.equal(buffer.append(torch.tensor([[5], [6]])), torch.tensor([[0, 1, 5], [7, 8, 6]]))
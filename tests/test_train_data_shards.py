@@ -0,0 +1,83 @@
+import copy
+
+import torch
+
+from module_loader import load_module
+
+data_utils = load_module("entrypoints/train_drafter/data_utils.py")
+
+
+def random_data_point(generator, length):
+    return {
+        "input_ids": torch.randint(0, 9000, (length,), generator=generator),
+        "hidden_state": torch.randn(length, 8, generator=generator).to(torch.bfloat16),
+        "loss_mask": torch.randint(0, 2, (length,), generator=generator).to(torch.bool),
+        "target": torch.randn(length, 3, generator=generator),
+    }
+
+
+def assert_same_data_point(data_point, reference):
+    assert data_point.keys() == reference.keys()
+    for key, tensor in reference.items():
+        assert data_point[key].dtype == tensor.dtype
+        assert torch.equal(data_point[key], tensor)
+
+
+def test_shards_round_trip(tmp_path):
+    generator = torch.Generator().manual_seed(0)
+    data_points = [random_data_point(generator, length) for length in (5, 1, 17, 9, 12, 3)]
+    # a small shard size splits the data points over several shards
+    writer = data_utils.TrainDataShardWriter(str(tmp_path), shard_size=256)
+    for data_point in data_points:
+        writer.write(data_point)
+    writer.close()
+
+    assert data_utils.is_sharded_train_data(str(tmp_path))
+    assert len(list(tmp_path.glob("*.index.jsonl"))) > 1
+    shards = data_utils.TrainDataShards(str(tmp_path))
+    assert len(shards) == len(data_points)
+    for i, data_point in enumerate(data_points):
+        assert_same_data_point(data_utils.load_data_point(shards, i), data_point)
+
+    # a slice is the sequence of a subset of the data points
+    subset = shards[2:5]
+    assert len(subset) == 3
+    assert_same_data_point(subset[1], data_points[3])
+
+    # the copy sent to a DataLoader worker (through `__getstate__`) maps the shards again
+    worker_shards = copy.copy(shards)
+    assert shards.shards and worker_shards.shards == {}
+    assert_same_data_point(worker_shards[4], data_points[4])
+
+
+def test_resumed_run_appends_new_shards(tmp_path):
+    generator = torch.Generator().manual_seed(1)
+    data_points = [random_data_point(generator, 4) for _ in range(4)]
+    for run in range(2):
+        writer = data_utils.TrainDataShardWriter(str(tmp_path))
+        for i in range(2 * run, 2 * run + 2):
+            writer.write(data_points[i], sample_idx=i)
+        writer.close()
+        # the next run skips the samples already written
+        assert data_utils.TrainDataShards(str(tmp_path)).sample_indices() == set(range(2 * run + 2))
+
+    shards = data_utils.TrainDataShards(str(tmp_path))
+    assert len(list(tmp_path.glob("*.bin"))) == 2
+    for i, data_point in enumerate(data_points):
+        assert_same_data_point(shards[i], data_point)
+
+
+def test_interrupted_index_line_is_ignored(tmp_path):
+    generator = torch.Generator().manual_seed(2)
+    data_points = [random_data_point(generator, 6) for _ in range(2)]
+    writer = data_utils.TrainDataShardWriter(str(tmp_path))
+    for data_point in data_points:
+        writer.write(data_point)
+    writer.close()
+
+    # the run stopped in the middle of the last index line
+    index_file = tmp_path / "shard_00000.index.jsonl"
+    index_file.write_text(index_file.read_text()[:-10])
+    shards = data_utils.TrainDataShards(str(tmp_path))
+    assert len(shards) == 1
+    assert_same_data_point(shards[0], data_points[0])
@@ -0,0 +1,187 @@
+import gc
+from types import SimpleNamespace
+from typing import Optional
+
+import pytest
+import torch
+
+from module_loader import load_definitions, load_module
+
+kv_cache = load_module("models/drafters/kv_cache.py")
+eager = load_definitions(
+    "models/kv_variants/modeling_lumina_mgpt_kv.py",
+    ["_make_causal_mask", "_expand_mask"],
+    namespace={"Optional": Optional},
+)
+
+CPU = torch.device("cpu")
+
+
+def float_mask_loop(attention_mask, tree_mask, input_shape, past_key_values_length):
+    # the reference: the float32 causal mask plus the expanded padding mask, rebuilt at every step, with the tree
+    # mask written into its last columns
+    combined_attention_mask = None
+    if input_shape[-1] > 1:
+        combined_attention_mask = eager._make_causal_mask(
+            input_shape, torch.float32, device=CPU, past_key_values_length=past_key_values_length
+        )
+    if attention_mask is not None:
+        seq_length_with_past = input_shape[-1] + past_key_values_length
+        if attention_mask.shape[1] < seq_length_with_past:
+            attention_mask = torch.nn.functional.pad(
+                attention_mask, (0, seq_length_with_past - attention_mask.shape[1]), "constant", True
+            )
+        expanded_attn_mask = eager._expand_mask(attention_mask, torch.float32, tgt_len=input_shape[-1])
+        combined_attention_mask = (
+            expanded_attn_mask if combined_attention_mask is None else expanded_attn_mask + combined_attention_mask
+        )
+    if combined_attention_mask is None:
+        combined_attention_mask = torch.zeros(
+            input_shape[0], 1, input_shape[1], input_shape[1] + past_key_values_length
+        )
+    combined_attention_mask = combined_attention_mask.clone()
+    _, _, tree_shape0, tree_shape1 = tree_mask.shape
+    combined_attention_mask[:, :, -tree_shape0:, -tree_shape1:][
+        tree_mask.expand(input_shape[0], -1, -1, -1) == 0
+    ] = torch.finfo(torch.float32).min
+    return combined_attention_mask
+
+
+def random_tree_mask(tgt_len, tree_len, generator):
+    # every node attends to itself and to a random ancestor chain; the queries are the last `tgt_len` nodes
+    tree_mask = torch.eye(tree_len)
+    for node in range(1, tree_len):
+        parent = torch.randint(0, node, (1,), generator=generator).item()
+        tree_mask[node] += tree_mask[parent]
+    return tree_mask[None, None, tree_len - tgt_len:]
+
+
+def assert_same_mask(mask, reference, dtype):
+    allowed = reference == 0
+    if dtype == torch.bool:
+        assert torch.equal(mask, allowed)
+    else:
+        assert torch.equal(mask == 0, allowed)
+        assert (mask[~allowed] == torch.finfo(dtype).min).all()
+
+
+def simulate(steps, dtype, tree_attention_mask=None):
+    # steps: (attention_mask, tree_mask, past_key_values_length) of successive tree steps
+    tree_attention_mask = tree_attention_mask or kv_cache.TreeAttentionMask()
+    for attention_mask, tree_mask, past_key_values_length in steps:
+        input_shape = (2 if attention_mask is None else attention_mask.shape[0], tree_mask.shape[-2])
+        mask = tree_attention_mask(attention_mask, tree_mask, input_shape, past_key_values_length, dtype, CPU)
+        reference = float_mask_loop(attention_mask, tree_mask, input_shape, past_key_values_length)
+        assert mask.shape == reference.shape
+        assert_same_mask(mask, reference, dtype)
+    return tree_attention_mask
+
+
+def growing_steps(generator, num_steps=6, tgt_len=5, tree_len=5, holes=True):
+    # a left-padded prompt with holes, extended by the accepted tokens of every step
+    attention_mask = torch.ones(2, 9, dtype=torch.long)
+    attention_mask[1, :4] = 0
+    if holes:
+        attention_mask[0, 6] = 0
+    steps = []
+    for _ in range(num_steps):
+        prefix_len = attention_mask.shape[1]
+        tree_mask = random_tree_mask(tgt_len, tree_len, generator)
+        # the padding mask does not cover the tree tokens
+        steps.append((attention_mask.clone(), tree_mask, prefix_len + tree_len - tgt_len))
+        accepted = torch.randint(1, tgt_len + 1, (1,), generator=generator).item()
+        attention_mask = torch.cat((attention_mask, torch.ones(2, accepted, dtype=torch.long)), dim=1)
+        if holes:
+            # a row that accepted fewer tokens leaves a hole
+            attention_mask[0, -1] = 0
+    return steps
+
+
+@pytest.mark.parametrize("dtype", [torch.bool, torch.float32])
+def test_verification_steps_match_the_rebuilt_mask(dtype):
+    generator = torch.Generator().manual_seed(0)
+    simulate(growing_steps(generator), dtype)
+
+
+def test_drafter_blocks_wider_than_the_queries():
+    generator = torch.Generator().manual_seed(1)
+    simulate(growing_steps(generator, tgt_len=4, tree_len=12, holes=False), torch.float32)
+
+
+def test_compaction_resets_the_prefix():
+    generator = torch.Generator().manual_seed(2)
+    tree_attention_mask = simulate(growing_steps(generator, num_steps=3), torch.float32)
+
+    # the holes are removed: the new prefix is shorter and its columns differ from the written ones
+    tree_attention_mask.reset()
+    compacted = growing_steps(generator, num_steps=3, holes=False)
+    simulate(compacted, torch.float32, tree_attention_mask)
+
+
+def test_alternating_unpadded_prefixes():
+    # the conditional and unconditional caches of sequential CFG take turns, with different prefix lengths
+    generator = torch.Generator().manual_seed(3)
+    tree_attention_mask = kv_cache.TreeAttentionMask()
+    for step in range(4):
+        for prefix_len in (30 + 3 * step, 8 + 3 * step):
+            simulate([(None, random_tree_mask(5, 5, generator), prefix_len)], torch.float32, tree_attention_mask)
+
+
+def test_sequential_cfg_branches_only_write_their_new_columns():
+    # each branch of sequential CFG keeps its prefix in the mask of its own cache while the other one takes its steps
+    generator = torch.Generator().manual_seed(4)
+    tree_attention_mask = kv_cache.TreeAttentionMask()
+    caches = {branch: kv_cache.KVCache(torch.zeros(2, 1, 64, 4), torch.zeros((), dtype=torch.long))
+              for branch in ("cond", "uncond")}
+    steps = {
+        "cond": growing_steps(generator, num_steps=8),
+        # the shorter unconditional prompt
+        "uncond": [(attention_mask[:, 4:], tree_mask, past_key_values_length - 4)
+                   for attention_mask, tree_mask, past_key_values_length in growing_steps(generator, num_steps=8)],
+    }
+    written, buffers, kept = {"cond": 0, "uncond": 0}, {}, 0
+    for step in range(8):
+        for branch in ("cond", "uncond"):
+            attention_mask, tree_mask, past_key_values_length = steps[branch][step]
+            input_shape = (2, tree_mask.shape[-2])
+            mask = tree_attention_mask(
+                attention_mask, tree_mask, input_shape, past_key_values_length, torch.float32, CPU, cache=caches[branch]
+            )
+            reference = float_mask_loop(attention_mask, tree_mask, input_shape, past_key_values_length)
+            # the columns written by the previous steps of the branch are left as they were, unless the buffer grew
+            length = written[branch] if buffers.get(branch) == mask.data_ptr() else 0
+            kept += length > 0
+            assert (mask[..., :length] == 7.0).all()
+            assert_same_mask(mask[..., length:], reference[..., length:], torch.float32)
+            written[branch] = past_key_values_length + tree_mask.shape[-2] - tree_mask.shape[-1]
+            buffers[branch] = mask.data_ptr()
+            mask[..., :written[branch]] = 7.0
+    assert kept >= 8
+
+    # the masks of a branch go away with its cache
+    del caches
+    gc.collect()
+    assert len(tree_attention_mask.branches) == 0
+
+
+@pytest.mark.parametrize("path", ["models/drafters/cnets_anole.py", "models/drafters/cnets_llamagen.py"])
+def test_anole_and_llamagen_drafting_steps_use_the_builder(path):
+    drafter = load_definitions(
+        path, ["_make_causal_mask", "_expand_mask", "Model._prepare_decoder_attention_mask"],
+        namespace={"Optional": Optional},
+    )
+    model = SimpleNamespace(tree_attention_mask=kv_cache.TreeAttentionMask())
+    generator = torch.Generator().manual_seed(5)
+    for attention_mask, tree_mask, past_key_values_length in growing_steps(generator, tgt_len=4, tree_len=12):
+        model.tree_mask = tree_mask
+        input_shape = (2, tree_mask.shape[-2])
+        # the drafters pass the padding mask extended to the queries
+        attention_mask = torch.nn.functional.pad(
+            attention_mask, (0, past_key_values_length + 4 - attention_mask.shape[1]), value=1
+        )
+        mask = drafter._prepare_decoder_attention_mask(
+            model, attention_mask, input_shape, torch.zeros(2, 4, 8), past_key_values_length
+        )
+        assert mask.data_ptr() == next(iter(model.tree_attention_mask.buffers.values())).data_ptr()
+        reference = float_mask_loop(attention_mask, tree_mask, input_shape, past_key_values_length)
+        assert_same_mask(mask, reference, torch.float32)
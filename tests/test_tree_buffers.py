@@ -0,0 +1,213 @@
+import pytest
+import torch
+
+from module_loader import load_module
+
+tree_buffers = load_module("models/drafters/tree_buffers.py")
+choices = load_module("models/drafters/choices.py")
+
+TOPK = tree_buffers.TOPK
+TREES = ["mc_sim_7b_63", "mc_sim_7b_63_balanced", "naive_extend_57", "medusa_2_7b_63", "reverse_balanced_25", "chain"]
+
+
+def verifier_tree_buffers_loop(tree_choices):
+    # the reference: `generate_tree_buffers` of the EAGLE models, with list lookups and per-index searches
+    sorted_tree_choices = sorted(tree_choices, key=lambda x: (len(x), x))
+    tree_len = len(sorted_tree_choices) + 1
+
+    depth_counts = []
+    prev_depth = 0
+    for path in sorted_tree_choices:
+        depth = len(path)
+        if depth != prev_depth:
+            depth_counts.append(0)
+        depth_counts[depth - 1] += 1
+        prev_depth = depth
+
+    tree_attn_mask = torch.eye(tree_len, tree_len)
+    tree_attn_mask[:, 0] = 1
+    for i, cur_tree_choice in enumerate(sorted_tree_choices):
+        ancestor_idx = [sorted_tree_choices.index(cur_tree_choice[:c + 1]) + 1 for c in range(len(cur_tree_choice) - 1)]
+        tree_attn_mask[i + 1, ancestor_idx] = 1
+
+    tree_indices = torch.zeros(tree_len, dtype=torch.long)
+    p_indices = [0 for _ in range(tree_len - 1)]
+    b_indices = [[] for _ in range(tree_len - 1)]
+    start = 0
+    bias = 0
+    for i in range(len(depth_counts)):
+        inlayer_bias = 0
+        b = []
+        for j in range(depth_counts[i]):
+            cur_tree_choice = sorted_tree_choices[start + j]
+            cur_parent = cur_tree_choice[:-1]
+            if j != 0:
+                if cur_parent != parent:
+                    bias += 1
+                    inlayer_bias += 1
+                    parent = cur_parent
+                    b = []
+            else:
+                parent = cur_parent
+            tree_indices[start + j + 1] = cur_tree_choice[-1] + TOPK * (i + bias) + 1
+            p_indices[start + j] = inlayer_bias
+            b_indices[start + j] = list(b)
+            b.append(cur_tree_choice[-1] + TOPK * (i + bias) + 1)
+        start += depth_counts[i]
+
+    p_indices = [-1] + p_indices
+    tree_position_ids = torch.zeros(tree_len, dtype=torch.long)
+    start = 0
+    for i in range(len(depth_counts)):
+        tree_position_ids[start + 1: start + depth_counts[i] + 1] = i + 1
+        start += depth_counts[i]
+
+    retrieve_indices_nest = []
+    retrieve_paths = []
+    for cur_tree_choice in reversed(sorted_tree_choices):
+        if cur_tree_choice in retrieve_paths:
+            continue
+        retrieve_indice = []
+        for c in range(len(cur_tree_choice)):
+            retrieve_indice.append(sorted_tree_choices.index(cur_tree_choice[:c + 1]))
+            retrieve_paths.append(cur_tree_choice[:c + 1])
+        retrieve_indices_nest.append(retrieve_indice)
+    max_length = max(len(x) for x in retrieve_indices_nest)
+    retrieve_indices = torch.tensor([path + [-2] * (max_length - len(path)) for path in retrieve_indices_nest]) + 1
+    retrieve_indices = torch.cat([torch.zeros((retrieve_indices.shape[0], 1), dtype=torch.long), retrieve_indices], 1)
+
+    maxitem = retrieve_indices.max().item() + 5
+    retrieve_indices = sorted(retrieve_indices.tolist(), key=lambda lst: [x if x >= 0 else maxitem for x in lst])
+    retrieve_indices = torch.tensor(retrieve_indices, dtype=torch.long)
+
+    b_indices = [[]] + b_indices
+    b_indices_new = []
+    for path in retrieve_indices:
+        iblist = []
+        for index in path:
+            b = [] if index == -1 else b_indices[index]
+            if len(b) > 0:
+                iblist.append(torch.tensor([torch.where(tree_indices == bi)[0][0].item() for bi in b]))
+            else:
+                iblist.append([])
+        b_indices_new.append(iblist)
+
+    return {
+        "tree_attn_mask": tree_attn_mask[None, None],
+        "tree_indices": tree_indices,
+        "tree_position_ids": tree_position_ids,
+        "retrieve_indices": retrieve_indices,
+        "p_indices": torch.tensor(p_indices)[retrieve_indices],
+        "b_indices": b_indices_new,
+    }
+
+
+class Node:
+    def __init__(self, parent=None, value=None):
+        self.parent = parent
+        self.value = value
+        self.depth = parent.depth + 1 if parent else 0
+        self.children = []
+        if parent:
+            parent.children.append(self)
+
+    def all_index(self):
+        if not self.parent.parent:
+            return [self.index]
+        return self.parent.all_index() + [self.index]
+
+
+def drafter_tree_buffers_loop(tree_choices):
+    # the reference: `generate_tree_buffers` of the drafters, over an explicit tree of nodes
+    root = Node()
+    node_dic = {}
+    for path in sorted(tree_choices, key=lambda x: (len(x), x)):
+        parent = root if len(path) == 1 else node_dic[tuple(path[:-1])]
+        node_dic[tuple(path)] = Node(parent=parent, value=path[-1])
+    nodes_wc = [node for node in node_dic.values() if node.children]
+    for index, node in enumerate(nodes_wc):
+        node.index = index
+
+    tree_len = len(nodes_wc)
+    max_depth = max(node.depth for node in node_dic.values())
+    depth_counts = [0 for _ in range(max_depth - 1)]
+    for node in nodes_wc:
+        depth_counts[node.depth - 1] += 1
+    depth_counts_sum = [sum(depth_counts[:i + 1]) for i in range(len(depth_counts))]
+
+    tree_attn_mask = torch.eye(tree_len, tree_len)
+    for index, node in enumerate(nodes_wc):
+        tree_attn_mask[index, node.all_index()] = 1
+    attn_masks = [tree_attn_mask[:ml, :ml][-depth_counts[i]:] for i, ml in enumerate(depth_counts_sum)]
+
+    tree_indices_list = [torch.zeros(ml, dtype=torch.long) for ml in depth_counts]
+    repeat_nums = [[] for _ in depth_counts]
+    start = 0
+    for i in range(len(depth_counts)):
+        bias = 0
+        repeat_j = 0
+        for j in range(depth_counts[i]):
+            cur_node = nodes_wc[start + j]
+            if j != 0:
+                if cur_node.parent != parent:
+                    bias += 1
+                    parent = cur_node.parent
+                    repeat_nums[i].append(j - repeat_j)
+                    repeat_j = j
+            else:
+                parent = cur_node.parent
+            tree_indices_list[i][j] = cur_node.value + TOPK * bias
+        repeat_nums[i].append(j - repeat_j + 1)
+        start += depth_counts[i]
+
+    return {
+        "attn_mask": [mask[None, None] for mask in attn_masks],
+        "tree_indices": tree_indices_list,
+        "position_ids": [torch.zeros(ml, dtype=torch.long) for ml in depth_counts],
+        "repeat_nums": repeat_nums,
+    }
+
+
+def assert_same_buffers(buffers, reference):
+    if isinstance(reference, torch.Tensor):
+        assert isinstance(buffers, torch.Tensor) and buffers.dtype == reference.dtype
+        assert torch.equal(buffers, reference)
+    elif isinstance(reference, dict):
+        assert buffers.keys() == reference.keys()
+        for key in reference:
+            assert_same_buffers(buffers[key], reference[key])
+    elif isinstance(reference, list):
+        assert isinstance(buffers, list) and len(buffers) == len(reference)
+        for value, reference_value in zip(buffers, reference):
+            assert_same_buffers(value, reference_value)
+    else:
+        assert buffers == reference
+
+
+@pytest.mark.parametrize("tree_name", TREES)
+def test_compiled_buffers_match_the_previous_implementations(tree_name):
+    tree_choices = getattr(choices, tree_name)
+    compiled = tree_buffers.compile_tree_buffers(tree_choices)
+    drafter = compiled.pop("drafter")
+    assert_same_buffers(compiled, verifier_tree_buffers_loop(tree_choices))
+    assert_same_buffers(drafter, drafter_tree_buffers_loop(tree_choices))
+
+
+def test_buffers_are_memoized_by_the_canonical_tree(tmp_path, monkeypatch):
+    monkeypatch.setattr(tree_buffers, "TREE_BUFFERS_CACHE_DIR", str(tmp_path))
+    tree_buffers.load_tree_buffers.cache_clear()
+    tree_buffers.load_tree_buffers_on_device.cache_clear()
+
+    shuffled = list(reversed(choices.mc_sim_7b_63))
+    buffers = tree_buffers.get_tree_buffers(choices.mc_sim_7b_63, device="cpu")
+    assert tree_buffers.tree_hash(shuffled) == tree_buffers.tree_hash(choices.mc_sim_7b_63)
+    assert tree_buffers.get_tree_buffers(shuffled, device="cpu")["retrieve_indices"] is buffers["retrieve_indices"]
+    assert "drafter" not in buffers
+    assert (tmp_path / f"{tree_buffers.tree_hash(shuffled)}.pt").exists()
+
+    # a new process loads the compiled buffers from the disk
+    tree_buffers.load_tree_buffers.cache_clear()
+    assert_same_buffers(
+        tree_buffers.load_tree_buffers(tree_buffers.canonical_tree_choices(shuffled)),
+        tree_buffers.compile_tree_buffers(shuffled),
+    )
@@ -0,0 +1,227 @@
+import copy
+import time
+from types import SimpleNamespace
+from typing import List, Optional, Tuple, Union
+
+import torch
+
+from module_loader import load_definitions, load_module
+
+kv_cache = load_module("models/drafters/kv_cache.py")
+sdpa_utils = load_module("models/kv_variants/sdpa_utils.py")
+
+
+def _identity_decorator(*args, **kwargs):
+    return lambda function: function
+
+
+modeling = load_definitions(
+    "models/kv_variants/modeling_lumina_mgpt_kv.py",
+    [
+        "_make_causal_mask", "_expand_mask", "ChameleonRMSNorm", "LlamaRotaryEmbedding", "rotate_half",
+        "apply_rotary_pos_emb", "ChameleonMLP", "ChameleonLayerNorm", "repeat_kv", "ChameleonAttention",
+        "ChameleonFlashAttention2", "ChameleonSdpaAttention", "CHAMELEON_ATTENTION_CLASSES", "ChameleonDecoderLayer",
+        "ChameleonModel.forward", "ChameleonModel._prepare_decoder_attention_mask",
+    ],
+    namespace={
+        "Optional": Optional, "Tuple": Tuple, "Union": Union,
+        "ChameleonConfig": object, "Cache": object, "StaticCache": type("StaticCache", (), {}),
+        "BaseModelOutputWithPast": SimpleNamespace,
+        "ACT2FN": {"silu": torch.nn.SiLU()},
+        "logger": SimpleNamespace(warning_once=lambda *args, **kwargs: None),
+        "prepare_boolean_attention_mask": sdpa_utils.prepare_boolean_attention_mask,
+        "sdpa_attention": sdpa_utils.sdpa_attention,
+        "TreeAttentionMask": kv_cache.TreeAttentionMask,
+        "is_flash_attn_greater_or_equal_2_10": lambda: True,
+        "add_start_docstrings_to_model_forward": _identity_decorator,
+        "add_code_sample_docstrings": _identity_decorator,
+        "CHAMELEON_INPUTS_DOCSTRING": "", "_CHECKPOINT_FOR_DOC": "", "_CONFIG_FOR_DOC": "", "_EXPECTED_OUTPUT_SHAPE": [],
+    },
+)
+
+
+def toy_config(attn_implementation="eager", num_hidden_layers=2):
+    # the attributes of the ChameleonConfig read by the decoder, for a tiny model with grouped key/value heads
+    return SimpleNamespace(
+        hidden_size=32, intermediate_size=64, num_attention_heads=4, num_key_value_heads=2,
+        num_hidden_layers=num_hidden_layers,
+        max_position_embeddings=128, rope_theta=10000.0, rope_scaling=None, attention_dropout=0.0, attention_bias=False,
+        mlp_bias=False, hidden_act="silu", rms_norm_eps=1e-5, dropout=0.0, model_parallel_size=1, vocab_size=9000,
+        output_attentions=False, output_hidden_states=False, use_cache=False, use_return_dict=False,
+        _attn_implementation=attn_implementation,
+    )
+
+
+class ToyChameleonModel(torch.nn.Module):
+    """
+    The decoder of the Lumina-mGPT KV variant (`ChameleonModel.forward` and its mask preparation, with the real
+    decoder layers and attention classes) at a toy size and without the VQ model.
+    """
+
+    forward = modeling.forward
+    _prepare_decoder_attention_mask = modeling._prepare_decoder_attention_mask
+
+    def __init__(self, config, seed=0):
+        super().__init__()
+        torch.manual_seed(seed)
+        self.config = config
+        self.embed_tokens = torch.nn.Embedding(config.vocab_size, config.hidden_size)
+        self.layers = torch.nn.ModuleList(
+            [modeling.ChameleonDecoderLayer(config, layer_idx) for layer_idx in range(config.num_hidden_layers)]
+        )
+        self.norm = modeling.ChameleonRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
+        for module in self.modules():
+            if isinstance(module, modeling.ChameleonLayerNorm):
+                # non-trivial per-head gamma and beta
+                torch.nn.init.normal_(module.weight, 1.0, 0.1)
+                torch.nn.init.normal_(module.bias, 0.0, 0.1)
+        self.gradient_checkpointing = False
+        self.tree_attention_mask = kv_cache.TreeAttentionMask()
+        self.eval()
+
+
+def empty_cache(config, batch_size=1, max_length=128, dtype=torch.float32):
+    # the KVCache objects of every layer over one contiguous storage, as `initialize_past_key_values` builds them
+    head_dim = config.hidden_size // config.num_attention_heads
+    data = torch.zeros(
+        2 * config.num_hidden_layers, batch_size, config.num_key_value_heads, max_length, head_dim, dtype=dtype
+    )
+    current_length_data = torch.zeros(2 * config.num_hidden_layers, dtype=torch.long)
+    past_key_values = [
+        [kv_cache.KVCache(data[2 * i + j], current_length_data[2 * i + j]) for j in range(2)]
+        for i in range(config.num_hidden_layers)
+    ]
+    return past_key_values, [data], current_length_data
+
+
+choices = load_module("models/drafters/choices.py")
+tree_buffers = load_module("models/drafters/tree_buffers.py")
+acceptance = load_module("models/drafters/acceptance.py")
+
+drafter = load_definitions(
+    "models/drafters/cnets_lumina_mgpt.py",
+    [
+        "TOPK", "generate_tree_buffers", "_make_causal_mask", "_expand_mask", "ChameleonRMSNorm", "LlamaRotaryEmbedding",
+        "rotate_half", "apply_rotary_pos_emb", "ChameleonMLP", "ChameleonLayerNorm", "repeat_kv", "ChameleonAttention",
+        "ChameleonFlashAttention2", "ChameleonSdpaAttention", "CHAMELEON_ATTENTION_CLASSES", "ChameleonDecoderLayer",
+        "repeat_hidden", "sample", "stack_retrieve_indices", "splice_forced_tokens", "ImageVocabHead",
+        "vocab_token_ids", "global_token_ids", "sample_head", "cfg_head", "Model",
+    ],
+    namespace={
+        "List": List, "Optional": Optional, "Tuple": Tuple, "Union": Union,
+        "ChameleonConfig": object, "Cache": object, "ACT2FN": {"silu": torch.nn.SiLU()},
+        "logger": SimpleNamespace(warning_once=lambda *args, **kwargs: None),
+        "KVCache": kv_cache.KVCache, "TreeAttentionMask": kv_cache.TreeAttentionMask,
+        "restore_past_key_values": kv_cache.restore_past_key_values,
+        "get_drafter_tree_buffers": tree_buffers.get_drafter_tree_buffers,
+        "is_flash_attn_greater_or_equal_2_10": lambda: True,
+    },
+)
+
+ea_model = load_definitions(
+    "models/ea_model_lumina_mgpt.py",
+    ["MultiModalLogitsProcessor", "InterleavedTopKLogitsWarper", "generate_tree_buffers", "GenerationState",
+     "EaLumina_mGPT"],
+    namespace={
+        **{name: getattr(choices, name) for name in dir(choices) if not name.startswith("_")},
+        **{name: getattr(kv_cache, name) for name in dir(kv_cache) if not name.startswith("_")},
+        "List": List, "Tuple": Tuple, "time": time, "copy": copy, "LogitsProcessor": object, "LogitsWarper": object,
+        "tqdm": lambda total: SimpleNamespace(n=0, update=lambda n: None, close=lambda: None),
+        "Model": drafter.Model, "ImageVocabHead": drafter.ImageVocabHead, "cfg_head": drafter.cfg_head,
+        "splice_forced_tokens": drafter.splice_forced_tokens, "stack_retrieve_indices": drafter.stack_retrieve_indices,
+        "vocab_token_ids": drafter.vocab_token_ids,
+        "evaluate_posterior_tensorized": acceptance.evaluate_posterior_tensorized,
+        "max_num_children": acceptance.max_num_children, "get_tree_buffers": tree_buffers.get_tree_buffers,
+    },
+)
+
+IMAGE_TOKENS = torch.arange(4, 8196)
+IMAGE_SYNTAX_TOKENS = torch.tensor([8196, 8197, 8803, 8828])
+
+
+def bigram_drafter(drafter, base_model):
+    # the drafter predicts the next token from the current one alone, through the embeddings and the LM head of the
+    # base model, hence its drafts are right wherever the context does not change the prediction of the base model
+    # and the trees are accepted to varied depths
+    hidden_size = drafter.fc.weight.shape[0]
+    with torch.no_grad():
+        drafter.embed_tokens.weight.copy_(base_model.model.embed_tokens.weight)
+        drafter.fc.weight.zero_()
+        drafter.fc.weight[:, :hidden_size] = torch.eye(hidden_size)
+        if drafter.fc.bias is not None:
+            drafter.fc.bias.zero_()
+        for layer in drafter.layers:
+            layer.self_attn.o_proj.weight.zero_()
+            layer.mlp.down_proj.weight.zero_()
+
+
+class ToyBaseModel(torch.nn.Module):
+    """
+    The base model of `EaLumina_mGPT`: the toy decoder and an LM head. The head is scaled up so that the target
+    distributions are (numerically) one-hot, which makes the generated tokens independent of the random draws and of
+    the batch the prompt is decoded in.
+    """
+
+    def __init__(self, config, seed=0):
+        super().__init__()
+        self.config = config
+        self.model = ToyChameleonModel(config, seed=seed)
+        with torch.no_grad():
+            # the context weighs enough on the predictions that a wrong tree mask or KV cache changes the tokens
+            for layer in self.model.layers:
+                layer.self_attn.o_proj.weight.mul_(2.0)
+        self.lm_head = torch.nn.Linear(config.hidden_size, config.vocab_size, bias=False)
+        torch.nn.init.normal_(self.lm_head.weight, 0.0, 1e4)
+
+    @property
+    def dtype(self):
+        return self.lm_head.weight.dtype
+
+
+class ToyEaLumina_mGPT(ea_model.EaLumina_mGPT):
+    """
+    `EaLumina_mGPT` over the toy base model and a one-layer bigram drafter, without checkpoints or a GPU.
+    """
+
+    def __init__(self, eagle_version=2, cfg_mode="parallel", total_token=16, depth=4, top_k=None, seed=0):
+        torch.nn.Module.__init__(self)
+        config = toy_config()
+        # room for the holes of the batched rows
+        config.max_position_embeddings = 512
+        self.base_model = ToyBaseModel(config, seed=seed)
+        self.config = config
+        self.dtype = torch.float32
+        self.hidden_size = config.hidden_size
+        self.vocab_size = config.vocab_size
+        self.cfg_mode = cfg_mode
+        self.eagle_version = eagle_version
+
+        drafter_config = toy_config(num_hidden_layers=1)
+        drafter_config.pad_token_id = None
+        drafter_config.max_position_embeddings = config.max_position_embeddings
+        if top_k is None:
+            # the static trees of EAGLE v1 are compiled for TOPK children per node
+            top_k = 4 if eagle_version == 2 else drafter.TOPK
+        torch.manual_seed(seed + 1)
+        self.ea_layer = drafter.Model(drafter_config, total_tokens=total_token, depth=depth, top_k=top_k)
+        self.ea_layer.diff_device = False
+        self.ea_layer.eval()
+        self.ea_layer.init_tree()
+        bigram_drafter(self.ea_layer, self.base_model)
+
+        self.nearest_latents = torch.arange(len(IMAGE_TOKENS))[:, None]
+        self.image_token_offset = 4
+        self.image_tokens = IMAGE_TOKENS
+        self.image_syntax_tokens = IMAGE_SYNTAX_TOKENS
+        self.image_token_mask = torch.zeros(self.vocab_size, dtype=torch.bool)
+        self.image_token_mask[self.image_tokens] = True
+        self.image_syntax_token_mask = torch.zeros(self.vocab_size, dtype=torch.bool)
+        self.image_syntax_token_mask[self.image_syntax_tokens] = True
+        self.image_start_token_id = 8197
+
+        self.internal_logits_processors = [ea_model.MultiModalLogitsProcessor(voc_size=self.vocab_size)]
+        self.drafter_logits_processors = copy.deepcopy(self.internal_logits_processors)
+        self.kv_page_pool = None
+        self.image_vocab_head = None
+        self.uncond_prefix_cache = None
+        self.prompt_prefix_cache = None